@@ -386,6 +386,7 @@ class Address(namedtuple("AddressTuple", "hash kind")):
         addr_hash = to_bytes(addr_hash)
         ret = super().__new__(cls, addr_hash, kind)
         ret._addr2str_cache = [None] * cls._NUM_FMTS
+        ret._scripthash_hex = None
         ret._check_sanity()
         return ret
 
@@ -662,8 +663,11 @@ class Address(namedtuple("AddressTuple", "hash kind")):
         return sha256(self.to_script())
 
     def to_scripthash_hex(self):
-        """Like other bitcoin hashes this is reversed when written in hex."""
-        return hash_to_hex_str(self.to_scripthash())
+        """Like other bitcoin hashes this is reversed when written in hex.
+        Cached, as the synchronizer asks for it over and over."""
+        if self._scripthash_hex is None:
+            self._scripthash_hex = hash_to_hex_str(self.to_scripthash())
+        return self._scripthash_hex
 
     def __str__(self):
         return self.to_ui_string()
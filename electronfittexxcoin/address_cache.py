@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+#
+# Electron Cash - A Fittexxcoin SPV Wallet
+# License: MIT License
+#
+''' Persistent cache of the derived addresses of a deterministic wallet.
+
+Opening a wallet used to parse every address string in the 'addresses'
+storage key and hash every address script again for the synchronizer.
+AddressCache keeps, for both the receiving and the change branch, the
+addresses in binary along with their scripthash and (for single key
+wallets) the derived public key, and is stored as the 'address_cache' key
+next to 'addresses' (which is still written, for older versions).
+
+Addresses are a function of the keystores and of their index, so the cache
+is valid as long as the fingerprint of the keystores it was made with is the
+one of the wallet, and it holds as many addresses as 'addresses'.
+
+Storage format: {'version': 1, 'fingerprint': hex, 'receiving': base64,
+'change': base64}, where each base64 blob is a concatenation of records
+    kind (1 byte) | hash length (1) | hash | scripthash (32) | pubkey length (1) | pubkey
+with a pubkey length of 0 for addresses whose pubkey is not known. '''
+
+import base64
+import hashlib
+import json
+
+from .address import Address
+
+STORAGE_KEY = 'address_cache'
+VERSION = 1
+
+
+def fingerprint(wallet_type, txin_type, master_public_keys):
+    ''' Identifies everything the addresses of a wallet are derived from. '''
+    data = json.dumps([wallet_type, txin_type, list(master_public_keys)])
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+class AddressCache:
+
+    def __init__(self, fingerprint):
+        self.fingerprint = fingerprint
+        # for_change -> serialized records and their count
+        self.records = {False: bytearray(), True: bytearray()}
+        self.counts = {False: 0, True: 0}
+        # for_change -> list of the pubkeys (bytes or None), by index
+        self.pubkeys = {False: [], True: []}
+
+    def add(self, for_change, address, pubkey=None):
+        ''' Appends address (and its pubkey, bytes, if known) to a branch. '''
+        rec = self.records[for_change]
+        rec.append(address.kind)
+        rec.append(len(address.hash))
+        rec += address.hash
+        rec += bytes.fromhex(address.to_scripthash_hex())[::-1]
+        if pubkey:
+            rec.append(len(pubkey))
+            rec += pubkey
+        else:
+            rec.append(0)
+        self.counts[for_change] += 1
+        self.pubkeys[for_change].append(pubkey or None)
+
+    def truncate(self, for_change, count):
+        ''' Keeps only the first count addresses of a branch. '''
+        if count >= self.counts[for_change]:
+            return
+        rec = self.records[for_change]
+        pos = 0
+        for i in range(count):
+            pos += 2 + rec[pos + 1] + 32
+            pos += 1 + rec[pos]
+        del rec[pos:]
+        self.counts[for_change] = count
+        del self.pubkeys[for_change][count:]
+
+    def sync(self, for_change, addresses):
+        ''' Makes a branch match the list `addresses`, of which the cache
+        holds a prefix (or which is a prefix of the cache). '''
+        self.truncate(for_change, len(addresses))
+        for address in addresses[self.counts[for_change]:]:
+            self.add(for_change, address)
+
+    def get_pubkey(self, for_change, n):
+        ''' Returns the pubkey (bytes) of address n of a branch, or None. '''
+        pubkeys = self.pubkeys[for_change]
+        return pubkeys[n] if 0 <= n < len(pubkeys) else None
+
+    def dump(self):
+        return {
+            'version': VERSION,
+            'fingerprint': self.fingerprint,
+            'receiving': base64.b64encode(self.records[False]).decode('ascii'),
+            'change': base64.b64encode(self.records[True]).decode('ascii'),
+        }
+
+    @classmethod
+    def load(cls, d, fingerprint):
+        ''' Returns (cache, receiving_addresses, change_addresses) from the
+        stored dict d, or None if d is missing, of another version or for
+        other keystores, or corrupt. '''
+        if not isinstance(d, dict) or d.get('version') != VERSION or d.get('fingerprint') != fingerprint:
+            return None
+        self = cls(fingerprint)
+        branches = []
+        try:
+            for for_change, key in ((False, 'receiving'), (True, 'change')):
+                rec = base64.b64decode(d[key], validate=True)
+                addresses = []
+                pubkeys = self.pubkeys[for_change]
+                pos, end = 0, len(rec)
+                while pos < end:
+                    kind, hlen = rec[pos], rec[pos + 1]
+                    pos += 2
+                    address = Address(rec[pos:pos + hlen], kind)
+                    pos += hlen
+                    # the cached scripthash, so that it is not computed again
+                    address._scripthash_hex = rec[pos:pos + 32][::-1].hex()
+                    pos += 32
+                    plen = rec[pos]
+                    pos += 1
+                    pubkeys.append(rec[pos:pos + plen] if plen else None)
+                    pos += plen
+                    addresses.append(address)
+                if pos != end:
+                    raise ValueError('truncated record')
+                self.records[for_change] = bytearray(rec)
+                self.counts[for_change] = len(addresses)
+                branches.append(addresses)
+        except (KeyError, TypeError, ValueError, IndexError, AssertionError):
+            return None
+        return self, branches[0], branches[1]
@@ -117,8 +117,28 @@ class ASERTDaa:
         `next_bits_aserti` implementation in mining.py (see
         https://github.com/jtoomim/difficulty) """
 
+        return self._bits_for_exponent(self.bits_to_target(anchor_bits),
+                                       self._exponent(time_diff, height_diff))
+
+    def next_bits_aserti3_2d_batch(self, anchor_bits: int, diffs) -> list:
+        """ Returns next_bits_aserti3_2d(anchor_bits, time_diff, height_diff)
+        for each (time_diff, height_diff) in diffs. The anchor target is only
+        computed once, and so are the bits of blocks with the same exponent
+        (e.g. blocks on schedule). """
         target = self.bits_to_target(anchor_bits)
-
+        exponent_of = self._exponent
+        bits_for_exponent = self._bits_for_exponent
+        memo = {}
+        ret = []
+        for time_diff, height_diff in diffs:
+            exponent = exponent_of(time_diff, height_diff)
+            bits = memo.get(exponent)
+            if bits is None:
+                bits = memo[exponent] = bits_for_exponent(target, exponent)
+            ret.append(bits)
+        return ret
+
+    def _exponent(self, time_diff: Union[float, int], height_diff: int) -> int:
         # Ultimately, we want to approximate the following ASERT formula, using
         # only integer (fixed-point) math:
         #     new_target = old_target * 2^((time_diff -
@@ -129,8 +149,9 @@ class ASERTDaa:
         # uses a 64-bit signed integer for the exponent. If inputs violate that,
         # then the implementation will diverge.
         assert(abs(time_diff - self.IDEAL_BLOCK_TIME * (height_diff+1)) < (1<<(63-self.RBITS)))
-        exponent = int(((time_diff - self.IDEAL_BLOCK_TIME*(height_diff+1)) * self.RADIX) / self.HALF_LIFE)
+        return int(((time_diff - self.IDEAL_BLOCK_TIME*(height_diff+1)) * self.RADIX) / self.HALF_LIFE)
 
+    def _bits_for_exponent(self, target: int, exponent: int) -> int:
         # Next, we use the 2^x = 2 * 2^(x-1) identity to shift our exponent into the (0, 1] interval.
         shifts = exponent >> self.RBITS
         exponent -= shifts * self.RADIX
@@ -462,6 +462,10 @@ class BaseWizard(util.PrintError):
 
     def on_password(self, password, encrypt):
         self.storage.set_password(password, encrypt)
+        if self.wallet_type in ('standard', 'multisig') and self.seed_ts is None:
+            # Restoring an existing seed or key rather than creating a new
+            # one: look ahead of the gap limit on the first sync.
+            self.storage.put('restore_lookahead', True)
         for k in self.keystores:
             if k.may_have_password():
                 k.update_password(None, password)
@@ -24,6 +24,7 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import ctypes
 import hashlib
 from Crypto.Hash import SHA512
 import base64
@@ -41,6 +42,7 @@ from . import networks
 from .util import (bfh, bh2u, to_string, print_error, InvalidPassword,
                    assert_bytes, to_bytes, inv_dict, profiler)
 from . import version
+from . import secp256k1 as _secp256k1
 from .ecc_fast import do_monkey_patching_of_python_ecdsa_internals_with_libsecp256k1
 
 # Ensure Python interpreter is not running with -O, since this entire
@@ -1020,6 +1022,46 @@ def _CKD_pub(cK, c, s):
     cK_n = GetPubKey(public_key.pubkey,True)
     return cK_n, c_n
 
+def CKD_pub_range(cK, c, start, stop):
+    """ Returns the public keys (compressed, bytes) of the children start to
+    stop - 1 of the node (cK, c), like CKD_pub(cK, c, n)[0] for each n.
+
+    The parent is parsed once and, with libsecp256k1, each child is a single
+    tweak_add of it, instead of a scalar multiplication and a point addition
+    through python-ecdsa. """
+    if start < 0 or stop > BIP32_PRIME:
+        raise ValueError('CKD_pub_range: index out of range')
+    lib = _secp256k1.secp256k1
+    parent = None
+    if lib:
+        parent = ctypes.create_string_buffer(64)
+        if not lib.secp256k1_ec_pubkey_parse(lib.ctx, parent, cK, len(cK)):
+            parent = None
+    if parent is None:
+        return [CKD_pub(cK, c, n)[0] for n in range(start, stop)]
+    ctx = lib.ctx
+    tweak_add = lib.secp256k1_ec_pubkey_tweak_add
+    serialize = lib.secp256k1_ec_pubkey_serialize
+    parent = parent.raw
+    child = ctypes.create_string_buffer(64)
+    out = ctypes.create_string_buffer(33)
+    out_size = ctypes.c_size_t(33)
+    compressed = _secp256k1.SECP256K1_EC_COMPRESSED
+    hmac_digest = hmac.digest
+    result = []
+    for n in range(start, stop):
+        I = hmac_digest(c, cK + n.to_bytes(4, 'big'), 'sha512')
+        child.raw = parent
+        if not tweak_add(ctx, child, I[0:32]):
+            # I_L >= order or the child is the point at infinity, with a
+            # probability below 1 in 2^127. Let the slow path deal with it.
+            result.append(CKD_pub(cK, c, n)[0])
+            continue
+        out_size.value = 33
+        serialize(ctx, out, ctypes.byref(out_size), child, compressed)
+        result.append(out.raw)
+    return result
+
 
 def xprv_header(xtype, *, net=None):
     if net is None: net = networks.net
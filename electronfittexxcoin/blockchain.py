@@ -21,10 +21,17 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import concurrent.futures
+import hashlib
+import json
+import mmap
+import multiprocessing
 import os
+import struct
 import sys
 import threading
 
+from operator import attrgetter
 from typing import Optional
 
 from . import asert_daa
@@ -52,6 +59,30 @@ MAX_TARGET = 0x00000000ffffffffffffffffffffffffffffffffffffffffffffffffffffffff
 NULL_HEADER = bytes([0]) * HEADER_SIZE
 NULL_HASH_BYTES = bytes([0]) * 32
 NULL_HASH_HEX = NULL_HASH_BYTES.hex()
+# Number of headers below the tip of each Blockchain whose deserialized form
+# and hash are kept in memory (they are read over and over by the DAA and the
+# median time past computations).
+RECENT_HEADERS = 512
+# (timestamp, bits) fields, at offset 68 of a serialized header
+_TIMESTAMP_BITS = struct.Struct('<II')
+# the same, unpacked from each header of a chunk by iter_unpack()
+_CHUNK_TIMESTAMP_BITS = struct.Struct('<68xII4x')
+
+
+def legacy_retarget_bits(prior_bits, first_timestamp, prior_timestamp):
+    ''' The bits of a block at a retarget height, from the bits and
+    timestamp of the previous block and the timestamp of the first block of
+    the period. '''
+    prior_target = bits_to_target(prior_bits)
+    target_span = networks.net.LEGACY_POW_TARGET_TIMESPAN  # Usually 2 weeks
+    span = prior_timestamp - first_timestamp
+    # Clamp the adjustment factor between 25% and 400% of the expected timespan
+    span = max(target_span // 4, min(span, target_span * 4))
+    new_target = (prior_target * span) // target_span
+    # Ensure the new target does not exceed the maximum target
+    if new_target > MAX_TARGET:
+        return MAX_BITS
+    return target_to_bits(new_target)
 
 
 def bits_to_work(bits):
@@ -159,11 +190,29 @@ def hash_header(header):
 
 blockchains = {}
 
+# Layout of the headers of all the Blockchains, see save_index()
+INDEX_FILENAME = 'index.json'
+INDEX_VERSION = 1
+
+# Which headers up to the checkpoint we have, see HeaderBitmap. None if the
+# network has no checkpoint.
+header_bitmap = None
+
 def read_blockchains(config):
-    blockchains[0] = Blockchain(config, 0, None)
     fdir = os.path.join(util.get_headers_dir(config), 'forks')
     if not os.path.exists(fdir):
         os.mkdir(fdir)
+    index = _load_index(fdir)
+    if index is not None:
+        for entry in index:
+            segments = [_Segment(*x) for x in entry['segments']]
+            b = Blockchain(config, entry['base_height'], entry['parent_base_height'], segments)
+            blockchains[b.base_height] = b
+        _remove_unreferenced(config)
+        _load_header_bitmap(config)
+        return blockchains
+    # No index yet: one file per fork, named after the parent and base heights
+    blockchains[0] = Blockchain(config, 0, None)
     l = filter(fittexxcoin x: x.startswith('fork_'), os.listdir(fdir))
     l = sorted(l, key = fittexxcoin x: int(x.split('_')[1]))
     for filename in l:
@@ -171,8 +220,222 @@ def read_blockchains(config):
         base_height = int(filename.split('_')[2])
         b = Blockchain(config, base_height, parent_base_height)
         blockchains[b.base_height] = b
+    save_index(config)
+    _load_header_bitmap(config)
     return blockchains
 
+def _load_header_bitmap(config):
+    global header_bitmap
+    header_bitmap = None
+    if networks.net.VERIFICATION_BLOCK_HEIGHT is None:
+        return
+    path = os.path.join(util.get_headers_dir(config), 'blockchain_headers.bitmap')
+    bitmap = HeaderBitmap(path, networks.net.VERIFICATION_BLOCK_HEIGHT + 1)
+    if not bitmap.load():
+        bitmap.rebuild(blockchains[0])
+        bitmap.save()
+    header_bitmap = bitmap
+
+def _load_index(fdir):
+    ''' Returns the list of chain entries of the index in fdir, or None if
+    there is no (usable) index. '''
+    path = os.path.join(fdir, INDEX_FILENAME)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            d = json.load(f)
+        if d.get('version') != INDEX_VERSION:
+            raise ValueError('unknown version {}'.format(d.get('version')))
+        chains = d['chains']
+        if not any(x['base_height'] == 0 and x['parent_base_height'] is None for x in chains):
+            raise ValueError('no main chain')
+        return chains
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        util.print_error("[blockchain] ignoring headers index:", repr(e))
+        return None
+
+def save_index(config):
+    ''' Atomically replaces the headers index with the segments of all the
+    Blockchains. Header files are only ever extended or truncated in place,
+    so whatever the index on disk is, it describes valid data. '''
+    fdir = os.path.join(util.get_headers_dir(config), 'forks')
+    chains = []
+    for b in sorted(blockchains.values(), key=attrgetter('base_height')):
+        chains.append({'base_height': b.base_height,
+                       'parent_base_height': b.parent_base_height,
+                       'segments': [x.to_list() for x in b.segments]})
+    path = os.path.join(fdir, INDEX_FILENAME)
+    tmp_path = path + '.tmp'
+    with _files_lock:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'version': INDEX_VERSION, 'chains': chains}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+def _remove_unreferenced(config):
+    ''' Deletes the files in the forks directory which no Blockchain uses. '''
+    d = util.get_headers_dir(config)
+    with _files_lock:
+        used = {os.path.normpath(x.path) for b in list(blockchains.values()) for x in b.segments}
+        for filename in os.listdir(os.path.join(d, 'forks')):
+            rel = os.path.join('forks', filename)
+            if filename.startswith(INDEX_FILENAME) or rel in used:
+                continue
+            util.print_error("[blockchain] removing unused headers file", rel)
+            _close_map(os.path.join(d, rel))
+            os.remove(os.path.join(d, rel))
+
+# The headers files are shared by the Blockchains: after a swap, a chain may
+# read part of its headers from the file of another one. Reads go through
+# one read-only map per file. _files_lock must be held to use the maps and to
+# modify the files (the map has to go before the file is truncated).
+_files_lock = threading.RLock()
+_maps = {}  # absolute path -> map of the headers in the file
+
+def _get_map(path, length):
+    ''' Returns a map of at least the first `length` bytes of the file at
+    path, or None if the file is shorter than that. '''
+    m = _maps.get(path)
+    if m is None or len(m) < length:
+        _close_map(path)
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return None
+        size -= size % HEADER_SIZE
+        if size < length or not size:
+            return None
+        with open(path, 'rb') as f:
+            m = _maps[path] = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+    return m
+
+def _close_map(path):
+    m = _maps.pop(path, None)
+    if m is not None:
+        m.close()
+
+def close_files():
+    ''' Closes the maps of all the headers files. '''
+    with _files_lock:
+        for path in list(_maps):
+            _close_map(path)
+
+class HeaderBitmap(util.PrintError):
+    ''' One bit per height in [0, size): whether we have the header. The
+    headers up to the checkpoint are only fetched (with proofs against the
+    checkpoint) when something needs them, so the headers file is mostly
+    holes there. The bitmap answers "do we have it" without reading the
+    file, and is what the missing headers are requested from.
+
+    Blockchain.write() sets the bits after the headers are on disk. Reads
+    of the file correct the bits which disagree with it, in case it was
+    written by something else. '''
+
+    MAGIC = b'FXHB'
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self.bits = bytearray((size + 7) // 8)
+        self.lock = threading.Lock()
+
+    def load(self):
+        ''' Returns False if there is no usable saved bitmap. '''
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return False
+        if data[:4] != self.MAGIC or len(data) != 8 + len(self.bits) or struct.unpack_from('<I', data, 4)[0] != self.size:
+            self.print_error("ignoring", self.path)
+            return False
+        self.bits[:] = data[8:]
+        return True
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                with self.lock:
+                    f.write(self.MAGIC + struct.pack('<I', self.size) + self.bits)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            self.print_error("cannot save", self.path, repr(e))
+
+    def rebuild(self, chain):
+        ''' Sets the bits from the headers chain has. '''
+        self.clear()
+        for height in range(min(self.size, chain.height() + 1)):
+            if chain.read_raw_header(height) is not None:
+                self.bits[height >> 3] |= 1 << (height & 7)
+        self.print_error("rebuilt,", self.count(), "headers present")
+
+    def clear(self):
+        with self.lock:
+            self.bits[:] = bytes(len(self.bits))
+
+    def __contains__(self, height):
+        return 0 <= height < self.size and bool(self.bits[height >> 3] & (1 << (height & 7)))
+
+    def count(self):
+        return sum(bin(x).count('1') for x in self.bits)
+
+    def add(self, base_height, data):
+        ''' Sets the bits of the headers in data, which starts at
+        base_height, except those of null headers. Returns whether any bit
+        changed. '''
+        changed = False
+        with self.lock:
+            bits = self.bits
+            for i in range(min(len(data) // HEADER_SIZE, self.size - base_height)):
+                height = base_height + i
+                if data[i * HEADER_SIZE:(i + 1) * HEADER_SIZE] == NULL_HEADER:
+                    continue
+                mask = 1 << (height & 7)
+                if not bits[height >> 3] & mask:
+                    bits[height >> 3] |= mask
+                    changed = True
+        return changed
+
+    def discard(self, height, stop=None):
+        ''' Clears the bits of [height, stop), by default only height's.
+        Returns whether any bit changed. '''
+        stop = min(self.size, height + 1 if stop is None else stop)
+        changed = False
+        with self.lock:
+            for h in range(max(0, height), stop):
+                mask = 1 << (h & 7)
+                if self.bits[h >> 3] & mask:
+                    self.bits[h >> 3] &= ~mask & 0xff
+                    changed = True
+        return changed
+
+    def missing(self, heights):
+        ''' Returns the sorted heights of `heights` in range which are not
+        present. '''
+        return sorted({h for h in heights if 0 <= h < self.size and h not in self})
+
+
+def height_ranges(heights, max_gap=0, max_count=2016):
+    ''' Groups sorted heights into (start, count) ranges of at most
+    max_count headers. Heights less than max_gap apart are requested
+    together, the headers in between being cheaper than another request and
+    proof. '''
+    ranges = []
+    start = prev = None
+    for height in heights:
+        if start is not None and height - prev <= max_gap + 1 and height - start < max_count:
+            prev = height
+            continue
+        if start is not None:
+            ranges.append((start, prev - start + 1))
+        start = prev = height
+    if start is not None:
+        ranges.append((start, prev - start + 1))
+    return ranges
+
 def check_header(header):
     if type(header) is not dict:
         return False
@@ -202,6 +465,68 @@ def verify_proven_chunk(chunk_base_height, chunk_data):
                 raise VerifyError("prev hash mismatch: %s vs %s" % (prev_header_hash, header.get('prev_block_hash')))
         prev_header_hash = this_header_hash
 
+def hash_and_check_chunk(chunk_data):
+    ''' Hashes the headers in chunk_data and checks each against the
+    target of its own bits. Returns (hashes, bad_pow): the concatenated 32
+    byte hashes (internal byte order) and the indices of the headers with
+    insufficient proof of work.
+
+    This is the part of chunk verification which does not depend on the
+    other headers, so it can be done ahead of time and in another process
+    (see ChunkVerifier), leaving the sequential checks to verify_chunk. '''
+    sha256 = hashlib.sha256
+    targets = {}
+    hashes = bytearray()
+    bad_pow = []
+    for i in range(len(chunk_data) // HEADER_SIZE):
+        h = chunk_data[i * HEADER_SIZE:(i + 1) * HEADER_SIZE]
+        digest = sha256(sha256(h).digest()).digest()
+        hashes += digest
+        bits = int.from_bytes(h[72:76], 'little')
+        target = targets.get(bits)
+        if target is None:
+            try:
+                target = bits_to_target(bits)
+            except Exception:
+                target = -1
+            targets[bits] = target
+        if int.from_bytes(digest, 'little') > target:
+            bad_pow.append(i)
+    return bytes(hashes), bad_pow
+
+class ChunkVerifier(util.PrintError):
+    ''' Runs hash_and_check_chunk in a pool of worker processes, so that
+    it runs in parallel with the downloading and the sequential verification
+    of other chunks. With 0 processes, or if the pool cannot be used, the
+    work is done right away in the calling thread. '''
+
+    def __init__(self, processes):
+        self.processes = processes
+        self.executor = None
+
+    def submit(self, chunk_data):
+        ''' Returns a concurrent.futures.Future for the result of
+        hash_and_check_chunk(chunk_data). '''
+        if self.processes > 0:
+            try:
+                if self.executor is None:
+                    # spawn, as forking a process with threads (Qt, network, ...) is unsafe
+                    self.executor = concurrent.futures.ProcessPoolExecutor(
+                        max_workers=self.processes, mp_context=multiprocessing.get_context('spawn'))
+                return self.executor.submit(hash_and_check_chunk, chunk_data)
+            except Exception as e:  # BrokenProcessPool, no multiprocessing support, etc
+                self.print_error("cannot use worker processes:", repr(e))
+                self.processes = 0
+                self.shutdown()
+        future = concurrent.futures.Future()
+        future.set_result(hash_and_check_chunk(chunk_data))
+        return future
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
 # Copied from electrumx
 def root_from_proof(hash, branch, index):
     hash_func = Hash
@@ -239,16 +564,67 @@ class HeaderChunk:
     def get_header_at_index(self, index):
         return self.headers[index]
 
+class _Segment:
+    ''' The headers at heights [start, stop) of a Blockchain, stored in the
+    file at path (relative to the headers directory) whose first header is
+    the one at height file_base. A stop of None means that the segment owns
+    the end of the file and extends up to it: only such segments are appended
+    to or truncated. '''
+
+    __slots__ = ('path', 'file_base', 'start', 'stop')
+
+    def __init__(self, path, file_base, start, stop=None):
+        self.path = path
+        self.file_base = file_base
+        self.start = start
+        self.stop = stop
+
+    def __repr__(self):
+        return "<_Segment {} [{}, {})>".format(self.path, self.start, self.stop)
+
+    def to_list(self):
+        return [self.path, self.file_base, self.start, self.stop]
+
+    def offset(self, height):
+        return (height - self.file_base) * HEADER_SIZE
+
+
+def _split_segments(segments, height):
+    ''' Returns the segments covering the heights below height and those
+    covering the heights from height on. '''
+    head, tail = [], []
+    for x in segments:
+        if x.stop is not None and x.stop <= height:
+            head.append(x)
+        elif x.start >= height:
+            tail.append(x)
+        else:
+            head.append(_Segment(x.path, x.file_base, x.start, height))
+            tail.append(_Segment(x.path, x.file_base, height, x.stop))
+    return head, tail
+
+
 class Blockchain(util.PrintError):
     """
     Manages blockchain headers and their verification
+
+    The headers of a Blockchain are a list of segments, each a range of
+    heights in some headers file, see _Segment. A fork starts out with one
+    segment in a file of its own. When it becomes longer than its parent the
+    two swap places by exchanging segments, so that no headers are copied,
+    and the new layout is committed by rewriting the index (save_index).
     """
 
-    def __init__(self, config, base_height, parent_base_height):
+    def __init__(self, config, base_height, parent_base_height, segments=None):
         self.config = config
         self.catch_up = None # interface catching up
         self.base_height = base_height
         self.parent_base_height = parent_base_height
+        if segments is None:
+            filename = 'blockchain_headers' if parent_base_height is None else os.path.join('forks', 'fork_%d_%d'%(parent_base_height, base_height))
+            segments = [_Segment(filename, base_height, base_height)]
+        self.segments = segments
+        self._recent = {}  # height -> (header dict, hash hex) for heights near the tip
 
         self.lock = threading.Lock()
         with self.lock:
@@ -285,8 +661,9 @@ class Blockchain(util.PrintError):
 
     def fork(parent, header):
         base_height = header.get('block_height')
-        self = Blockchain(parent.config, base_height, parent.base_height)
-        open(self.path(), 'w+').close()
+        self = Blockchain(parent.config, base_height, parent.base_height, [])
+        # registered before its first segment is committed to the index
+        blockchains[base_height] = self
         self.save_header(header)
         return self
 
@@ -298,8 +675,28 @@ class Blockchain(util.PrintError):
             return self._size
 
     def update_size(self):
-        p = self.path()
-        self._size = os.path.getsize(p)//HEADER_SIZE if os.path.exists(p) else 0
+        self._size = self._end() - self.base_height
+
+    def _end(self):
+        ''' Returns the height after the last header of the segments. '''
+        end = self.base_height
+        for x in self.segments:
+            if x.stop is not None:
+                end = x.stop
+            else:
+                p = self._abspath(x.path)
+                n = os.path.getsize(p)//HEADER_SIZE if os.path.exists(p) else 0
+                end = max(x.start, x.file_base + n)
+        return end
+
+    def _abspath(self, filename):
+        return os.path.join(util.get_headers_dir(self.config), filename)
+
+    def _find_segment(self, height):
+        for x in reversed(self.segments):
+            if x.start <= height:
+                return x
+        return None
 
     def verify_header(self, header, prev_header, bits=None):
      prev_header_hash = hash_header(prev_header)
@@ -322,25 +719,53 @@ class Blockchain(util.PrintError):
      return True
 
 
-    def verify_chunk(self, chunk_base_height, chunk_data):
-        chunk = HeaderChunk(chunk_base_height, chunk_data)
+    def verify_chunk(self, chunk_base_height, chunk_data, hashes_and_pow=None):
+        ''' Same checks as verify_header for every header in the chunk.
+        hashes_and_pow is the result of hash_and_check_chunk(chunk_data), if
+        it was computed beforehand. '''
+        hashes, bad_pow = hashes_and_pow or hash_and_check_chunk(chunk_data)
+        bad_pow = set(bad_pow)
 
-        prev_header = None
+        prev_hash = NULL_HASH_BYTES
         if chunk_base_height != 0:
-            prev_header = self.read_header(chunk_base_height - 1)
+            prev_raw = self.read_raw_header(chunk_base_height - 1)
+            prev_hash = Hash(prev_raw) if prev_raw else NULL_HASH_BYTES
 
+        # Check the chain of hashes, then the difficulty.
         header_count = len(chunk_data) // HEADER_SIZE
         for i in range(header_count):
-            header = chunk.get_header_at_index(i)
-            # Check the chain of hashes and the difficulty.
-            bits = self.get_bits(header, chunk)
-            self.verify_header(header, prev_header, bits)
-            prev_header = header
+            offset = i * HEADER_SIZE
+            if chunk_data[offset + 4:offset + 36] != prev_hash:
+                raise VerifyError("prev hash mismatch: %s vs %s" % (hash_encode(prev_hash), hash_encode(chunk_data[offset + 4:offset + 36])))
+            prev_hash = hashes[i * 32:(i + 1) * 32]
+        expected_bits = self.get_chunk_bits(chunk_base_height, chunk_data)
+        for i, (timestamp, header_bits) in enumerate(_CHUNK_TIMESTAMP_BITS.iter_unpack(chunk_data[:header_count * HEADER_SIZE])):
+            bits = expected_bits[i]
+            if bits != header_bits:
+                self.print_error('Warning: bits mismatch at height {}: {} vs {}'.format(chunk_base_height + i, bits, header_bits))
+            elif i in bad_pow:
+                this_hash = hashes[i * 32:(i + 1) * 32]
+                raise VerifyError("insufficient proof of work: %s vs target %s" % (int.from_bytes(this_hash, 'little'), bits_to_target(bits)))
 
     def path(self):
-        d = util.get_headers_dir(self.config)
-        filename = 'blockchain_headers' if self.parent_base_height is None else os.path.join('forks', 'fork_%d_%d'%(self.parent_base_height, self.base_height))
-        return os.path.join(d, filename)
+        ''' The file holding the first headers of this chain. '''
+        if self.segments:
+            return self._abspath(self.segments[0].path)
+        return self._abspath(self._new_filename(self.base_height))
+
+    def _new_filename(self, height):
+        ''' Returns an unused file name for a segment starting at height. '''
+        if self.parent_base_height is None:
+            filename = os.path.join('forks', 'headers_%d' % height)
+        else:
+            filename = os.path.join('forks', 'fork_%d_%d' % (self.parent_base_height, height))
+        used = {x.path for b in blockchains.values() for x in b.segments}
+        used.update(x.path for x in self.segments)
+        name, i = filename, 0
+        while name in used or os.path.exists(self._abspath(name)):
+            i += 1
+            name = '%s_%d' % (filename, i)
+        return name
 
     def save_chunk(self, base_height, chunk_data):
         chunk_offset = (base_height - self.base_height) * HEADER_SIZE
@@ -361,45 +786,135 @@ class Blockchain(util.PrintError):
         if parent_branch_size >= self.size():
             return
         self.print_error("swap", self.base_height, self.parent_base_height)
-        parent_base_height = self.parent_base_height
         base_height = self.base_height
         parent = self.parent()
-        with open(self.path(), 'rb') as f:
-            my_data = f.read()
-        with open(parent.path(), 'rb') as f:
-            f.seek((base_height - parent.base_height)*HEADER_SIZE)
-            parent_data = f.read(parent_branch_size*HEADER_SIZE)
-        self.write(parent_data, 0)
-        parent.write(my_data, (base_height - parent.base_height)*HEADER_SIZE)
-        # store file path
-        for b in blockchains.values():
-            b.old_path = b.path()
-        # swap parameters
-        self.parent_base_height = parent.parent_base_height; parent.parent_base_height = parent_base_height
-        self.base_height = parent.base_height; parent.base_height = base_height
-        self._size = parent._size; parent._size = parent_branch_size
-        # move files
-        for b in blockchains.values():
-            if b in [self, parent]: continue
-            if b.old_path != b.path():
-                self.print_error("renaming", b.old_path, b.path())
-                os.rename(b.old_path, b.path())
+        bitmap_data = None
+        if parent.parent_base_height is None and base_height < self._bitmap_size():
+            bitmap_data = b''.join(self.read_raw_header(h) or NULL_HEADER
+                                   for h in range(base_height, min(header_bitmap.size, self.height() + 1)))
+        with parent.lock, self.lock:
+            # The headers of the parent below our base become ours, and ours
+            # replace the parent's above it. Only the segment lists change.
+            head, tail = _split_segments(parent.segments, base_height)
+            self.segments = head + self.segments
+            parent.segments = tail
+            # swap parameters
+            self.parent_base_height, parent.parent_base_height = parent.parent_base_height, parent.base_height
+            self.base_height, parent.base_height = parent.base_height, base_height
+            self._recent.clear()
+            parent._recent.clear()
+            self.update_size()
+            parent.update_size()
         # update pointers
         blockchains[self.base_height] = self
         blockchains[parent.base_height] = parent
+        save_index(self.config)
+        if bitmap_data is not None:
+            # our headers replaced the parent's in the bitmap's range
+            changed = header_bitmap.discard(base_height, header_bitmap.size)
+            if header_bitmap.add(base_height, bitmap_data) or changed:
+                header_bitmap.save()
 
     def write(self, data, offset, truncate=True):
-        filename = self.path()
-        with self.lock:
-            with open(filename, 'rb+') as f:
-                if truncate and offset != self._size*HEADER_SIZE:
-                    f.seek(offset)
-                    f.truncate()
-                f.seek(offset)
-                f.write(data)
+        start = self.base_height + offset // HEADER_SIZE
+        bitmap = header_bitmap if self.parent_base_height is None and start < self._bitmap_size() else None
+        bitmap_changed = False
+        with self.lock, _files_lock:
+            for height in [h for h in self._recent if h >= start]:
+                del self._recent[height]
+            changed = False
+            if truncate and offset != self._size*HEADER_SIZE:
+                changed = self._truncate(start)
+                if bitmap is not None:
+                    bitmap_changed = bitmap.discard(start, bitmap.size)
+            if bitmap is not None:
+                bitmap_data = data
+            height = start
+            while data:
+                x = self._find_segment(height)
+                if x is None or (x.stop is not None and height >= x.stop):
+                    # Past the end of a segment we cannot append to
+                    end = self._end()
+                    x = _Segment(self._new_filename(end), end, end)
+                    self.segments.append(x)
+                    changed = True
+                n = len(data) if x.stop is None else min(len(data), (x.stop - height) * HEADER_SIZE)
+                self._write_file(x.path, x.offset(height), data[:n])
+                data = data[n:]
+                height += n // HEADER_SIZE
+            self.update_size()
+            if bitmap is not None:
+                bitmap_changed = bitmap.add(start, bitmap_data) or bitmap_changed
+        if bitmap_changed:
+            bitmap.save()
+        if changed:
+            save_index(self.config)
+            _remove_unreferenced(self.config)
+
+    def init_sparse(self, count):
+        ''' Drops the headers of the chain and makes it `count` headers long,
+        all zeroes. The file is sparse, so this doesn't take the disk space:
+        used for the headers before the checkpoint, which are fetched when
+        needed. '''
+        with self.lock, _files_lock:
+            self._recent.clear()
+            changed = self._truncate(self.base_height)
+            if not self.segments:
+                self.segments.append(_Segment(self._new_filename(self.base_height), self.base_height, self.base_height))
+                changed = True
+            x = self.segments[-1]
+            path = self._abspath(x.path)
+            if not os.path.exists(path):
+                self._write_file(x.path, 0, b'')
+            util.ensure_sparse_file(path)
+            if count:
+                self._write_file(x.path, x.offset(self.base_height + count) - 1, b'\x00')
+            self.update_size()
+        if changed:
+            save_index(self.config)
+            _remove_unreferenced(self.config)
+
+    def _truncate(self, height):
+        ''' Drops the headers from height on. Returns whether the segments
+        changed. '''
+        before = [x.to_list() for x in self.segments]
+        segments = []
+        for x in self.segments:
+            if x.stop is None:
+                if x.start > height:
+                    self._truncate_file(x.path, x.offset(x.start))
+                    continue
+                self._truncate_file(x.path, x.offset(height))
+            elif x.start >= height:
+                continue
+            elif x.stop > height:
+                x.stop = height
+            segments.append(x)
+        self.segments = segments
+        return [x.to_list() for x in segments] != before
+
+    @staticmethod
+    def _bitmap_size():
+        return header_bitmap.size if header_bitmap is not None else 0
+
+    def _write_file(self, filename, offset, data):
+        path = self._abspath(filename)
+        _close_map(path)
+        with open(path, 'rb+' if os.path.exists(path) else 'wb+') as f:
+            f.seek(offset)
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _truncate_file(self, filename, size):
+        path = self._abspath(filename)
+        # The map has to go before the file is truncated (on Windows)
+        _close_map(path)
+        if os.path.exists(path) and os.path.getsize(path) > size:
+            with open(path, 'rb+') as f:
+                f.truncate(size)
                 f.flush()
                 os.fsync(f.fileno())
-            self.update_size()
 
     def save_header(self, header):
         delta = header.get('block_height') - self.base_height
@@ -409,35 +924,108 @@ class Blockchain(util.PrintError):
         self.write(data, delta*HEADER_SIZE)
         self.swap_with_parent()
 
+    def read_raw_header(self, height):
+        ''' Returns the serialized header at height, or None if we don't
+        have it. '''
+        if height < 0:
+            return None
+        if height < self.base_height:
+            return self.parent().read_raw_header(height)
+        with self.lock:
+            return self._read_raw(height)
+
+    def _read_raw(self, height):
+        ''' Like read_raw_header for heights >= self.base_height. Must be
+        called with self.lock held. '''
+        delta = height - self.base_height
+        if delta >= self._size:
+            return None
+        x = self._find_segment(height)
+        offset = x.offset(height)
+        with _files_lock:
+            m = _get_map(self._abspath(x.path), offset + HEADER_SIZE)
+            h = m[offset:offset + HEADER_SIZE] if m is not None else None
+        # Is it a pre-checkpoint header that has never been requested?
+        missing = h is None or h == NULL_HEADER
+        bitmap = header_bitmap
+        if bitmap is not None and height < bitmap.size and self.parent_base_height is None and (height in bitmap) == missing:
+            # the file was changed behind our back, the bitmap will be saved with the next change
+            if missing:
+                bitmap.discard(height)
+            else:
+                bitmap.add(height, h)
+        if missing:
+            return None
+        return h
+
+    def _get_recent(self, height):
+        ''' Returns the (header, hash) cached for height >= self.base_height,
+        reading it into the cache if it is near the tip, or None. '''
+        with self.lock:
+            ent = self._recent.get(height)
+            if ent is None:
+                tip = self.base_height + self._size - 1
+                if tip - RECENT_HEADERS < height <= tip:
+                    h = self._read_raw(height)
+                    if h is None:
+                        return None
+                    ent = self._recent[height] = (deserialize_header(h, height), hash_encode(Hash(h)))
+                    if len(self._recent) > 2 * RECENT_HEADERS:
+                        for old in [x for x in self._recent if x <= tip - RECENT_HEADERS]:
+                            del self._recent[old]
+            return ent
+
     def read_header(self, height, chunk=None):
+        ''' Returns the header at height as a dict, or None if we don't have
+        it. Headers near the tip are cached: callers must not modify the
+        dicts returned. '''
         # If the read is done within an outer call with local unstored header data, we first look in the chunk data currently being processed.
         if chunk is not None and chunk.contains_height(height):
             return chunk.get_header_at_height(height)
 
         assert self.parent_base_height != self.base_height
         if height < 0:
-            return
+            return None
         if height < self.base_height:
             return self.parent().read_header(height)
-        if height > self.height():
-            return
-        delta = height - self.base_height
-        name = self.path()
-        if os.path.exists(name):
-            with open(name, 'rb') as f:
-                f.seek(delta * HEADER_SIZE)
-                h = f.read(HEADER_SIZE)
-            # Is it a pre-checkpoint header that has never been requested?
-            if h == NULL_HEADER:
-                return None
-            return deserialize_header(h, height)
+        ent = self._get_recent(height)
+        if ent is not None:
+            return ent[0]
+        h = self.read_raw_header(height)
+        if h is None:
+            return None
+        return deserialize_header(h, height)
+
+    def read_timestamp_bits(self, height, chunk=None):
+        ''' Returns the (timestamp, bits) of the header at height, without
+        deserializing the whole header, or None if we don't have it. '''
+        if chunk is not None and chunk.contains_height(height):
+            header = chunk.get_header_at_height(height)
+            return header['timestamp'], header['bits']
+        if 0 <= height < self.base_height:
+            return self.parent().read_timestamp_bits(height)
+        ent = self._recent.get(height)
+        if ent is not None:
+            return ent[0]['timestamp'], ent[0]['bits']
+        h = self.read_raw_header(height)
+        if h is None:
+            return None
+        return _TIMESTAMP_BITS.unpack_from(h, 68)
 
     def get_hash(self, height):
-        if height == -1:
+        if height < 0:
             return NULL_HASH_HEX
         elif height == 0:
             return networks.net.GENESIS
-        return hash_header(self.read_header(height))
+        elif height < self.base_height:
+            return self.parent().get_hash(height)
+        ent = self._get_recent(height)
+        if ent is not None:
+            return ent[1]
+        h = self.read_raw_header(height)
+        if h is None:
+            return NULL_HASH_HEX
+        return hash_encode(Hash(h))
 
     # Not used.
     def BIP9(self, height, flag):
@@ -448,7 +1036,7 @@ class Blockchain(util.PrintError):
         if height < 0:
             return 0
         times = [
-            self.read_header(h, chunk)['timestamp']
+            self.read_timestamp_bits(h, chunk)[0]
             for h in range(max(0, height - 10), height + 1)
         ]
         return sorted(times)[len(times) // 2]
@@ -544,20 +1132,34 @@ class Blockchain(util.PrintError):
         raise Exception("get_new_bits missing prior header at height {}".format(height - 1))
     
     # Calculate the new target based on the timestamps
-     prior_target = bits_to_target(prior['bits'])
-     target_span = networks.net.LEGACY_POW_TARGET_TIMESPAN  # Usually 2 weeks
-     span = prior['timestamp'] - first['timestamp']
-    
-    # Clamp the adjustment factor between 25% and 400% of the expected timespan
-     span = max(target_span // 4, min(span, target_span * 4))
-     new_target = (prior_target * span) // target_span
-
-    # Ensure the new target does not exceed the maximum target
-     if new_target > MAX_TARGET:
-        return MAX_BITS
-    
-    # Return the new target as compact bits
-     return target_to_bits(new_target)
+     return legacy_retarget_bits(prior['bits'], first['timestamp'], prior['timestamp'])
+
+    def get_chunk_bits(self, base_height, chunk_data):
+        ''' Returns the bits get_bits() expects for each header of
+        chunk_data, which starts at base_height, in one pass over the chunk:
+        the timestamps and bits of the previous headers are taken from the
+        chunk instead of being read and deserialized for every header. '''
+        N_BLOCKS = networks.net.LEGACY_POW_RETARGET_BLOCKS  # Usually 2016
+        rows = list(_CHUNK_TIMESTAMP_BITS.iter_unpack(chunk_data[:len(chunk_data) - len(chunk_data) % HEADER_SIZE]))
+        prior = None
+        if base_height > 0:
+            prior = self.read_timestamp_bits(base_height - 1)
+            if prior is None:
+                raise Exception("get_bits missing header {}".format(base_height - 1))
+        ret = []
+        for i, row in enumerate(rows):
+            height = base_height + i
+            if height == 0:
+                ret.append(MAX_BITS)
+            elif height % N_BLOCKS == 0:
+                first = rows[i - N_BLOCKS] if i >= N_BLOCKS else self.read_timestamp_bits(height - N_BLOCKS)
+                if first is None:
+                    raise Exception("get_new_bits missing first header at height {}".format(height - N_BLOCKS))
+                ret.append(legacy_retarget_bits(prior[1], first[0], prior[0]))
+            else:
+                ret.append(prior[1])
+            prior = row
+        return ret
 
     
 
@@ -582,7 +1184,7 @@ class Blockchain(util.PrintError):
             return False
         return True
 
-    def connect_chunk(self, base_height, hexdata, proof_was_provided=False):
+    def connect_chunk(self, base_height, hexdata, proof_was_provided=False, hashes_and_pow=None):
         chunk = HeaderChunk(base_height, hexdata)
 
         header_count = len(hexdata) // HEADER_SIZE
@@ -624,7 +1226,7 @@ class Blockchain(util.PrintError):
 
         try:
             if not proof_was_provided:
-                self.verify_chunk(base_height, hexdata)
+                self.verify_chunk(base_height, hexdata, hashes_and_pow)
             self.save_chunk(base_height, hexdata)
             return CHUNK_ACCEPTED
         except VerifyError as e:
@@ -10,7 +10,7 @@ import threading
 import queue
 import weakref
 import math
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from .util import PrintError, print_error
 
 class ExpiringCache:
@@ -91,6 +91,53 @@ class ExpiringCache:
         )
         return (f'<{__class__.__name__} "{name}" at {address}, {length} item{"s" if length != 1 else ""} (maxlen={maxlen} timeout={timeout})>')
 
+class ByteBudgetCache:
+    ''' A thread-safe LRU cache for str or bytes values (such as raw
+    transactions), bounded by the total length of the values it holds rather
+    than by their number. Unlike ExpiringCache, the least recently used items
+    are evicted right away by put() when the budget is exceeded. A single
+    value bigger than the budget is not cached. '''
+    def __init__(self, max_bytes, *, name="An Unnamed Cache"):
+        self.max_bytes = max_bytes
+        self.name = name
+        self.d = OrderedDict()
+        self.nbytes = 0
+        self.hits = self.misses = 0
+        self.lock = threading.Lock()
+    def get(self, key, default=None):
+        with self.lock:
+            value = self.d.get(key)
+            if value is None:
+                self.misses += 1
+                return default
+            self.d.move_to_end(key)
+            self.hits += 1
+            return value
+    def put(self, key, value):
+        size = len(value)
+        with self.lock:
+            old = self.d.pop(key, None)
+            if old is not None:
+                self.nbytes -= len(old)
+            if size > self.max_bytes:
+                return
+            self.d[key] = value
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                _, old = self.d.popitem(last=False)
+                self.nbytes -= len(old)
+    def clear(self):
+        with self.lock:
+            self.d.clear()
+            self.nbytes = 0
+    def __contains__(self, key):
+        return key in self.d
+    def __len__(self):
+        return len(self.d)
+    def __repr__(self):
+        return (f'<{__class__.__name__} "{self.name}" at 0x{id(self):x}, {len(self)} items, '
+                f'{self.nbytes}/{self.max_bytes} bytes, {self.hits} hits {self.misses} misses>')
+
 class _ExpiringCacheMgr(PrintError):
     '''Do not use this class directly. Instead just create ExpiringCache
     instances and that will handle the creation of this object automatically
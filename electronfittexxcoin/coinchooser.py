@@ -24,6 +24,7 @@
 # SOFTWARE.
 from collections import defaultdict, namedtuple
 from math import floor, log10
+from operator import attrgetter, itemgetter
 
 from .bitcoin import sha256, COIN, TYPE_ADDRESS
 from .transaction import Transaction
@@ -70,6 +71,28 @@ class PRNG:
 
 Bucket = namedtuple('Bucket', ['desc', 'size', 'value', 'coins'])
 
+def input_size_estimator(sign_schnorr=False):
+    '''Returns a function of a coin which returns
+    Transaction.estimated_input_size(coin), computed once per kind of input:
+    the estimate only depends on the scriptSig if there is one, and
+    otherwise on the input type and the number and size of its keys and
+    signatures.'''
+    sizes = {}
+
+    def input_size(coin):
+        script_sig = coin.get('scriptSig')
+        if script_sig is not None:
+            key = len(script_sig)
+        else:
+            key = (coin['type'], coin.get('num_sig', 1), len(coin.get('x_pubkeys', [None])),
+                   Transaction.estimate_pubkey_size_for_txin(coin))
+        size = sizes.get(key)
+        if size is None:
+            size = sizes[key] = Transaction.estimated_input_size(coin, sign_schnorr=sign_schnorr)
+        return size
+
+    return input_size
+
 def strip_unneeded(bkts, sufficient_funds):
     '''Remove buckets that are unnecessary in achieving the spend amount'''
     bkts = sorted(bkts, key = fittexxcoin bkt: bkt.value)
@@ -90,9 +113,10 @@ class CoinChooserBase(PrintError):
         for key, coin in zip(keys, coins):
             buckets[key].append(coin)
 
+        input_size = input_size_estimator(sign_schnorr)
+
         def make_Bucket(desc, coins):
-            size = sum(Transaction.estimated_input_size(coin, sign_schnorr=sign_schnorr)
-                       for coin in coins)
+            size = sum(map(input_size, coins))
             value = sum(coin['value'] for coin in coins)
             return Bucket(desc, size, value, coins)
 
@@ -191,8 +215,8 @@ class CoinChooserBase(PrintError):
 
         # Collect the coins into buckets, choose a subset of the buckets
         buckets = self.bucketize_coins(coins, sign_schnorr=sign_schnorr)
-        buckets = self.choose_buckets(buckets, sufficient_funds,
-                                      self.penalty_func(tx))
+        buckets = self.select_buckets(buckets, sufficient_funds, tx, base_size,
+                                      fee_estimator, dust_threshold)
 
         tx.add_inputs([coin for b in buckets for coin in b.coins])
         tx_size = base_size + sum(bucket.size for bucket in buckets)
@@ -209,6 +233,13 @@ class CoinChooserBase(PrintError):
 
         return tx
 
+    def select_buckets(self, buckets, sufficient_funds, tx, base_size,
+                       fee_estimator, dust_threshold):
+        '''Returns the buckets to spend to pay the outputs of tx, a
+        transaction of base_size bytes without inputs or change.'''
+        return self.choose_buckets(buckets, sufficient_funds,
+                                   self.penalty_func(tx))
+
     def choose_buckets(self, buckets, sufficient_funds, penalty_func):
         raise NotImplementedError('To be subclassed')
 
@@ -284,8 +315,169 @@ class CoinChooserPrivacy(CoinChooserRandom):
         return penalty
 
 
+class CoinChooserBranchAndBound(CoinChooserPrivacy):
+    '''Scales to very large coin sets. The buckets (by address, as with
+    CoinChooserPrivacy) are valued at their effective value: their value
+    less the fee to spend them. A depth first branch and bound search over
+    them, largest first, looks for a set which pays the outputs and fee
+    with no change, wasting less than the cost of making change. If there
+    is none, it falls back to the CoinChooserPrivacy heuristic, with its
+    random trials drawn and summed incrementally.'''
+
+    # Give up the search after this many steps
+    MAX_TRIES = 100000
+    # The size of a pay-to-bitcoin-address change output, and of an input spending it
+    CHANGE_OUTPUT_SIZE = 34
+    CHANGE_INPUT_SIZE = 148
+
+    def select_buckets(self, buckets, sufficient_funds, tx, base_size,
+                       fee_estimator, dust_threshold):
+        spent_amount = tx.output_value()
+
+        def enough(value, size):
+            return value >= spent_amount + fee_estimator(base_size + size)
+
+        total_value = sum(bucket.value for bucket in buckets)
+        total_size = sum(bucket.size for bucket in buckets)
+        if not enough(total_value, total_size):
+            raise NotEnoughFunds()
+
+        # Change less than the dust threshold is not made but left to the fee
+        cost_of_change = fee_estimator(self.CHANGE_OUTPUT_SIZE) + min(
+            fee_estimator(self.CHANGE_INPUT_SIZE), dust_threshold - 1)
+        target = spent_amount + fee_estimator(base_size)
+        selected = self.branch_and_bound(buckets, target, cost_of_change, fee_estimator)
+        if selected is not None:
+            value = sum(bucket.value for bucket in selected)
+            size = sum(bucket.size for bucket in selected)
+            # the fees of the buckets were rounded separately: check again
+            excess = value - spent_amount - fee_estimator(base_size + size)
+            if 0 <= excess < cost_of_change:
+                self.print_error("Branch and bound: {} of {} buckets, {} in excess".format(
+                    len(selected), len(buckets), excess))
+                return selected
+
+        candidates = self.bucket_candidates_fast(buckets, enough)
+        penalty_func = self.penalty_func(tx)
+        penalties = [penalty_func(cand) for cand in candidates]
+        winner = candidates[penalties.index(min(penalties))]
+        self.print_error("Bucket sets:", len(buckets))
+        self.print_error("Winning penalty:", min(penalties))
+        return winner
+
+    def branch_and_bound(self, buckets, target, cost_of_change, fee_estimator):
+        '''Returns the buckets whose effective values add up to between
+        target and target + cost_of_change with the least excess, or None if
+        none was found within MAX_TRIES steps.'''
+        effective = []
+        for bucket in buckets:
+            value = bucket.value - fee_estimator(bucket.size)
+            if value > 0:
+                effective.append((value, bucket))
+        effective.sort(key=itemgetter(0), reverse=True)
+        values = [value for value, bucket in effective]
+
+        available = sum(values)
+        if available < target:
+            return None
+        current = 0
+        # selection[i] is whether effective[i] is in the current set, for the
+        # buckets decided so far
+        selection = []
+        best, best_excess = None, cost_of_change
+        for tries in range(self.MAX_TRIES):
+            if current + available < target or current >= target + cost_of_change:
+                backtrack = True
+            elif current >= target:
+                if current - target < best_excess:
+                    best, best_excess = list(selection), current - target
+                    if not best_excess:
+                        break
+                backtrack = True
+            else:
+                backtrack = False
+
+            if backtrack:
+                # Undecide the excluded buckets, and exclude the last included one
+                while selection and not selection[-1]:
+                    selection.pop()
+                    available += values[len(selection)]
+                if not selection:
+                    break  # the whole tree was searched
+                selection[-1] = False
+                current -= values[len(selection) - 1]
+            else:
+                depth = len(selection)
+                available -= values[depth]
+                if depth and not selection[-1] and values[depth] == values[depth - 1]:
+                    # Including this one would repeat the search without the
+                    # previous one, which has the same value
+                    selection.append(False)
+                else:
+                    selection.append(True)
+                    current += values[depth]
+
+        if best is None:
+            return None
+        return [bucket for (value, bucket), included in zip(effective, best) if included]
+
+    def bucket_candidates_fast(self, buckets, enough):
+        '''The candidates of CoinChooserRandom.bucket_candidates, from
+        random permutations which are only drawn as far as needed, with
+        running totals. enough(value, size) is whether buckets of that total
+        value and size pay for the transaction.'''
+        candidates = set()
+
+        # Add all singletons
+        for n, bucket in enumerate(buckets):
+            if enough(bucket.value, bucket.size):
+                candidates.add((n,))
+
+        # And now some random ones
+        attempts = min(100, (len(buckets) - 1) * 10 + 1)
+        permutation = list(range(len(buckets)))
+        for i in range(attempts):
+            value = size = 0
+            for count in range(len(permutation)):
+                # one more step of a Fisher-Yates shuffle
+                j = self.p.randint(count, len(permutation))
+                permutation[count], permutation[j] = permutation[j], permutation[count]
+                bucket = buckets[permutation[count]]
+                value += bucket.value
+                size += bucket.size
+                if enough(value, size):
+                    candidates.add(tuple(sorted(permutation[:count + 1])))
+                    break
+            else:
+                raise NotEnoughFunds()
+
+        return [self.strip_unneeded_fast([buckets[n] for n in c], enough) for c in candidates]
+
+    @staticmethod
+    def strip_unneeded_fast(bkts, enough):
+        '''strip_unneeded(), with running totals.'''
+        bkts = sorted(bkts, key=attrgetter('value'))
+        value = sum(bkt.value for bkt in bkts)
+        size = sum(bkt.size for bkt in bkts)
+        for i, bkt in enumerate(bkts):
+            value -= bkt.value
+            size -= bkt.size
+            if not enough(value, size):
+                return bkts[i:]
+        # Shouldn't get here
+        return bkts
+
+
+COIN_CHOOSERS = {
+    'Privacy': CoinChooserPrivacy,
+    'BranchAndBound': CoinChooserBranchAndBound,
+}
+
 def get_name(config):
     kind = config.get('coin_chooser')
     if not kind in COIN_CHOOSERS:
-        kind = 'Priority'
+        kind = 'Privacy'
     return kind
+
+def get_coin_chooser(config):
+    return COIN_CHOOSERS[get_name(config)]()
@@ -28,6 +28,7 @@ import argparse
 import ast
 import base64
 import datetime
+import itertools
 import json
 import queue
 import sys
@@ -38,6 +39,7 @@ from functools import wraps
 
 from . import bitcoin
 from . import rpa
+from . import token
 from . import util
 from .address import Address, AddressError
 from .bitcoin import hash_160, COIN, TYPE_ADDRESS
@@ -68,6 +70,24 @@ def assertOutpoint(out: str):
     assert len(prevout_hash) == 32, f"{prevout_hash.hex()} should be a 32-byte hash"
     assert int(prevout_n) >= 0, f"invalid output index {prevout_n}"
 
+def encode_cursor(kind, key):
+    """Returns the continuation token handed out by the paginated commands,
+    for the page after `key`. It is opaque to clients."""
+    return base64.urlsafe_b64encode(json.dumps([kind] + list(key)).encode('utf-8')).decode('ascii')
+
+def decode_cursor(kind, cursor):
+    """Returns the key encoded by encode_cursor, for command `kind`."""
+    try:
+        l = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+        assert isinstance(l, list) and l[0] == kind
+        return tuple(l[1:])
+    except Exception:
+        raise BaseException("Invalid cursor")
+
+def check_limit(limit):
+    if limit is not None and limit < 1:
+        raise BaseException("limit must be at least 1")
+
 class Command:
     def __init__(self, func, s):
         self.name = func.__name__
@@ -347,14 +367,34 @@ class Commands:
         return self.network.synchronous_get(('blockchain.scripthash.get_history', [sh]))
 
     @command('w')
-    def listunspent(self):
+    def listunspent(self, limit=None, cursor=None, from_height=None, to_height=None, token_category=None):
         """List unspent outputs. Returns the list of unspent transaction
-        outputs in your wallet."""
-        l = self.wallet.get_utxos(exclude_frozen=False)
+        outputs in your wallet. If limit, cursor, from_height or to_height is
+        given, returns a page of outputs in outpoint order along with the
+        cursor of the next page, which is null on the last page, and with
+        token data rendered as JSON."""
+        check_limit(limit)
+        paginate = not (limit is None and cursor is None and from_height is None and to_height is None)
+        after = decode_cursor('listunspent', cursor)[0] if cursor is not None else None
+        l = self.wallet.get_utxos(exclude_frozen=False, token_category=token_category,
+                                  from_height=from_height, to_height=to_height,
+                                  after=after, limit=limit + 1 if limit is not None else None)
+        next_cursor = None
+        if limit is not None and len(l) > limit:
+            del l[limit:]
+            next_cursor = encode_cursor('listunspent', ('{}:{}'.format(l[-1]['prevout_hash'], l[-1]['prevout_n']),))
         for i in l:
             v = i["value"]
             i["value"] = str(PyDecimal(v)/COIN) if v is not None else None
             i["address"] = i["address"].to_ui_string()
+            td = i["token_data"]
+            if td and paginate:
+                i["token_data"] = {'category': td.id_hex, 'amount': str(td.amount)}
+                if td.has_nft():
+                    i["token_data"]['nft'] = {'capability': token.Capability(td.get_capability()).name,
+                                              'commitment': td.commitment.hex()}
+        if paginate:
+            return {'utxos': l, 'cursor': next_cursor}
         return l
 
     @command('n')
@@ -673,12 +713,19 @@ class Commands:
         return tx.as_dict()
 
     @command('w')
-    def history(self, year=0, show_addresses=False, show_fiat=False, use_net=False, timeout=30.0):
-        """Wallet history. Returns the transaction history of your wallet."""
+    def history(self, year=0, show_addresses=False, show_fiat=False, use_net=False, timeout=30.0,
+                limit=None, cursor=None, from_height=None, to_height=None):
+        """Wallet history. Returns the transaction history of your wallet. If
+        limit, cursor, from_height or to_height is given, returns a page of
+        the history, newest first, along with the cursor of the next (older)
+        page, which is null on the last page."""
         t0 = time.time()
         year, show_addresses, show_fiat, use_net, timeout = (
             int(year), bool(show_addresses), bool(show_fiat), bool(use_net),
             float(timeout) )
+        check_limit(limit)
+        paginate = not (limit is None and cursor is None and from_height is None and to_height is None)
+        before = decode_cursor('history', cursor) if cursor is not None else None
         def time_remaining(): return max(timeout - (time.time()-t0), 0)
         kwargs = { 'show_addresses'   : show_addresses,
                    'fee_calc_timeout' : timeout,
@@ -714,7 +761,16 @@ class Commands:
                 try: q.get(timeout=min(max(time_remaining()/2.0, 0.001), 10.0))
                 except queue.Empty: pass
                 kwargs['fee_calc_timeout'] = time_remaining()  # since we blocked above, recompute time_remaining for kwargs
-        return self.wallet.export_history(**kwargs)
+        if not paginate:
+            return self.wallet.export_history(**kwargs)
+        with self.wallet.lock:
+            start, stop = self.wallet.get_history_bounds(from_height=from_height, to_height=to_height, before=before)
+            page_start = max(start, stop - limit) if limit is not None else start
+            h = self.wallet.get_history(reverse=True, start=page_start, stop=stop)
+            next_key = self.wallet.get_history_key(h[-1].tx_hash) if h and page_start > start else None
+        kwargs['history'] = h
+        return {'history': self.wallet.export_history(**kwargs),
+                'cursor': encode_cursor('history', next_key) if next_key else None}
 
     @command('w')
     def setlabel(self, key, label):
@@ -743,10 +799,26 @@ class Commands:
         return results
 
     @command('w')
-    def listaddresses(self, receiving=False, change=False, labels=False, frozen=False, unused=False, funded=False, balance=False):
-        """List wallet addresses. Returns the list of all addresses in your wallet. Use optional arguments to filter the results."""
+    def listaddresses(self, receiving=False, change=False, labels=False, frozen=False, unused=False, funded=False, balance=False,
+                      limit=None, cursor=None):
+        """List wallet addresses. Returns the list of all addresses in your wallet. Use optional arguments to filter the results.
+        If limit or cursor is given, returns a page of addresses along with the cursor of the next page, which is null on the
+        last page."""
+        check_limit(limit)
+        paginate = limit is not None or cursor is not None
+        if receiving and not change:
+            addrs, for_change = self.wallet.get_receiving_addresses(), False
+        elif change and not receiving:
+            addrs, for_change = self.wallet.get_change_addresses(), True
+        else:
+            addrs, for_change = self.wallet.get_addresses(), None
+        start = 0
+        if cursor is not None:
+            after = Address.from_string(decode_cursor('listaddresses', cursor)[0])
+            start = self._address_position(addrs, after, for_change) + 1
         out = []
-        for addr in self.wallet.get_addresses():
+        next_cursor = None
+        for addr in itertools.islice(addrs, start, None):
             if frozen and not self.wallet.is_frozen(addr):
                 continue
             if receiving and self.wallet.is_change(addr):
@@ -757,6 +829,10 @@ class Commands:
                 continue
             if funded and self.wallet.is_empty(addr):
                 continue
+            if limit is not None and len(out) >= limit:
+                # there is a next page: addr is on it
+                next_cursor = encode_cursor('listaddresses', (out_addr.to_storage_string(),))
+                break
             item = addr.to_ui_string()
             if labels or balance:
                 item = (item,)
@@ -765,8 +841,32 @@ class Commands:
             if labels:
                 item += (repr(self.wallet.labels.get(addr.to_storage_string(), '')),)
             out.append(item)
+            out_addr = addr
+        if paginate:
+            return {'addresses': out, 'cursor': next_cursor}
         return out
 
+    def _address_position(self, addrs, addr, for_change):
+        """Returns the position of addr in addrs, the receiving addresses (for_change False), the change addresses
+        (True) or all the addresses (None) of the wallet. Deterministic wallets look it up in their address -> index
+        map rather than scanning the list."""
+        pos = None
+        if self.wallet.is_deterministic():
+            try:
+                is_change, i = self.wallet.get_address_index(addr)
+            except Exception:
+                pass
+            else:
+                if for_change is None:
+                    pos = len(self.wallet.get_receiving_addresses()) + i if is_change else i
+                elif is_change == for_change:
+                    pos = i
+        elif addr in addrs:
+            pos = addrs.index(addr)
+        if pos is None or pos >= len(addrs) or addrs[pos] != addr:
+            raise BaseException("Invalid cursor: address no longer in wallet")
+        return pos
+
     @command('n')
     def gettransaction(self, txid):
         """Retrieve a transaction. """
@@ -971,14 +1071,17 @@ command_options = {
     'expired':     (None, "Show only expired requests."),
     'fee':         ("-f", "Transaction fee (absolute, in FXX)"),
     'feerate':     (None, "Transaction fee rate (in sat/byte)"),
+    'cursor':      (None, "Continuation token returned with the previous page"),
     'force':       (None, "Create new address beyond gap limit, if no more addresses are available."),
     'from_addr':   ("-F", "Source address (must be a wallet address; use sweep to spend from non-wallet address)."),
+    'from_height': (None, "Only show items at or above this block height"),
     'frozen':      (None, "Show only frozen addresses"),
     'funded':      (None, "Show only funded addresses"),
     'imax':        (None, "Maximum number of inputs"),
     'index_url':   (None, 'Override the URL where you would like users to be shown the BIP70 Payment Request'),
     'labels':      ("-l", "Show the labels of listed addresses"),
     'language':    ("-L", "Default language for wordlist"),
+    'limit':       (None, "Maximum number of items to return, returns a page and a cursor for the next one"),
     'locktime':    (None, "Set locktime block number"),
     'memo':        ("-m", "Description of the request"),
     'nbits':       (None, "Number of bits of entropy"),
@@ -996,6 +1099,8 @@ command_options = {
     'seed_type':   (None, "The type of seed to create, currently: 'electrum' and 'bip39' is supported. Default 'bip39'."),
     'show_addresses': (None, "Show input and output addresses"),
     'show_fiat':   (None, "Show fiat value of transactions"),
+    'to_height':   (None, "Only show items below this block height, which excludes unconfirmed items"),
+    'token_category': (None, "Only show outputs with tokens of this category (hex)"),
     'timeout':     (None, "Timeout in seconds to wait for the overall operation to complete. Defaults to 30.0."),
     'unsigned':    ("-u", "Do not sign transaction"),
     'unused':      (None, "Show only unused addresses"),
@@ -1013,6 +1118,9 @@ arg_types = {
     'nbits': int,
     'imax': int,
     'year': int,
+    'limit': int,
+    'from_height': int,
+    'to_height': int,
     'entropy': int,
     'tx': tx_from_str,
     'pubkeys': json_loads,
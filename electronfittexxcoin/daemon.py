@@ -36,7 +36,7 @@ from .network import Network
 from .util import (json_decode, DaemonThread, print_error, to_string,
                    standardize_path)
 from .wallet import Wallet
-from .storage import WalletStorage
+from .storage import WalletStorage, delete_wallet_file
 from .commands import known_commands, Commands
 from .simple_config import SimpleConfig
 from .exchange_rate import FxThread
@@ -273,6 +273,8 @@ class Daemon(DaemonThread):
             return
         if storage.get_action():
             return
+        if self.config.get('wallet_journal') is not None:
+            storage.set_journal_enabled(self.config.get('wallet_journal'))
         wallet = Wallet(storage)
         wallet.start_threads(self.network)
         self.wallets[path] = wallet
@@ -287,10 +289,7 @@ class Daemon(DaemonThread):
 
     def delete_wallet(self, path):
         self.stop_wallet(path)
-        if os.path.exists(path):
-            os.unlink(path)
-            return True
-        return False
+        return delete_wallet_file(path)
 
     def stop_wallet(self, path):
         # Issue #659 wallet may already be stopped.
@@ -333,6 +332,7 @@ class Daemon(DaemonThread):
             self.server.handle_request() if self.server else time.sleep(0.1)
         for k, wallet in self.wallets.items():
             wallet.stop_threads()
+            wallet.storage.close()
         if self.network:
             self.print_error("shutting down network")
             self.network.stop()
@@ -139,4 +139,53 @@ def is_using_fast_ecc():
     return _patched_functions.monkey_patching_active
 
 
+
+def _verify_der_batch(items):
+    ctx = secp256k1.secp256k1.ctx
+    pubkey_parse = secp256k1.secp256k1.secp256k1_ec_pubkey_parse
+    parse_compact = secp256k1.secp256k1.secp256k1_ecdsa_signature_parse_compact
+    normalize = secp256k1.secp256k1.secp256k1_ecdsa_signature_normalize
+    ecdsa_verify = secp256k1.secp256k1.secp256k1_ecdsa_verify
+    sigdecode_der = ecdsa.util.sigdecode_der
+    order = ecdsa.curves.SECP256k1.order
+    sig = create_string_buffer(64)
+    parsed = {}
+    results = []
+    append = results.append
+    for pubkey, der_sig, msghash in items:
+        if not ((len(pubkey) == 33 and pubkey[0] in (2, 3)) or (len(pubkey) == 65 and pubkey[0] == 4)):
+            append(None)
+            continue
+        try:
+            # Decoded by python-ecdsa like the one at a time path, so that
+            # exactly the same encodings are accepted.
+            r, s = sigdecode_der(der_sig, order)
+            compact = r.to_bytes(32, byteorder="big") + s.to_bytes(32, byteorder="big")
+        except Exception:
+            append(False)
+            continue
+        pubkey_parsed = parsed.get(pubkey)
+        if pubkey_parsed is None:
+            pubkey_parsed = create_string_buffer(64)
+            if not pubkey_parse(ctx, pubkey_parsed, pubkey, len(pubkey)):
+                pubkey_parsed = False
+            parsed[pubkey] = pubkey_parsed
+        if pubkey_parsed is False or not parse_compact(ctx, sig, compact):
+            append(False)
+            continue
+        normalize(ctx, sig, sig)
+        append(ecdsa_verify(ctx, sig, msghash, pubkey_parsed) == 1)
+    return results
+
+
+def verify_der_batch(items, *, threads=None):
+    ''' Verifies many DER encoded ECDSA signatures with libsecp256k1.
+    `items` is an iterable of (pubkey, der_sig, msghash) tuples of bytes
+    objects. Returns a list with one result per item: True or False, or None
+    for items with a pubkey in an unusual encoding, which are left to the
+    caller to verify one at a time. Requires is_using_fast_ecc(). '''
+    if not _patched_functions.monkey_patching_active:
+        raise Exception("libsecp256k1 is not in use")
+    return secp256k1.run_batch(_verify_der_batch, items, threads)
+
 _prepare_monkey_patching_of_python_ecdsa_internals_with_libsecp256k1()
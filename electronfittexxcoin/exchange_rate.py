@@ -535,6 +535,21 @@ class FxThread(ThreadJob):
             self.history_used_spot = True
         return PyDecimal(rate) if rate is not None else None
 
+    def history_rates(self, d_ts):
+        ''' Returns the list of history_rate() for each datetime in d_ts, looking
+        up each distinct day only once. None entries give a None rate. '''
+        by_day = {}
+        rates = []
+        for d_t in d_ts:
+            if d_t is None:
+                rates.append(None)
+                continue
+            day = d_t.date()
+            if day not in by_day:
+                by_day[day] = self.history_rate(d_t)
+            rates.append(by_day[day])
+        return rates
+
     def historical_value_str(self, satoshis, d_t):
         rate = self.history_rate(d_t)
         return self.value_str(satoshis, rate)
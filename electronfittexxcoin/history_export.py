@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+#
+# Electron Cash - A Fittexxcoin SPV Wallet
+# License: MIT License
+#
+''' Streaming wallet history export.
+
+write_history() writes the items of Abstract_Wallet.iter_export_history to a
+file-like object as they are produced, so that exporting a huge history does
+not need to hold the whole history (nor the whole output) in memory. '''
+
+import csv
+import json
+
+from .address import Address
+
+FORMATS = ('csv', 'json', 'jsonl')
+
+_FIAT_FIELDS = ('fiat_value', 'fiat_balance', 'fiat_fee')
+
+
+def _filtered_addresses(addrs):
+    return ','.join(x for x in (addrs or []) if Address.is_valid(x))
+
+
+def csv_header(ccy, has_fiat_columns, show_addresses):
+    cols = ["transaction_hash", "label", "confirmations", "value", "fee", "timestamp"]
+    if has_fiat_columns:
+        cols += [f"fiat_value_{ccy}", f"fiat_balance_{ccy}", f"fiat_fee_{ccy}"]  # in CSV mode, we use column names eg fiat_value_USD, etc
+    if show_addresses:
+        cols += ["input_addresses", "output_addresses"]
+    return cols
+
+
+def csv_row(item, has_fiat_columns, show_addresses):
+    cols = [item['txid'], item.get('label', ''), item['confirmations'], item['value'], item['fee'], item['date']]
+    if has_fiat_columns:
+        cols += [item['fiat_value'], item['fiat_balance'], item['fiat_fee']]
+    if show_addresses:
+        cols.append(_filtered_addresses(item.get('input_addresses')))
+        cols.append(_filtered_addresses(item.get('output_addresses')))
+    return cols
+
+
+def write_history(wallet, sink, fmt='csv', *, fx=None, show_addresses=False, **kwargs):
+    ''' Exports the history of `wallet` to the text file-like object `sink`
+    in format `fmt`, one of FORMATS. 'json' writes a single (indented) array,
+    as the GUI always did, 'jsonl' writes one json object per line.
+
+    Fiat columns are included if `fx` is given and has history rates
+    enabled. The remaining keyword args are passed on to
+    wallet.iter_export_history (progress_callback, cancel_event, etc).
+    Returns the number of items written. '''
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown history export format: {fmt}")
+    has_fiat_columns = bool(fx and fx.show_history())
+    ccy = (fx and fx.get_currency()) or ''
+    items = wallet.iter_export_history(fx=fx if has_fiat_columns else None,
+                                       show_addresses=show_addresses, **kwargs)
+    n = 0
+    if fmt == 'csv':
+        writer = csv.writer(sink, lineterminator='\n')
+        writer.writerow(csv_header(ccy, has_fiat_columns, show_addresses))
+        for item in items:
+            writer.writerow(csv_row(item, has_fiat_columns, show_addresses))
+            n += 1
+        return n
+    for item in items:
+        if has_fiat_columns and ccy:
+            item['fiat_currency'] = ccy  # add the currency to each entry in the json. this wastes space but json is bloated anyway so this won't hurt too much, we hope
+        elif not has_fiat_columns:
+            # No need to include these fields as they will always be 'No Data'
+            for k in _FIAT_FIELDS:
+                item.pop(k, None)
+        if fmt == 'jsonl':
+            sink.write(json.dumps(item))
+            sink.write('\n')
+        else:
+            # Same output as json.dumps(list_of_items, indent=4), one item at a time
+            sink.write(',\n    ' if n else '[\n    ')
+            sink.write(json.dumps(item, indent=4).replace('\n', '\n    '))
+        n += 1
+    if fmt == 'json':
+        sink.write('\n]' if n else '[]')
+    return n
@@ -22,6 +22,7 @@
 # ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
+import json
 import os
 import re
 import requests
@@ -34,6 +35,7 @@ import traceback
 
 from typing import Optional, Tuple
 from collections import namedtuple
+from operator import itemgetter
 
 from pathvalidate import sanitize_filename
 
@@ -56,7 +58,8 @@ def Connection(server, queue, config_path, callback=None):
 
     Once the thread has connected, it finishes, placing a tuple on the
     queue of the form (server, socket), where socket is None if
-    connection failed.
+    connection failed. It then calls its on_done attribute, if set (use
+    `callback` to set it).
     """
     host, port, protocol = server.rsplit(':', 2)
     if not protocol in 'st':
@@ -84,6 +87,7 @@ class TcpConnection(threading.Thread, util.PrintError):
         self.port = int(self.port)
         self.use_ssl = (self.protocol == 's')
         self.daemon = True
+        self.on_done = None  # called once the result was put on the queue
 
     def diagnostic_name(self):
         return self.host
@@ -290,6 +294,8 @@ class TcpConnection(threading.Thread, util.PrintError):
         if socket:
             self.print_error("connected")
         self.queue.put((self.server, socket))
+        if self.on_done:
+            self.on_done()
 
 
 class Interface(util.PrintError):
@@ -297,10 +303,26 @@ class Interface(util.PrintError):
     electrum server.  It's exposed API is:
 
     - Member functions close(), fileno(), get_responses(), has_timed_out(),
-      ping_required(), queue_request(), send_requests()
+      ping_required(), queue_request(), send_requests(), set_batching()
     - Member variable server.
+
+    Once batching is enabled, queued requests are sent as JSON-RPC batches
+    (arrays of requests) of up to BATCH_MAX_BYTES, and the responses in the
+    batch responses are matched back to their requests by id. The number of
+    unanswered requests is limited by a window which adapts to the latency
+    and error rate of the server, see num_requests().
     """
 
+    BATCH_MAX_BYTES = 64 * 1024  # max. size of a JSON-RPC batch we send
+    BATCH_MAX_REQUESTS = 100  # max. number of requests in a batch
+    MIN_WINDOW = 10  # the adaptive window never shrinks below this
+    # The window shrinks if the latency of the responses gets above
+    # min. latency * LATENCY_FACTOR + LATENCY_SLACK secs, or if more than
+    # MAX_ERROR_RATE of the responses are errors.
+    LATENCY_FACTOR = 4
+    LATENCY_SLACK = 0.25
+    MAX_ERROR_RATE = 0.2
+
     MODE_DEFAULT = 'default'
     MODE_BACKWARD = 'backward'
     MODE_BINARY = 'binary'
@@ -323,6 +345,15 @@ class Interface(util.PrintError):
 
         self.mode = None
 
+        self.batching = False
+        self.batched_ids = set()  # wire ids of the unanswered requests that were sent in a batch
+        self.send_times = {}  # wire id -> time the request was sent
+        self.window = None  # limit on unanswered requests, adapted in _on_response()
+        self.latency = None  # moving average of the response latency
+        self.min_latency = None
+        self.error_rate = 0.0  # moving average of the fraction of error responses
+        self.last_decrease = 0.0
+
     def __repr__(self):
         return "<{}.{} {}>".format(__name__, type(self).__name__, self.format_address())
 
@@ -337,7 +368,7 @@ class Interface(util.PrintError):
         return self.host
 
     def fileno(self):
-        # Needed for select
+        # Needed for the network event loop
         return self.socket.fileno()
 
     def close(self):
@@ -356,6 +387,13 @@ class Interface(util.PrintError):
         self.request_time = time.time()
         self.unsent_requests.append(args)
 
+    def set_batching(self, b):
+        """Enable or disable sending requests in JSON-RPC batches. Batching
+        should only be enabled once the server answered server.version."""
+        b = bool(b)
+        if b != self.batching:
+            self.print_error("batching", "enabled" if b else "disabled")
+        self.batching = b
 
     ReqThrottleParams = namedtuple("ReqThrottleParams", "max chunkSize")
     req_throttle_default = ReqThrottleParams(2000, 100)
@@ -380,13 +418,67 @@ class Interface(util.PrintError):
         config.set_key("network_unanswered_requests_throttle", l)
 
     def num_requests(self):
-        """If there are more than tup.max (default: 2000) unanswered requests,
-        don't send any more. Otherwise send more requests, but not more than tup.chunkSize
-        (default: 100) at a time."""
+        """Returns the number of queued requests that may be sent now. The
+        number of unanswered requests is limited by an adaptive window, which
+        starts at tup.chunkSize (default: 100) and may grow up to tup.max
+        (default: 2000) unanswered requests while the server keeps up."""
         tup = self.get_req_throttle_params(self.config)
-        if len(self.unanswered_requests) >= tup.max:
-            return 0
-        return min(tup.chunkSize, len(self.unsent_requests))
+        if self.window is None:
+            self.window = tup.chunkSize
+        room = min(self.window, tup.max) - len(self.unanswered_requests)
+        return max(0, min(room, len(self.unsent_requests)))
+
+    def _on_response(self, wire_id, is_error):
+        """Adapts the window to the latency and error rate of the server:
+        grow it by one per good response (which doubles it every round trip)
+        and halve it at most once per round trip while the server is slow or
+        failing."""
+        now = time.time()
+        self.error_rate = 0.95 * self.error_rate + (0.05 if is_error else 0.0)
+        sent = self.send_times.pop(wire_id, None)
+        if sent is None or self.window is None:
+            return
+        latency = now - sent
+        self.latency = latency if self.latency is None else 0.9 * self.latency + 0.1 * latency
+        self.min_latency = latency if self.min_latency is None else min(self.min_latency, latency)
+        tup = self.get_req_throttle_params(self.config)
+        if (self.error_rate > self.MAX_ERROR_RATE
+                or self.latency > self.min_latency * self.LATENCY_FACTOR + self.LATENCY_SLACK):
+            if now - self.last_decrease > self.latency:
+                self.last_decrease = now
+                self.window = max(min(self.MIN_WINDOW, tup.max), self.window // 2)
+                if self.debug:
+                    self.print_error("window decreased to {} (latency {:.3f} error rate {:.2f})"
+                                     .format(self.window, self.latency, self.error_rate))
+        elif self.window < tup.max and self.unsent_requests:
+            # only grow while requests are waiting for room in the window
+            self.window += 1
+
+    def _frame_requests(self, wire_requests):
+        """Returns the bytes to send for the (method, params, id) requests:
+        one JSON object per line, or if batching, JSON arrays of requests of
+        up to BATCH_MAX_BYTES (a request bigger than that is sent alone)."""
+        encoded = [json.dumps({'method': m, 'params': p, 'id': i}).encode('utf8')
+                   for m, p, i in wire_requests]
+        if not self.batching:
+            return b''.join(e + b'\n' for e in encoded)
+        out = bytearray()
+        start = size = 0
+        for n, e in enumerate(encoded):
+            if n > start and (size + len(e) + 1 > self.BATCH_MAX_BYTES or n - start >= self.BATCH_MAX_REQUESTS):
+                self._append_batch(out, encoded, wire_requests, start, n)
+                start, size = n, 0
+            size += len(e) + 1
+        if start < len(encoded):
+            self._append_batch(out, encoded, wire_requests, start, len(encoded))
+        return bytes(out)
+
+    def _append_batch(self, out, encoded, wire_requests, start, stop):
+        if stop - start == 1:
+            out += encoded[start] + b'\n'
+            return
+        out += b'[' + b','.join(encoded[start:stop]) + b']\n'
+        self.batched_ids.update(r[2] for r in wire_requests[start:stop])
 
     def send_requests(self):
         """Sends queued requests. Returns False on failure."""
@@ -399,11 +491,10 @@ class Interface(util.PrintError):
                 return True
 
             self.last_send = time.time()
-            make_dict = fittexxcoin m, p, i: {'method': m, 'params': p, 'id': i}
             n = self.num_requests()
             wire_requests = self.unsent_requests[0:n]
 
-            self.pipe.send_all([make_dict(*r) for r in wire_requests])
+            self.pipe.send_raw(self._frame_requests(wire_requests))
         except util.timeout:
             # this is OK, the send is in the pipe and we'll flush it out
             # eventually.
@@ -416,12 +507,30 @@ class Interface(util.PrintError):
             return False
 
         self.unsent_requests = self.unsent_requests[n:]
+        now = time.time()
         for request in wire_requests:
             if self.debug:
                 self.print_error("-->", request)
             self.unanswered_requests[request[2]] = request
+            self.send_times[request[2]] = now
         return True
 
+    def _batch_rejected(self):
+        """The server answered a batch with an error without id, so it does
+        not support batches: disable batching and queue the requests that
+        were sent in batches again."""
+        self.print_error("server rejected a batch request, disabling batching")
+        self.set_batching(False)
+        requeue = []
+        for wire_id in self.batched_ids:
+            request = self.unanswered_requests.pop(wire_id, None)
+            self.send_times.pop(wire_id, None)
+            if request:
+                requeue.append(request)
+        self.batched_ids.clear()
+        requeue.sort(key=itemgetter(2))
+        self.unsent_requests[0:0] = requeue
+
     def ping_required(self):
         """Returns True if a ping should be sent."""
         return time.time() - self.last_send > PING_INTERVAL
@@ -446,9 +555,9 @@ class Interface(util.PrintError):
         """
         responses = []
         while True:
-            response = None
+            message = None
             try:
-                response = self.pipe.get()
+                message = self.pipe.get()
             except util.timeout:
                 break
             except self.pipe.Closed as e:
@@ -456,50 +565,76 @@ class Interface(util.PrintError):
             except Exception as e:
                 traceback.print_exc(file=sys.stderr)
 
-            if not isinstance(response, dict):
-                # time to close this connection.
-                if response is not None:
-                    self.print_error("received non-object type {}".format(type(response)))
-                # signal that this connection is done.
-                responses.append((None, None))
-                break
-
-            if self.debug:
-                self.print_error("<--", response)
-            wire_id = response.get('id', None)
-            if wire_id is None:  # Notification
-                if not isinstance(response.get('method'), str):  # defend against funny/out-of-spec JSON
-                    if response.get('error'):
-                        # Fulcrum servers versions 1.0.1 and earlier sometimes
-                        # would send spurious 'error' messages with id=null and
-                        # no 'method'. This would only happen on idle timeout
-                        # of the client.  We will tolerate this and simply
-                        # discard the message in that case.
-                        #
-                        # Electron Cash:
-                        #   https://github.com/fittexxcoinblockchain/electron-fittexxcoin/issues/1774
-                        # Fulcrum:
-                        #   https://github.com/cculianu/Fulcrum/issues/20
-                        self.print_error("Ignoring spurious error message from server:", response.get('error'))
-                        continue
-                    else:
-                        # Malforned notification -- signal bad server
-                        self.print_error("Server sent us a notification message without a 'method':", response)
-                        responses.append((None, None))  # Signal
-                        break
-                # At this point the notification has a 'method' defined, so we know it's good.
-                responses.append((None, response))
+            if isinstance(message, list) and message:
+                # A batch response: each element is the response to one of
+                # the requests of the batch, in any order.
+                if self.debug:
+                    self.print_error("<-- batch of", len(message))
+                batch = message
             else:
-                request = self.unanswered_requests.pop(wire_id, None)
-                if request:
-                    responses.append((request, response))
-                else:
-                    self.print_error("unknown wire ID", wire_id)
-                    responses.append((None, None))  # Signal
+                batch = (message,)
+            ok = True
+            for response in batch:
+                if not self._add_response(response, responses):
+                    ok = False
                     break
+            if not ok:
+                break
 
         return responses
 
+    def _add_response(self, response, responses):
+        """Appends the (request, response) pair for the message `response`
+        to `responses`. Returns False if the connection is to be closed (in
+        which case a (None, None) was appended)."""
+        if not isinstance(response, dict):
+            # time to close this connection.
+            if response is not None:
+                self.print_error("received non-object type {}".format(type(response)))
+            # signal that this connection is done.
+            responses.append((None, None))
+            return False
+
+        if self.debug:
+            self.print_error("<--", response)
+        wire_id = response.get('id', None)
+        if wire_id is None:  # Notification
+            if not isinstance(response.get('method'), str):  # defend against funny/out-of-spec JSON
+                if response.get('error'):
+                    if self.batching and self.batched_ids:
+                        self._batch_rejected()
+                        return True
+                    # Fulcrum servers versions 1.0.1 and earlier sometimes
+                    # would send spurious 'error' messages with id=null and
+                    # no 'method'. This would only happen on idle timeout
+                    # of the client.  We will tolerate this and simply
+                    # discard the message in that case.
+                    #
+                    # Electron Cash:
+                    #   https://github.com/fittexxcoinblockchain/electron-fittexxcoin/issues/1774
+                    # Fulcrum:
+                    #   https://github.com/cculianu/Fulcrum/issues/20
+                    self.print_error("Ignoring spurious error message from server:", response.get('error'))
+                    return True
+                else:
+                    # Malforned notification -- signal bad server
+                    self.print_error("Server sent us a notification message without a 'method':", response)
+                    responses.append((None, None))  # Signal
+                    return False
+            # At this point the notification has a 'method' defined, so we know it's good.
+            responses.append((None, response))
+        else:
+            request = self.unanswered_requests.pop(wire_id, None)
+            if request:
+                self.batched_ids.discard(wire_id)
+                self._on_response(wire_id, bool(response.get('error')))
+                responses.append((request, response))
+            else:
+                self.print_error("unknown wire ID", wire_id)
+                responses.append((None, None))  # Signal
+                return False
+        return True
+
 
 def check_cert(host, cert):
     try:
@@ -25,6 +25,7 @@
 # SOFTWARE.
 
 import inspect
+from functools import lru_cache
 from typing import Optional
 from . import bitcoin
 from .bitcoin import *
@@ -279,6 +280,14 @@ class Deterministic_KeyStore(Software_KeyStore):
         return pw_decode(self.passphrase, password) if self.passphrase else ''
 
 
+@lru_cache(maxsize=256)
+def _xpub_node(xpub, net):
+    ''' The chain code and public key of xpub, deserialized once for all
+    the keys derived from it. '''
+    _, _, _, _, c, cK = deserialize_xpub(xpub, net=net)
+    return c, cK
+
+
 class Xpub:
 
     def __init__(self):
@@ -294,7 +303,7 @@ class Xpub:
     def get_master_public_key(self):
         return self.xpub
 
-    def derive_pubkey(self, for_change, n):
+    def _branch_xpub(self, for_change):
         xpub = self.xpub_change if for_change else self.xpub_receive
         if xpub is None:
             xpub = bip32_public_derivation(self.xpub, "", "/%d"%for_change)
@@ -302,11 +311,20 @@ class Xpub:
                 self.xpub_change = xpub
             else:
                 self.xpub_receive = xpub
-        return self.get_pubkey_from_xpub(xpub, (n,))
+        return xpub
+
+    def derive_pubkey(self, for_change, n):
+        return self.derive_pubkey_range(for_change, n, n + 1)[0]
+
+    def derive_pubkey_range(self, for_change, start, stop):
+        ''' Returns the pubkeys (hex) of indices start to stop - 1 of the
+        receiving or change branch, derived in bulk. '''
+        c, cK = _xpub_node(self._branch_xpub(for_change), networks.net)
+        return [bh2u(K) for K in CKD_pub_range(cK, c, start, stop)]
 
     @classmethod
     def get_pubkey_from_xpub(self, xpub, sequence):
-        _, _, _, _, c, cK = deserialize_xpub(xpub)
+        c, cK = _xpub_node(xpub, networks.net)
         for i in sequence:
             cK, c = CKD_pub(cK, c, i)
         return bh2u(cK)
@@ -542,6 +560,9 @@ class Old_KeyStore(Deterministic_KeyStore):
     def derive_pubkey(self, for_change, n):
         return self.get_pubkey_from_mpk(self.mpk, for_change, n)
 
+    def derive_pubkey_range(self, for_change, start, stop):
+        return [self.derive_pubkey(for_change, n) for n in range(start, stop)]
+
     def get_private_key_from_stretched_exponent(self, for_change, n, secexp):
         order = generator_secp256k1.order()
         secexp = (secexp + self.get_sequence(self.mpk, for_change, n)) % order
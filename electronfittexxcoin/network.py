@@ -22,15 +22,14 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import asyncio
 import time
 import queue
 import os
 import stat
-import errno
 import random
 import re
-import select
-from collections import defaultdict
+from collections import defaultdict, deque
 import threading
 import socket
 import json
@@ -44,6 +43,9 @@ from . import networks
 from .i18n import _
 from .interface import Connection, Interface
 from . import blockchain
+from .caches import ByteBudgetCache
+from .transaction import Transaction
+from .tx_store import TxStore
 from . import version
 from .tor import TorController, check_proxy_bypass_tor_control
 from .utils import Event
@@ -214,6 +216,12 @@ class Network(util.DaemonThread):
     Connections are initiated by a Connection() thread which stops once
     the connection succeeds or fails.
 
+    The network thread runs an asyncio event loop which waits on the sockets
+    of all the connected interfaces, and which is woken up as soon as a
+    response arrives or a request is queued from another thread (see
+    wakeup()). All responses and callbacks are processed in the network
+    thread, as are the jobs (Synchronizer, Verifier, etc).
+
     Our external API:
 
     - Member functions get_header(), get_interfaces(), get_local_height(),
@@ -229,6 +237,21 @@ class Network(util.DaemonThread):
     SERVER_RETRY_INTERVAL = 10  # How often to reconnect when server down in secs
     MAX_MESSAGE_BYTES = 1024*1024*32 # = 32MB. The message size limit in bytes. This is to prevent a DoS vector whereby the server can fill memory with garbage data.
 
+    # Methods for which identical (method, params) requests that are in
+    # flight at the same time share a single request to the server. Only
+    # queries whose answer doesn't change over time: a follower of e.g. a
+    # get_history request could otherwise get an answer computed before the
+    # change that made it ask.
+    DEDUP_METHODS = frozenset((
+        'blockchain.transaction.get', 'blockchain.transaction.get_merkle',
+        'blockchain.block.header',
+    ))
+    RESPONSE_CACHE_BYTES = 16 * 1024 * 1024  # default size of self.response_cache
+    TX_STORE_BYTES = 64 * 1024 * 1024  # default size of self.tx_store
+    # Missing headers before the checkpoint which are at most this far apart
+    # are fetched in one request, see request_checkpoint_headers.
+    SPARSE_HEADERS_GAP = 16
+
     tor_controller: TorController = None
 
     def __init__(self, config=None):
@@ -260,7 +283,28 @@ class Network(util.DaemonThread):
         self.pending_sends_lock = threading.Lock()
 
         self.pending_sends = []
+        self.pending_replies = []  # (callback, response) answered from the cache, needs pending_sends_lock
         self.message_id = util.Monotonic(locking=True)
+        # In-flight request deduplication, see queue_request()
+        self.inflight_lock = threading.Lock()
+        self.inflight = {}  # (method, repr(params)) -> message_id of the request sent to the server
+        self.inflight_keys = {}  # message_id -> its key in self.inflight
+        self.inflight_followers = {}  # message_id -> message_ids of the requests waiting on it
+        # Header chunk sync, see on_block_headers()
+        self.chunk_verifier = blockchain.ChunkVerifier(self.config.get('header_verify_processes',
+                                                                       min(4, (os.cpu_count() or 1) - 1)))
+        self.verifying_chunks = deque()  # (interface, base_height, count, chunk_data, future) in order of arrival
+        self.prefetched_chunks = defaultdict(set)  # interface -> base heights of the header chunks requested ahead
+        # Responses to immutable requests (raw transactions by txid), shared
+        # by all the wallets using this network.
+        self.response_cache = ByteBudgetCache(self.config.get('network_response_cache_bytes', self.RESPONSE_CACHE_BYTES),
+                                              name="Network.response_cache")
+        # ... and on disk, so they survive a restart. Also used by Transaction.tx_cache_get
+        self.tx_store = None
+        if self.config.path:
+            self.tx_store = TxStore(os.path.join(self.config.path, 'cache', 'transactions'),
+                                    self.config.get('tx_store_max_bytes', self.TX_STORE_BYTES))
+            Transaction.tx_store = self.tx_store
         self.verified_checkpoint = False
         self.verifications_required = 0
         # If the height is cleared from the network constants, we're
@@ -302,7 +346,13 @@ class Network(util.DaemonThread):
         self.auto_connect = self.config.get('auto_connect', DEFAULT_AUTO_CONNECT)
         self.connecting = set()
         self.requested_chunks = set()
+        self.requested_headers = {}  # height -> Interface, see request_checkpoint_headers()
         self.socket_queue = queue.Queue()
+        # The asyncio event loop of the network thread, see run()
+        self.loop = None
+        self.wakeup_event = None
+        self._readers = {}  # fd -> Interface whose socket is watched for reading
+        self._writers = set()  # fds watched for writing
         if Network.INSTANCE:
             # This happens on iOS which kills and restarts the daemon on app sleep/wake
             self.print_error("A new instance has started and is replacing the old one.")
@@ -456,6 +506,11 @@ class Network(util.DaemonThread):
         on a random, currently active (connected) interface.  Otherwise
         `interface` should be None or a valid Interface instance.
 
+        Requests with a callback may be answered without asking the server:
+        immutable results are answered from self.response_cache, and a
+        request for one of DEDUP_METHODS which is identical to a request
+        already in flight on the main interface gets the response of that
+        request.
 
         If no interface is available:
             - If `callback` is supplied: the request will be enqueued and sent
@@ -472,7 +527,24 @@ class Network(util.DaemonThread):
             if max_qlen and len(self.unanswered_requests) >= max_qlen:
                 # Indicate to client code we are busy
                 return None
+            result = self.get_cached_result(method, params)
+            if result is not None:
+                with self.pending_sends_lock:
+                    self.pending_replies.append((callback, {'id': message_id, 'method': method,
+                                                            'params': params, 'result': result}))
+                self.wakeup()
+                return message_id
             self.unanswered_requests[message_id] = [method, params, callback]
+            if method in self.DEDUP_METHODS and interface is self.interface:
+                key = (method, repr(params))
+                with self.inflight_lock:
+                    primary = self.inflight.get(key)
+                    if primary is not None:
+                        # wait for the response to the identical request in flight
+                        self.inflight_followers.setdefault(primary, []).append(message_id)
+                        return message_id
+                    self.inflight[key] = message_id
+                    self.inflight_keys[message_id] = key
             if not interface:
                 # Request was queued -- it should get sent if/when we get
                 # an interface in the future
@@ -484,10 +556,66 @@ class Network(util.DaemonThread):
         interface.queue_request(method, params, message_id)
         if self is not Network.INSTANCE:
             self.print_error("*** WARNING: queueing request on a stale instance!")
+        self.wakeup()
         return message_id
 
+    @staticmethod
+    def _is_cacheable(method, params):
+        return method == 'blockchain.transaction.get' and len(params) in (1, 2) and not params[1:] == [True]
+
+    def get_cached_result(self, method, params):
+        """Returns the cached result of an immutable request, or None."""
+        if self._is_cacheable(method, params):
+            result = self.response_cache.get(params[0])
+            if result is None and self.tx_store is not None:
+                result = self.tx_store.get(params[0])
+                if result is not None:
+                    self.response_cache.put(params[0], result)
+            return result
+
+    def _cache_result(self, method, params, result):
+        if self._is_cacheable(method, params) and isinstance(result, str):
+            try:
+                # Never cache (and serve to other wallets) a phony tx
+                if Hash(bytes.fromhex(result))[::-1].hex() != params[0]:
+                    return
+            except (ValueError, TypeError):
+                return
+            self.response_cache.put(params[0], result)
+            if self.tx_store is not None:
+                self.tx_store.put(params[0], result)
+
+    def _pop_followers(self, message_id):
+        """Returns the callbacks of the requests which were waiting for the
+        response to request message_id, see queue_request()."""
+        with self.inflight_lock:
+            key = self.inflight_keys.pop(message_id, None)
+            if key is None:
+                return []
+            if self.inflight.get(key) == message_id:
+                del self.inflight[key]
+            follower_ids = self.inflight_followers.pop(message_id, ())
+        callbacks = []
+        for follower_id in follower_ids:
+            client_req = self.unanswered_requests.pop(follower_id, None)
+            if client_req:  # may have been cancelled meanwhile
+                callbacks.append(client_req[2])
+        return callbacks
+
+    def process_pending_replies(self):
+        with self.pending_sends_lock:
+            replies = self.pending_replies
+            self.pending_replies = []
+        for callback, response in replies:
+            callback(response)
+
     def send_subscriptions(self):
         self.sub_cache.clear()
+        with self.inflight_lock:
+            # the requests below are sent again, and deduplicated again
+            self.inflight.clear()
+            self.inflight_keys.clear()
+            self.inflight_followers.clear()
         # Resend unanswered requests
         old_reqs = self.unanswered_requests
         self.unanswered_requests = {}
@@ -603,8 +731,10 @@ class Network(util.DaemonThread):
                 self.print_error("connecting to %s as new interface" % server_key)
                 self.set_status('connecting')
             self.connecting.add(server_key)
-            c = Connection(server_key, self.socket_queue, self.config.path,
-                           fittexxcoin x: x.bad_certificate.append_weak(self.on_bad_certificate))
+            def on_connection(c):
+                c.bad_certificate.append_weak(self.on_bad_certificate)
+                c.on_done = self.wakeup
+            c = Connection(server_key, self.socket_queue, self.config.path, on_connection)
 
     def get_unavailable_servers(self):
         exclude_set = set(self.interfaces)
@@ -779,6 +909,11 @@ class Network(util.DaemonThread):
                     self.interfaces.pop(interface.server)
                 if interface.server == self.default_server:
                     self.interface = None
+                if threading.current_thread() is self:
+                    self._unwatch_interface(interface)
+                self.prefetched_chunks.pop(interface, None)
+                for height in [h for h, i in self.requested_headers.items() if i is interface]:
+                    del self.requested_headers[height]
                 interface.close()
 
     def add_recent_server(self, server):
@@ -880,10 +1015,14 @@ class Network(util.DaemonThread):
                 # callback, are only sent to the current interface,
                 # and are placed in the unanswered_requests dictionary
                 client_req = self.unanswered_requests.pop(message_id, None)
-                if client_req:
+                followers = self._pop_followers(message_id)
+                if client_req or followers:
                     if interface != self.interface:
                         self.print_error("advisory: response from non-primary {}".format(interface))
-                    callbacks = [client_req[2]]
+                    callbacks = [client_req[2]] if client_req else []
+                    callbacks += followers
+                    if response.get('error') is None:
+                        self._cache_result(method, params, response.get('result'))
                 else:
                     # fixme: will only work for subscriptions
                     k = self.get_index(method, params)
@@ -967,6 +1106,7 @@ class Network(util.DaemonThread):
         if messages:
             with self.pending_sends_lock:
                self.pending_sends.append((messages, callback))
+            self.wakeup()
 
     def process_pending_sends(self):
         # Requests needs connectivity.  If we don't have an interface,
@@ -1026,6 +1166,15 @@ class Network(util.DaemonThread):
                     idx += 1
         return ct, nmsgs
 
+    def _cancel_pending_replies(self, callback, *, method=None, params=None) -> int:
+        with self.pending_sends_lock:
+            n = len(self.pending_replies)
+            self.pending_replies = [(cb, r) for cb, r in self.pending_replies
+                                    if not (cb == callback
+                                            and (method is None or r['method'] == method)
+                                            and (params is None or r['params'] == params))]
+            return n - len(self.pending_replies)
+
     def unsubscribe(self, callback):
         """Unsubscribe a callback to free object references to enable GC.
         It is advised that this function only be called from the network thread
@@ -1067,6 +1216,7 @@ class Network(util.DaemonThread):
                     # knows what future programmers may do. :)
                     self.unanswered_requests.pop(message_id, None)
                     ct += 1
+        ct += self._cancel_pending_replies(callback, method=method, params=params)
         ct2, ct3 = self._cancel_pending_sends(callback, method=method, params=params)
         if ct or ct2 or ct3:
             qname = getattr(callback, '__qualname__', repr(callback))
@@ -1171,6 +1321,41 @@ class Network(util.DaemonThread):
         chunk_count = 2016
         return self.request_headers(interface, chunk_base_height, chunk_count, silent=True)
 
+    def request_checkpoint_headers(self, interface, heights):
+        ''' Requests the headers at the given heights at or before the
+        checkpoint, with proofs against it. Used for the headers we do not
+        have: the headers file is only filled there on demand.
+
+        In sparse mode (config 'header_sparse_mode', the default) only the
+        headers asked for are fetched, in runs of nearby heights. Otherwise
+        the whole chunks of 2016 headers containing them are. Returns the
+        number of requests sent. '''
+        cp_height = networks.net.VERIFICATION_BLOCK_HEIGHT
+        if cp_height is None:
+            return 0
+        heights = sorted({h for h in heights if 0 < h <= cp_height})
+        if not self.config.get('header_sparse_mode', True):
+            return sum(1 for index in sorted({h // 2016 for h in heights})
+                       if self.request_chunk(interface, index))
+        n = 0
+        heights = [h for h in heights if h not in self.requested_headers]
+        for base_height, count in blockchain.height_ranges(heights, self.SPARSE_HEADERS_GAP):
+            if count == 1:
+                sent = self.request_header(interface, base_height)
+            else:
+                interface.print_error("requesting headers {} to {}".format(base_height, base_height + count - 1))
+                sent = self._request_headers(interface, base_height, count, cp_height)
+            if not sent:
+                break
+            for height in range(base_height, base_height + count):
+                self.requested_headers[height] = interface
+            n += 1
+        return n
+
+    def _clear_requested_headers(self, base_height, count):
+        for height in range(base_height, base_height + count):
+            self.requested_headers.pop(height, None)
+
     def request_headers(self, interface, base_height, count, silent=False):
         if not silent:
             interface.print_error("requesting multiple consecutive headers, from {} count {}".format(base_height, count))
@@ -1206,6 +1391,10 @@ class Network(util.DaemonThread):
             # Ensure the chunk can be rerequested, but only if the request originated from us.
             if request and request[1][0] // 2016 in self.requested_chunks:
                 self.requested_chunks.remove(request[1][0] // 2016)
+            if request:
+                self._clear_requested_headers(request[1][0], request[1][1])
+                # A failed request ahead must be made again once the chunk before it connects
+                self._discard_prefetched(interface, request[1][0])
             return
 
         # Ignore unsolicited chunks
@@ -1218,6 +1407,7 @@ class Network(util.DaemonThread):
             return
         if index in self.requested_chunks:
             self.requested_chunks.remove(index)
+        self._clear_requested_headers(request_base_height, expected_header_count)
 
         header_hexsize = blockchain.HEADER_SIZE * 2
         hexdata = result['hex']
@@ -1225,6 +1415,7 @@ class Network(util.DaemonThread):
         # We accept less headers than we asked for, to cover the case where the distance to the tip was unknown.
         if actual_header_count > expected_header_count:
             interface.print_error("chunk data size incorrect expected_size={} actual_size={}".format(expected_header_count * header_hexsize, len(hexdata)))
+            self._discard_prefetched(interface, request_base_height)
             return
 
         proof_was_provided = False
@@ -1270,17 +1461,72 @@ class Network(util.DaemonThread):
                 return
             # We connect this verification chunk into the longest chain.
             target_blockchain = self.blockchains[0]
+        elif proof_was_provided and request_base_height + actual_header_count - 1 <= networks.net.VERIFICATION_BLOCK_HEIGHT:
+            # Headers before the checkpoint are in the longest chain.
+            target_blockchain = self.blockchains[0]
         else:
             target_blockchain = interface.blockchain
 
         chunk_data = bfh(hexdata)
-        connect_state = (target_blockchain.connect_chunk(request_base_height, chunk_data, proof_was_provided)
+        if not proof_was_provided and initial_interface_mode != Interface.MODE_VERIFICATION and target_blockchain:
+            # Catching up. The headers are hashed and checked by the chunk
+            # verifier while the next chunk downloads, and the chunks are
+            # connected in order by process_verified_chunks().
+            next_base_height = request_base_height + actual_header_count
+            if (actual_header_count == expected_header_count and next_base_height <= interface.tip
+                    and next_base_height not in self.prefetched_chunks[interface]):
+                self.prefetched_chunks[interface].add(next_base_height)
+                self.request_headers(interface, next_base_height, 2016)
+            future = self.chunk_verifier.submit(chunk_data)
+            self.verifying_chunks.append((interface, request_base_height, actual_header_count, chunk_data, future))
+            future.add_done_callback(self._on_chunk_verified)
+            return
+
+        self._connect_chunk(interface, target_blockchain, request_base_height, actual_header_count, chunk_data,
+                            proof_was_provided, was_verification_request, initial_interface_mode)
+
+    def _discard_prefetched(self, interface, base_height):
+        ''' Forget that the chunk at base_height was requested ahead, so that
+        it is requested again once the chunk before it connects. '''
+        prefetched = self.prefetched_chunks.get(interface)
+        if prefetched is not None:
+            prefetched.discard(base_height)
+
+    def _on_chunk_verified(self, future):
+        # called from a thread of the chunk verifier
+        self.wakeup()
+
+    def process_verified_chunks(self):
+        ''' Connects the chunks queued by on_block_headers, in the order they
+        were received, as their verification by the chunk verifier completes. '''
+        while self.verifying_chunks and self.verifying_chunks[0][4].done():
+            interface, base_height, count, chunk_data, future = self.verifying_chunks.popleft()
+            if interface not in self.interfaces.values():
+                continue  # closed meanwhile
+            target_blockchain = interface.blockchain
+            if target_blockchain and base_height > target_blockchain.height() + 1:
+                # a chunk requested ahead, after a chunk that did not connect
+                interface.print_error("dropping chunk which does not connect, height={}".format(base_height))
+                self._discard_prefetched(interface, base_height)
+                continue
+            try:
+                hashes_and_pow = future.result()
+            except Exception as e:
+                interface.print_error("chunk verifier failed, verifying in-process:", repr(e))
+                hashes_and_pow = None
+            self._connect_chunk(interface, target_blockchain, base_height, count, chunk_data,
+                                False, False, interface.mode, hashes_and_pow)
+
+    def _connect_chunk(self, interface, target_blockchain, request_base_height, actual_header_count, chunk_data,
+                       proof_was_provided, was_verification_request, initial_interface_mode, hashes_and_pow=None):
+        connect_state = (target_blockchain.connect_chunk(request_base_height, chunk_data, proof_was_provided, hashes_and_pow)
                          if target_blockchain
                          else blockchain.CHUNK_BAD)  # fix #1079 -- invariant is violated here due to extant bugs, so rather than raise an exception, just trigger a connection_down below...
         if connect_state == blockchain.CHUNK_ACCEPTED:
             interface.print_error("connected chunk, height={} count={} proof_was_provided={}".format(request_base_height, actual_header_count, proof_was_provided))
         elif connect_state == blockchain.CHUNK_FORKS:
             interface.print_error("identified forking chunk, height={} count={}".format(request_base_height, actual_header_count))
+            self._discard_prefetched(interface, request_base_height)
             # We actually have all the headers up to the bad point. In theory we
             # can use them to detect a fork point in some cases. But that's bonus
             # work for someone later.
@@ -1311,8 +1557,13 @@ class Network(util.DaemonThread):
             pass
         else:
             if interface.blockchain.height() < interface.tip:
-                self.request_headers(interface, request_base_height + actual_header_count, 2016)
+                next_base_height = request_base_height + actual_header_count
+                if next_base_height in self.prefetched_chunks[interface]:
+                    self.prefetched_chunks[interface].discard(next_base_height)  # already requested
+                else:
+                    self.request_headers(interface, next_base_height, 2016)
             else:
+                self.prefetched_chunks.pop(interface, None)
                 interface.set_mode(Interface.MODE_DEFAULT)
                 interface.print_error('catch up done', interface.blockchain.height())
                 interface.blockchain.catch_up = None
@@ -1335,8 +1586,7 @@ class Network(util.DaemonThread):
             params = [height]
         else:
             params = [height, networks.net.VERIFICATION_BLOCK_HEIGHT]
-        self.queue_request('blockchain.block.header', params, interface)
-        return True
+        return self.queue_request('blockchain.block.header', params, interface) is not None
         
         
 
@@ -1345,6 +1595,8 @@ class Network(util.DaemonThread):
         result = response.get('result')
         if not result:
             interface.print_error(response)
+            if request:
+                self._clear_requested_headers(request[1][0], 1)
             self.connection_down(interface.server)
             return
 
@@ -1375,6 +1627,12 @@ class Network(util.DaemonThread):
         else:
             hexheader = result
 
+        if self.requested_headers.pop(height, None) is not None and proof_was_provided and interface.mode == Interface.MODE_DEFAULT:
+            # A header before the checkpoint, see request_checkpoint_headers
+            if self.blockchains[0].connect_chunk(height, bfh(hexheader), True) == blockchain.CHUNK_ACCEPTED:
+                self.notify('blockchain_updated')
+            return
+
         # Simple header request.
         header = blockchain.deserialize_header(bfh(hexheader), height)
         # Is there a blockchain that already includes this header?
@@ -1493,93 +1751,142 @@ class Network(util.DaemonThread):
         # refresh network dialog
         self.notify('interfaces')
 
-    def find_bad_fds_and_kill(self):
-        bad = []
-        with self.interface_lock:
-            for s,i in self.interfaces.copy().items():
-                try:
-                    r, w, x = select.select([i],[i],[],0) # non-blocking select to test if fd's are good.
-                except (OSError, ValueError):
-                    i.print_error("Bad file descriptor {}, closing".format(i.fileno()))
-                    self.connection_down(s)
-                    bad.append(i)
-        if bad:
-            self.print_error("{} bad file descriptors detected and shut down: {}".format(len(bad), bad))
-        return bad
-
-    def wait_on_sockets(self):
-        def try_to_recover(err):
-            self.print_error("wait_on_sockets: {} raised by select() call.. trying to recover...".format(err))
-            self.find_bad_fds_and_kill()
-
-        rin = []
-        win = []
-        r_immed = []
+    def wakeup(self):
+        """Wakes up the event loop of the network thread, so that queued
+        requests and connection results are handled right away instead of on
+        the next tick. May be called from any thread."""
+        loop, evt = self.loop, self.wakeup_event
+        if loop is None or evt is None or evt.is_set():
+            # Note: if evt is set, the loop has yet to clear it and then
+            # handle the queued work, so there's no need to wake it again.
+            return
+        if threading.current_thread() is self:
+            evt.set()
+            return
+        try:
+            loop.call_soon_threadsafe(evt.set)
+        except RuntimeError:
+            pass  # loop was closed, the network is stopping
+
+    def _watch_interfaces(self):
+        """Makes the event loop watch the sockets of the current interfaces,
+        and stop watching those of interfaces that were closed (possibly from
+        another thread) since the last call."""
         with self.interface_lock:
             interfaces = list(self.interfaces.values())
-            for interface in interfaces:
-                if interface.fileno() < 0:
-                    continue
-                read_pending, write_pending = interface.pipe.get_selectloop_info()
-                if read_pending:
-                    r_immed.append(interface)
-                else:
-                    rin.append(interface)
-                if write_pending or interface.num_requests():
-                    win.append(interface)
+        current = {id(i) for i in interfaces}
+        # Stale ones first: a new socket may have reused the fd of a closed one
+        for fd, interface in list(self._readers.items()):
+            if id(interface) not in current or interface.fileno() != fd:
+                self._unwatch_fd(fd)
+        for interface in interfaces:
+            fd = interface.fileno()
+            if fd < 0 or fd in self._readers:
+                continue
+            try:
+                self.loop.add_reader(fd, self._on_readable, interface)
+            except (OSError, ValueError) as e:
+                interface.print_error("Bad file descriptor {}, closing: {}".format(fd, repr(e)))
+                self.connection_down(interface.server)
+                continue
+            self._readers[fd] = interface
+
+    def _unwatch_fd(self, fd):
+        self._readers.pop(fd, None)
+        self.loop.remove_reader(fd)
+        if fd in self._writers:
+            self._writers.discard(fd)
+            self.loop.remove_writer(fd)
+
+    def _unwatch_interface(self, interface):
+        for fd, i in list(self._readers.items()):
+            if i is interface:
+                self._unwatch_fd(fd)
+
+    def _is_watched(self, interface):
+        fd = interface.fileno()
+        return fd >= 0 and self._readers.get(fd) is interface
+
+    def _on_readable(self, interface):
+        if not self._is_watched(interface):
+            return
+        self.process_responses(interface)
+        # let the jobs see the responses right away
+        self.wakeup_event.set()
 
-        timeout = 0 if r_immed else 0.1
+    def _on_writable(self, interface):
+        if not self._is_watched(interface):
+            return
+        if not self._flush_interface(interface):
+            self.connection_down(interface.server)
 
-        try:
-            # Python docs say Windows doesn't like empty selects.
-            if win or rin:
-                rout, wout, xout = select.select(rin, win, [], timeout)
-            else:
-                rout = wout = xout = ()
-                if timeout:
-                    # Sleep to prevent busy looping
-                    time.sleep(timeout)
-        except socket.error as e:
-            code = None
-            if isinstance(e, OSError): # Should always be the case unless ancient python3
-                code = e.errno
-            if code == errno.EINTR:
-                return # calling loop will try again later
-            elif code == errno.EBADF:
-                # A filedescriptor was closed from underneath us because we have race conditions in this class. :(
-                # Note that due to race conditions with the gui thread even with the checks above it's entirely possible
-                # for the socket fd to become -1, or to be not -1 but still be invalid/closed.
-                try_to_recover("EBADF")
-                return # calling loop will try again later
-            raise # ruh ruh. user will get a crash dialog screen and network will die. FIXME: figure out a  way to restart network..
-        except ValueError:
-            # Note sometimes select() ends up getting a file descriptor that's -1 because race conditions, in which case it raises
-            # ValueError
-            try_to_recover("ValueError")
-            return # calling loop will try again later
-
-        assert not xout
-        for interface in wout:
+    def _flush_interface(self, interface):
+        """Sends the queued requests of interface, as many as the request
+        throttle and the socket allow. If the socket can't take all of the
+        data, the rest is sent when it becomes writable. Returns False on
+        failure."""
+        while True:
             if not interface.send_requests():
-                self.connection_down(interface.server)
-        for interface in r_immed:
-            self.process_responses(interface)
-        for interface in rout:
-            self.process_responses(interface)
+                return False
+            if interface.pipe.send_buf or not interface.num_requests():
+                break
+        fd = interface.fileno()
+        if interface.pipe.send_buf:
+            if fd not in self._writers and self._readers.get(fd) is interface:
+                self.loop.add_writer(fd, self._on_writable, interface)
+                self._writers.add(fd)
+        elif fd in self._writers:
+            self._writers.discard(fd)
+            self.loop.remove_writer(fd)
+        return True
+
+    def send_requests(self):
+        """Sends the queued requests of all the interfaces."""
+        with self.interface_lock:
+            interfaces = list(self.interfaces.values())
+        for interface in interfaces:
+            if interface.fileno() < 0 or interface.fileno() in self._writers:
+                continue  # closed, or waiting for the socket to become writable
+            if interface.num_requests() or interface.pipe.send_buf:
+                if not self._flush_interface(interface):
+                    self.connection_down(interface.server)
+
+    async def wait_for_activity(self, timeout=0.1):
+        """Waits until there is something to do: a response was received or
+        wakeup() was called, or until timeout, so that the periodic work in
+        run_loop still runs at least every `timeout` seconds."""
+        evt = self.wakeup_event
+        if not evt.is_set():
+            # A timer setting the event is much cheaper than wait_for(),
+            # which wraps the wait in a new task on every iteration.
+            timer = self.loop.call_later(timeout, evt.set)
+            await evt.wait()
+            timer.cancel()
+        evt.clear()
+
+    async def run_loop(self):
+        self.wakeup_event = asyncio.Event()
+        while self.is_running():
+            self.maintain_sockets()
+            self._watch_interfaces()
+            await self.wait_for_activity()
+            self.process_verified_chunks()
+            if self.verified_checkpoint:
+                self.run_jobs()    # Synchronizer and Verifier and Fx
+            self.process_pending_replies()
+            self.process_pending_sends()
+            self.send_requests()
 
     def init_headers_file(self):
         b = self.blockchains[0]
-        filename = b.path()
-        # NB: HEADER_SIZE = 80 bytes
-        length = blockchain.HEADER_SIZE * (networks.net.VERIFICATION_BLOCK_HEIGHT + 1)
-        if not os.path.exists(filename) or os.path.getsize(filename) < length:
-            with open(filename, 'wb') as f:
-                if length>0:
-                    f.seek(length-1)
-                    f.write(b'\x00')
-        util.ensure_sparse_file(filename)
-        with b.lock:
-            b.update_size()
+        count = networks.net.VERIFICATION_BLOCK_HEIGHT + 1
+        if b.size() < count:
+            # Goes through the segments and the file maps of the chain: the
+            # file may be mapped, or shared with a fork after a swap.
+            b.init_sparse(count)
+            if blockchain.header_bitmap is not None:
+                blockchain.header_bitmap.clear()
+                blockchain.header_bitmap.save()
 
     def run(self):
         b = self.blockchains[0]
@@ -1590,22 +1897,37 @@ class Network(util.DaemonThread):
         if header is not None:
             self.verified_checkpoint = True
 
-        while self.is_running():
-            self.maintain_sockets()
-            self.wait_on_sockets()
-            if self.verified_checkpoint:
-                self.run_jobs()    # Synchronizer and Verifier and Fx
-            self.process_pending_sends()
-        self.stop_network()
+        # Explicitly a selector loop: the default loop on Windows is the
+        # ProactorEventLoop, which has no add_reader()/add_writer().
+        self.loop = asyncio.SelectorEventLoop()
+        try:
+            self.loop.run_until_complete(self.run_loop())
+        finally:
+            self.stop_network()
+            self._watch_interfaces()  # unwatches the closed sockets
+            loop, self.loop, self.wakeup_event = self.loop, None, None
+            loop.close()
+            self.chunk_verifier.shutdown()
 
         self.tor_controller.active_port_changed.remove(self.on_tor_port_changed)
         self.tor_controller.stop()
         self.tor_controller = None
 
+        if self.tx_store is not None:
+            if Transaction.tx_store is self.tx_store:
+                Transaction.tx_store = None
+            self.tx_store.close()
+
         self.on_stop()
 
+    def stop(self):
+        super().stop()
+        self.wakeup()
+
     def on_server_version(self, interface, version_data):
         interface.server_version = version_data
+        # server.version is answered, further requests may be batched
+        interface.set_batching(self.config.get('network_batch_requests', True))
 
     def on_notify_header(self, interface, header_dict):
         """
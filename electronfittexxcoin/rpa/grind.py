@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# -*- mode: python3 -*-
+# Part of the Electron Cash SPV Wallet
+# License: MIT
+
+'''
+Grinding of RPA (paycode) transaction signatures in worker processes.
+
+To pay to a paycode, the hash of the first input of the transaction must
+start with a prefix of the scan pubkey of the paycode, and the only part of
+the input we are free to change is the signature. So we sign it over and
+over with the nonces 0, 1, 2, ... as extra entropy (ndata) until the hash
+matches. Signing holds the GIL only briefly, but everything around it does
+not, so this runs in processes rather than threads.
+
+The nonces are split in blocks which are handed out round-robin to the
+workers. A worker stops at its first match, or once its next block comes
+after the lowest block a match was found in, so the result is always the
+match with the lowest nonce: the same whatever the number of workers, and
+the same as grinding in the calling thread. Cancellation and the progress
+counters live in shared memory.
+'''
+
+import concurrent.futures
+import concurrent.futures.process
+import ctypes
+import hashlib
+import multiprocessing
+import os
+from collections import namedtuple
+
+from .. import schnorr
+from ..util import print_error
+
+# The serialized input is prefix + signature + suffix. `target` is the hex
+# prefix the double sha256 of the input must start with.
+GrindJob = namedtuple('GrindJob', 'sec pre_hash prefix suffix nhashtype target')
+
+SEARCH_SPACE = 0xff_ff_ff_ff_ff  # 5 byte nonces
+BLOCK_SIZE = 256
+
+_NOT_FOUND = SEARCH_SPACE + 1  # larger than any block number
+
+# State shared with the worker processes, set up by _init_worker: a cancel
+# flag followed by the lowest block with a match of each job, and the number
+# of nonces tried by each worker.
+_state = None
+_counters = None
+
+
+def _init_worker(state, counters):
+    global _state, _counters
+    _state, _counters = state, counters
+
+
+def grind_blocks(job, job_num, worker, n_workers, state, counters, poll=None, block_size=BLOCK_SIZE):
+    ''' Tries the nonces of the blocks worker, worker + n_workers, ... of the
+    job. Returns (nonce, signature) for the first match, or None if cancelled
+    or if another worker found a match in an earlier block. state[0] is the
+    cancel flag and state[1 + job_num] the lowest block with a match found so
+    far; counters[worker] is incremented by the number of nonces tried. poll
+    is called after each block. '''
+    sign = schnorr.sign
+    sha256 = hashlib.sha256
+    sec, pre_hash, prefix, suffix = job.sec, job.pre_hash, job.prefix, job.suffix
+    hashtype = bytes((job.nhashtype & 0xff,))
+    target = job.target
+    block = worker
+    while not state[0] and block < state[1 + job_num] and block * block_size <= SEARCH_SPACE:
+        start = block * block_size
+        for nonce in range(start, min(start + block_size, SEARCH_SPACE + 1)):
+            ndata = sha256(nonce.to_bytes(length=5, byteorder='little')).digest()
+            signature = sign(sec, pre_hash, ndata=ndata) + hashtype
+            hashed_input = sha256(sha256(prefix + signature + suffix).digest()).digest()
+            if hashed_input.hex().startswith(target):
+                counters[worker] += nonce - start + 1
+                return nonce, signature
+        counters[worker] += block_size
+        block += n_workers
+        if poll:
+            poll()
+    return None
+
+
+def _pool_grind_blocks(job, job_num, worker, n_workers, block_size):
+    return grind_blocks(job, job_num, worker, n_workers, _state, _counters, block_size=block_size)
+
+
+def grind(jobs, *, processes=None, exit_event=None, progress_callback=None, block_size=BLOCK_SIZE):
+    ''' Grinds the GrindJobs `jobs`. Returns a list with a (nonce, signature)
+    for each job, or None if exit_event got set.
+
+    Uses `processes` worker processes (default: one per core). With 0 or 1,
+    or if worker processes cannot be used, the grinding is done in the
+    calling thread. progress_callback, if given, is called from the calling
+    thread with the total number of signatures made so far. '''
+    jobs = list(jobs)
+    if processes is None:
+        processes = os.cpu_count() or 1
+    if processes > 1:
+        try:
+            return _grind_in_processes(jobs, processes, exit_event, progress_callback, block_size)
+        except (OSError, ImportError, NotImplementedError, concurrent.futures.process.BrokenProcessPool) as e:
+            print_error("[rpa.grind] cannot use worker processes:", repr(e))
+    state = (ctypes.c_int64 * (1 + len(jobs)))(0, *([_NOT_FOUND] * len(jobs)))
+    counters = (ctypes.c_uint64 * 1)()
+
+    def poll():
+        if exit_event and exit_event.is_set():
+            state[0] = 1
+        if progress_callback:
+            progress_callback(counters[0])
+
+    results = []
+    for job_num, job in enumerate(jobs):
+        result = grind_blocks(job, job_num, 0, 1, state, counters, poll, block_size)
+        if result is None:
+            return None  # cancelled
+        results.append(result)
+    return results
+
+
+def _grind_in_processes(jobs, processes, exit_event, progress_callback, block_size):
+    # spawn, as forking a process with threads (Qt, network, ...) is unsafe
+    ctx = multiprocessing.get_context('spawn')
+    state = ctx.RawArray(ctypes.c_int64, [0] + [_NOT_FOUND] * len(jobs))
+    counters = ctx.RawArray(ctypes.c_uint64, processes)
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=processes, mp_context=ctx,
+                                                      initializer=_init_worker, initargs=(state, counters))
+    try:
+        futures = {}
+        for job_num, job in enumerate(jobs):
+            for worker in range(processes):
+                future = executor.submit(_pool_grind_blocks, job, job_num, worker, processes, block_size)
+                futures[future] = job_num
+        results = [None] * len(jobs)
+        pending = set(futures)
+        while pending:
+            done, pending = concurrent.futures.wait(pending, timeout=0.25,
+                                                    return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                result = future.result()
+                if result is None:
+                    continue
+                job_num = futures[future]
+                # Only this process writes the lowest blocks, so no lock
+                # is needed. Workers stop once past it.
+                state[1 + job_num] = min(state[1 + job_num], result[0] // block_size)
+                if results[job_num] is None or result[0] < results[job_num][0]:
+                    results[job_num] = result
+            if exit_event and exit_event.is_set():
+                state[0] = 1
+            if progress_callback:
+                progress_callback(sum(counters))
+        if state[0]:
+            return None  # cancelled
+        return results
+    finally:
+        state[0] = 1
+        executor.shutdown(wait=True)
@@ -9,16 +9,13 @@
 '''
 This implements the functionality for RPA (Reusable Payment Address) aka Paycodes
 '''
-import copy
-import multiprocessing
 import random
 import threading
 import time
-import queue
-import traceback
 from decimal import Decimal as PyDecimal
 
 from . import addr
+from . import grind
 from .. import bitcoin
 from .. import networks
 from .. import schnorr
@@ -29,7 +26,7 @@ from ..i18n import _
 from ..plugins import run_hook
 from ..transaction import Transaction, OPReturn
 from ..keystore import KeyStore
-from ..util import print_msg, print_error, do_in_main_thread
+from ..util import print_msg, print_error, do_in_main_thread, NotEnoughFunds
 
 
 def _satoshis(amount):
@@ -218,6 +215,22 @@ def generate_transaction_from_paycode(wallet, config, amount, rpa_paycode, fee=N
                                       change_addr=None, nocheck=False, password=None, locktime=None,
                                       op_return=None, op_return_raw=None, progress_callback=None, exit_event=None,
                                       coins=None):
+    txs = generate_transactions_from_paycodes(wallet, config, [(rpa_paycode, amount)], fee=fee, from_addr=from_addr,
+                                              change_addr=change_addr, nocheck=nocheck, password=password,
+                                              locktime=locktime, op_return=op_return, op_return_raw=op_return_raw,
+                                              progress_callback=progress_callback, exit_event=exit_event,
+                                              coins=coins)
+    return txs and txs[0]
+
+
+def generate_transactions_from_paycodes(wallet, config, payments, fee=None, from_addr=None,
+                                        change_addr=None, nocheck=False, password=None, locktime=None,
+                                        op_return=None, op_return_raw=None, progress_callback=None, exit_event=None,
+                                        coins=None, processes=None):
+    """ Makes one transaction for each (paycode, amount) in `payments`, each
+    spending different coins, and grinds their signatures together in
+    worker processes (see grind.grind). Returns the list of raw transactions,
+    or None if exit_event got set. """
     if not wallet.is_schnorr_enabled():
         raise RuntimeError(_("You must enable Schnorr signing in settings for this wallet in order to send to a paycode"
                              " address."))
@@ -226,7 +239,47 @@ def generate_transaction_from_paycode(wallet, config, amount, rpa_paycode, fee=N
                              "In order to enable Schnorr fast-signing, please ensure you have built and installed the"
                              " FXX-specific libsecp256k1 library."))
 
-    exit_event = exit_event or threading.Event()  # Since we rely on exit_event below, ensure it's valid regardless
+    if len(payments) > 1 and not coins:
+        domain = from_addr.split(',') if from_addr else None
+        domain = None if domain is None else [_resolver(wallet, x, nocheck) for x in domain]
+        coins = wallet.get_spendable_coins(domain, config)
+    prepared = []
+    for rpa_paycode, amount in payments:
+        if prepared:
+            # Spend other coins than the transactions before
+            spent = {(txin['prevout_hash'], txin['prevout_n']) for p in prepared for txin in p[0].inputs()}
+            coins = [c for c in coins if (c['prevout_hash'], c['prevout_n']) not in spent]
+            if not coins:
+                raise NotEnoughFunds()
+        prepared.append(_prepare_transaction_from_paycode(wallet, config, amount, rpa_paycode, fee, from_addr,
+                                                          change_addr, nocheck, password, locktime, op_return,
+                                                          op_return_raw, coins))
+
+    progress_count = 0
+    if progress_callback:
+        do_in_main_thread(progress_callback, progress_count)
+
+    def on_progress(grind_count):
+        nonlocal progress_count
+        if progress_count < grind_count // 1000:
+            progress_count = grind_count // 1000
+            do_in_main_thread(progress_callback, progress_count)
+
+    t0 = time.time()
+    results = grind.grind([p[1] for p in prepared], processes=processes, exit_event=exit_event,
+                          progress_callback=progress_callback and on_progress)
+    if results is None:
+        return None  # User cancelled
+    tf = time.time()
+    print_error(f"RPA grind: {len(prepared)} transaction(s), nonces {[r[0] for r in results]} in {tf-t0:1.3f} secs")
+    return [_finish_transaction_from_paycode(*p, r[1]) for p, r in zip(prepared, results)]
+
+
+def _prepare_transaction_from_paycode(wallet, config, amount, rpa_paycode, fee, from_addr, change_addr, nocheck,
+                                      password, locktime, op_return, op_return_raw, coins):
+    """ Makes the transaction paying `amount` to `rpa_paycode`. Returns it
+    along with the grind.GrindJob for the signature of its first input, the
+    pubkey and the sighash of that input. """
     # Decode the paycode
     rprefix, addr_hash = addr.decode(rpa_paycode)
     paycode_hex = addr_hash.hex().upper()
@@ -334,102 +387,37 @@ def generate_transaction_from_paycode(wallet, config, amount, rpa_paycode, fee=N
     nHashType = 0x00000041  # hardcoded, perhaps should be taken from unsigned input dict
     pre_hash = Hash(bfh(tx.serialize_preimage(0, nHashType, use_cache=False)))
 
-    # While loop for grinding.  Keep grinding until txid prefix matches
-    # paycode scanpubkey prefix.
-    grind_count = 0
-    progress_count = 0
-
-    if progress_callback:
-        do_in_main_thread(progress_callback, progress_count)
-
-    # The below unrolls some of the Transacton class signing code into here, to optimize it. It's much faster this
-    # way, even if a bit complex. -Calin
-    def my_sign(sec: bytes, pre_hash: bytes, ndata: bytes, nHashType: int):
-        sig = schnorr.sign(sec, pre_hash, ndata=ndata)
-        return sig + bytes((nHashType & 0xff,))
-
-    search_space = 0xff_ff_ff_ff_ff
     ser_prefix = Transaction.serialize_outpoint_bytes(txin)
     script_prefix = push_script_bytes(bytes((0x0,) * 65))[:-65]  # create the push prefix e.g. 0x41
     script_suffix = push_script_bytes(pubkey)  # push of the pubkey
     script_prefix = var_int_bytes(len(script_prefix) + 65 + len(script_suffix)) + script_prefix  # prepend length byte
     ser_suffix = int_to_bytes(txin.get('sequence', 0xffffffff - 1), 4)
     prefix_target_hex = paycode_field_scan_pubkey[2:prefix_chars + 2].lower()
-    n_threads = multiprocessing.cpu_count()
-    tx_matches_paycode_prefix = False
-    t0 = time.time()
-    results = queue.Queue()
-
-    def thread_func(thread_num):
-        try:
-            nonlocal grind_count, tx_matches_paycode_prefix, progress_count
-            nonce = (search_space // n_threads) * thread_num
-            my_tx = copy.deepcopy(tx)
-            my_txin = my_tx._inputs[0]
-            while not tx_matches_paycode_prefix:
-                if exit_event.is_set():
-                    results.put(None)  # NoneType indicates user cancelled
-                    return
-                nonce_bytes = nonce.to_bytes(length=5, byteorder='little')
-                ndata = sha256(nonce_bytes)
-                signature = my_sign(sec, pre_hash, ndata, nHashType)
-                assert len(signature) == 65
-                serialized_input = ser_prefix + script_prefix + signature + script_suffix + ser_suffix
-
-                if progress_callback and progress_count < grind_count // 1000:
-                    progress_count = grind_count // 1000
-                    do_in_main_thread(progress_callback, progress_count)
-
-                hashed_input = sha256(sha256(serialized_input))
-                hashed_input_prefix_hex = hashed_input[:2].hex()[0:prefix_chars]
-
-                if hashed_input_prefix_hex == prefix_target_hex:
-                    print_error(f"matched prefix {prefix_target_hex} for serialized input with hash: {hashed_input.hex()}")
-                    reason=[]
-                    if not Transaction.verify_signature(pubkey, signature[:-1], pre_hash, reason=reason):
-                        raise RuntimeError(f"Signature verification failed: {str(reason)}")
-                    else:
-                        my_txin['signatures'][0] = signature.hex()
-                        my_txin['pubkeys'][0] = pubkey.hex()
-                        check_input = my_tx.serialize_input_bytes(my_txin, bytes.fromhex(my_tx.input_script(my_txin)))
-                        check_hash = Hash(check_input)
-                        if hashed_input != check_hash:
-                            print_error(f"Real input hash: {check_hash.hex()} does not match what we calculated: {hashed_input.hex()}")
-                            print_error(f"our ser input : {serialized_input.hex()}")
-                            print_error(f"real ser input: {check_input.hex()}")
-                            raise RuntimeError("Internal error calculating the input prefix. Calculated prefix does not"
-                                               " match what the Transaction class would have done. FIXME!")
-                        tx_matches_paycode_prefix = True
-                        results.put(my_tx)
-                grind_count += 1
-                nonce += 1
-        except Exception as e:
-            traceback.print_exc(file=sys.stderr)
-            results.put(e)
-
-    threads = []
-    for i in range(n_threads):
-        threads.append(threading.Thread(target=thread_func, args=(i,), name=f"RPA grinder thread {i + 1}"))
-        threads[-1].start()
-    tx_or_e = results.get(block=True)
-
-    def join_threads():
-        exit_event.set()  # Just in case, get sub-threads to stop
-        for t in threads:
-            t.join()
-
-    try:
-        if isinstance(tx_or_e, Exception):
-            # This should never happen. Sub-thread got an exception. Bubble it out.
-            raise tx_or_e
-        elif tx_or_e is None:
-            # User cancelled
-            return
-        tx = tx_or_e
-    finally:
-        join_threads()
-    tf = time.time()
-    print_error(f"RPA grind: Using {n_threads} threads, iterated {grind_count} times in {tf-t0:1.3f} secs")
+    job = grind.GrindJob(sec, pre_hash, ser_prefix + script_prefix, script_suffix + ser_suffix, nHashType,
+                         prefix_target_hex)
+    return tx, job, pubkey, pre_hash
+
+
+def _finish_transaction_from_paycode(tx, job, pubkey, pre_hash, signature):
+    """ Puts the ground `signature` in the first input of tx, after checking
+    it, and returns the raw transaction. """
+    reason = []
+    if not Transaction.verify_signature(pubkey, signature[:-1], pre_hash, reason=reason):
+        raise RuntimeError(f"Signature verification failed: {str(reason)}")
+    txin = tx._inputs[0]
+    txin['signatures'][0] = signature.hex()
+    txin['pubkeys'][0] = pubkey.hex()
+    serialized_input = job.prefix + signature + job.suffix
+    hashed_input = Hash(serialized_input)
+    check_input = tx.serialize_input_bytes(txin, bytes.fromhex(tx.input_script(txin)))
+    check_hash = Hash(check_input)
+    if hashed_input != check_hash or not hashed_input.hex().startswith(job.target):
+        print_error(f"Real input hash: {check_hash.hex()} does not match what we calculated: {hashed_input.hex()}")
+        print_error(f"our ser input : {serialized_input.hex()}")
+        print_error(f"real ser input: {check_input.hex()}")
+        raise RuntimeError("Internal error calculating the input prefix. Calculated prefix does not"
+                           " match what the Transaction class would have done. FIXME!")
+    print_error(f"matched prefix {job.target} for serialized input with hash: {hashed_input.hex()}")
 
     # Re-serialize the transaction.
     retval = tx.raw = tx.serialize()
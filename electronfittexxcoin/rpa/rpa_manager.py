@@ -23,6 +23,8 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import bisect
+from functools import partial
 from threading import Lock
 import queue
 import time
@@ -30,10 +32,104 @@ import time
 from electronfittexxcoin.util import ThreadJob
 
 
+class BlockRangeScan:
+    """Keeps track of the block ranges requested from the server, and of how far the scan got.
+
+    Several ranges are in flight at once and they may complete in any order.  `height`, the first block not
+    known to be scanned, only moves past contiguous completed ranges.  Completed ranges above it are kept in
+    `done` (and persisted by the wallet) so that they are skipped if the scan is resumed later.
+
+    The number of blocks per request adapts to the responses: it is halved when a response lists too many
+    transactions or takes too long, and doubled when it lists few and is quick.  Servers limit the number of
+    blocks of a request, so a failed request also caps it."""
+
+    MIN_BLOCKS = 1
+    MAX_BLOCKS = 1000
+    TARGET_RESULTS = 500  # transactions per response
+    TARGET_LATENCY = 3.0  # seconds per response
+
+    def __init__(self, height, done=(), blocks=50):
+        self.height = height
+        self.done = sorted([start, end] for start, end in done if end >= height)
+        self.blocks = blocks
+        self.max_blocks = self.MAX_BLOCKS
+        self.next = height
+        self.retry = []  # (start, end) of the failed ranges, to request again
+        self.in_flight = {}  # start -> [end, time sent]
+        self._advance()
+
+    def _advance(self):
+        while self.done and self.done[0][0] <= self.height:
+            self.height = max(self.height, self.done.pop(0)[1] + 1)
+        self.next = max(self.next, self.height)
+
+    def next_range(self, tip, now=None):
+        """Returns the next (start, end) range of blocks to request, with end <= tip, or None."""
+        if self.retry:
+            start, end = self.retry.pop(0)
+            if end - start + 1 > self.blocks:
+                self.retry.insert(0, (start + self.blocks, end))
+                end = start + self.blocks - 1
+        else:
+            start = self.next
+            for done_start, done_end in self.done:
+                if done_start <= start <= done_end:
+                    start = done_end + 1
+            if start > tip:
+                return None
+            end = min(tip, start + self.blocks - 1)
+            # stop short of the next range that is already scanned
+            i = bisect.bisect_right(self.done, [start, start])
+            if i < len(self.done):
+                end = min(end, self.done[i][0] - 1)
+            self.next = end + 1
+        self.in_flight[start] = [end, time.time() if now is None else now]
+        return start, end
+
+    def got_history(self, start, num_results, now=None):
+        """Adapts the number of blocks per request to the response for the range at start."""
+        end, sent = self.in_flight[start]
+        blocks = end - start + 1
+        latency = (time.time() if now is None else now) - sent
+        if num_results > self.TARGET_RESULTS or latency > self.TARGET_LATENCY:
+            self.blocks = max(self.MIN_BLOCKS, min(self.blocks, blocks // 2))
+        elif num_results < self.TARGET_RESULTS // 2 and latency < self.TARGET_LATENCY / 2 and blocks >= self.blocks:
+            self.blocks = min(self.max_blocks, blocks * 2)
+
+    def complete(self, start):
+        """Marks the range at start as scanned.  Returns True if `height` moved."""
+        end = self.in_flight.pop(start)[0]
+        bisect.insort(self.done, [start, end])
+        height = self.height
+        self._advance()
+        return self.height != height
+
+    def failed(self, start, shrink=False):
+        """Puts the range at start back to be requested again.  With shrink, the request itself was refused
+        and later requests are capped at half its size."""
+        end = self.in_flight.pop(start)[0]
+        bisect.insort(self.retry, (start, end))
+        if shrink:
+            self.max_blocks = max(self.MIN_BLOCKS, (end - start + 1) // 2)
+            self.blocks = min(self.blocks, self.max_blocks)
+
+    def caught_up(self, tip):
+        return not self.in_flight and not self.retry and self.height > tip
+
+
 class RpaManager(ThreadJob):
     """Based loosely on the structure of the synchronizer class.
     External interface: __init__() and add() member functions."""
 
+    # At most this many block ranges are requested at once, and no more are requested while this many
+    # transactions of the ranges in flight are still to be fetched or processed.
+    MAX_RANGES_IN_FLIGHT = 4
+    MAX_PENDING_TXS = 2000
+    # Time spent processing raw transactions per run() (phase 4), in seconds
+    PHASE_4_TIME_BUDGET = 0.05
+    # The scan progress is written to disk at most this often, in seconds, and when caught up
+    CHECKPOINT_INTERVAL = 30.0
+
     def __init__(self, wallet, network):
         from electronfittexxcoin.wallet import RpaWallet
         assert isinstance(wallet, RpaWallet)
@@ -47,8 +143,17 @@ class RpaManager(ThreadJob):
         # self.tx_heights is a dict that stores the height of each tx the rpa_manager encounters.
         self.tx_heights = dict()
 
-        # self.block_requests is a dict that stores the requests made for blocks from the server.
-        self.block_requests = dict()
+        # self.scan keeps track of the block ranges requested from the server.  It is created by the first
+        # phase 1 that knows the server height.
+        self.scan = None
+        # Block range start -> number of its transactions not yet fetched and processed, for the ranges whose
+        # history was received.  A range is scanned when this drops to zero.
+        self.range_pending = dict()
+        # Ranges with a transaction that could not be fetched, to be scanned again
+        self.range_failed = set()
+        self.pending_txs = 0
+        self._checkpoint_dirty = False
+        self._last_checkpoint = time.time()
 
         # To avoid downloading the same txn multiple times if mempool polling
         self.already_downloaded_txids = set()
@@ -58,6 +163,11 @@ class RpaManager(ThreadJob):
         wn = self.wallet.diagnostic_name() if self.wallet else "???"
         return f"{wn}/{cn}"
 
+    def is_stopped(self) -> bool:
+        """True once the wallet dropped this manager (see Abstract_Wallet.stop_threads).  The responses to its
+        requests may still arrive after that, and must then be ignored: a new manager may be scanning."""
+        return self.wallet.rpa_manager is not self
+
     @property
     def up_to_date(self) -> bool:
         return self._up_to_date
@@ -84,12 +194,6 @@ class RpaManager(ThreadJob):
         self.last_mempool_check = time.time()
 
     def rpa_phase_1(self):
-        # Check the rawtx queue first, because if it still has transactions to process from a previous run,
-        # we don't want to request more blocks from the server until we're caught up.
-        if not self.rpa_q_rawtx.empty():
-            self.up_to_date = False
-            return
-
         # Make sure the password is available.  If not, do nothing.
         if self.wallet.has_password() and self.wallet.rpa_pwd is None:
             return
@@ -100,48 +204,58 @@ class RpaManager(ThreadJob):
         if not server_height:
             return
 
-        rpa_height = self.wallet.rpa_height
-        if rpa_height is None:
-            self.wallet.rpa_height = rpa_height = server_height - 100
-
-        # Only request blocks if the rpa_height is lagging behind the tip.
-        if rpa_height < server_height:
-
-            number_of_blocks = 50
-            # Only request enough blocks to get to the tip.  Otherwise, the next request will be too far ahead
-            if rpa_height + number_of_blocks > server_height:
-                number_of_blocks = server_height-rpa_height
-
-            # Define the "grind string" (the RPA prefix)
-            rpa_grind_string = self.wallet.get_grind_string()
-            params = [rpa_height, number_of_blocks + 1, rpa_grind_string]
-            requests = []
-
-            # self.block_requests is used to ensure only 1 call is made at any given height.
-            # Otherwise, a plethora of requests can be sent.
-            if rpa_height not in self.block_requests:
-                requests.append(('blockchain.reusable.get_history', params))
-                self.network.send(requests, self.rpa_phase_2)
-                self.block_requests[rpa_height]=1
-                self.up_to_date = False
-        else:
-            self.up_to_date = True
+        if self.scan is None:
+            rpa_height = self.wallet.rpa_height
+            if rpa_height is None:
+                rpa_height = server_height - 100
+            # Resume from the stored height, skipping the ranges above it that were already scanned.
+            self.scan = BlockRangeScan(rpa_height, self.wallet.rpa_scanned_ranges)
+
+        # Keep several ranges in flight, but stop requesting more while the transactions of the previous ones
+        # pile up.
+        rpa_grind_string = self.wallet.get_grind_string()
+        requests = []
+        while len(self.scan.in_flight) < self.MAX_RANGES_IN_FLIGHT and self.pending_txs < self.MAX_PENDING_TXS:
+            block_range = self.scan.next_range(server_height)
+            if block_range is None:
+                break
+            start, end = block_range
+            requests.append(('blockchain.reusable.get_history', [start, end - start + 1, rpa_grind_string]))
+        if requests:
+            self.network.send(requests, self.rpa_phase_2)
+
+        self.up_to_date = self.scan.caught_up(server_height) and self.rpa_q_rawtx.empty()
 
     def rpa_phase_2(self, response):
         """This is the callback that gives us a payload of txids.  Iterate through them,
         and request the full Raw TX for each."""
 
+        if self.is_stopped():
+            return
+
         # Unpack the response
         payload = response.get('result')
         method = response.get('method')
         params = response.get('params')
+        block_range = None
+        if method == 'blockchain.reusable.get_history':
+            block_range = params[0]
+            if self.scan is None or block_range not in self.scan.in_flight:
+                return
 
         # Payload can be empty if there was an error
         if payload is None:
             error = response.get('error')
             self.print_error(f"Got error reply for '{method}' with params: {params}. Error: {error}")
+            if block_range is not None:
+                # Request the range again, in smaller pieces
+                self.scan.failed(block_range, shrink=True)
             return
 
+        if block_range is not None:
+            self.scan.got_history(block_range, len(payload))
+
+        rawtx_requests = []
         for i in payload:
             txid = i['tx_hash']
             tx_height = i['height']
@@ -149,104 +263,128 @@ class RpaManager(ThreadJob):
                 # Skip known txns (mempool polling)
                 continue
             self.tx_heights[txid] = tx_height
-            rawtx_request = [('blockchain.transaction.get', [txid])]
-            self.network.send(rawtx_request, self.rpa_phase_3)
+            rawtx_requests.append(('blockchain.transaction.get', [txid]))
+        if rawtx_requests:
+            self.network.send(rawtx_requests, partial(self.rpa_phase_3, block_range=block_range))
 
-        # We will also implement a special queue item called "lastblock" which contains the literal strick "lastblock"
-        # instead of a rawtx.  This can pushed on the queue after all other items in the payload are pushed.  The FIFO
-        # structure of the network queue will then process this last, and this module can then update the rpa_height
-        # for the wallet.  This neatly handles all the cases where there are no transactions at certain blockheights,
-        # empty payloads, and so on.  This approach means we aren't looking at the heights of individual transactions.
-        # Instead we're concerned with the height of the entire payload with regards to bumping the wallet height.
+        # The range is scanned once phase 4 processed all its transactions.  A range without any is done now.
+        if block_range is not None:
+            self.range_pending[block_range] = len(rawtx_requests)
+            self.pending_txs += len(rawtx_requests)
+            if not rawtx_requests:
+                self._range_done(block_range)
 
-        # Put the lastblock item into the queue.  Only for block requests, not mempool.
-        if method == 'blockchain.reusable.get_history':
-            # Don't forget to subtract one from the blockheight plus the number of blocks.
-            last_block_in_payload = params[0] + params[1] - 1
-            # Put a special "last block" item in the queue.  We can do it here rather than using a callback, which
-            # happens for normal queue items
-            raw_tx_and_height_tuple = ("lastblock", last_block_in_payload)
-            self.rpa_q_rawtx.put(raw_tx_and_height_tuple)
-
-    def rpa_phase_3(self, response):
+    def rpa_phase_3(self, response, block_range=None):
 
         # Each raw transaction that is returned needs to be put on the queue.
-        # We will store the transaction as a tuple consisting of the serialized tx, and the height.
+        # We will store the transaction as a tuple consisting of the serialized tx, and the block range it is
+        # part of (None for mempool transactions).
+
+        if self.is_stopped():
+            return
 
         raw_tx = response.get('result')
+        method = response.get('method')
         params = response.get('params')
         error = response.get('error')
         if error is not None:
             self.print_error(f"Got error reply for '{method}' with params: {params}. Error: {error}")
-            return
-        txid = params[0]
-        tx_height = self.tx_heights[txid]
-        raw_tx_and_height_tuple = (raw_tx, tx_height)
-        if tx_height <= 0:
-            self.already_downloaded_txids.add(txid)
-        self.rpa_q_rawtx.put(raw_tx_and_height_tuple)
+            if block_range is None:
+                return
+            # Still account for it in phase 4, and scan the range again once the rest of it is processed.
+            self.range_failed.add(block_range)
+            raw_tx = None
+        else:
+            txid = params[0]
+            if self.tx_heights.get(txid, 0) <= 0:
+                self.already_downloaded_txids.add(txid)
+        self.rpa_q_rawtx.put((raw_tx, block_range))
 
     def rpa_phase_4(self):
 
-        # The rawtx tuple unpacks into a a rawtx and a height.  There is a special value
-        # for rawtx: "lastblock", which also has a height, and is treated differently.
-        # It signals that the payload chunk is completely processed and the rpa_height in the wallet can be bumped.
+        # Process raw transactions for at most PHASE_4_TIME_BUDGET per run, to keep things peppy.  The network
+        # keeps fetching the next ones meanwhile.
 
-        limit_iters = 20
-        iterct = 0
+        deadline = time.time() + self.PHASE_4_TIME_BUDGET
 
-        while not self.rpa_q_rawtx.empty():
-            rawtx_tuple = self.rpa_q_rawtx.get()
-            rawtx = rawtx_tuple[0]
-            tx_height = rawtx_tuple[1]
+        while True:
+            try:
+                rawtx, block_range = self.rpa_q_rawtx.get_nowait()
+            except queue.Empty:
+                break
 
-            if rawtx != "lastblock":
+            if rawtx is not None:
                 password = self.wallet.rpa_pwd
                 # This will be assigned to zero if the private key cannot be extracted (most tx)
                 extracted_private_keys = self.wallet.extract_private_keys_from_transaction(rawtx, password)
                 for pk in extracted_private_keys:
                     self.wallet.import_private_key(pk, password)
-            else:
-                # last block
-                lastblock_height = tx_height
-                new_height = lastblock_height + 1
-                if new_height > 0:
-                    self.wallet.rpa_height = lastblock_height
-
-            iterct += 1
-            if iterct >= limit_iters:
-                # Don't iterate more than limit_iters, to keep things peppy
+
+            if block_range is not None:
+                self.pending_txs -= 1
+                self.range_pending[block_range] -= 1
+                if not self.range_pending[block_range]:
+                    self._range_done(block_range)
+
+            if time.time() >= deadline:
                 break
 
+        self._checkpoint()
+
+    def _range_done(self, block_range):
+        """All the transactions of the range at block_range went through phase 4."""
+        if self.is_stopped():
+            return
+        del self.range_pending[block_range]
+        if block_range in self.range_failed:
+            self.range_failed.discard(block_range)
+            self.scan.failed(block_range)
+            return
+        if self.scan.complete(block_range):
+            # rpa_height is the last block scanned
+            self.wallet.rpa_height = self.scan.height - 1
+        self.wallet.rpa_scanned_ranges = self.scan.done
+        self._checkpoint_dirty = True
+
+    def _checkpoint(self):
+        """Writes the scan progress to disk every CHECKPOINT_INTERVAL seconds, and once caught up, so that
+        a restart resumes from there."""
+        if not self._checkpoint_dirty:
+            return
+        now = time.time()
+        if now - self._last_checkpoint >= self.CHECKPOINT_INTERVAL or not self.scan.in_flight:
+            self.wallet.storage.write()
+            self._checkpoint_dirty = False
+            self._last_checkpoint = now
+
     def run(self):
         """Called from the network proxy thread main loop."""
 
         # This rpa_manager module is for communicating with the server on behalf of the wallet, and its purpose is to
         # manage the various network calls and functionality for RPA wallets.
         #
-        # The RPA process consists of 4 distinct phases.
+        # The RPA process consists of 4 distinct phases, which overlap: while the transactions of a range of
+        # blocks are processed, the next ranges are already requested and their transactions fetched.
         #
-        # Phase 1:  First check if the "raw tx queue" (used by later phases) is empty.  If empty, then
-        # continue.  If the server network height is greater than the wallet's "rpa height",
-        # then make a network request for a chunk of blocks, with care to only request each chunk once.
+        # Phase 1:  If the server network height is greater than the height the wallet scanned up to, request the
+        # next ranges of blocks, keeping up to MAX_RANGES_IN_FLIGHT of them in flight.  self.scan (BlockRangeScan)
+        # hands out the ranges and adapts their size to the responses.
         #
         # Phase 2:  This is the callback for the network request in phase 1.  Here we take the payload of transaction ids,
         # iterate through it, and make a network request to fetch the full raw tx.  Theoretically,
         # the full raw tx could have been returned along with the txid, but the server side developers
-        # decided it is better to a seperate call.  In the phase, we also put a "lastblock" item onto the queue
-        # that tells the system that the current chunk is complete.
+        # decided it is better to a seperate call.  We also note how many transactions the range has.
         #
-        # Phase 3:  This is the callback for the network request in phase 2.  The Raw tx is put into a queue for processing.
-        # We use a queue structure so we can easily deteremine when all the callbacks have been completed.  Perhaps this phase
-        # could have been combined with phase 4 but this is a cleaner design to handle this as separate phase.
+        # Phase 3:  This is the callback for the network request in phase 2.  The Raw tx is put into a queue for processing,
+        # along with the range it belongs to.
         #
         # Phaase 4: In this phase, we iterate through the raw transaction queue and process each transaction.  We attempt to
-        # extract the private key from the transaction and if successful, import it into the wallet keystore.  When we encounter
-        # the "lastblock" item, we know the current chunk has finished processing, and we can update the rpa_height in the wallet,
-        # which will allow phase 1 to process the next chunk, and so on.
+        # extract the private key from the transaction and if successful, import it into the wallet keystore.  When all the
+        # transactions of a range are processed, the range is complete.  The rpa_height in the wallet moves up as the
+        # ranges below it complete, and the completed ranges above it are stored too, so that the scan resumes where it
+        # left off after a restart.
         #
         # Note: only phase 1 and phase 4 are called directly from this run loop.  Phases 2 and 3 are executed as callbacks.
         self.rpa_phase_1()
         self.rpa_phase_1_mempool(polling=True)
         self.rpa_phase_4()
-
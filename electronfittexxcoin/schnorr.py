@@ -253,6 +253,59 @@ def verify(pubkey, signature, message_hash):
 
         return (int(R.x()).to_bytes(32, 'big') == rbytes)
 
+def _verify_batch_fast(items):
+    # The per call overhead of verify() (argument checks, attribute lookups,
+    # a new buffer and a parse for every pubkey) is a large part of the cost
+    # of a verification, so it is set up once here and pubkeys are parsed
+    # once per batch.
+    ctx = seclib.ctx
+    pubkey_parse = seclib.secp256k1_ec_pubkey_parse
+    schnorr_verify = _secp256k1_schnorr_verify
+    parsed = {}
+    results = []
+    append = results.append
+    for pubkey, signature, message_hash in items:
+        if (type(signature) is not bytes or len(signature) != 64
+                or type(message_hash) is not bytes or len(message_hash) != 32):
+            append(False)
+            continue
+        try:
+            pubkey_parsed = parsed[pubkey]
+        except KeyError:
+            pubkey_parsed = None
+            if type(pubkey) is bytes and len(pubkey) in (33, 65):
+                pubkey_parsed = create_string_buffer(64)
+                if not pubkey_parse(ctx, pubkey_parsed, pubkey, len(pubkey)):
+                    pubkey_parsed = None
+            parsed[pubkey] = pubkey_parsed
+        except TypeError:  # unhashable garbage
+            pubkey_parsed = None
+        append(pubkey_parsed is not None
+               and schnorr_verify(ctx, signature, message_hash, pubkey_parsed) == 1)
+    return results
+
+def _verify_batch_slow(items):
+    results = []
+    for item in items:
+        try:
+            results.append(bool(verify(*item)))
+        except Exception:  # garbage pubkeys can make it raise more than ValueError
+            results.append(False)
+    return results
+
+def verify_batch(items, *, threads=None):
+    '''Verify many Schnorr signatures at once.
+
+    `items` is an iterable of (pubkey, signature, message_hash) tuples, as
+    taken by `verify`. Returns a list of bools, one per item, in order. Items
+    for which `verify` would raise a ValueError are False.
+
+    With libsecp256k1, large batches are split across `threads` threads
+    (default: one per core).'''
+    if _secp256k1_schnorr_verify:
+        return secp256k1.run_batch(_verify_batch_fast, items, threads)
+    return _verify_batch_slow(items)
+
 class BlindSigner:
     """ Schnorr blind signature creator, signer side.
 
@@ -9,6 +9,8 @@ respectively.
 import os
 import sys
 import ctypes
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from ctypes.util import find_library
 from ctypes import (
     byref, c_byte, c_int, c_uint, c_char_p, c_size_t, c_void_p, create_string_buffer, CFUNCTYPE, POINTER
@@ -105,6 +107,9 @@ def _load_library():
         secp256k1.secp256k1_ec_pubkey_tweak_mul.argtypes = [c_void_p, c_char_p, c_char_p]
         secp256k1.secp256k1_ec_pubkey_tweak_mul.restype = c_int
 
+        secp256k1.secp256k1_ec_pubkey_tweak_add.argtypes = [c_void_p, c_char_p, c_char_p]
+        secp256k1.secp256k1_ec_pubkey_tweak_add.restype = c_int
+
         secp256k1.secp256k1_ec_pubkey_combine.argtypes = [c_void_p, c_void_p, POINTER(c_void_p), c_size_t]
         secp256k1.secp256k1_ec_pubkey_combine.restype = c_int
 
@@ -123,3 +128,40 @@ try:
     secp256k1 = _load_library()
 except:
     secp256k1 = None
+
+
+# Batches at least this large are split across threads by run_batch.
+BATCH_THREAD_MIN = 256
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def run_batch(func, items, threads=None):
+    ''' Returns func(items), a list with one result per item. Calls into the
+    library release the GIL, so if the batch is large enough and there is
+    more than one core, it is split in `threads` slices (default: the number
+    of cores) which are passed to func in parallel, and the results joined.
+    func must be thread safe; verification only reads the shared context.
+
+    The slices run on a pool of one thread per core, created on first use and
+    shared by all callers: it is never replaced, so that concurrent batches
+    from other threads keep working. '''
+    global _executor
+    items = list(items)
+    cores = os.cpu_count() or 1
+    if threads is None:
+        threads = cores
+    threads = min(threads, len(items) // (BATCH_THREAD_MIN // 2))
+    if threads <= 1 or len(items) < BATCH_THREAD_MIN:
+        return func(items)
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=cores, thread_name_prefix='secp256k1')
+        executor = _executor
+    step = -(-len(items) // threads)
+    futures = [executor.submit(func, items[i:i + step]) for i in range(0, len(items), step)]
+    results = []
+    for future in futures:
+        results.extend(future.result())
+    return results
@@ -0,0 +1,466 @@
+#!/usr/bin/env python3
+#
+# Electron Cash - A Fittexxcoin SPV Wallet
+# License: MIT License
+#
+''' SQLite wallet storage engine.
+
+This is an optional alternative to the json wallet file for very large
+wallets. The big per-transaction and per-address maps (transactions, txi,
+txo, ct_txi, ct_txo, addr_history, verified_tx3, labels, tx_fees, pruned_txo)
+live in their own tables, one row per entry, and everything else lives in a
+small `meta` key/value table which is loaded into memory like the json file
+is.
+
+SqliteWalletStorage keeps the WalletStorage get()/put()/write() interface:
+get() of a table key materializes a dict, and put() of a table key with a
+plain dict makes the table match it. The wallet itself does not go through
+those for its maps. Abstract_Wallet.transactions is a LazyTransactionMap and
+the other maps are RowMaps, which read rows from the database on demand,
+remember which keys were changed, and write only those rows when saved.
+
+Existing json wallets are converted with migrate_json_to_sqlite(). Wallet file
+encryption is not supported by this engine (keystore encryption is). '''
+
+import copy
+import json
+import os
+import sqlite3
+import threading
+from collections.abc import MutableMapping
+
+from .caches import ExpiringCache
+from .storage import WalletStorage, FINAL_SEED_VERSION
+from .transaction import Transaction
+from .util import profiler, standardize_path
+
+# storage key -> table. Each of these storage keys is a dict in the json
+# format; here each dict entry is a row.
+TABLES = ('transactions', 'txi', 'txo', 'ct_txi', 'ct_txo', 'addr_history',
+          'verified_tx3', 'labels', 'tx_fees', 'pruned_txo')
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS transactions (key TEXT PRIMARY KEY, raw TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS txi (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS txo (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS ct_txi (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS ct_txo (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS addr_history (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS verified_tx3 (key TEXT PRIMARY KEY, height INTEGER, timestamp INTEGER, pos INTEGER);
+CREATE TABLE IF NOT EXISTS labels (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS tx_fees (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS pruned_txo (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+'''
+
+
+class SqliteStorageError(Exception):
+    pass
+
+
+def _encode_row(table, value):
+    ''' Returns the tuple of column values (excluding the key) for a table. '''
+    if table == 'transactions':
+        return (value,)
+    if table == 'verified_tx3':
+        height, timestamp, pos = value
+        return (height, timestamp, pos)
+    return (json.dumps(value),)
+
+
+def _decode_row(table, cols):
+    if table == 'transactions':
+        return cols[0]
+    if table == 'verified_tx3':
+        return list(cols)
+    return json.loads(cols[0])
+
+
+def _columns(table):
+    if table == 'transactions':
+        return ('raw',)
+    if table == 'verified_tx3':
+        return ('height', 'timestamp', 'pos')
+    return ('value',)
+
+
+class SqliteWalletStorage(WalletStorage):
+
+    def __init__(self, path, manual_upgrades=False, *, in_memory_only=False):
+        if in_memory_only or not path:
+            raise SqliteStorageError('SQLite wallet storage needs a file path')
+        self.path = path = standardize_path(path)
+        self.print_error("wallet path", path)
+        self.manual_upgrades = manual_upgrades
+        self.lock = threading.RLock()
+        self.data = {}
+        self._file_exists = os.path.exists(self.path)
+        self.modified = False
+        self.pubkey = None
+        self.raw = None
+        self._in_memory_only = False
+        self._journal_pending = {}
+        self._journal_ready = False
+        self._compact_thread = None
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(_SCHEMA)
+        self.conn.commit()
+        if self._file_exists:
+            self.load_data()
+        else:
+            # avoid new wallets getting 'upgraded'
+            self.put('seed_version', FINAL_SEED_VERSION)
+
+    @profiler
+    def load_data(self, s=None, ec_key=None):
+        with self.lock:
+            self.data = {key: json.loads(value)
+                         for key, value in self.conn.execute('SELECT key, value FROM meta')}
+            for key in TABLES:
+                if key in self.data:
+                    # Files written before ct_txi and ct_txo had their own
+                    # tables keep them in meta.
+                    self._put_table(key, self.data.pop(key))
+                    self.conn.execute('DELETE FROM meta WHERE key = ?', (key,))
+                    self.conn.commit()
+        self._on_data_loaded()
+
+    def close(self):
+        ''' Commit and close the database. The storage cannot be used after
+        this. '''
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
+
+    def is_encrypted(self):
+        return False
+
+    def decrypt(self, password):
+        raise SqliteStorageError('SQLite wallet files are not encrypted')
+
+    def set_password(self, password, encrypt):
+        if encrypt and password:
+            raise SqliteStorageError('SQLite wallet storage does not support wallet file encryption')
+        self.put('use_encryption', bool(password))
+
+    def set_journal_enabled(self, enabled):
+        ''' Not applicable: SQLite already writes changes incrementally. '''
+
+    def get(self, key, default=None):
+        if key not in TABLES:
+            return super().get(key, default)
+        with self.lock:
+            d = {row[0]: _decode_row(key, row[1:])
+                 for row in self.conn.execute('SELECT key, {} FROM {}'.format(', '.join(_columns(key)), key))}
+        return d if d else default
+
+    def put(self, key, value):
+        with self.lock:
+            if key in TABLES:
+                if isinstance(value, RowMap) and value.storage is self and value.table == key:
+                    value.flush()
+                else:
+                    self._put_table(key, value or {})
+                return
+            if value is not None:
+                if self.data.get(key) != value:
+                    self.modified = True
+                    self.data[key] = value = copy.deepcopy(value)
+                    self.conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                                      (key, json.dumps(value)))
+            elif key in self.data:
+                self.modified = True
+                self.data.pop(key)
+                self.conn.execute('DELETE FROM meta WHERE key = ?', (key,))
+
+    def _put_table(self, table, d):
+        ''' Make `table` contain exactly the entries of dict `d`, writing only
+        the rows that differ. This reads the whole table: it is for bulk
+        replacement (e.g. migrate_json_to_sqlite). RowMaps track their changes
+        and write only those. '''
+        cols = _columns(table)
+        old = {row[0]: tuple(row[1:])
+               for row in self.conn.execute('SELECT key, {} FROM {}'.format(', '.join(cols), table))}
+        changed = []
+        for k, v in d.items():
+            row = _encode_row(table, v)
+            if old.pop(str(k), None) != row:
+                changed.append((str(k),) + row)
+        if changed:
+            self.conn.executemany('INSERT OR REPLACE INTO {} (key, {}) VALUES (?, {})'.format(
+                table, ', '.join(cols), ', '.join('?' * len(cols))), changed)
+        if old:
+            self.conn.executemany('DELETE FROM {} WHERE key = ?'.format(table), ((k,) for k in old))
+        if changed or old:
+            self.modified = True
+
+    # --- Row level access ---
+
+    def table_get(self, table, key, default=None):
+        with self.lock:
+            row = self.conn.execute('SELECT {} FROM {} WHERE key = ?'.format(', '.join(_columns(table)), table),
+                                    (key,)).fetchone()
+        return _decode_row(table, row) if row is not None else default
+
+    def table_put(self, table, key, value):
+        ''' Write a single row. A value of None deletes the row. '''
+        with self.lock:
+            if value is None:
+                self.conn.execute('DELETE FROM {} WHERE key = ?'.format(table), (key,))
+            else:
+                cols = _columns(table)
+                self.conn.execute('INSERT OR REPLACE INTO {} (key, {}) VALUES (?, {})'.format(
+                    table, ', '.join(cols), ', '.join('?' * len(cols))), (key,) + _encode_row(table, value))
+            self.modified = True
+
+    def table_write(self, table, rows, deleted=()):
+        ''' Write the (key, value) pairs of `rows` and delete the keys in
+        `deleted`. '''
+        cols = _columns(table)
+        with self.lock:
+            self.conn.executemany('INSERT OR REPLACE INTO {} (key, {}) VALUES (?, {})'.format(
+                table, ', '.join(cols), ', '.join('?' * len(cols))),
+                [(key,) + _encode_row(table, value) for key, value in rows])
+            self.conn.executemany('DELETE FROM {} WHERE key = ?'.format(table), ((key,) for key in deleted))
+            self.modified = True
+
+    def table_has(self, table, key):
+        with self.lock:
+            return self.conn.execute('SELECT 1 FROM {} WHERE key = ?'.format(table), (key,)).fetchone() is not None
+
+    def table_keys(self, table):
+        ''' Returns a list of all the keys of `table`, in sorted order. '''
+        with self.lock:
+            return [row[0] for row in self.conn.execute('SELECT key FROM {} ORDER BY key'.format(table))]
+
+    def table_items(self, table):
+        ''' Returns a list of all the (key, value) pairs of `table`. '''
+        with self.lock:
+            return [(row[0], _decode_row(table, row[1:]))
+                    for row in self.conn.execute('SELECT key, {} FROM {}'.format(', '.join(_columns(table)), table))]
+
+    def table_len(self, table):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM {}'.format(table)).fetchone()[0]
+
+    def table_clear(self, table):
+        with self.lock:
+            self.conn.execute('DELETE FROM {}'.format(table))
+            self.modified = True
+
+    def write(self):
+        with self.lock:
+            self._write()
+
+    def _write(self):
+        if threading.currentThread().isDaemon():
+            self.print_error('warning: daemon thread cannot write wallet')
+            return
+        if not self.modified:
+            return
+        self.conn.commit()
+        self._file_exists = True
+        self.print_error("saved", self.path)
+        self.modified = False
+
+    def write_snapshot(self):
+        ''' Commit, and move the write-ahead log into the database file so
+        that the file alone holds the whole wallet. '''
+        with self.lock:
+            self._write()
+            self.conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+
+class LazyTransactionMap(MutableMapping):
+    ''' Used for Abstract_Wallet.transactions when the wallet uses
+    SqliteWalletStorage. Maps tx_hash -> Transaction like the dict it
+    replaces, but raw transactions stay in the database and are only read
+    (and wrapped in a Transaction) when looked up. A bounded cache keeps the
+    Transaction objects of recently used entries so that repeated lookups
+    return the same object. Assignments and deletions go straight to the
+    database and are committed by the next storage.write(). '''
+
+    def __init__(self, storage, *, cache_size=2000):
+        self.storage = storage
+        self._cache = ExpiringCache(maxlen=cache_size, name="LazyTransactionMap")
+
+    def __getitem__(self, tx_hash):
+        tx = self._cache.get(tx_hash)
+        if tx is None:
+            raw = self.storage.table_get('transactions', tx_hash)
+            if raw is None:
+                raise KeyError(tx_hash)
+            tx = Transaction(raw)
+            self._cache.put(tx_hash, tx)
+        return tx
+
+    def __setitem__(self, tx_hash, tx):
+        self.storage.table_put('transactions', tx_hash, str(tx))
+        self._cache.put(tx_hash, tx)
+
+    def __delitem__(self, tx_hash):
+        if not self.storage.table_has('transactions', tx_hash):
+            raise KeyError(tx_hash)
+        self.storage.table_put('transactions', tx_hash, None)
+        self._cache.d.pop(tx_hash, None)
+
+    def __contains__(self, tx_hash):
+        return self.storage.table_has('transactions', tx_hash)
+
+    def __iter__(self):
+        # A list of keys, so that callers may mutate the map while iterating.
+        return iter(self.storage.table_keys('transactions'))
+
+    def __len__(self):
+        return self.storage.table_len('transactions')
+
+    def clear(self):
+        self.storage.table_clear('transactions')
+        self._cache.d.clear()
+
+
+class RowMap(MutableMapping):
+    ''' Used for the other big maps of Abstract_Wallet (txi, txo, ct_txi,
+    ct_txo, _history, verified_tx, tx_fees, pruned_txo, labels) when the
+    wallet uses SqliteWalletStorage. The keys of the table are read when the
+    map is created, but a value is only read (and decoded) the first time it
+    is looked up, and is then kept, so that code which modifies values in
+    place keeps working. With preload=True all the values are read up front.
+
+    Keys that are assigned or deleted are remembered, and flush() (called by
+    storage.put() of the map) writes just those rows. Code that modifies a
+    value in place must call touch(key) so that it is written too.
+
+    `decode` and `encode` convert a value from and to its stored form; encode
+    may return None to not store an entry (it is still kept in memory).
+    `decode_key` and `encode_key` do the same for keys. '''
+
+    def __init__(self, storage, table, *, decode=None, encode=None, decode_key=None, encode_key=None,
+                 preload=False):
+        assert table in TABLES and table != 'transactions'
+        self.storage = storage
+        self.table = table
+        self._decode = decode
+        self._encode = encode
+        self._encode_key = encode_key
+        self._values = {}
+        self._dirty = set()
+        self._cleared = False
+        if preload:
+            for key, value in storage.table_items(table):
+                if decode_key:
+                    key = decode_key(key)
+                self._values[key] = decode(value) if decode else value
+            # an ordered set
+            self._keys = dict.fromkeys(self._values)
+        else:
+            keys = storage.table_keys(table)
+            self._keys = dict.fromkeys(map(decode_key, keys) if decode_key else keys)
+
+    def __getitem__(self, key):
+        try:
+            return self._values[key]
+        except KeyError:
+            if key not in self._keys:
+                raise
+        value = self.storage.table_get(self.table, self._encode_key(key) if self._encode_key else key)
+        if value is None:
+            raise KeyError(key)
+        if self._decode:
+            value = self._decode(value)
+        self._values[key] = value
+        return value
+
+    def get(self, key, default=None):
+        if key in self._values:
+            return self._values[key]
+        if key not in self._keys:
+            return default
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        self._keys[key] = None
+        self._values[key] = value
+        self._dirty.add(key)
+
+    def __delitem__(self, key):
+        del self._keys[key]
+        self._values.pop(key, None)
+        self._dirty.add(key)
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def clear(self):
+        self._keys.clear()
+        self._values.clear()
+        self._dirty.clear()
+        self._cleared = True
+
+    def touch(self, key):
+        ''' Note that the value of `key` was modified in place. '''
+        self._dirty.add(key)
+
+    def flush(self):
+        ''' Write the rows changed since the last flush(). They are committed
+        by the next storage.write(). '''
+        if not self._dirty and not self._cleared:
+            return
+        rows, deleted = [], []
+        for key in self._dirty:
+            if key in self._keys and key not in self._values:
+                continue  # never read, so not changed
+            value = self._values.get(key) if key in self._keys else None
+            if value is not None and self._encode:
+                value = self._encode(value)
+            skey = self._encode_key(key) if self._encode_key else key
+            if value is None:
+                deleted.append(skey)
+            else:
+                rows.append((skey, value))
+        with self.storage.lock:
+            if self._cleared:
+                self.storage.table_clear(self.table)
+                self._cleared = False
+            self.storage.table_write(self.table, rows, deleted)
+        self._dirty.clear()
+
+
+@profiler
+def migrate_json_to_sqlite(src_path, dst_path):
+    ''' Copy the json wallet file at src_path to a new SQLite wallet file at
+    dst_path. The source file is left untouched. Encrypted wallet files must
+    first be saved unencrypted (the keystore may stay password protected). '''
+    src_path, dst_path = standardize_path(src_path), standardize_path(dst_path)
+    if os.path.exists(dst_path):
+        raise SqliteStorageError('destination file already exists: {}'.format(dst_path))
+    src = WalletStorage(src_path, manual_upgrades=True)
+    if isinstance(src, SqliteWalletStorage):
+        raise SqliteStorageError('{} is already a SQLite wallet'.format(src_path))
+    if not src.file_exists():
+        raise SqliteStorageError('no such wallet file: {}'.format(src_path))
+    if src.is_encrypted():
+        raise SqliteStorageError('cannot migrate an encrypted wallet file, remove the file encryption first')
+    if src.requires_split() or src.requires_upgrade():
+        raise SqliteStorageError('wallet file needs to be split or upgraded first, open it once to do so')
+    dst = SqliteWalletStorage(dst_path, manual_upgrades=True)
+    try:
+        with src.lock:
+            for key, value in src.data.items():
+                if key != 'storage_journal':
+                    dst.put(key, value)
+        dst.write()
+    finally:
+        dst.close()
+    return dst_path
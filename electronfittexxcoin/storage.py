@@ -49,6 +49,26 @@ FINAL_SEED_VERSION = 17     # electrum >= 2.7 will set this to prevent
 
 TMP_SUFFIX = ".tmp.{}".format(os.getpid())
 
+# The optional append-only journal lives next to the wallet file. See
+# WalletStorage.set_journal_enabled.
+JOURNAL_SUFFIX = ".journal"
+# The journal is folded back into the snapshot once it grows past this many
+# bytes, or past half the size of the snapshot itself, whichever is larger.
+JOURNAL_COMPACT_MIN_BYTES = 1024 * 1024
+
+
+def delete_wallet_file(path):
+    ''' Delete the wallet file at `path` and its journal, if any. Returns
+    False if there was no wallet file. '''
+    if not os.path.exists(path):
+        return False
+    os.unlink(path)
+    try:
+        os.unlink(path + JOURNAL_SUFFIX)
+    except FileNotFoundError:
+        pass
+    return True
+
 
 def multisig_type(wallet_type):
     '''If wallet_type is mofn multi-sig, return [m, n],
@@ -61,8 +81,28 @@ def multisig_type(wallet_type):
     return match
 
 
+SQLITE_MAGIC = b'SQLite format 3\x00'
+
+
+def is_sqlite_file(path):
+    '''Returns True if path is an existing SQLite database file (see
+    sqlite_storage.py), as opposed to a json wallet file.'''
+    try:
+        with open(path, 'rb') as f:
+            return f.read(len(SQLITE_MAGIC)) == SQLITE_MAGIC
+    except OSError:
+        return False
+
+
 class WalletStorage(PrintError):
 
+    def __new__(cls, path, *args, **kwargs):
+        # Existing SQLite wallet files are opened with the SQLite engine.
+        if cls is WalletStorage and path and is_sqlite_file(standardize_path(path)):
+            from .sqlite_storage import SqliteWalletStorage
+            cls = SqliteWalletStorage
+        return super().__new__(cls)
+
     def __init__(self, path, manual_upgrades=False, *, in_memory_only=False):
         self.path = path = standardize_path(path)
         self.print_error("wallet path", path)
@@ -74,6 +114,16 @@ class WalletStorage(PrintError):
         self.pubkey = None
         self.raw = None
         self._in_memory_only = in_memory_only
+        # Journal state. _journal_pending maps storage key -> pending op,
+        # _journal_ready is True when the on-disk snapshot + journal are in
+        # sync with self.data (so deltas may be appended).
+        self._journal_pending = {}
+        self._journal_ready = False
+        self._journal_seq = 0
+        self._journal_size = 0
+        self._snapshot_seq = 0
+        self._snapshot_hash = None  # of the wallet file the journal applies to
+        self._compact_thread = None
         if self.file_exists() and not self._in_memory_only:
             try:
                 with open(self.path, "r", encoding='utf-8') as f:
@@ -94,7 +144,7 @@ class WalletStorage(PrintError):
             bname = os.path.basename(self.path)
         return f"{dname}/{bname}"
 
-    def load_data(self, s):
+    def load_data(self, s, ec_key=None):
         try:
             self.data = json.loads(s)
 
@@ -116,6 +166,10 @@ class WalletStorage(PrintError):
                     continue
                 self.data[key] = value
 
+        self._load_journal(ec_key)
+        self._on_data_loaded()
+
+    def _on_data_loaded(self):
         # check here if I need to load a plugin
         t = self.get('wallet_type')
         l = plugin_loaders.get(t)
@@ -147,7 +201,7 @@ class WalletStorage(PrintError):
         s = zlib.decompress(ec_key.decrypt_message(self.raw)) if self.raw else None
         self.pubkey = ec_key.get_public_key()
         s = s.decode('utf8')
-        self.load_data(s)
+        self.load_data(s, ec_key)
 
     def set_password(self, password, encrypt):
         self.put('use_encryption', bool(password))
@@ -159,6 +213,9 @@ class WalletStorage(PrintError):
             self.pubkey = None
         if self.pubkey != old_pubkey:
             self.modified = True
+            # Journal records are encrypted to the old pubkey; force a full
+            # rewrite of the snapshot on the next write().
+            self._journal_ready = False
 
     def get(self, key, default=None):
         with self.lock:
@@ -172,12 +229,15 @@ class WalletStorage(PrintError):
     def put(self, key, value):
         with self.lock:
             if value is not None:
-                if self.data.get(key) != value:
+                old = self.data.get(key)
+                if old != value:
                     self.modified = True
-                    self.data[key] = copy.deepcopy(value)
+                    value = copy.deepcopy(value)
+                    self.data[key] = value
+                    self._journal_note(key, old, value)
             elif key in self.data:
                 self.modified = True
-                self.data.pop(key)
+                self._journal_note(key, self.data.pop(key), None)
 
     @profiler
     def write(self):
@@ -192,37 +252,372 @@ class WalletStorage(PrintError):
             return
         if not self.modified:
             return
-        s = json.dumps(self.data,
-                       indent=None if self.pubkey else 4,  # Fast settings if encrypted,
-                       sort_keys=not self.pubkey)          # readable settings otherwise.
-        if self.pubkey:
+        if self._journal_ready and self.file_exists():
+            if self._journal_pending:
+                self._append_journal()
+            self.modified = False
+            if self._journal_size > max(JOURNAL_COMPACT_MIN_BYTES, len(self.raw or '') // 2):
+                self._start_compaction()
+            return
+        self._write_snapshot()
+
+    def write_snapshot(self):
+        ''' Like write(), but always leaves the whole wallet in the wallet
+        file itself, folding the journal into it. Call this before copying
+        the wallet file elsewhere. '''
+        if self._in_memory_only:
+            return
+        self.join_compaction()
+        with self.lock:
+            if self.modified or os.path.exists(self.journal_path()):
+                self._write_snapshot()
+
+    def _dump_snapshot(self):
+        # Must be called with the lock held.
+        jinfo = self.data.get('storage_journal')
+        if jinfo is not None:
+            jinfo['seq'] = self._journal_seq
+        return json.dumps(self.data,
+                          indent=None if self.pubkey else 4,  # Fast settings if encrypted,
+                          sort_keys=not self.pubkey)          # readable settings otherwise.
+
+    @staticmethod
+    def _encode_snapshot(s, pubkey):
+        if pubkey:
             s = bytes(s, 'utf8')
             c = zlib.compress(s)
-            s = bitcoin.encrypt_message(c, self.pubkey)
+            s = bitcoin.encrypt_message(c, pubkey)
             s = s.decode('utf8')
+        return s
 
-        temp_path = self.path + TMP_SUFFIX
-        with open(temp_path, "w", encoding='utf-8') as f:
+    @staticmethod
+    def _snapshot_digest(s):
+        return hashlib.sha256(s.encode('utf8')).hexdigest()
+
+    def _write_snapshot(self):
+        self._journal_pending.clear()
+        s = self._encode_snapshot(self._dump_snapshot(), self.pubkey)
+        self._replace_file(self.path, s)
+        self.raw = s
+        self._file_exists = True
+        self._snapshot_seq = self._journal_seq
+        self._snapshot_hash = self._snapshot_digest(s)
+        self.print_error("saved", self.path)
+        self.modified = False
+        # Every journal record is now part of the snapshot.
+        self._remove_journal()
+        self._journal_ready = self.is_journal_enabled()
+
+    def _replace_file(self, path, s, temp_suffix=TMP_SUFFIX):
+        ''' Atomically replace the file at `path` with `s` (str or bytes),
+        keeping the file mode of the file being replaced. '''
+        self._install_file(self._write_temp_file(path, s, temp_suffix), path)
+
+    @staticmethod
+    def _write_temp_file(path, s, temp_suffix=TMP_SUFFIX):
+        ''' Write `s` to a temporary file next to `path`, for _install_file.
+        Returns the temporary file's path. '''
+        temp_path = path + temp_suffix
+        if isinstance(s, str):
+            f = open(temp_path, "w", encoding='utf-8')
+        else:
+            f = open(temp_path, "wb")
+        with f:
             f.write(s)
             f.flush()
             os.fsync(f.fileno())
+        return temp_path
 
+    def _install_file(self, temp_path, path):
+        ''' Atomically move the file written by _write_temp_file to `path`. '''
+        is_wallet_file = path == self.path
         default_mode = stat.S_IREAD | stat.S_IWRITE
         try:
-            mode = os.stat(self.path).st_mode if self.file_exists() else default_mode
+            mode = os.stat(path).st_mode if not is_wallet_file or self.file_exists() else default_mode
         except FileNotFoundError:
             mode = default_mode
-            self._file_exists = False
+            if is_wallet_file:
+                self._file_exists = False
 
-        if not self.file_exists():
+        if is_wallet_file and not self.file_exists():
             # See: https://github.com/spesmilo/electrum/issues/5082
             assert not os.path.exists(self.path)
-        os.replace(temp_path, self.path)
-        os.chmod(self.path, mode)
-        self.raw = s
-        self._file_exists = True
-        self.print_error("saved", self.path)
-        self.modified = False
+        os.replace(temp_path, path)
+        os.chmod(path, mode)
+
+    # --- Journal ---
+    #
+    # When the journal is enabled, write() does not rewrite the whole wallet
+    # file. The keys changed by put() since the last write are instead
+    # appended as a single delta record to "<wallet>.journal". For dict-valued
+    # keys (transactions, txi, txo, labels, verified_tx3, ...) only the
+    # changed entries of the dict are recorded.
+    #
+    # A record is one line: "<crc32 hex> <payload>\n". The payload is the json
+    # record, ECIES-encrypted to the wallet pubkey (just like the snapshot) if
+    # the wallet is encrypted. Records are numbered, and the snapshot stores
+    # the number of the last record folded into it, so that on load only newer
+    # records are replayed. A torn or corrupt record (crash mid-append) ends
+    # the replay and is truncated away, and so does a gap in the numbering.
+    #
+    # The journal is bound to one specific snapshot: it starts with a header
+    # record holding the sha256 of the wallet file it applies to. If the file
+    # was rewritten by something that doesn't know about the journal (an
+    # older version, say), no header matches and the journal is discarded
+    # instead of being replayed over the newer data.
+    #
+    # Once the journal gets large it is folded back into the snapshot by a
+    # background thread, see _compact().
+
+    def is_journal_enabled(self):
+        return bool(self.data.get('storage_journal')) and not self._in_memory_only and bool(self.path)
+
+    def set_journal_enabled(self, enabled):
+        ''' Turn the append-only journal on or off for this wallet. The setting
+        is saved in the wallet file. The next write() always writes a full
+        snapshot. '''
+        with self.lock:
+            if bool(enabled) == bool(self.data.get('storage_journal')):
+                return
+            if enabled:
+                self.data['storage_journal'] = {'id': bitcoin.bh2u(os.urandom(16)), 'seq': 0}
+            else:
+                self.data.pop('storage_journal', None)
+            self._journal_seq = 0
+            self._journal_pending.clear()
+            self._journal_ready = False
+            self.modified = True
+
+    def journal_path(self):
+        return self.path + JOURNAL_SUFFIX
+
+    def _journal_note(self, key, old, new):
+        ''' Remember the change of `key` from `old` to `new` (None if deleted)
+        for the next journal append. Called with the lock held. '''
+        if not self.data.get('storage_journal') or key == 'storage_journal':
+            return
+        pending = self._journal_pending.get(key)
+        if (isinstance(old, dict) and isinstance(new, dict)
+                and (pending is None or pending[0] == 'patch')):
+            sets, dels = (pending[1], pending[2]) if pending else ({}, set())
+            for k, v in new.items():
+                if k not in old or old[k] != v:
+                    sets[k] = v
+                    dels.discard(k)
+            for k in old.keys() - new.keys():
+                sets.pop(k, None)
+                dels.add(k)
+            self._journal_pending[key] = ('patch', sets, dels)
+        elif new is None:
+            self._journal_pending[key] = ('del',)
+        else:
+            self._journal_pending[key] = ('set', new)
+
+    def _encode_journal_record(self, rec):
+        payload = json.dumps(rec, separators=(',', ':'))
+        if self.pubkey:
+            payload = bitcoin.encrypt_message(zlib.compress(bytes(payload, 'utf8')), self.pubkey)
+        else:
+            payload = payload.encode('utf8')
+        return b'%08x %s\n' % (zlib.crc32(payload), payload)
+
+    def _append_journal(self):
+        ops = []
+        for key, op in self._journal_pending.items():
+            if op[0] == 'patch':
+                ops.append(['patch', key, op[1], sorted(op[2])])
+            else:
+                ops.append([op[0], key, *op[1:]])
+        self._journal_pending.clear()
+        jid = self.data['storage_journal']['id']
+        line = self._encode_journal_record({'id': jid, 'seq': self._journal_seq + 1, 'ops': ops})
+        if not self._journal_size:
+            line = self._journal_header(jid, self._snapshot_hash, self._snapshot_seq) + line
+        jpath = self.journal_path()
+        new_file = not os.path.exists(jpath)
+        with open(jpath, "ab") as f:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+        if new_file:
+            os.chmod(jpath, stat.S_IMODE(os.stat(self.path).st_mode))
+        self._journal_seq += 1
+        self._journal_size += len(line)
+        self.print_error("journal: appended record", self._journal_seq, "({} bytes)".format(len(line)))
+
+    def _journal_header(self, jid, snapshot_hash, seq):
+        ''' The record binding the journal records that follow it to the
+        snapshot with hash `snapshot_hash`, which holds the records up to
+        `seq`. '''
+        return self._encode_journal_record({'id': jid, 'snapshot': snapshot_hash, 'seq': seq})
+
+    def _apply_journal_ops(self, ops):
+        for op in ops:
+            kind, key = op[0], op[1]
+            if kind == 'set':
+                self.data[key] = op[2]
+            elif kind == 'del':
+                self.data.pop(key, None)
+            elif kind == 'patch':
+                d = self.data.get(key)
+                if not isinstance(d, dict):
+                    d = self.data[key] = {}
+                d.update(op[2])
+                for k in op[3]:
+                    d.pop(k, None)
+            else:
+                raise ValueError('unknown journal op: {}'.format(kind))
+
+    def _load_journal(self, ec_key=None):
+        ''' Replay the journal on top of the snapshot just loaded into
+        self.data. '''
+        self._journal_ready = False
+        jinfo = self.data.get('storage_journal')
+        if not jinfo or self._in_memory_only or not self.path:
+            return
+        seq = self._snapshot_seq = jinfo.get('seq', 0)
+        snapshot_hash = self._snapshot_hash = self._snapshot_digest(self.raw)
+        try:
+            with open(self.journal_path(), "rb") as f:
+                raw = f.read()
+        except FileNotFoundError:
+            raw = b''
+        records = []  # (offset, record)
+        good = 0
+        for line in raw.splitlines(keepends=True):
+            if not line.endswith(b'\n'):
+                break  # torn append
+            try:
+                crc, payload = line[:-1].split(b' ', 1)
+                if int(crc, 16) != zlib.crc32(payload):
+                    break
+                if ec_key:
+                    payload = zlib.decompress(ec_key.decrypt_message(payload))
+                rec = json.loads(payload.decode('utf8'))
+            except Exception as e:
+                self.print_error("journal: bad record:", repr(e))
+                break
+            if rec.get('id') == jinfo['id']:
+                records.append((good, rec))
+            good += len(line)
+        # Replay from the header of our snapshot. There may be two headers:
+        # compaction binds the journal to the new snapshot before installing
+        # it.
+        base = None
+        for i, (offset, rec) in enumerate(records):
+            if 'snapshot' in rec and rec['snapshot'] == snapshot_hash:
+                base = i
+        applied = 0
+        if base is None:
+            if raw:
+                self.print_error("journal: not made for this wallet file, discarding it")
+            good = 0
+        else:
+            seq = records[base][1]['seq']
+            for offset, rec in records:
+                if 'snapshot' in rec or rec['seq'] <= seq:
+                    continue
+                if rec['seq'] != seq + 1:
+                    self.print_error("journal: record", rec['seq'], "follows", seq)
+                    good = offset
+                    break
+                self._apply_journal_ops(rec['ops'])
+                seq = rec['seq']
+                applied += 1
+        if good < len(raw):
+            self.print_error("journal: discarding {} bytes of records".format(len(raw) - good))
+            if good:
+                with open(self.journal_path(), "r+b") as f:
+                    f.truncate(good)
+                    f.flush()
+                    os.fsync(f.fileno())
+            else:
+                self._remove_journal()
+        if applied:
+            self.print_error("journal: replayed {} records".format(applied))
+        self._journal_seq = seq
+        self._journal_size = good
+        self._journal_ready = True
+
+    def _remove_journal(self):
+        if self.path:
+            try:
+                os.unlink(self.journal_path())
+            except FileNotFoundError:
+                pass
+        self._journal_size = 0
+
+    def _start_compaction(self):
+        if self._compact_thread and self._compact_thread.is_alive():
+            return
+        # Not a daemon thread: it must not be killed halfway through a write.
+        self._compact_thread = threading.Thread(target=self._compact, name="WalletStorage compaction")
+        self._compact_thread.start()
+
+    def _compact(self):
+        ''' Fold the journal back into the snapshot. The new snapshot is
+        encoded, written and fsynced without the lock held; the lock is only
+        taken to dump the json and, at the end, to rename the file into place
+        and swap in the journal records appended meanwhile. So put() and
+        write() are not held up for long. '''
+        temp_path = None
+        try:
+            with self.lock:
+                if not self._journal_ready:
+                    return
+                seq, pubkey, offset = self._journal_seq, self.pubkey, self._journal_size
+                jid = self.data['storage_journal']['id']
+                s = self._dump_snapshot()
+            s = self._encode_snapshot(s, pubkey)
+            snapshot_hash = self._snapshot_digest(s)
+            temp_path = self._write_temp_file(self.path, s, TMP_SUFFIX + ".compact")
+            with self.lock:
+                if not self._journal_ready or pubkey != self.pubkey or self._snapshot_seq >= seq:
+                    return  # a full write() beat us to it
+                jpath = self.journal_path()
+                with open(jpath, "rb") as f:
+                    f.seek(offset)
+                    tail = f.read()
+                # Bind the journal to the new snapshot too before installing
+                # it, so that whichever file is there after a crash, its
+                # records are replayed.
+                header = self._journal_header(jid, snapshot_hash, seq)
+                with open(jpath, "ab") as f:
+                    f.write(header)
+                    f.flush()
+                    os.fsync(f.fileno())
+                self._journal_size += len(header)
+                self._install_file(temp_path, self.path)
+                temp_path = None
+                self.raw = s
+                self._snapshot_seq = seq
+                self._snapshot_hash = snapshot_hash
+                # Keep only the records that were appended while we worked.
+                if tail:
+                    self._replace_file(jpath, header + tail)
+                    self._journal_size = len(header) + len(tail)
+                else:
+                    self._remove_journal()
+                self.print_error("journal: compacted into", self.path)
+        except Exception as e:
+            # Not fatal, the snapshot + journal on disk are still consistent.
+            self.print_error("journal: compaction failed:", repr(e))
+        finally:
+            if temp_path is not None:
+                try:
+                    os.unlink(temp_path)
+                except OSError:
+                    pass
+
+    def join_compaction(self):
+        ''' Wait for a background compaction, if any, to finish. '''
+        t = self._compact_thread
+        if t and t is not threading.current_thread():
+            t.join()
+
+    def close(self):
+        ''' Called when the wallet is closed for good. '''
+        self.join_compaction()
 
     def requires_split(self):
         d = self.get('accounts', {})
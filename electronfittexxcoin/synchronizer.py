@@ -27,10 +27,16 @@
 # SOFTWARE.
 
 from collections import defaultdict
+from operator import itemgetter
 from threading import Lock
-from typing import DefaultDict, Dict, Iterable, Optional, Set, Tuple
+from typing import DefaultDict, Dict, Iterable, List, Optional, Set, Tuple
 import hashlib
+import heapq
+import itertools
+import queue
 import sys
+import threading
+import time
 import traceback
 import warnings
 
@@ -41,6 +47,61 @@ from . import networks
 from .bitcoin import InvalidXKeyFormat
 
 
+class RollingStatus:
+    """The status of the history of a scripthash (see Synchronizer.get_status), kept up to date as the history
+    changes.  Only the entries after the part the new history has in common with the previous one are hashed,
+    resuming from a copy of the sha256 state, so a history that grew by a few entries costs only those."""
+
+    # A copy of the hash state is kept every this many entries, to resume from when entries before the end changed
+    SNAPSHOT_EVERY = 256
+
+    __slots__ = ('hist', 'snapshots', 'status', 'source', 'source_len')
+
+    def __init__(self):
+        self.hist = []  # the entries hashed so far
+        self.snapshots = [(0, hashlib.sha256())]  # (number of entries hashed, sha256 state), by number of entries
+        self.status = None
+        # The list the status was last computed for, and its length then.  Histories are only ever replaced or
+        # appended to, so the same list with the same length has the same status.
+        self.source = None
+        self.source_len = 0
+
+    def update(self, hist) -> Optional[str]:
+        """Returns the status of hist, a list of (tx_hash, height)."""
+        if hist is self.source and len(hist) == self.source_len:
+            return self.status
+        old = self.hist
+        n = min(len(old), len(hist))
+        if old[:n] == hist[:n]:
+            common = n
+        else:
+            # Binary search for the length of the common prefix
+            lo, hi = 0, n - 1
+            while lo < hi:
+                mid = (lo + hi + 1) // 2
+                if old[:mid] == hist[:mid]:
+                    lo = mid
+                else:
+                    hi = mid - 1
+            common = lo
+        snapshots = self.snapshots
+        while snapshots[-1][0] > common:
+            snapshots.pop()
+        pos, sha = snapshots[-1]
+        sha = sha.copy()
+        every = self.SNAPSHOT_EVERY
+        for i in range(pos, len(hist)):
+            tx_hash, height = hist[i]
+            sha.update(f"{tx_hash}:{height:d}:".encode('ascii'))
+            if not (i + 1) % every:
+                snapshots.append((i + 1, sha.copy()))
+        self.hist = list(hist)
+        self.status = bh2u(sha.digest()) if hist else None
+        self.source = hist
+        self.source_len = len(hist)
+        return self.status
+
+
 class Synchronizer(ThreadJob):
     """The synchronizer keeps the wallet up-to-date with its set of
     addresses and their transactions.  It subscribes over the network
@@ -49,8 +110,15 @@ class Synchronizer(ThreadJob):
     we don't have the full history of, and requests binary transaction
     data of any transactions the wallet doesn't have.
 
+    Missing transactions are requested most recent first, at most
+    TX_WINDOW at a time, and a worker thread deserializes them and
+    adds them to the wallet.
+
     External interface: __init__() and add() member functions."""
 
+    # Maximum number of txs requested or waiting for the worker thread at a time
+    TX_WINDOW = 200
+
     def __init__(self, wallet, network):
         self.wallet = wallet
         self.network = network
@@ -58,6 +126,8 @@ class Synchronizer(ThreadJob):
         self.cleaned_up = False
         self._need_release = False
         self.new_addresses: Set[Address] = set()
+        # Addresses the wallet removed, to unsubscribe from (see remove())
+        self.removed_addresses: Set[Address] = set()
         if ((sys.implementation.name == 'cpython' and sys.version_info < (3, 6, 0))
                 or (sys.implementation.name != 'cpython' and sys.version_info < (3, 7, 0))):
             # Assumption: CPython 3.6+, or other Python 3.7+
@@ -66,8 +136,22 @@ class Synchronizer(ThreadJob):
                           " Please switch Python versions!", RuntimeWarning, stacklevel=2)
         # Basically, an ordered set of Addresses
         self.new_addresses_for_change: Dict[Address, None] = dict()
-        # Mapping of tx_hash -> tx_height
+        # Mapping of tx_hash -> tx_height, of the txs missing from the wallet: queued, being fetched or being
+        # processed
         self.requested_tx: Dict[str, int] = dict()
+        # Heap of (priority, seq, tx_hash, scripthash) of the missing txs not yet requested, see _request_missing_txs
+        self.tx_queue: List[Tuple[int, int, str, Optional[str]]] = []
+        self.tx_seq = itertools.count()
+        # Mapping of tx_hash -> scripthash of the txs requested and not yet done with
+        self.tx_fetching: Dict[str, Optional[str]] = dict()
+        # The worker thread (started on demand) gets (tx_hash, raw tx, height) from tx_work and gives back the
+        # tx_hash in tx_done once done
+        self.tx_worker: Optional[threading.Thread] = None
+        self.tx_work = queue.Queue()
+        self.tx_done = queue.Queue()
+        # Number of txs done since requested_tx was last empty, for the progress
+        self.tx_fetched = 0
+        self.tx_last_update = 0.0
         # Mapping of scripthash -> set of requested tx_hashes
         self.requested_tx_by_sh: DefaultDict[str, Set[str]] = defaultdict(set)
         self.requested_histories = {}
@@ -81,6 +165,8 @@ class Synchronizer(ThreadJob):
         self.change_subs_expiry_candidates: Set[str] = set()
         # mapping of scripthash -> Address
         self.h2addr: Dict[str, Address] = {}
+        # mapping of scripthash -> RollingStatus of its history
+        self.statuses: Dict[str, RollingStatus] = {}
         self.lock = Lock()
         self._tick_ct = 0
         self.limit_change_subs = max(self.wallet.limit_change_addr_subs, 0)  # Disallow negatives; they create problems
@@ -126,6 +212,16 @@ class Synchronizer(ThreadJob):
         self.network.cancel_requests(self._on_address_history)
         self.network.cancel_requests(self._tx_response)
         self.network.remove_jobs([self])
+        if self.tx_worker:
+            # Drop the txs the worker did not get to, and stop it
+            while True:
+                try:
+                    self.tx_work.get_nowait()
+                except queue.Empty:
+                    break
+            self.tx_work.put(None)
+            self.tx_worker = None
+        self.statuses.clear()
 
     def release(self):
         """ Called from main thread, enqueues a 'release' to happen in the
@@ -141,6 +237,30 @@ class Synchronizer(ThreadJob):
                 # we use a dict here to preserve order -- this is an "ordered set"
                 self.new_addresses_for_change[address] = None
 
+    def remove(self, addresses: Iterable[Address]):
+        """ Called by the wallet after it removed addresses (the unused
+        lookahead addresses of a restore). This can be called from the proxy
+        or GUI threads. """
+        with self.lock:
+            self.removed_addresses.update(addresses)
+
+    def _unsubscribe_removed(self):
+        with self.lock:
+            removed, self.removed_addresses = self.removed_addresses, set()
+            self.new_addresses -= removed
+            for addr in removed:
+                self.new_addresses_for_change.pop(addr, None)
+        if not removed:
+            return
+        hashes = [addr.to_scripthash_hex() for addr in removed]
+        for sh in hashes:
+            self.h2addr.pop(sh, None)
+            self.statuses.pop(sh, None)
+            self.requested_hashes.discard(sh)
+            self.change_subs.discard(sh)
+            self.change_subs_expiry_candidates.discard(sh)
+        self.network.unsubscribe_from_scripthashes(hashes, self._on_address_status)
+
     def _check_change_subs_limits(self):
         if not self.limit_change_subs:
             return
@@ -160,6 +280,7 @@ class Synchronizer(ThreadJob):
             self.change_scripthashes_that_are_retired.add(scripthash)
             self.change_subs_expiry_candidates.discard(scripthash)
             self.change_subs.discard(scripthash)
+            self.statuses.pop(scripthash, None)
             ctr -= 1
         if unsubs:
             self.print_error(f"change_subs limit reached ({self.limit_change_subs}), unsubscribing from"
@@ -167,8 +288,25 @@ class Synchronizer(ThreadJob):
                              f" change scripthash subs ct now: {len(self.change_subs)}")
             self.network.unsubscribe_from_scripthashes(unsubs, self._on_address_status)
 
+    def _by_recency(self, addresses: Iterable[Address]) -> List[Address]:
+        """ Returns addresses with the most recently used ones first: those with unconfirmed history, then by the
+        height of their last transaction, then those without history in their original order. """
+        get_address_history = self.wallet.get_address_history
+        no_history = (1, 0)
+
+        def key(addr):
+            hist = get_address_history(addr)
+            if not hist:
+                return no_history
+            height = hist[-1][1]
+            return (0, -height if height > 0 else -sys.maxsize)
+
+        return sorted(addresses, key=key)
+
     def _subscribe_to_addresses(self, addresses: Iterable[Address], *, for_change=False):
-        hashes2addr = {addr.to_scripthash_hex(): addr for addr in addresses}
+        # The subscriptions go out in order (batched by the interface), so the addresses likely to have news
+        # sync first.
+        hashes2addr = {addr.to_scripthash_hex(): addr for addr in self._by_recency(addresses)}
         if not hashes2addr:
             return  # Nothing to do!
         # Keep a hash -> address mapping
@@ -203,6 +341,13 @@ class Synchronizer(ThreadJob):
             status.extend(f"{tx_hash}:{height:d}:".encode('ascii'))
         return bh2u(hashlib.sha256(status).digest())
 
+    def _get_status(self, scripthash: str, hist: List[Tuple[str, int]]) -> Optional[str]:
+        """ Same as get_status(hist), but only hashes what changed since the last history of scripthash. """
+        rolling = self.statuses.get(scripthash)
+        if rolling is None:
+            rolling = self.statuses[scripthash] = RollingStatus()
+        return rolling.update(hist)
+
     @property
     def change_subs_active(self) -> Set[str]:
         return self.change_subs - self.requested_hashes
@@ -246,7 +391,7 @@ class Synchronizer(ThreadJob):
         if not addr:
             return  # Bad server response?
         history = self.wallet.get_address_history(addr)
-        if self.get_status(history) != result:
+        if self._get_status(scripthash, history) != result:
             if self.requested_histories.get(scripthash) is None:
                 self.requested_histories[scripthash] = result
                 self.network.request_scripthash_history(scripthash, self._on_address_history)
@@ -268,17 +413,16 @@ class Synchronizer(ThreadJob):
         self.print_error("receiving history {} {}".format(addr, len(result)))
         # Remove request; this allows up_to_date to be True
         server_status = self.requested_histories.pop(scripthash)
-        hashes = set(map(fittexxcoin item: item['tx_hash'], result))
-        hist = list(map(fittexxcoin item: (item['tx_hash'], item['height']), result))
+        hist = list(map(itemgetter('tx_hash', 'height'), result))
+        hashes = set(map(itemgetter(0), hist))
         # tx_fees
-        tx_fees = [(item['tx_hash'], item.get('fee')) for item in result]
-        tx_fees = dict(filter(fittexxcoin x:x[1] is not None, tx_fees))
+        tx_fees = {item['tx_hash']: item['fee'] for item in result if item.get('fee') is not None}
         # Check that txids are unique
         if len(hashes) != len(result):
             self.print_error("error: server history has non-unique txids: {}"
                              .format(addr))
         # Check that the status corresponds to what was announced
-        elif self.get_status(hist) != server_status:
+        elif self._get_status(scripthash, hist) != server_status:
             self.print_error("error: status mismatch: {}".format(addr))
         else:
             # Store received history
@@ -288,73 +432,143 @@ class Synchronizer(ThreadJob):
         # Check that this scripthash is a candidate for purge
         self._check_change_scripthash(scripthash)
 
-    def _tx_response(self, response, scripthash: Optional[str]):
+    def _tx_response(self, response):
         if self.cleaned_up:
             return
         params, result, error = self._parse_response(response)
         tx_hash = params[0] or ''
-        # unconditionally pop. so we don't end up in a "not up to date" state
-        # on bad server reply or reorg.
-        # see Electrum commit 7b8114f865f644c5611c3bb849c4f4fc6ce9e376 fix#5122
-        tx_height = self.requested_tx.pop(tx_hash, 0)
+        if tx_hash not in self.tx_fetching:
+            return  # Not requested (anymore)
+        if error:
+            # was some response error.
+            # we assume a blockchain reorg happened and tx disappeared.
+            # unconditionally pop. so we don't end up in a "not up to date" state
+            # on bad server reply or reorg.
+            # see Electrum commit 7b8114f865f644c5611c3bb849c4f4fc6ce9e376 fix#5122
+            self.print_error("error for tx_hash {}, skipping".format(tx_hash))
+            self.tx_done.put(tx_hash)
+            return
+        # Deserializing and adding the tx to the wallet is left to the worker thread
+        if self.tx_worker is None:
+            self.tx_worker = threading.Thread(target=self._tx_worker_thread, args=(self.tx_work,),
+                                              name='Synchronizer tx worker', daemon=True)
+            self.tx_worker.start()
+        self.tx_work.put((tx_hash, result, self.requested_tx.get(tx_hash, 0)))
+
+    def _tx_worker_thread(self, work: queue.Queue):
+        """ Runs in the thread self.tx_worker: deserializes the received txs and adds them to the wallet, then hands
+        them back to the network thread (see _process_done_txs). Stops once released, without adding the txs
+        still queued to the wallet. """
+        while True:
+            item = work.get()
+            if item is None or self.cleaned_up:
+                return
+            tx_hash, raw, tx_height = item
+            try:
+                self._receive_tx(tx_hash, raw, tx_height)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                self.tx_done.put(tx_hash)
+
+    def _receive_tx(self, tx_hash: str, raw: str, tx_height: int):
+        try:
+            tx = Transaction(raw)
+            tx.deserialize()
+        except Exception:
+            traceback.print_exc()
+            self.print_msg("cannot deserialize transaction, skipping", tx_hash)
+            return
+        # Paranoia - in case server is malicious and serves bogus tx.
+        # We must do this because verifier verifies merkle_proof based on this
+        # tx_hash.
+        chk_txid = tx.txid_fast()
+        if tx_hash != chk_txid:
+            self.print_error("received tx does not match expected txid ({} != {}), skipping"
+                             .format(tx_hash, chk_txid))
+            return
+        del chk_txid
+        # /Paranoia
+        self.wallet.receive_tx_callback(tx_hash, tx, tx_height)
+        self.print_error("received tx %s height: %d bytes: %d" %
+                         (tx_hash, tx_height, len(tx.raw)))
+        # callbacks
+        self.network.trigger_callback('new_transaction', tx, self.wallet)
+
+    def _tx_done(self, tx_hash: str):
+        """ Called in the network thread once tx_hash was received and processed, or failed. """
+        scripthash = self.tx_fetching.pop(tx_hash, None)
+        self.requested_tx.pop(tx_hash, None)
+        self.tx_fetched += 1
         # Maintain the requested_tx_by_sh dict
         if scripthash in self.requested_tx_by_sh:
             self.requested_tx_by_sh[scripthash].discard(tx_hash)
             if not self.requested_tx_by_sh[scripthash]:
                 del self.requested_tx_by_sh[scripthash]
+        # wallet balance updated for this sh, check if it is a candidate for purge
+        self._check_change_scripthash(scripthash)
 
-        def process():
-            if error:
-                # was some response error. note we popped the tx already
-                # we assume a blockchain reorg happened and tx disappeared.
-                self.print_error("error for tx_hash {}, skipping".format(tx_hash))
-                return
+    def _process_done_txs(self):
+        """ Takes back the txs the worker thread is done with, and requests more. """
+        done_ct = 0
+        while True:
             try:
-                tx = Transaction(result)
-                tx.deserialize()
-            except Exception:
-                traceback.print_exc()
-                self.print_msg("cannot deserialize transaction, skipping", tx_hash)
-                return
-            # Paranoia - in case server is malicious and serves bogus tx.
-            # We must do this because verifier verifies merkle_proof based on this
-            # tx_hash.
-            chk_txid = tx.txid_fast()
-            if tx_hash != chk_txid:
-                self.print_error("received tx does not match expected txid ({} != {}), skipping"
-                                 .format(tx_hash, chk_txid))
-                return
-            del chk_txid
-            # /Paranoia
-            self.wallet.receive_tx_callback(tx_hash, tx, tx_height)
-            self.print_error("received tx %s height: %d bytes: %d" %
-                             (tx_hash, tx_height, len(tx.raw)))
-            # callbacks
-            self.network.trigger_callback('new_transaction', tx, self.wallet)
-            if not self.requested_tx:
-                self.network.trigger_callback('wallet_updated', self.wallet)
+                tx_hash = self.tx_done.get_nowait()
+            except queue.Empty:
+                break
+            self._tx_done(tx_hash)
+            done_ct += 1
+        if not done_ct:
+            return
+        self._send_tx_requests()
+        now = time.time()
+        if not self.requested_tx:
+            self.tx_fetched = 0
+            self.network.trigger_callback('wallet_updated', self.wallet)
+        elif now - self.tx_last_update >= 1.0:
+            # So that the progress is shown, and the history as it fills in
+            self.network.trigger_callback('wallet_updated', self.wallet)
+        else:
+            return
+        self.tx_last_update = now
 
-        process()
+    def _send_tx_requests(self):
+        """ Requests the most recent missing txs, keeping at most TX_WINDOW of them requested or waiting for the
+        worker thread. """
+        requests = []
+        room = self.TX_WINDOW - len(self.tx_fetching)
+        while room > 0 and self.tx_queue:
+            _, _, tx_hash, scripthash = heapq.heappop(self.tx_queue)
+            if tx_hash not in self.requested_tx or tx_hash in self.tx_fetching:
+                continue
+            self.tx_fetching[tx_hash] = scripthash
+            requests.append(('blockchain.transaction.get', [tx_hash]))
+            room -= 1
+        if requests:
+            self.network.send(requests, self._tx_response)
 
-        # wallet balance updated for this sh, check if it is a candidate for purge
-        self._check_change_scripthash(scripthash)
+    def get_tx_progress(self) -> Tuple[int, int]:
+        """ Returns the number of txs fetched since the wallet last had all its txs, and the number still missing. """
+        return self.tx_fetched, len(self.requested_tx)
 
     def _request_missing_txs(self, hist: Iterable[Tuple[str, int]], scripthash: Optional[str]) -> bool:
         # "hist" is a list of [tx_hash, tx_height] lists
-        requests = []
+        queued = False
         for tx_hash, tx_height in hist:
             if tx_hash in self.requested_tx:
                 continue
             if tx_hash in self.wallet.transactions:
                 continue
-            requests.append(('blockchain.transaction.get', [tx_hash]))
+            # Newest first: unconfirmed, then by decreasing height
+            priority = -tx_height if tx_height > 0 else -sys.maxsize
+            heapq.heappush(self.tx_queue, (priority, next(self.tx_seq), tx_hash, scripthash))
             self.requested_tx[tx_hash] = tx_height
+            queued = True
             if self.limit_change_subs and scripthash is not None:
                 self.requested_tx_by_sh[scripthash].add(tx_hash)
-        if requests:
-            self.network.send(requests, fittexxcoin response: self._tx_response(response, scripthash))
-            return True
-        return False
+        if queued:
+            self._send_tx_requests()
+        return queued
 
     @profiler
     def _initialize(self):
@@ -372,10 +586,13 @@ class Synchronizer(ThreadJob):
         if self.requested_tx:
             self.print_error("missing tx", self.requested_tx)
 
-        self._subscribe_to_addresses(self.wallet.get_receiving_addresses())
         if not self.limit_change_subs:
-            self._subscribe_to_addresses(self.wallet.get_change_addresses(), for_change=True)
+            # All at once, so that recently used change addresses come before the unused receiving ones.  (Without
+            # the limit, for_change makes no difference.)
+            self._subscribe_to_addresses([*self.wallet.get_receiving_addresses(),
+                                         *self.wallet.get_change_addresses()])
         else:
+            self._subscribe_to_addresses(self.wallet.get_receiving_addresses())
             # Subs limiting for change addrs in place, do it in the network thread next time we run, grabbing
             # self.limit_change_subs addresses at a time
             with self.lock:
@@ -416,8 +633,12 @@ class Synchronizer(ThreadJob):
         self._tick_ct += 1
 
         try:
-            # 1. Create new addresses
+            # 0. Take back the txs processed by the worker thread
+            self._process_done_txs()
+
+            # 1. Create new addresses (or remove the lookahead ones of a restore)
             self.wallet.synchronize()
+            self._unsubscribe_removed()
 
             # 2. Subscribe to new addresses
             addresses, addresses_for_change = self._pop_new_addresses()
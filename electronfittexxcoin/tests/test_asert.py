@@ -11,6 +11,8 @@ class Test_ASERTDaa(unittest.TestCase):
             t_delta = time - ref_time
             h_delta = height - anchor_height
             self.assertEqual(target, asert.next_bits_aserti3_2d(ref_bits, t_delta, h_delta))
+        diffs = [(time - ref_time, height - anchor_height) for height, time, target in blocks]
+        self.assertEqual(asert.next_bits_aserti3_2d_batch(ref_bits, diffs), [target for height, time, target in blocks])
 
     # Steady 600s blocks at POW limit target
     def test_steady_at_pow_limit(self):
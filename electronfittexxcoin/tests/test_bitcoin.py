@@ -10,7 +10,9 @@ from ..bitcoin import (
     Hash, public_key_from_private_key, address_from_private_key, is_private_key,
     xpub_from_xprv, var_int, op_push, push_script, regenerate_key, verify_message,
     deserialize_privkey, serialize_privkey, is_minikey, is_compressed, is_xpub,
-    xpub_type, is_xprv, is_bip32_derivation, Bip38Key, OpCodes)
+    xpub_type, is_xprv, is_bip32_derivation, Bip38Key, OpCodes, CKD_pub, CKD_pub_range,
+    deserialize_xpub)
+from .. import secp256k1
 from ..networks import set_mainnet, set_testnet
 from ..util import bfh, bh2u
 
@@ -261,6 +263,22 @@ class Test_xprv_xpub(unittest.TestCase):
         self.assertEqual("xpub6FnCn6nSzZAw5Tw7cgR9bi15UV96gLZhjDstkXXxvCLsUXBGXPdSnLFbdpq8p9HmGsApME5hQTZ3emM2rnY5agb9rXpVGyy3bdW6EEgAtqt", xpub)
         self.assertEqual("xprvA2nrNbFZABcdryreWet9Ea4LvTJcGsqrMzxHx98MMrotbir7yrKCEXw7nadnHM8Dq38EGfSh6dqA9QWTyefMLEcBYJUuekgW4BYPJcr9E7j", xprv)
 
+    def test_CKD_pub_range(self):
+        xpub = self.xprv_xpub[0]['xpub']
+        _, _, _, _, c, cK = deserialize_xpub(xpub)
+        expected = [CKD_pub(cK, c, n)[0] for n in range(95, 130)]
+        self.assertEqual(expected, CKD_pub_range(cK, c, 95, 130))
+        self.assertEqual([], CKD_pub_range(cK, c, 7, 7))
+        # without libsecp256k1
+        saved = secp256k1.secp256k1
+        secp256k1.secp256k1 = None
+        try:
+            self.assertEqual(expected[:5], CKD_pub_range(cK, c, 95, 100))
+        finally:
+            secp256k1.secp256k1 = saved
+        with self.assertRaises(ValueError):
+            CKD_pub_range(cK, c, 0, 0x80000001)
+
     def test_xpub_from_xprv(self):
         """We can derive the xpub key from a xprv."""
         for xprv_details in self.xprv_xpub:
@@ -1,5 +1,9 @@
+import os
+import shutil
+import tempfile
 import unittest
 from .. import blockchain as bc
+from ..simple_config import SimpleConfig
 
 
 class MyBlockchain(bc.Blockchain):
@@ -115,3 +119,294 @@ class TestBlockchain(unittest.TestCase):
             bc.bits_to_target(0x04923456)
         with self.assertRaises(Exception):  # overflow
             bc.bits_to_target(0xff123456)
+
+
+def make_headers(prior, n, time_interval=600):
+    headers = []
+    for i in range(n):
+        prior = get_block(prior, time_interval, prior['bits'])
+        headers.append(prior)
+    return headers
+
+
+class TestHeaderStore(unittest.TestCase):
+
+    first = {
+        'version': 4,
+        'prev_block_hash': '00' * 32,
+        'merkle_root': '11' * 32,
+        'timestamp': 1269211443,
+        'bits': 0x18015ddc,
+        'nonce': 0,
+        'block_height': 0
+    }
+
+    def setUp(self):
+        super().setUp()
+        self.dir = tempfile.mkdtemp()
+        self.saved_blockchains = dict(bc.blockchains)
+        self.saved_bitmap = bc.header_bitmap
+        bc.blockchains.clear()
+        config = SimpleConfig({'electron_cash_path': self.dir})
+        self.chain = bc.read_blockchains(config)[0]
+        open(self.chain.path(), 'wb').close()
+        self.headers = [self.first] + make_headers(self.first, 599)
+        self.chain.write(b''.join(bytes.fromhex(bc.serialize_header(h)) for h in self.headers), 0)
+
+    def tearDown(self):
+        super().tearDown()
+        bc.close_files()
+        bc.blockchains.clear()
+        bc.blockchains.update(self.saved_blockchains)
+        bc.header_bitmap = self.saved_bitmap
+        shutil.rmtree(self.dir)
+
+    def test_read(self):
+        chain = self.chain
+        self.assertEqual(chain.height(), 599)
+        for height in (1, 10, 50, 87, 88, 100, 590, 599):
+            h = self.headers[height]
+            self.assertEqual(chain.read_header(height), h)
+            self.assertEqual(chain.read_header(height), h)  # from the cache, if recent
+            self.assertEqual(chain.get_hash(height), bc.hash_header(h))
+            self.assertEqual(chain.read_timestamp_bits(height), (h['timestamp'], h['bits']))
+            times = sorted(x['timestamp'] for x in self.headers[max(0, height - 10):height + 1])
+            self.assertEqual(chain.get_median_time_past(height), times[len(times) // 2])
+        self.assertIsNone(chain.read_header(600))
+        self.assertIsNone(chain.read_timestamp_bits(600))
+        self.assertIsNone(chain.read_header(-1))
+        self.assertEqual(chain.get_hash(600), bc.NULL_HASH_HEX)
+        self.assertEqual(chain.get_hash(-5), bc.NULL_HASH_HEX)
+        self.assertLessEqual(len(chain._recent), 2 * bc.RECENT_HEADERS)
+
+    def test_write_invalidates(self):
+        chain = self.chain
+        self.assertEqual(chain.read_header(599), self.headers[599])
+        other = get_block(self.headers[598], 1, self.headers[598]['bits'])
+        chain.write(bytes.fromhex(bc.serialize_header(other)), 599 * bc.HEADER_SIZE)
+        self.assertEqual(chain.read_header(599), other)
+        self.assertEqual(chain.get_hash(599), bc.hash_header(other))
+        chain.save_header(get_block(other, 600, other['bits']))
+        self.assertEqual(chain.height(), 600)
+        self.assertEqual(chain.read_header(600)['prev_block_hash'], bc.hash_header(other))
+
+    def test_fork_swap(self):
+        chain = self.chain
+        for height in range(580, 600):
+            chain.get_hash(height)  # fill the cache
+        fork_headers = make_headers(self.headers[589], 20, time_interval=300)
+        fork = bc.Blockchain.fork(chain, fork_headers[0])
+        for h in fork_headers[1:]:
+            fork.save_header(h)
+        # the fork is now the longest chain, and has taken the place of the parent
+        self.assertIs(bc.blockchains[0], fork)
+        self.assertEqual(fork.height(), 609)
+        self.assertEqual(chain.base_height, 590)
+        for height in (1, 589):
+            self.assertEqual(fork.read_header(height), self.headers[height])
+            self.assertEqual(chain.read_header(height), self.headers[height])
+        for i, h in enumerate(fork_headers):
+            self.assertEqual(fork.read_header(590 + i), h)
+            self.assertEqual(fork.get_hash(590 + i), bc.hash_header(h))
+        for height in range(590, 600):
+            self.assertEqual(chain.read_header(height), self.headers[height])
+            self.assertEqual(chain.get_hash(height), bc.hash_header(self.headers[height]))
+
+
+    def make_fork(self):
+        fork_headers = make_headers(self.headers[589], 20, time_interval=300)
+        fork = bc.Blockchain.fork(self.chain, fork_headers[0])
+        for h in fork_headers[1:]:
+            fork.save_header(h)
+        return fork, fork_headers
+
+    def file_contents(self):
+        d = os.path.dirname(self.chain.path())
+        ret = {}
+        for name in ['blockchain_headers'] + [os.path.join('forks', x) for x in os.listdir(os.path.join(d, 'forks'))]:
+            if not name.endswith('.json'):
+                with open(os.path.join(d, name), 'rb') as f:
+                    ret[name] = f.read()
+        return ret
+
+    def test_swap_copies_nothing(self):
+        fork_headers = make_headers(self.headers[589], 20, time_interval=300)
+        fork = bc.Blockchain.fork(self.chain, fork_headers[0])
+        for h in fork_headers[1:10]:
+            fork.save_header(h)
+        before = self.file_contents()
+        fork.save_header(fork_headers[10])  # longer than the parent branch
+        self.assertIs(bc.blockchains[0], fork)
+        after = self.file_contents()
+        # only the new header was written, at the end of the fork's file
+        self.assertEqual(set(before), set(after))
+        for name, data in before.items():
+            self.assertTrue(after[name].startswith(data))
+        self.assertEqual(sum(len(x) for x in after.values()) - sum(len(x) for x in before.values()), bc.HEADER_SIZE)
+
+    def test_reload(self):
+        chain = self.chain
+        fork, fork_headers = self.make_fork()
+        config = chain.config
+        bc.close_files()
+        bc.blockchains.clear()
+        chains = bc.read_blockchains(config)
+        self.assertEqual(sorted(chains), [0, 590])
+        main, old = chains[0], chains[590]
+        self.assertEqual(main.height(), 609)
+        self.assertEqual(old.height(), 599)
+        self.assertEqual(old.parent_base_height, 0)
+        for height in (0, 100, 589):
+            self.assertEqual(main.read_header(height), self.headers[height])
+        for i, h in enumerate(fork_headers):
+            self.assertEqual(main.read_header(590 + i), h)
+        for height in range(590, 600):
+            self.assertEqual(old.read_header(height), self.headers[height])
+
+    def test_truncate_after_swap(self):
+        fork, fork_headers = self.make_fork()
+        # a reorg within the headers the fork took over from its parent
+        other = make_headers(self.headers[499], 3, time_interval=700)
+        fork.write(b''.join(bytes.fromhex(bc.serialize_header(h)) for h in other), 500 * bc.HEADER_SIZE)
+        self.assertEqual(fork.height(), 502)
+        for i, h in enumerate(other):
+            self.assertEqual(fork.read_header(500 + i), h)
+        self.assertEqual(fork.read_header(499), self.headers[499])
+        self.assertIsNone(fork.read_header(503))
+        # the old chain still has its own headers
+        old = bc.blockchains[590]
+        for height in range(590, 600):
+            self.assertEqual(old.read_header(height), self.headers[height])
+        # and the headers of the fork that are no longer used are gone
+        self.assertEqual(sorted(os.listdir(os.path.dirname(fork.path()) + '/forks')),
+                         sorted([bc.INDEX_FILENAME, os.path.basename(fork.segments[-1].path)]))
+
+    def test_init_sparse(self):
+        fork, fork_headers = self.make_fork()
+        self.assertEqual(fork.read_header(100), self.headers[100])  # mapped
+        fork.init_sparse(1000)
+        self.assertEqual(fork.height(), 999)
+        self.assertEqual(fork.segments[-1].file_base, 0)
+        self.assertNotEqual(fork.read_header(100), self.headers[100])
+        self.assertEqual(os.path.getsize(fork.path()), 1000 * bc.HEADER_SIZE)
+        # the headers of the old chain are left alone
+        old = bc.blockchains[590]
+        for height in range(590, 600):
+            self.assertEqual(old.read_header(height), self.headers[height])
+
+    def test_legacy_layout(self):
+        chain = self.chain
+        config = chain.config
+        d = os.path.dirname(chain.path())
+        fork_headers = make_headers(self.headers[589], 5, time_interval=300)
+        os.remove(os.path.join(d, 'forks', bc.INDEX_FILENAME))  # as written by older versions
+        with open(os.path.join(d, 'forks', 'fork_0_590'), 'wb') as f:
+            f.write(b''.join(bytes.fromhex(bc.serialize_header(h)) for h in fork_headers))
+        bc.close_files()
+        bc.blockchains.clear()
+        chains = bc.read_blockchains(config)
+        self.assertEqual(sorted(chains), [0, 590])
+        self.assertTrue(os.path.exists(os.path.join(d, 'forks', bc.INDEX_FILENAME)))
+        self.assertEqual(chains[590].height(), 594)
+        self.assertEqual(chains[590].read_header(592), fork_headers[2])
+        self.assertEqual(chains[590].read_header(100), self.headers[100])
+
+    def test_sparse_headers(self):
+        chain = self.chain
+        bitmap = bc.header_bitmap
+        self.assertEqual(bitmap.size, bc.networks.net.VERIFICATION_BLOCK_HEIGHT + 1)
+        self.assertEqual(bitmap.count(), 600)
+        # a proven header from before the checkpoint, far from the others
+        header = dict(self.headers[599], block_height=1500, nonce=7)
+        chain.write(bytes.fromhex(bc.serialize_header(header)), 1500 * bc.HEADER_SIZE, truncate=False)
+        self.assertIn(1500, bitmap)
+        self.assertEqual(bitmap.missing([5, 600, 1000, 1500, 1501]), [600, 1000, 1501])
+        self.assertIsNone(chain.read_header(1000))
+        self.assertEqual(chain.read_header(1500), header)
+        # saved, or rebuilt from the headers file
+        bc.close_files()
+        for remove in (False, True):
+            if remove:
+                os.remove(bitmap.path)
+            bc.blockchains.clear()
+            chain = bc.read_blockchains(chain.config)[0]
+            self.assertIsNot(bc.header_bitmap, bitmap)
+            self.assertEqual(bc.header_bitmap.bits, bitmap.bits)
+            self.assertEqual(chain.read_header(1500), header)
+
+    def test_chunk_bits(self):
+        chain = self.chain
+        # over a retarget height, with a period which is too fast, then too slow
+        headers = self.headers + make_headers(self.headers[-1], 1600, time_interval=150)
+        headers += make_headers(headers[-1], 2500, time_interval=3600)
+        data = b''.join(bytes.fromhex(bc.serialize_header(h)) for h in headers)
+        full = bc.HeaderChunk(0, data)
+        expected = [chain.get_bits(h, full) for h in headers]
+        self.assertNotEqual(expected[2016], expected[2015])
+        self.assertNotEqual(expected[4032], expected[4031])
+        self.assertEqual(chain.get_chunk_bits(0, data), expected)
+        # a chunk following the stored headers, reading the first header of the period from the file
+        self.assertEqual(chain.get_chunk_bits(600, data[600 * bc.HEADER_SIZE:]), expected[600:])
+        with self.assertRaises(Exception):
+            chain.get_chunk_bits(700, data[700 * bc.HEADER_SIZE:])
+
+    def test_height_ranges(self):
+        self.assertEqual(bc.height_ranges([]), [])
+        self.assertEqual(bc.height_ranges([5, 6, 7, 9, 20]), [(5, 3), (9, 1), (20, 1)])
+        self.assertEqual(bc.height_ranges([5, 6, 7, 9, 20], max_gap=1), [(5, 5), (20, 1)])
+        self.assertEqual(bc.height_ranges([1, 2, 3, 4, 5], max_count=2), [(1, 2), (3, 2), (5, 1)])
+
+
+def mine_headers(n, bits=0x207fffff):
+    target = bc.bits_to_target(bits)
+    header = {'version': 4, 'prev_block_hash': '00' * 32, 'merkle_root': '11' * 32,
+              'timestamp': 1500000000, 'bits': bits, 'nonce': 0, 'block_height': 0}
+    data = b''
+    for height in range(n):
+        if height:
+            header = dict(header, prev_block_hash=bc.hash_header(header), nonce=0,
+                          timestamp=header['timestamp'] + 600, block_height=height)
+        while int(bc.hash_header(header), 16) > target:
+            header['nonce'] += 1
+        data += bytes.fromhex(bc.serialize_header(header))
+    return data
+
+
+class TestVerifyChunk(unittest.TestCase):
+
+    data = mine_headers(100)
+
+    def test_hash_and_check_chunk(self):
+        hashes, bad_pow = bc.hash_and_check_chunk(self.data)
+        self.assertEqual(bad_pow, [])
+        for i in range(100):
+            raw = self.data[i * 80:(i + 1) * 80]
+            self.assertEqual(bc.hash_encode(hashes[i * 32:(i + 1) * 32]), bc.hash_header_hex(raw.hex()))
+        # a header with its nonce changed most likely does not meet the target anymore
+        for nonce in range(1, 100):
+            bad = self.data[:76] + nonce.to_bytes(4, 'little') + self.data[80:]
+            if bc.hash_and_check_chunk(bad)[1]:
+                break
+        self.assertEqual(bc.hash_and_check_chunk(bad)[1], [0])
+
+    def test_verify_chunk(self):
+        chain = MyBlockchain()
+        chain.verify_chunk(0, self.data)
+        chain.verify_chunk(0, self.data, bc.hash_and_check_chunk(self.data))
+        with self.assertRaises(bc.VerifyError):
+            # prev hash mismatch
+            chain.verify_chunk(0, self.data[:80] + self.data[160:])
+        hashes, bad_pow = bc.hash_and_check_chunk(self.data)
+        with self.assertRaises(bc.VerifyError):
+            chain.verify_chunk(0, self.data, (hashes, [50]))
+
+    def test_chunk_verifier(self):
+        verifier = bc.ChunkVerifier(0)
+        self.assertEqual(verifier.submit(self.data).result(), bc.hash_and_check_chunk(self.data))
+        verifier = bc.ChunkVerifier(1)
+        try:
+            futures = [verifier.submit(self.data[:i * 800]) for i in range(1, 4)]
+            for i, future in enumerate(futures, 1):
+                self.assertEqual(future.result(timeout=60), bc.hash_and_check_chunk(self.data[:i * 800]))
+        finally:
+            verifier.shutdown()
@@ -0,0 +1,65 @@
+import threading
+import unittest
+
+from ..caches import ByteBudgetCache
+
+
+class TestByteBudgetCache(unittest.TestCase):
+
+    def test_get_put(self):
+        c = ByteBudgetCache(100)
+        self.assertIsNone(c.get('a'))
+        self.assertEqual(c.get('a', 'x'), 'x')
+        c.put('a', 'aaaa')
+        self.assertEqual(c.get('a'), 'aaaa')
+        self.assertIn('a', c)
+        self.assertEqual(len(c), 1)
+        self.assertEqual(c.nbytes, 4)
+        self.assertEqual((c.hits, c.misses), (1, 2))
+        # replacing a value accounts for the old one
+        c.put('a', 'aa')
+        self.assertEqual(c.nbytes, 2)
+        c.clear()
+        self.assertEqual(len(c), 0)
+        self.assertEqual(c.nbytes, 0)
+
+    def test_evicts_least_recently_used(self):
+        c = ByteBudgetCache(30)
+        for k in 'abc':
+            c.put(k, k * 10)
+        c.get('a')  # 'b' is now the least recently used
+        c.put('d', 'd' * 10)
+        self.assertNotIn('b', c)
+        self.assertEqual(set(c.d), set('acd'))
+        self.assertEqual(c.nbytes, 30)
+        # a big value evicts as many as needed
+        c.put('e', 'e' * 25)
+        self.assertEqual(list(c.d), ['e'])
+        self.assertEqual(c.nbytes, 25)
+
+    def test_value_over_budget(self):
+        c = ByteBudgetCache(10)
+        c.put('a', 'a' * 5)
+        c.put('b', b'b' * 11)
+        self.assertNotIn('b', c)
+        self.assertEqual(c.get('a'), 'aaaaa')
+        # also drops the previous value of the key
+        c.put('a', 'a' * 11)
+        self.assertNotIn('a', c)
+        self.assertEqual(c.nbytes, 0)
+
+    def test_threads(self):
+        c = ByteBudgetCache(1000)
+
+        def work(n):
+            for i in range(2000):
+                c.put((n, i % 50), 'x' * (i % 30))
+                c.get((n, (i * 7) % 50))
+
+        threads = [threading.Thread(target=work, args=(n,)) for n in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(c.nbytes, sum(len(v) for v in c.d.values()))
+        self.assertLessEqual(c.nbytes, 1000)
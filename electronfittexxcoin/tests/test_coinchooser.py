@@ -0,0 +1,104 @@
+import os
+import unittest
+from operator import attrgetter
+
+from .. import coinchooser
+from ..address import Address
+from ..bitcoin import TYPE_ADDRESS
+from ..coinchooser import CoinChooserBranchAndBound, CoinChooserPrivacy, input_size_estimator
+from ..transaction import Transaction
+from ..util import NotEnoughFunds
+
+PUBKEY = '02' + '11' * 32
+INPUT_SIZE = 148  # a p2pkh input with an ECDSA signature
+
+
+def make_coin(value, address=None):
+    return {'address': address or Address.from_P2PKH_hash(os.urandom(20)), 'value': value,
+            'prevout_hash': os.urandom(32).hex(), 'prevout_n': 0, 'height': 100, 'coinbase': False,
+            'type': 'p2pkh', 'x_pubkeys': [PUBKEY], 'pubkeys': [PUBKEY], 'num_sig': 1, 'signatures': [None]}
+
+
+def fee_estimator(size):
+    return size  # 1 sat/byte
+
+
+class TestInputSize(unittest.TestCase):
+
+    def test_estimator(self):
+        coins = [make_coin(1000), make_coin(2000), dict(make_coin(3000), scriptSig='00' * 100)]
+        for sign_schnorr in (False, True):
+            input_size = input_size_estimator(sign_schnorr)
+            for coin in coins:
+                self.assertEqual(Transaction.estimated_input_size(coin, sign_schnorr=sign_schnorr), input_size(coin))
+        self.assertEqual(INPUT_SIZE, input_size_estimator()(coins[0]))
+
+
+class TestBranchAndBound(unittest.TestCase):
+
+    def setUp(self):
+        self.chooser = CoinChooserBranchAndBound()
+        self.payee = Address.from_P2PKH_hash(os.urandom(20))
+        self.change = [Address.from_P2PKH_hash(os.urandom(20))]
+        self.base_size = Transaction.from_io([], self.outputs(0)).estimated_size()
+
+    def outputs(self, amount):
+        return [(TYPE_ADDRESS, self.payee, amount)]
+
+    def make_tx(self, coins, amount):
+        return self.chooser.make_tx(coins, self.outputs(amount), self.change, fee_estimator, 546)
+
+    def test_changeless(self):
+        # effective values (value less the fee to spend it)
+        coins = [make_coin(value + INPUT_SIZE) for value in (30000, 20000, 15000, 7000, 3000)]
+        tx = self.make_tx(coins, 35000 - self.base_size)
+        self.assertEqual(1, len(tx.outputs()))
+        self.assertEqual([20000 + INPUT_SIZE, 15000 + INPUT_SIZE], sorted((c['value'] for c in tx.inputs()), reverse=True))
+        self.assertEqual(self.base_size + 2 * INPUT_SIZE, tx.get_fee())
+
+        # a little excess is left to the fee
+        tx = self.make_tx(coins, 35000 - self.base_size - 100)
+        self.assertEqual(1, len(tx.outputs()))
+        self.assertEqual(self.base_size + 2 * INPUT_SIZE + 100, tx.get_fee())
+
+    def test_fallback(self):
+        coins = [make_coin(10 ** 9), make_coin(10 ** 6)]
+        tx = self.make_tx(coins, 500000)
+        self.assertEqual([10 ** 6], [c['value'] for c in tx.inputs()])
+        self.assertEqual(2, len(tx.outputs()))
+        # the change is rounded down to hundreds
+        self.assertGreaterEqual(tx.get_fee(), self.base_size + INPUT_SIZE + 34)
+        self.assertLess(tx.get_fee(), self.base_size + INPUT_SIZE + 34 + 100)
+        with self.assertRaises(NotEnoughFunds):
+            self.make_tx(coins, 10 ** 9 + 10 ** 6)
+
+    def test_buckets(self):
+        # the coins of an address are spent together
+        address = Address.from_P2PKH_hash(os.urandom(20))
+        coins = [make_coin(10000 + INPUT_SIZE, address), make_coin(5000 + INPUT_SIZE, address),
+                 make_coin(16000 + INPUT_SIZE), make_coin(40000)]
+        tx = self.make_tx(coins, 15000 - self.base_size)
+        self.assertEqual(1, len(tx.outputs()))
+        self.assertEqual({address}, {c['address'] for c in tx.inputs()})
+
+    def test_candidates(self):
+        coins = [make_coin(1000 + i * 37) for i in range(300)]
+        self.chooser.p = coinchooser.PRNG(b'test')
+        buckets = self.chooser.bucketize_coins(coins)
+        spent_amount = 20000
+
+        def enough(value, size):
+            return value >= spent_amount + fee_estimator(self.base_size + size)
+        candidates = self.chooser.bucket_candidates_fast(buckets, enough)
+        self.assertGreater(len(candidates), 1)
+        for c in candidates:
+            self.assertTrue(enough(sum(b.value for b in c), sum(b.size for b in c)))
+            # minimal: without its smallest bucket it is not enough
+            rest = sorted(c, key=attrgetter('value'))[1:]
+            self.assertFalse(enough(sum(b.value for b in rest), sum(b.size for b in rest)))
+
+    def test_get_coin_chooser(self):
+        self.assertIsInstance(coinchooser.get_coin_chooser({}), CoinChooserPrivacy)
+        self.assertNotIsInstance(coinchooser.get_coin_chooser({}), CoinChooserBranchAndBound)
+        self.assertIsInstance(coinchooser.get_coin_chooser({'coin_chooser': 'BranchAndBound'}),
+                              CoinChooserBranchAndBound)
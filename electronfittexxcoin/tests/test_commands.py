@@ -2,6 +2,8 @@ import unittest
 from decimal import Decimal as PyDecimal
 
 from ..commands import Commands
+from ..wallet import restore_wallet_from_text
+from .test_wallet import SyntheticHistoryTestCase, WalletTestCase
 
 
 class TestCommands(unittest.TestCase):
@@ -31,3 +33,82 @@ class TestCommands(unittest.TestCase):
         self.assertEqual("2asd", Commands._setconfig_normalize_value('rpcpassword', '2asd'))
         self.assertEqual("['file:///var/www/','https://electrum.org']",
             Commands._setconfig_normalize_value('rpcpassword', "['file:///var/www/','https://electrum.org']"))
+
+
+class TestPaginatedCommands(SyntheticHistoryTestCase):
+
+    def setUp(self):
+        super().setUp()
+        w = self.wallet
+        self.txids = ['%02x' % i * 32 for i in range(1, 6)]
+        txo = {txid: [(0, 1000 * (i + 1), False)] for i, txid in enumerate(self.txids)}
+        self.set_history([(txid, 100 + i) for i, txid in enumerate(self.txids)], txo, {})
+        for i, txid in enumerate(self.txids):
+            w.add_unverified_tx(txid, 100 + i)
+            w.tx_fees[txid] = 0
+        self.cmds = Commands(self.config, w, None)
+
+    def test_history_pages(self):
+        seen = []
+        cursor = None
+        while True:
+            page = self.cmds.history(limit=2, cursor=cursor)
+            seen.append([item['txid'] for item in page['history']])
+            cursor = page['cursor']
+            if cursor is None:
+                break
+        t = self.txids
+        self.assertEqual([[t[4], t[3]], [t[2], t[1]], [t[0]]], seen)
+        self.assertEqual(self.cmds.history()[:2], self.cmds.history(limit=2)['history'])
+        page = self.cmds.history(from_height=101, to_height=103)
+        self.assertEqual([t[2], t[1]], [item['txid'] for item in page['history']])
+        self.assertIsNone(page['cursor'])
+        with self.assertRaises(BaseException):
+            self.cmds.history(cursor='bogus')
+
+    def test_listunspent_pages(self):
+        page = self.cmds.listunspent(limit=3)
+        self.assertEqual(self.txids[:3], [u['prevout_hash'] for u in page['utxos']])
+        page = self.cmds.listunspent(limit=3, cursor=page['cursor'])
+        self.assertEqual(self.txids[3:], [u['prevout_hash'] for u in page['utxos']])
+        self.assertIsNone(page['cursor'])
+        page = self.cmds.listunspent(from_height=103)
+        self.assertEqual(self.txids[3:], [u['prevout_hash'] for u in page['utxos']])
+        self.assertEqual(5, len(self.cmds.listunspent()))
+
+    def test_listaddresses_pages(self):
+        page = self.cmds.listaddresses(limit=1, funded=True)
+        self.assertEqual([self.addr.to_ui_string()], page['addresses'])
+        self.assertIsNone(page['cursor'])
+        self.assertEqual([], self.cmds.listaddresses(limit=1, frozen=True)['addresses'])
+
+
+class TestListAddresses(WalletTestCase):
+
+    def setUp(self):
+        super().setUp()
+        xpub = 'xpub6CUzEfgtza7ZNtfDGYwHPnbPMPiQh93mAbP6v7C3ozUgkZq4tXSgYb9qqZ62oh8RCeexdSF7ZJmTzCm5bdWLB3zSMF8rNfuY8kccNAsdF4d'
+        self.wallet = restore_wallet_from_text(xpub, path=self.wallet_path, config=self.config)['wallet']
+        self.wallet.synchronize()
+        self.cmds = Commands(self.config, self.wallet, None)
+
+    def test_address_position(self):
+        w = self.wallet
+        addrs, receiving, change = w.get_addresses(), w.get_receiving_addresses(), w.get_change_addresses()
+        for addr in (receiving[0], receiving[-1], change[0], change[3]):
+            self.assertEqual(addrs.index(addr), self.cmds._address_position(addrs, addr, None))
+        self.assertEqual(3, self.cmds._address_position(change, change[3], True))
+        self.assertEqual(5, self.cmds._address_position(receiving, receiving[5], False))
+        with self.assertRaises(BaseException):
+            self.cmds._address_position(receiving, change[3], False)
+
+    def test_last_page(self):
+        w = self.wallet
+        receiving = w.get_receiving_addresses()
+        w.set_frozen_state(receiving[2:4], True)
+        # the addresses after the page are all filtered out: no next page
+        page = self.cmds.listaddresses(limit=2, frozen=True)
+        self.assertEqual([addr.to_ui_string() for addr in receiving[2:4]], page['addresses'])
+        self.assertIsNone(page['cursor'])
+        page = self.cmds.listaddresses(limit=1, frozen=True)
+        self.assertIsNotNone(page['cursor'])
@@ -1,10 +1,12 @@
 from contextlib import contextmanager
+import json
 import select
 import unittest
 import ssl
 import pathlib
 import socket
 import threading
+import time
 
 from .. import interface
 
@@ -108,3 +110,112 @@ class TestInterfaceSSLVerify(unittest.TestCase):
             with self.assertRaises(ssl.SSLCertVerificationError) as cm:
                 self._has_ca_signed_valid_cert(f"{host}:{port}:s")
             self.assertEqual(cm.exception.verify_code, 20)  # X509_V_ERR_UNABLE_TO_GET_ISSUER_CERT_LOCALLY
+
+
+class TestInterfaceBatching(unittest.TestCase):
+
+    def setUp(self):
+        a, self.peer = socket.socketpair()
+        self.peer.settimeout(5)
+        self.buf = b''
+        self.iface = interface.Interface('localhost:1:t', a)
+
+    def tearDown(self):
+        self.iface.close()
+        self.peer.close()
+
+    def read_messages(self, n):
+        while self.buf.count(b'\n') < n:
+            self.buf += self.peer.recv(65536)
+        lines = self.buf.split(b'\n')
+        self.buf = b'\n'.join(lines[n:])
+        return [json.loads(line) for line in lines[:n]]
+
+    def reply(self, *messages):
+        self.peer.sendall(b''.join(json.dumps(m).encode('utf8') + b'\n' for m in messages))
+
+    def get_responses(self, n):
+        responses = []
+        t0 = time.time()
+        while len(responses) < n and time.time() - t0 < 5:
+            responses += self.iface.get_responses()
+        return responses
+
+    def test_framing(self):
+        iface = self.iface
+        for i in range(3):
+            iface.queue_request('server.ping', [], i)
+        self.assertTrue(iface.send_requests())
+        self.assertEqual([0, 1, 2], [m['id'] for m in self.read_messages(3)])
+
+        iface.set_batching(True)
+        iface.BATCH_MAX_BYTES = 300
+        for i in range(3, 10):
+            iface.queue_request('blockchain.scripthash.get_history', ['%064x' % i], i)
+        self.assertTrue(iface.send_requests())
+        batches = self.read_messages(7 // 2 + 1)  # two ~120 byte requests per batch
+        self.assertTrue(all(isinstance(b, list) for b in batches[:-1]))
+        ids = []
+        for b in batches:
+            ids += [m['id'] for m in (b if isinstance(b, list) else [b])]
+        self.assertEqual(list(range(3, 10)), ids)
+        self.assertEqual(set(range(3, 10)), set(iface.unanswered_requests) - {0, 1, 2})
+
+    def test_batch_responses(self):
+        iface = self.iface
+        iface.set_batching(True)
+        for i in range(5):
+            iface.queue_request('blockchain.transaction.get', [str(i)], i)
+        self.assertTrue(iface.send_requests())
+        self.assertEqual(5, len(self.read_messages(1)[0]))
+        # out of order, split in two batches, and a notification in between
+        self.reply([{'id': 3, 'result': '3'}, {'id': 0, 'result': '0'}],
+                   {'method': 'blockchain.headers.subscribe', 'params': [{}]},
+                   [{'id': 1, 'result': '1'}, {'id': 4, 'result': '4'}, {'id': 2, 'result': '2'}])
+        responses = self.get_responses(6)
+        self.assertEqual(6, len(responses))
+        for request, response in responses:
+            if request is None:
+                self.assertEqual('blockchain.headers.subscribe', response['method'])
+            else:
+                self.assertEqual(request[1][0], response['result'])
+        self.assertFalse(iface.unanswered_requests)
+        self.assertFalse(iface.batched_ids)
+
+    def test_batch_rejected(self):
+        iface = self.iface
+        iface.set_batching(True)
+        for i in range(4):
+            iface.queue_request('blockchain.transaction.get', [str(i)], i)
+        self.assertTrue(iface.send_requests())
+        self.read_messages(1)
+        self.reply({'id': None, 'error': {'code': -32600, 'message': 'batches not supported'}})
+        t0 = time.time()
+        while iface.batching and time.time() - t0 < 5:
+            self.assertEqual([], iface.get_responses())
+        self.assertFalse(iface.batching)
+        self.assertEqual([0, 1, 2, 3], [r[2] for r in iface.unsent_requests])
+        self.assertTrue(iface.send_requests())
+        self.assertEqual([0, 1, 2, 3], [m['id'] for m in self.read_messages(4)])
+
+    def test_adaptive_window(self):
+        iface = self.iface
+        for i in range(1000):
+            iface.queue_request('server.ping', [], i)
+        self.assertEqual(100, iface.num_requests())
+        self.assertTrue(iface.send_requests())
+        self.assertEqual(0, iface.num_requests())
+        self.read_messages(100)
+        # fast responses grow the window
+        self.reply(*({'id': i, 'result': None} for i in range(100)))
+        self.assertEqual(100, len(self.get_responses(100)))
+        self.assertEqual(200, iface.window)
+        self.assertEqual(200, iface.num_requests())
+        # slow responses shrink it
+        self.assertTrue(iface.send_requests())
+        self.read_messages(200)
+        for i in range(100, 300):
+            iface.send_times[i] -= 10
+        self.reply(*({'id': i, 'result': None} for i in range(100, 300)))
+        self.assertEqual(200, len(self.get_responses(200)))
+        self.assertEqual(100, iface.window)
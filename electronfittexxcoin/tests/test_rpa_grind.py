@@ -0,0 +1,52 @@
+import hashlib
+import threading
+import unittest
+
+from .. import schnorr
+from ..rpa import grind
+
+
+def make_job(n, target):
+    sec = hashlib.sha256(b'sec%d' % n).digest()
+    pre_hash = hashlib.sha256(b'pre_hash%d' % n).digest()
+    return grind.GrindJob(sec, pre_hash, b'\x01' * 41, b'\x21' + b'\x02' * 33 + b'\xfe\xff\xff\xff', 0x41, target)
+
+
+def check(job, nonce, signature):
+    ndata = hashlib.sha256(nonce.to_bytes(length=5, byteorder='little')).digest()
+    if signature != schnorr.sign(job.sec, job.pre_hash, ndata=ndata) + b'\x41':
+        return False
+    h = hashlib.sha256(hashlib.sha256(job.prefix + signature + job.suffix).digest()).digest()
+    return h.hex().startswith(job.target)
+
+
+class TestGrind(unittest.TestCase):
+
+    def setUp(self):
+        if not schnorr.has_fast_sign():
+            self.skipTest("accelerated ECC library not available")
+
+    def test_lowest_nonce(self):
+        job = make_job(0, 'a3')
+        (nonce, signature), = grind.grind([job], processes=0, block_size=4)
+        self.assertTrue(check(job, nonce, signature))
+        # no nonce before it matches: a single block of the nonces below it
+        # (the worker stops before block 1) has no match
+        counters = [0]
+        self.assertIsNone(grind.grind_blocks(job, 0, 0, 1, [0, 1], counters, block_size=nonce))
+        self.assertEqual([nonce], counters)
+        self.assertEqual((nonce, signature), grind.grind_blocks(job, 0, 0, 1, [0, 1], counters, block_size=nonce + 1))
+
+    def test_processes_same_result(self):
+        jobs = [make_job(1, 'b'), make_job(2, 'c7'), make_job(3, '5')]
+        expected = grind.grind(jobs, processes=0, block_size=8)
+        self.assertTrue(all(check(job, *result) for job, result in zip(jobs, expected)))
+        counts = []
+        self.assertEqual(expected, grind.grind(jobs, processes=3, block_size=8, progress_callback=counts.append))
+        self.assertTrue(counts)
+
+    def test_cancel(self):
+        exit_event = threading.Event()
+        exit_event.set()
+        self.assertIsNone(grind.grind([make_job(4, 'ffff')], processes=0, exit_event=exit_event))
+        self.assertIsNone(grind.grind([make_job(4, 'ffff')], processes=2, exit_event=exit_event))
@@ -0,0 +1,182 @@
+import unittest
+
+from ..rpa.rpa_manager import BlockRangeScan, RpaManager
+from ..storage import WalletStorage
+from ..wallet import RpaWallet
+
+
+class TestBlockRangeScan(unittest.TestCase):
+
+    def test_out_of_order(self):
+        scan = BlockRangeScan(100, blocks=10)
+        ranges = [scan.next_range(200, now=0) for i in range(3)]
+        self.assertEqual([(100, 109), (110, 119), (120, 129)], ranges)
+        self.assertFalse(scan.complete(110))
+        self.assertFalse(scan.complete(120))
+        self.assertEqual(100, scan.height)
+        self.assertEqual([[110, 119], [120, 129]], scan.done)
+        self.assertTrue(scan.complete(100))
+        self.assertEqual(130, scan.height)
+        self.assertEqual([], scan.done)
+
+    def test_resume(self):
+        # scanned up to 99, and 110-119 and 130-139 were scanned too
+        scan = BlockRangeScan(100, done=[[130, 139], [110, 119], [50, 60]], blocks=50)
+        self.assertEqual((100, 109), scan.next_range(200))
+        self.assertEqual((120, 129), scan.next_range(200))
+        self.assertEqual((140, 189), scan.next_range(200))
+        self.assertEqual((190, 200), scan.next_range(200))
+        self.assertIsNone(scan.next_range(200))
+        for start in (120, 100, 140, 190):
+            scan.complete(start)
+        self.assertEqual(201, scan.height)
+        self.assertTrue(scan.caught_up(200))
+        self.assertFalse(scan.caught_up(201))
+
+    def test_failed(self):
+        scan = BlockRangeScan(0, blocks=40)
+        scan.next_range(1000)
+        scan.next_range(1000)
+        scan.failed(0, shrink=True)
+        self.assertEqual(20, scan.blocks)
+        self.assertEqual((0, 19), scan.next_range(1000))
+        self.assertEqual((20, 39), scan.next_range(1000))
+        self.assertEqual((80, 99), scan.next_range(1000))
+        # a failure which is not the request itself does not shrink it
+        scan.failed(80)
+        self.assertEqual(20, scan.blocks)
+        self.assertEqual((80, 99), scan.next_range(1000))
+
+    def test_adapt(self):
+        scan = BlockRangeScan(0, blocks=50)
+        scan.next_range(100000, now=0)
+        scan.got_history(0, 10, now=0.1)
+        self.assertEqual(100, scan.blocks)
+        scan.next_range(100000, now=0)
+        # 50-149: too many transactions
+        scan.got_history(50, 10000, now=0.1)
+        self.assertEqual(50, scan.blocks)
+        scan.next_range(100000, now=0)
+        # 150-199: too slow
+        scan.got_history(150, 10, now=60)
+        self.assertEqual(25, scan.blocks)
+        scan.max_blocks = 16
+        scan.next_range(100000, now=0)
+        scan.got_history(200, 0, now=0)
+        self.assertEqual(16, scan.blocks)
+
+
+class MockNetwork:
+
+    def __init__(self, height):
+        self.height = height
+        self.sent = []
+
+    def get_server_height(self):
+        return self.height
+
+    def send(self, messages, callback):
+        for method, params in messages:
+            self.sent.append((method, params, callback))
+
+    def trigger_callback(self, *args):
+        pass
+
+    def answer(self, histories):
+        ''' Answers the pending requests, the block ranges with the
+        histories dict: start height -> list of txids. '''
+        sent, self.sent = self.sent, []
+        for method, params, callback in sent:
+            if method == 'blockchain.reusable.get_history':
+                txids = histories.get(params[0], [])
+                result = [{'tx_hash': txid, 'height': params[0]} for txid in txids]
+            elif method == 'blockchain.transaction.get':
+                result = 'raw_' + params[0]
+            else:
+                result = []
+            callback({'method': method, 'params': params, 'result': result})
+
+
+class MockRpaWallet(RpaWallet):
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.seed_ts = None
+        self.imported = []
+
+    def diagnostic_name(self):
+        return 'mock'
+
+    def has_password(self):
+        return False
+
+    def get_grind_string(self):
+        return 'ff'
+
+    def extract_private_keys_from_transaction(self, rawtx, password):
+        return [rawtx] if rawtx.startswith('raw_key') else []
+
+    def import_private_key(self, sec, pw):
+        self.imported.append(sec)
+
+
+class TestRpaManager(unittest.TestCase):
+
+    def setUp(self):
+        self.storage = WalletStorage('', in_memory_only=True)
+        self.storage.put('rpa_height', 1000)
+        self.wallet = MockRpaWallet(self.storage)
+        self.network = MockNetwork(1400)
+
+    def make_manager(self):
+        manager = self.wallet.rpa_manager = RpaManager(self.wallet, self.network)
+        return manager
+
+    def test_pipeline(self):
+        manager = self.make_manager()
+        manager.run()
+        requests = [params for method, params, callback in self.network.sent
+                    if method == 'blockchain.reusable.get_history']
+        self.assertEqual(RpaManager.MAX_RANGES_IN_FLIGHT, len(requests))
+        self.assertEqual([1000, 1050, 1100, 1150], [params[0] for params in requests])
+        self.network.answer({1050: ['key1', 'tx2'], 1100: ['tx3']})
+        self.network.answer({})
+        manager.run()
+        # the first range had no transactions, so the scan moved past all of them
+        self.assertEqual(['raw_key1'], self.wallet.imported)
+        self.assertEqual(1199, self.wallet.rpa_height)
+        self.assertEqual([], self.wallet.rpa_scanned_ranges)
+        self.assertFalse(manager.up_to_date)
+        for i in range(10):
+            self.network.answer({})
+            manager.run()
+        self.assertEqual(1400, self.wallet.rpa_height)
+        self.assertTrue(manager.up_to_date)
+
+    def test_resume(self):
+        manager = self.make_manager()
+        manager.run()
+        # the range at 1050 is scanned, but the one before it is not
+        sent, self.network.sent = self.network.sent, []
+        for method, params, callback in sent:
+            if method == 'blockchain.reusable.get_history' and params[0] == 1050:
+                callback({'method': method, 'params': params, 'result': []})
+        self.assertEqual(1000, self.wallet.rpa_height)
+        self.assertEqual([[1050, 1099]], self.wallet.rpa_scanned_ranges)
+        # so a new manager does not request it again
+        manager = self.make_manager()
+        manager.run()
+        starts = [params[0] for method, params, callback in self.network.sent
+                  if method == 'blockchain.reusable.get_history']
+        self.assertEqual([1000, 1100, 1150, 1200], starts)
+
+    def test_stopped(self):
+        manager = self.make_manager()
+        manager.run()
+        self.wallet.rpa_manager = None
+        # responses arriving after the wallet dropped the manager are ignored
+        self.network.answer({1050: ['key1']})
+        manager.run()
+        self.assertEqual([], self.wallet.imported)
+        self.assertEqual(1000, self.wallet.rpa_height)
+        self.assertEqual([], self.wallet.rpa_scanned_ranges)
@@ -10,6 +10,8 @@ from .. import schnorr
 import hashlib
 import secrets
 from ..bitcoin import regenerate_key
+from .. import ecc_fast
+from ..transaction import Transaction
 
 class TestSchnorr(unittest.TestCase):
 
@@ -100,3 +102,79 @@ class TestBlind(unittest.TestCase):
 
         for a,n in zip(alist, nlist):
             self.assertEqual(jac_1(a,n), jac_2(a,n), msg=(a,n))
+
+
+class TestVerifyBatch(unittest.TestCase):
+
+    def make_items(self, n):
+        items = []
+        for i in range(n):
+            privkey = secrets.token_bytes(32)
+            pubkey = regenerate_key(privkey).GetPubKey(i % 3 != 0)
+            msghash = secrets.token_bytes(32)
+            sig = schnorr.sign(privkey, msghash)
+            if i % 4 == 1:
+                msghash = secrets.token_bytes(32)  # wrong message
+            elif i % 4 == 2:
+                pubkey = items[-1][0]  # wrong key, and a repeated one
+            items.append((pubkey, sig, msghash))
+        items.append((b'\x02' + b'\xff' * 32, items[0][1], items[0][2]))  # not on the curve
+        items.append((items[0][0], items[0][1][:63], items[0][2]))  # bad length
+        return items
+
+    def expected(self, items):
+        results = []
+        for item in items:
+            try:
+                results.append(schnorr.verify(*item))
+            except Exception:
+                results.append(False)
+        return results
+
+    def test_fast(self):
+        if not schnorr.has_fast_verify():
+            self.skipTest("accelerated ECC library not available")
+        items = self.make_items(40)
+        expected = self.expected(items)
+        self.assertIn(True, expected)
+        self.assertIn(False, expected)
+        self.assertEqual(schnorr.verify_batch(items), expected)
+        # split across threads
+        items = items * 8
+        self.assertEqual(schnorr.verify_batch(items, threads=4), expected * 8)
+        self.assertEqual(schnorr.verify_batch([]), [])
+
+    def test_slow(self):
+        items = self.make_items(12)
+        saved = schnorr._secp256k1_schnorr_verify
+        schnorr._secp256k1_schnorr_verify = None
+        try:
+            expected = self.expected(items)
+            self.assertEqual(schnorr.verify_batch(items), expected)
+        finally:
+            schnorr._secp256k1_schnorr_verify = saved
+        if saved:
+            self.assertEqual(schnorr.verify_batch(items), expected)
+
+    def test_transaction_verify_signatures(self):
+        items = self.make_items(8)
+        for i in range(12):
+            privkey = secrets.token_bytes(32)
+            pubkey = regenerate_key(privkey).GetPubKey(i % 2 == 0)
+            msghash = secrets.token_bytes(32)
+            sig = Transaction._ecdsa_sign(privkey, msghash)
+            if i % 3 == 1:
+                sig = sig[:-1] + bytes([sig[-1] ^ 1])  # wrong signature
+            elif i % 3 == 2:
+                sig = sig + b'\x00'  # trailing garbage
+            items.append((pubkey, sig, msghash))
+        # hybrid encoding, which only the one at a time path understands
+        items.append((b'\x06' + items[-1][0][1:], items[-1][1], items[-1][2]))
+        expected = [Transaction.verify_signature(*item) if len(item[1]) != 64 else ok
+                    for item, ok in zip(items, self.expected(items))]
+        self.assertIn(True, expected[8:])
+        self.assertIn(False, expected[8:])
+        self.assertEqual(Transaction.verify_signatures(items), expected)
+        if ecc_fast.is_using_fast_ecc():
+            self.assertEqual(ecc_fast.verify_der_batch(items[8:-1] * 30, threads=3), expected[8:-1] * 30)
+            self.assertEqual(ecc_fast.verify_der_batch(items[-1:]), [None])
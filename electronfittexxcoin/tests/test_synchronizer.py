@@ -0,0 +1,198 @@
+import os
+import queue
+import time
+import unittest
+
+from ..address import Address
+from ..synchronizer import RollingStatus, Synchronizer
+from ..transaction import Transaction
+from .test_transaction import signed_blob
+
+
+def make_hist(n, height=100):
+    return [(os.urandom(32).hex(), height + i) for i in range(n)]
+
+
+class TestRollingStatus(unittest.TestCase):
+
+    def setUp(self):
+        self.rolling = RollingStatus()
+
+    def check(self, hist):
+        self.assertEqual(Synchronizer.get_status(hist), self.rolling.update(hist))
+
+    def test_empty(self):
+        self.check([])
+        self.check(make_hist(3))
+        self.check([])
+
+    def test_append(self):
+        hist = make_hist(1000)
+        self.check(hist)
+        hist.append((os.urandom(32).hex(), 0))
+        # the same list, appended to
+        self.check(hist)
+        self.check(hist + make_hist(300, 2000))
+
+    def test_changes(self):
+        hist = make_hist(1000)
+        self.check(hist)
+        # a mempool tx confirms
+        hist2 = hist + [(os.urandom(32).hex(), 0)]
+        self.check(hist2)
+        hist3 = hist + [(hist2[-1][0], 1200)]
+        self.check(hist3)
+        # reorg deep into the history
+        hist4 = hist[:10] + make_hist(5, 110)
+        self.check(hist4)
+        self.check(make_hist(600))
+        # the entries may also be lists, as loaded from the wallet file
+        self.check([list(entry) for entry in hist])
+        self.check(hist)
+
+    def test_snapshots(self):
+        hist = make_hist(1000)
+        self.rolling.update(hist)
+        self.assertEqual([0, 256, 512, 768], [pos for pos, sha in self.rolling.snapshots])
+        self.check(hist[:600])
+        self.assertEqual([0, 256, 512], [pos for pos, sha in self.rolling.snapshots])
+
+
+class MockWallet:
+
+    def __init__(self, history=None):
+        self.history = history or {}
+        self.storage = {'wallet_type': 'standard'}
+        self.transactions = {}
+        self.limit_change_addr_subs = 0
+        self.received = []
+
+    def diagnostic_name(self):
+        return 'mock'
+
+    def get_address_history(self, addr):
+        return self.history.get(addr, [])
+
+    def get_history_values(self):
+        return self.history.values()
+
+    def get_receiving_addresses(self):
+        return []
+
+    def get_change_addresses(self):
+        return []
+
+    def receive_tx_callback(self, tx_hash, tx, tx_height):
+        self.received.append((tx_hash, tx_height))
+
+
+class MockNetwork:
+
+    def __init__(self):
+        self.sent = []
+        self.subscribed = set()
+
+    def send(self, messages, callback):
+        for method, params in messages:
+            self.sent.append((params[0], callback))
+
+    def subscribe_to_scripthashes(self, scripthashes, callback):
+        self.subscribed.update(scripthashes)
+
+    def unsubscribe_from_scripthashes(self, scripthashes, callback):
+        self.subscribed.difference_update(scripthashes)
+
+    def trigger_callback(self, *args):
+        pass
+
+    def answer(self, results):
+        sent, self.sent = self.sent, []
+        for tx_hash, callback in sent:
+            if tx_hash in results:
+                callback({'params': [tx_hash], 'result': results[tx_hash]})
+            else:
+                callback({'params': [tx_hash], 'error': 'not found'})
+        return [tx_hash for tx_hash, callback in sent]
+
+
+class TestSubscribeOrder(unittest.TestCase):
+
+    def test_by_recency(self):
+        sync = Synchronizer.__new__(Synchronizer)
+        sync.wallet = MockWallet({'a': make_hist(2, 100), 'c': make_hist(1, 500), 'e': make_hist(3, 100) + [('f' * 64, 0)]})
+        self.assertEqual(['e', 'c', 'a', 'b', 'd'], sync._by_recency(['a', 'b', 'c', 'd', 'e']))
+
+
+class TestTxFetch(unittest.TestCase):
+
+    def setUp(self):
+        self.wallet = MockWallet()
+        self.network = MockNetwork()
+        self.sync = Synchronizer(self.wallet, self.network)
+
+    def tearDown(self):
+        if self.sync.tx_worker:
+            self.sync.tx_work.put(None)
+
+    def wait_done(self):
+        for i in range(500):
+            self.sync._process_done_txs()
+            if not self.sync.get_tx_progress()[1]:
+                return
+            time.sleep(0.01)
+        self.fail('the worker thread did not finish')
+
+    def test_newest_first(self):
+        window = Synchronizer.TX_WINDOW
+        hist = make_hist(window + 50, 1000)
+        hist[3] = (hist[3][0], 0)  # unconfirmed
+        self.sync._request_missing_txs(hist, None)
+        self.assertEqual((0, window + 50), self.sync.get_tx_progress())
+        newest = [hist[3][0]] + [tx_hash for tx_hash, height in reversed(hist) if height]
+        self.assertEqual(newest[:window], self.network.answer({}))
+        self.sync._process_done_txs()
+        self.assertEqual((window, 50), self.sync.get_tx_progress())
+        self.assertEqual(newest[window:], self.network.answer({}))
+        self.sync._process_done_txs()
+        self.assertEqual((0, 0), self.sync.get_tx_progress())
+        self.assertTrue(self.sync.is_up_to_date())
+
+    def test_worker(self):
+        tx_hash = Transaction(signed_blob).txid()
+        hist = [(tx_hash, 500), ('00' * 32, 501)]
+        self.sync._request_missing_txs(hist, None)
+        self.assertEqual(['00' * 32, tx_hash], self.network.answer({tx_hash: signed_blob, '00' * 32: '00'}))
+        self.wait_done()
+        self.assertEqual([(tx_hash, 500)], self.wallet.received)
+        self.assertTrue(self.sync.is_up_to_date())
+        # already in the wallet
+        self.wallet.transactions[tx_hash] = None
+        self.assertFalse(self.sync._request_missing_txs(hist[:1], None))
+
+    def test_worker_released(self):
+        tx_hash = Transaction(signed_blob).txid()
+        work = queue.Queue()
+        work.put((tx_hash, signed_blob, 500))
+        work.put(None)
+        self.sync.cleaned_up = True
+        self.sync._tx_worker_thread(work)
+        self.assertEqual([], self.wallet.received)
+
+
+class TestRemove(unittest.TestCase):
+
+    def test_unsubscribe(self):
+        wallet = MockWallet()
+        network = MockNetwork()
+        sync = Synchronizer(wallet, network)
+        addresses = [Address.from_P2PKH_hash(os.urandom(20)) for i in range(4)]
+        sync._subscribe_to_addresses(addresses)
+        sync.add(addresses[3])
+        self.assertEqual(4, len(network.subscribed))
+        sync.remove(addresses[2:])
+        sync._unsubscribe_removed()
+        self.assertEqual({addr.to_scripthash_hex() for addr in addresses[:2]}, network.subscribed)
+        self.assertEqual(set(addresses[:2]), set(sync.h2addr.values()))
+        # addresses[3] was queued for subscription, and is not subscribed anymore
+        queued, queued_for_change = sync._pop_new_addresses()
+        self.assertFalse(queued or queued_for_change)
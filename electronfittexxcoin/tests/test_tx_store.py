@@ -0,0 +1,111 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from ..bitcoin import Hash
+from ..transaction import Transaction
+from ..tx_store import TxStore, MAGIC
+
+
+def make_tx(size=200):
+    raw = os.urandom(size)
+    return Hash(raw)[::-1].hex(), raw.hex()
+
+
+class TestTxStore(unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'cache', 'transactions')
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self.dir)
+
+    def test_put_get_reopen(self):
+        store = TxStore(self.path)
+        txs = [make_tx() for i in range(10)]
+        for txid, raw in txs:
+            self.assertTrue(store.put(txid, raw))
+        self.assertTrue(store.put(*txs[0]))  # already there
+        for txid, raw in txs:
+            self.assertEqual(store.get(txid), raw)
+        self.assertIsNone(store.get(make_tx()[0]))
+        self.assertIsNone(store.get('not hex'))
+        store.close()
+        self.assertIsNone(store.get(txs[0][0]))
+        store = TxStore(self.path)
+        self.assertEqual(len(store), 10)
+        for txid, raw in txs:
+            self.assertIn(txid, store)
+            self.assertEqual(store.get(txid), raw)
+        store.close()
+        # one record per tx
+        self.assertEqual(os.path.getsize(self.path), len(MAGIC) + 10 * (36 + 200))
+
+    def test_rejects_wrong_txid(self):
+        store = TxStore(self.path)
+        txid, raw = make_tx()
+        self.assertFalse(store.put(txid, make_tx()[1]))
+        self.assertFalse(store.put(txid[:-2], raw))
+        self.assertNotIn(txid, store)
+        store.close()
+
+    def test_corrupt_and_truncated(self):
+        store = TxStore(self.path)
+        txs = [make_tx() for i in range(3)]
+        for txid, raw in txs:
+            store.put(txid, raw)
+        store.close()
+        with open(self.path, 'r+b') as f:
+            # flip a byte of the second tx
+            f.seek(len(MAGIC) + (36 + 200) + 36 + 5)
+            b = f.read(1)
+            f.seek(-1, os.SEEK_CUR)
+            f.write(bytes([b[0] ^ 1]))
+            # and cut the last record short
+            f.truncate(os.path.getsize(self.path) - 10)
+        store = TxStore(self.path)
+        self.assertEqual(store.get(txs[0][0]), txs[0][1])
+        self.assertIsNone(store.get(txs[1][0]))
+        self.assertNotIn(txs[1][0], store)
+        self.assertNotIn(txs[2][0], store)
+        self.assertEqual(os.path.getsize(self.path), len(MAGIC) + 2 * (36 + 200))
+        # the store is still usable
+        self.assertTrue(store.put(*txs[2]))
+        self.assertEqual(store.get(txs[2][0]), txs[2][1])
+        store.close()
+
+    def test_lru_and_compaction(self):
+        store = TxStore(self.path, max_bytes=900)
+        txs = [make_tx() for i in range(5)]
+        for txid, raw in txs[:4]:
+            store.put(txid, raw)
+        store.get(txs[0][0])
+        store.put(*txs[4])  # evicts txs[1], the least recently used
+        self.assertNotIn(txs[1][0], store)
+        self.assertEqual([t[0] in store for t in txs], [True, False, True, True, True])
+        self.assertLessEqual(store.live_bytes, 900)
+        for i in range(20):
+            store.put(*make_tx())
+        # the file is rewritten so that it does not grow without bound
+        self.assertLessEqual(os.path.getsize(self.path), len(MAGIC) + 2 * 900 + 36 * 10)
+        kept = [bytes(k).hex() for k in store.index]
+        store.close()
+        store = TxStore(self.path, max_bytes=900)
+        self.assertEqual([bytes(k).hex() for k in store.index], kept)
+        store.close()
+
+    def test_transaction_cache(self):
+        store = TxStore(self.path)
+        txid, raw = make_tx()
+        old, Transaction.tx_store = Transaction.tx_store, store
+        try:
+            Transaction.tx_cache_put(Transaction(raw), txid)
+            Transaction._fetched_tx_cache.d.clear()
+            self.assertEqual(Transaction.tx_cache_get(txid).raw, raw)
+        finally:
+            Transaction.tx_store = old
+            store.close()
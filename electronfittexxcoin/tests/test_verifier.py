@@ -0,0 +1,187 @@
+import os
+import unittest
+
+from ..bitcoin import Hash, hash_decode, hash_encode
+from ..verifier import PartialMerkleTree, SPV, SPVDelegate
+
+
+def merkle_tree(txids):
+    ''' Returns the merkle root of txids and the merkle branch of each. '''
+    level = [hash_decode(txid) for txid in txids]
+    branches = [[] for txid in txids]
+    positions = list(range(len(txids)))
+    while len(level) > 1:
+        if len(level) % 2:
+            level.append(level[-1])
+        for branch, i in zip(branches, positions):
+            branch.append(hash_encode(level[i ^ 1]))
+        level = [Hash(level[i] + level[i + 1]) for i in range(0, len(level), 2)]
+        positions = [i >> 1 for i in positions]
+    return hash_encode(level[0]), branches
+
+
+def make_block(n):
+    txids = [os.urandom(32).hex() for i in range(n)]
+    root, branches = merkle_tree(txids)
+    return txids, {'merkle_root': root, 'timestamp': 1234}, branches
+
+
+class TestPartialMerkleTree(unittest.TestCase):
+
+    def test_verify(self):
+        txids, header, branches = make_block(11)
+        for pos in (0, 5, 10):
+            self.assertEqual(header['merkle_root'], SPV.hash_merkle_root(branches[pos], txids[pos], pos))
+        tree = PartialMerkleTree(header)
+        self.assertFalse(tree.verify(branches[3], txids[3], 2))
+        self.assertFalse(tree.verify(branches[3], os.urandom(32).hex(), 3))
+        self.assertEqual({}, tree.nodes)
+        for pos in range(len(txids)):
+            self.assertTrue(tree.verify(branches[pos], txids[pos], pos))
+        # a wrong tx still does not verify against the known nodes
+        self.assertFalse(tree.verify(branches[4], txids[5], 4))
+
+    def test_known_nodes(self):
+        txids, header, branches = make_block(8)
+        tree = PartialMerkleTree(header)
+        self.assertTrue(tree.verify(branches[2], txids[2], 2))
+        # the sibling of a verified tx is known: the rest of its branch is not looked at
+        self.assertTrue(tree.verify(['00' * 32] * 3, txids[3], 3))
+        self.assertTrue(tree.verify(branches[0][:1] + ['00' * 32] * 2, txids[0], 0))
+        self.assertFalse(tree.verify(branches[1], os.urandom(32).hex(), 1))
+
+
+class MockBlockchain:
+
+    def __init__(self, headers):
+        self.headers = headers
+        self.reads = []
+
+    def read_header(self, height):
+        self.reads.append(height)
+        return self.headers.get(height)
+
+    def get_base_height(self):
+        return 0
+
+
+class MockInterface:
+
+    def __init__(self, blockchain):
+        self.blockchain = blockchain
+
+
+class MockNetwork:
+
+    def __init__(self, headers):
+        self.chain = MockBlockchain(headers)
+        self.interface = MockInterface(self.chain)
+        self.sent = []
+
+    def blockchain(self):
+        return self.chain
+
+    def get_local_height(self):
+        return max(self.chain.headers)
+
+    def get_merkle_for_transaction(self, tx_hash, tx_height, callback, max_qlen=10):
+        if len(self.sent) >= max_qlen:
+            return None
+        self.sent.append((tx_hash, tx_height, callback))
+        return len(self.sent)
+
+    def trigger_callback(self, *args):
+        pass
+
+
+class MockWallet(SPVDelegate):
+
+    def __init__(self, unverified):
+        self.unverified = unverified
+        self.verified = {}
+        self.failed = {}
+
+    def get_unverified_txs(self):
+        return dict(self.unverified)
+
+    def add_verified_tx(self, tx_hash, height_ts_pos_tup, header):
+        self.unverified.pop(tx_hash)
+        self.verified[tx_hash] = height_ts_pos_tup
+
+    def is_up_to_date(self):
+        return False
+
+    def save_verified_tx(self, write=False):
+        pass
+
+    def undo_verifications(self, blkchain, height):
+        return set()
+
+    def verification_failed(self, tx_hash, reason):
+        self.failed[tx_hash] = reason
+
+    def diagnostic_name(self):
+        return 'mock'
+
+
+class TestSPV(unittest.TestCase):
+
+    def setUp(self):
+        self.blocks = {height: make_block(n) for height, n in ((100, 6), (101, 3), (102, 1))}
+        headers = {height: header for height, (txids, header, branches) in self.blocks.items()}
+        unverified = {txid: height for height, (txids, header, branches) in self.blocks.items() for txid in txids}
+        self.network = MockNetwork(headers)
+        self.wallet = MockWallet(unverified)
+        self.spv = SPV(self.network, self.wallet)
+
+    def answer(self):
+        sent, self.network.sent = self.network.sent, []
+        for tx_hash, tx_height, callback in sent:
+            txids, header, branches = self.blocks[tx_height]
+            pos = txids.index(tx_hash)
+            callback({'params': [tx_hash, tx_height],
+                      'result': {'block_height': tx_height, 'merkle': branches[pos], 'pos': pos}})
+        return [tx_height for tx_hash, tx_height, callback in sent]
+
+    def test_by_block(self):
+        self.spv.run()
+        self.assertEqual([100] * 6 + [101] * 3 + [102], [h for tx_hash, h, callback in self.network.sent])
+        self.assertEqual([100, 101, 102], self.network.chain.reads)
+        self.assertEqual({100, 101, 102}, set(self.spv.blocks))
+        self.answer()
+        self.assertEqual(10, len(self.wallet.verified))
+        self.assertEqual({}, self.wallet.failed)
+        self.assertEqual((100, 1234, 4), self.wallet.verified[self.blocks[100][0][4]])
+        self.assertTrue(self.spv.is_up_to_date())
+        # the headers were read once per block, and the blocks are forgotten
+        self.assertEqual([100, 101, 102], self.network.chain.reads)
+        self.assertEqual({}, self.spv.blocks)
+
+    def test_qlen(self):
+        self.assertEqual(SPV.MIN_QLEN, self.spv.qlen)
+        self.spv.qlen = 4
+        self.spv.run()
+        self.assertTrue(self.spv.qbusy)
+        self.assertEqual([100] * 4, self.answer())
+        # answered fast
+        self.assertEqual(8, self.spv.qlen)
+        self.spv.run()
+        self.assertEqual([100, 100, 101, 101, 101, 102], self.answer())
+        self.assertEqual(14, self.spv.qlen)
+        self.assertEqual(10, len(self.wallet.verified))
+        # slow or failed requests halve it
+        self.spv.request_times['ab' * 32] = 0
+        self.spv.verify_merkle({'params': ['ab' * 32, 100], 'result': {}})
+        self.assertEqual(SPV.MIN_QLEN, self.spv.qlen)
+        self.assertEqual('error_response', self.wallet.failed['ab' * 32])
+
+    def test_mismatch(self):
+        self.spv.run()
+        sent, self.network.sent = self.network.sent, []
+        tx_hash, tx_height, callback = sent[0]
+        txids, header, branches = self.blocks[tx_height]
+        callback({'params': [tx_hash, tx_height],
+                  'result': {'block_height': tx_height, 'merkle': branches[1], 'pos': 1}})
+        self.assertEqual('merkle_mismatch', self.wallet.failed[tx_hash])
+        self.assertEqual(5, self.spv.blocks[100].pending)
+
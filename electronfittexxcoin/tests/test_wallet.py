@@ -4,13 +4,16 @@ import sys
 import unittest
 import os
 import json
+import threading
 
 from io import StringIO
-from ..storage import WalletStorage, FINAL_SEED_VERSION
+from ..storage import WalletStorage, FINAL_SEED_VERSION, delete_wallet_file
 from .. import wallet
 from ..wallet import create_new_wallet, restore_wallet_from_text
+from ..history_export import write_history
 from ..simple_config import SimpleConfig
 from ..address import Address
+from ..util import UserCancelled
 
 
 class FakeSynchronizer(object):
@@ -73,6 +76,280 @@ class TestWalletStorage(WalletTestCase):
             contents = f.read()
         self.assertEqual(some_dict, json.loads(contents))
 
+    def test_journal_append_and_replay(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.set_journal_enabled(True)
+        storage.put('labels', {'a': 'x', 'b': 'y'})
+        storage.write()  # first write is always a full snapshot
+        self.assertFalse(os.path.exists(storage.journal_path()))
+        snapshot = open(self.wallet_path).read()
+
+        storage.put('labels', {'a': 'x', 'c': 'z'})
+        storage.put('foo', 1)
+        storage.write()
+        # The snapshot is untouched, the change went into the journal
+        self.assertEqual(snapshot, open(self.wallet_path).read())
+        self.assertTrue(os.path.exists(storage.journal_path()))
+
+        storage2 = WalletStorage(self.wallet_path, manual_upgrades=True)
+        self.assertEqual({'a': 'x', 'c': 'z'}, storage2.get('labels'))
+        self.assertEqual(1, storage2.get('foo'))
+
+    def test_journal_torn_record(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.set_journal_enabled(True)
+        storage.write()
+        storage.put('foo', 1)
+        storage.write()
+        storage.put('foo', 2)
+        storage.write()
+        # Simulate a crash in the middle of appending the last record
+        with open(storage.journal_path(), 'r+b') as f:
+            f.truncate(os.path.getsize(storage.journal_path()) - 5)
+
+        storage2 = WalletStorage(self.wallet_path, manual_upgrades=True)
+        self.assertEqual(1, storage2.get('foo'))
+        # Appending after the recovery works
+        storage2.put('foo', 3)
+        storage2.write()
+        storage3 = WalletStorage(self.wallet_path, manual_upgrades=True)
+        self.assertEqual(3, storage3.get('foo'))
+
+    def test_journal_compaction(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.set_journal_enabled(True)
+        storage.write()
+        storage._compact()
+        for i in range(10):
+            storage.put('counter', i)
+            storage.write()
+        storage._compact()
+        self.assertFalse(os.path.exists(storage.journal_path()))
+        with open(self.wallet_path, "r") as f:
+            self.assertEqual(9, json.loads(f.read())['counter'])
+        storage.put('counter', 10)
+        storage.write()
+        storage2 = WalletStorage(self.wallet_path, manual_upgrades=True)
+        self.assertEqual(10, storage2.get('counter'))
+
+        # records appended while the snapshot is being written are kept
+        def encode(s, pubkey):
+            storage.put('late', 1)
+            storage.write()
+            return WalletStorage._encode_snapshot(s, pubkey)
+        storage._encode_snapshot = encode
+        storage._compact()
+        with open(self.wallet_path, "r") as f:
+            self.assertNotIn('late', json.loads(f.read()))
+        storage3 = WalletStorage(self.wallet_path, manual_upgrades=True)
+        self.assertEqual(1, storage3.get('late'))
+        self.assertEqual(10, storage3.get('counter'))
+
+    def test_journal_stale(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.set_journal_enabled(True)
+        storage.write()
+        storage.put('foo', 1)
+        storage.write()
+        # A version without the journal rewrites the file, storage_journal included
+        with open(self.wallet_path, "r") as f:
+            data = json.loads(f.read())
+        data['foo'] = 2
+        with open(self.wallet_path, "w") as f:
+            f.write(json.dumps(data))
+
+        storage2 = WalletStorage(self.wallet_path, manual_upgrades=True)
+        self.assertEqual(2, storage2.get('foo'))
+        self.assertFalse(os.path.exists(storage.journal_path()))
+
+    def test_journal_gap(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.set_journal_enabled(True)
+        storage.write()
+        for i in range(1, 4):
+            storage.put('foo', i)
+            storage.write()
+        with open(storage.journal_path(), 'rb') as f:
+            lines = f.readlines()
+        self.assertEqual(4, len(lines))  # the header, then a record per write
+        with open(storage.journal_path(), 'wb') as f:
+            f.write(b''.join(lines[:2] + lines[3:]))
+
+        storage2 = WalletStorage(self.wallet_path, manual_upgrades=True)
+        self.assertEqual(1, storage2.get('foo'))
+        self.assertEqual(b''.join(lines[:2]), open(storage.journal_path(), 'rb').read())
+
+    def test_journal_encrypted(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.set_journal_enabled(True)
+        storage.set_password('secret', encrypt=True)
+        storage.write()
+        storage.put('foo', 'bar')
+        storage.write()
+        with open(storage.journal_path(), 'rb') as f:
+            self.assertNotIn(b'bar', f.read())
+
+        storage2 = WalletStorage(self.wallet_path, manual_upgrades=True)
+        self.assertTrue(storage2.is_encrypted())
+        storage2.decrypt('secret')
+        self.assertEqual('bar', storage2.get('foo'))
+
+    def test_journal_snapshot_and_delete(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.set_journal_enabled(True)
+        storage.write()
+        storage.put('foo', 1)
+        storage.write()
+        self.assertTrue(os.path.exists(storage.journal_path()))
+        # a copy of the wallet file alone has everything
+        storage.write_snapshot()
+        self.assertFalse(os.path.exists(storage.journal_path()))
+        backup_path = self.wallet_path + '.backup'
+        shutil.copyfile(self.wallet_path, backup_path)
+        self.assertEqual(1, WalletStorage(backup_path, manual_upgrades=True).get('foo'))
+
+        storage.put('foo', 2)
+        storage.write()
+        self.assertTrue(delete_wallet_file(self.wallet_path))
+        self.assertFalse(os.path.exists(self.wallet_path))
+        self.assertFalse(os.path.exists(storage.journal_path()))
+        self.assertFalse(delete_wallet_file(self.wallet_path))
+
+class TestSqliteWalletStorage(WalletTestCase):
+
+    def test_migrate_and_read(self):
+        from ..sqlite_storage import SqliteWalletStorage, migrate_json_to_sqlite
+        storage = WalletStorage(self.wallet_path)
+        storage.put('wallet_type', 'imported_addr')
+        storage.put('labels', {'a': 'b'})
+        storage.put('verified_tx3', {'aa' * 32: [100, 1500000000, 1]})
+        storage.put('transactions', {'aa' * 32: '0100'})
+        storage.write()
+
+        sqlite_path = self.wallet_path + '.sqlite'
+        migrate_json_to_sqlite(self.wallet_path, sqlite_path)
+        storage2 = WalletStorage(sqlite_path, manual_upgrades=True)
+        self.assertIsInstance(storage2, SqliteWalletStorage)
+        self.assertTrue(storage2.file_exists())
+        for key in ('wallet_type', 'labels', 'verified_tx3', 'transactions', 'seed_version'):
+            self.assertEqual(storage.get(key), storage2.get(key))
+        self.assertEqual('0100', storage2.table_get('transactions', 'aa' * 32))
+
+    def test_put_writes_changed_rows(self):
+        from ..sqlite_storage import SqliteWalletStorage
+        sqlite_path = self.wallet_path + '.sqlite'
+        storage = SqliteWalletStorage(sqlite_path)
+        storage.put('labels', {'a': 'x', 'b': 'y'})
+        storage.put('foo', [1, 2])
+        storage.write()
+        storage.put('labels', {'a': 'x', 'c': 'z'})
+        storage.write()
+        storage.close()
+
+        storage2 = WalletStorage(sqlite_path, manual_upgrades=True)
+        self.assertEqual({'a': 'x', 'c': 'z'}, storage2.get('labels'))
+        self.assertEqual([1, 2], storage2.get('foo'))
+        self.assertEqual(2, storage2.table_len('labels'))
+        self.assertEqual([('a', 'x'), ('c', 'z')], sorted(storage2.table_items('labels')))
+
+    def test_lazy_transaction_map(self):
+        from ..sqlite_storage import SqliteWalletStorage, LazyTransactionMap
+        from ..transaction import Transaction
+        storage = SqliteWalletStorage(self.wallet_path + '.sqlite')
+        txs = LazyTransactionMap(storage)
+        tx = Transaction('0100')
+        txs['bb' * 32] = tx
+        self.assertIs(tx, txs['bb' * 32])
+        self.assertIn('bb' * 32, txs)
+        self.assertEqual(['bb' * 32], list(txs))
+        self.assertEqual(1, len(txs))
+        self.assertIsNone(txs.get('cc' * 32))
+        self.assertIs(tx, txs.pop('bb' * 32))
+        self.assertEqual(0, len(txs))
+        self.assertRaises(KeyError, txs.__delitem__, 'bb' * 32)
+
+    def test_row_map(self):
+        from ..sqlite_storage import SqliteWalletStorage, RowMap
+        storage = SqliteWalletStorage(self.wallet_path + '.sqlite')
+        storage.put('txo', {'aa': {'x': 1}, 'bb': {'y': 2}, 'cc': {'z': 3}})
+        storage.write()
+        d = RowMap(storage, 'txo')
+        self.assertEqual({'aa', 'bb', 'cc'}, set(d))
+        self.assertIn('bb', d)
+        self.assertEqual({}, d._values)  # nothing read yet
+        self.assertEqual({'y': 2}, d['bb'])
+        self.assertIsNone(d.get('dd'))
+        d['bb']['y'] = 20
+        d.touch('bb')
+        d['dd'] = {'w': 4}
+        del d['aa']
+        self.assertEqual({'bb', 'cc', 'dd'}, set(d))
+        statements = []
+        storage.conn.set_trace_callback(statements.append)
+        storage.put('txo', d)
+        storage.write()
+        storage.conn.set_trace_callback(None)
+        # only the changed rows were written, nothing was read
+        self.assertFalse([s for s in statements if s.startswith('SELECT')])
+        self.assertEqual(2, len([s for s in statements if s.startswith('INSERT')]))
+        self.assertEqual(1, len([s for s in statements if s.startswith('DELETE')]))
+        self.assertEqual({'bb': {'y': 20}, 'cc': {'z': 3}, 'dd': {'w': 4}}, storage.get('txo'))
+
+        d.clear()
+        d['ee'] = {'v': 5}
+        d.flush()
+        self.assertEqual({'ee': {'v': 5}}, storage.get('txo'))
+
+    def test_open_wallet(self):
+        from ..sqlite_storage import SqliteWalletStorage, RowMap, LazyTransactionMap, migrate_json_to_sqlite
+        from ..transaction import Transaction
+        xpub = 'xpub6CUzEfgtza7ZNtfDGYwHPnbPMPiQh93mAbP6v7C3ozUgkZq4tXSgYb9qqZ62oh8RCeexdSF7ZJmTzCm5bdWLB3zSMF8rNfuY8kccNAsdF4d'
+        restore_wallet_from_text(xpub, path=self.wallet_path, config=self.config)
+        sqlite_path = self.wallet_path + '.sqlite'
+        migrate_json_to_sqlite(self.wallet_path, sqlite_path)
+
+        w = wallet.Wallet(WalletStorage(sqlite_path))
+        self.assertIsInstance(w.storage, SqliteWalletStorage)
+        self.assertIsInstance(w.transactions, LazyTransactionMap)
+        for d in (w.txi, w.txo, w.ct_txi, w.ct_txo, w.verified_tx, w.tx_fees, w.pruned_txo, w.labels, w._history):
+            self.assertIsInstance(d, RowMap)
+        addr = w.pubkeys_to_address(w.derive_pubkeys(0, 0))
+        a, b = 'aa' * 32, 'bb' * 32
+        with w.lock:
+            w.transactions[a] = Transaction('0100')
+            w.transactions[b] = Transaction('0200')
+            w.txo[a] = {addr: [(0, 1000, False)]}
+            w.txi[b] = {addr: [(a + ':0', 1000)]}
+            w.tx_fees[b] = 226
+            w.verified_tx[a] = (100, 1500000000, 1)
+        w.save_transactions()
+        w.save_verified_tx()
+        w.set_label(a, 'received')
+        w.storage.write()
+        w.storage.close()
+
+        w2 = wallet.Wallet(WalletStorage(sqlite_path))
+        # the rows are not read at open
+        for d in (w2.txi, w2.txo, w2.verified_tx, w2.tx_fees):
+            self.assertEqual({}, d._values)
+        self.assertEqual({a, b}, set(w2.transactions))
+        self.assertIn(a, w2.txo)
+        self.assertIn(b, w2.txi)
+        self.assertEqual('0200', str(w2.transactions[b]))
+        self.assertEqual(226, w2.tx_fees[b])
+        self.assertEqual((100, 1500000000, 1), tuple(w2.verified_tx[a]))
+        self.assertEqual('received', w2.labels[a])
+        self.assertEqual({addr.to_storage_string(): [[0, 1000, False]]}, w2.storage.table_get('txo', a))
+        self.assertEqual({addr.to_storage_string(): [[a + ':0', 1000]]}, w2.storage.table_get('txi', b))
+
+        # an unreferenced transaction is dropped at open
+        with w2.lock:
+            del w2.txi[b]
+        w2.save_transactions(write=True)
+        w3 = wallet.Wallet(WalletStorage(sqlite_path))
+        self.assertEqual({a}, set(w3.transactions))
+
+
 class TestCreateRestoreWallet(WalletTestCase):
 
     def test_create_new_wallet(self):
@@ -136,4 +413,310 @@ class TestCreateRestoreWallet(WalletTestCase):
         self.assertEqual(Address.from_string('qzrseeup3rhehuaf9e6nr3sgm6t5eegufu96l404mu'), addr0)
         self.assertEqual('Kz7FS9Adyj6RgSVGx5YLjZPanUhuze4yvcziZ1qLA24a3GJJZvBr',
                          wallet.export_private_key(addr0, password=None))
-        self.assertEqual(1, len(wallet.get_receiving_addresses()))
\ No newline at end of file
+        self.assertEqual(1, len(wallet.get_receiving_addresses()))
+
+
+class TestAddressCache(WalletTestCase):
+
+    xpub = 'xpub6CUzEfgtza7ZNtfDGYwHPnbPMPiQh93mAbP6v7C3ozUgkZq4tXSgYb9qqZ62oh8RCeexdSF7ZJmTzCm5bdWLB3zSMF8rNfuY8kccNAsdF4d'
+
+    def reopen(self):
+        storage = WalletStorage(self.wallet_path)
+        return wallet.Wallet(storage), storage
+
+    def test_reload(self):
+        w = restore_wallet_from_text(self.xpub, path=self.wallet_path, config=self.config)['wallet']
+        w.create_new_addresses(False, 5)
+        w.save_addresses()
+        w.storage.write()
+        receiving, change = w.get_receiving_addresses(), w.get_change_addresses()
+        self.assertEqual(25, len(receiving))
+        self.assertIn('address_cache', w.storage.data)
+
+        w2, storage = self.reopen()
+        self.assertEqual(receiving, w2.get_receiving_addresses())
+        self.assertEqual(change, w2.get_change_addresses())
+        self.assertIsNotNone(w2.get_receiving_addresses()[24]._scripthash_hex)
+        self.assertEqual([a.to_scripthash_hex() for a in receiving],
+                         [Address(a.hash, a.kind).to_scripthash_hex() for a in w2.get_receiving_addresses()])
+        self.assertEqual((True, 3), w2.get_address_index(change[3]))
+        self.assertEqual((False, 24), w2.get_address_index(receiving[24]))
+        self.assertEqual(w.keystore.derive_pubkey(False, 7), w2.get_pubkey(False, 7))
+        self.assertEqual(w2.keystore.derive_pubkey(True, 2), w2.get_public_key(change[2]))
+
+        # a truncated address list truncates the cache with it
+        w2.receiving_addresses = w2.receiving_addresses[:21]
+        w2.save_addresses()
+        storage.write()
+        w3, storage = self.reopen()
+        self.assertEqual(receiving[:21], w3.get_receiving_addresses())
+
+    def test_invalid_cache(self):
+        from .. import address_cache
+        w = restore_wallet_from_text(self.xpub, path=self.wallet_path, config=self.config)['wallet']
+        w.save_addresses()
+        cache = w.storage.get('address_cache')
+        self.assertIsNotNone(address_cache.AddressCache.load(cache, cache['fingerprint']))
+        self.assertIsNone(address_cache.AddressCache.load(cache, '00' * 32))
+        self.assertIsNone(address_cache.AddressCache.load(dict(cache, receiving=cache['receiving'][:-8]),
+                                                          cache['fingerprint']))
+        self.assertIsNone(address_cache.AddressCache.load(dict(cache, version=0), cache['fingerprint']))
+
+
+
+class MockSynchronizer:
+
+    def __init__(self):
+        self.added = []
+        self.removed = []
+
+    def add(self, address, *, for_change=False):
+        self.added.append(address)
+
+    def remove(self, addresses):
+        self.removed.extend(addresses)
+
+
+class TestRestoreLookahead(WalletTestCase):
+
+    xpub = TestAddressCache.xpub
+
+    def test_lookahead(self):
+        w = restore_wallet_from_text(self.xpub, path=self.wallet_path, config=self.config)['wallet']
+        lookahead, block = w.RESTORE_LOOKAHEAD, w.RESTORE_BLOCK
+        # restored offline at the gap limit, the lookahead is for the first sync
+        self.assertEqual(20, len(w.get_receiving_addresses()))
+        self.assertTrue(w.storage.get('restore_lookahead'))
+        w.synchronize()
+        self.assertEqual(20 + lookahead, len(w.get_receiving_addresses()))
+        self.assertEqual(20 + lookahead, len(w.get_change_addresses()))
+
+        w.storage.put('stored_height', 2000)
+        w.synchronizer = sync = MockSynchronizer()
+        receiving = w.get_receiving_addresses()[:]
+        # a used address extends the lookahead by at least a block
+        w._history[receiving[10]] = [('00' * 32, 1000)]
+        w.synchronize()
+        self.assertEqual(20 + lookahead + block, len(w.get_receiving_addresses()))
+        self.assertEqual(w.get_receiving_addresses()[20 + lookahead:], sync.added)
+        # not synchronized yet, so the lookahead stays
+        self.assertEqual([], sync.removed)
+
+        w.set_up_to_date(True)
+        w.synchronize()
+        self.assertIsNone(w.storage.get('restore_lookahead'))
+        self.assertEqual(receiving[:31], w.get_receiving_addresses())
+        self.assertEqual(20, len(w.get_change_addresses()))
+        self.assertEqual((lookahead + block - 11) + lookahead, len(sync.removed))
+        self.assertNotIn(receiving[31], w._history)
+        self.assertFalse(w.is_mine(receiving[31]))
+        # and it stays at the gap limit from now on
+        w.synchronize()
+        self.assertEqual(31, len(w.get_receiving_addresses()))
+
+
+class SyntheticHistoryTestCase(WalletTestCase):
+    ''' A single address wallet whose history and txo/txi entries are set
+    directly by the tests. '''
+
+    def setUp(self):
+        super().setUp()
+        text = 'qr2q6aadv6nxmqwjt8qmax76yqp09mlqzq5jsz5fe9'
+        self.wallet = restore_wallet_from_text(text, path=self.wallet_path, config=self.config)['wallet']
+        self.addr = self.wallet.get_receiving_addresses()[0]
+
+    def set_history(self, hist, txo, txi):
+        w = self.wallet
+        with w.lock:
+            for tx_hash, outs in txo.items():
+                w.txo[tx_hash] = {self.addr: outs}
+            for tx_hash, ins in txi.items():
+                w.txi[tx_hash] = {self.addr: ins}
+            w._history[self.addr] = hist
+            w._invalidate_addr(self.addr)
+
+
+class TestAddrCoinsIndex(SyntheticHistoryTestCase):
+
+    def test_balance_and_utxos(self):
+        w = self.wallet
+        a, b, c = 'aa' * 32, 'bb' * 32, 'cc' * 32
+        self.set_history([(a, 100), (b, 0)], {a: [(0, 1000, False), (1, 2000, False)], b: [(0, 500, False)]}, {})
+        self.assertEqual((3000, 500, 0), w.get_addr_balance(self.addr))
+        self.assertEqual({a + ':0', a + ':1', b + ':0'}, set(w.get_addr_utxo(self.addr)))
+
+        # spend a:0 in a confirmed tx
+        self.set_history([(a, 100), (b, 0), (c, 101)], {a: [(0, 1000, False), (1, 2000, False)],
+                                                         b: [(0, 500, False)]},
+                         {c: [(a + ':0', 1000)]})
+        self.assertEqual((2000, 500, 0), w.get_addr_balance(self.addr))
+        self.assertEqual({a + ':1', b + ':0'}, set(w.get_addr_utxo(self.addr)))
+        self.assertEqual([b + ':0'], ['{prevout_hash}:{prevout_n}'.format(**x)
+                                      for x in w.get_utxos(confirmed_only=False, exclude_frozen=True)
+                                      if x['value'] == 500])
+
+        # coin-level freezing
+        w.set_frozen_coin_state([a + ':1'], True)
+        self.assertEqual((0, 500, 0), w.get_addr_balance(self.addr, exclude_frozen_coins=True))
+        self.assertEqual((2000, 500, 0), w.get_addr_balance(self.addr))
+        self.assertEqual({b + ':0'}, {'{prevout_hash}:{prevout_n}'.format(**x)
+                                      for x in w.get_utxos(exclude_frozen=True)})
+        w.set_frozen_coin_state([a + ':1'], False)
+        self.assertEqual((2000, 500, 0), w.get_addr_balance(self.addr, exclude_frozen_coins=True))
+
+    def test_coinbase_maturity(self):
+        w = self.wallet
+        a = 'aa' * 32
+        self.set_history([(a, 100)], {a: [(0, 5000, True)]}, {})
+        # offline wallet: local height is the stored height
+        w.storage.put('stored_height', 150)
+        self.assertEqual((0, 0, 5000), w.get_addr_balance(self.addr))
+        w.storage.put('stored_height', 250)
+        self.assertEqual((5000, 0, 0), w.get_addr_balance(self.addr))
+
+
+class TestHistoryIndex(SyntheticHistoryTestCase):
+
+    def assertHistoryMatches(self, **kwargs):
+        w = self.wallet
+        # an explicit domain takes the full recompute path
+        expected = w.get_history([self.addr], **kwargs)
+        self.assertEqual(expected, w.get_history(**kwargs))
+        n = len(expected)
+        self.assertEqual(n, w.get_history_len())
+        for start, stop in ((0, 1), (1, n), (n - 2, None), (None, -1)):
+            self.assertEqual(w.get_history([self.addr], start=start, stop=stop, **kwargs),
+                             w.get_history(start=start, stop=stop, **kwargs))
+        return expected
+
+    def test_incremental_updates(self):
+        w = self.wallet
+        a, b, c, d = 'aa' * 32, 'bb' * 32, 'cc' * 32, 'dd' * 32
+        txo = {a: [(0, 1000, False), (1, 2000, False)], b: [(0, 500, False)]}
+        self.set_history([(a, 100), (b, 0)], txo, {})
+        for tx_hash, height in ((a, 100), (b, 0)):
+            w.add_unverified_tx(tx_hash, height)
+        h = self.assertHistoryMatches()
+        self.assertEqual([(a, 3000, 3000), (b, 500, 3500)], [(x.tx_hash, x.amount, x.balance) for x in h])
+
+        # a spend in a later block, then the mempool tx confirms before it
+        self.set_history([(a, 100), (b, 0), (c, 102)], txo, {c: [(a + ':0', 1000)]})
+        w.add_unverified_tx(c, 102)
+        self.assertHistoryMatches()
+        w.add_unverified_tx(b, 101)
+        h = self.assertHistoryMatches()
+        self.assertEqual([a, b, c], [x.tx_hash for x in h])
+        self.assertHistoryMatches(reverse=True)
+
+        # a receive and a send in the same block
+        txo[d] = [(0, 700, False)]
+        self.set_history([(a, 100), (b, 101), (c, 102), (d, 102)], txo, {c: [(a + ':0', 1000)]})
+        w.add_unverified_tx(d, 102)
+        h = self.assertHistoryMatches(receives_before_sends=True)
+        self.assertEqual([a, b, d, c], [x.tx_hash for x in h])
+        self.assertEqual(3200, h[-1].balance)
+
+        # pruned tx: its delta and the balances before it are unknown
+        w.pruned_txo_values.add(b)
+        h = self.assertHistoryMatches(receives_before_sends=True)
+        self.assertEqual([None, None], [h[0].balance, h[1].amount])
+        w.pruned_txo_values.discard(b)
+
+        # tx's disappear from the history
+        self.set_history([(a, 100), (d, 102)], txo, {})
+        h = self.assertHistoryMatches(include_tokens=True, include_tokens_balances=True)
+        self.assertEqual([a, d], [x.tx_hash for x in h])
+        self.assertEqual({}, h[0].tokens_deltas)
+
+
+class TestHistoryExport(SyntheticHistoryTestCase):
+
+    def setUp(self):
+        super().setUp()
+        w = self.wallet
+        # 12 tx's in 4 blocks, each block has receives and sends
+        self.txids = ['%02x' % i * 32 for i in range(1, 13)]
+        txo = {txid: [(0, 1000 * (i + 1), False)] for i, txid in enumerate(self.txids) if i % 3 != 2}
+        txi = {txid: [(self.txids[i - 2] + ':0', 1000 * (i - 1))] for i, txid in enumerate(self.txids) if i % 3 == 2}
+        self.set_history([(txid, 100 + i // 3) for i, txid in enumerate(self.txids)], txo, txi)
+        for i, txid in enumerate(self.txids):
+            w.add_unverified_tx(txid, 100 + i // 3)
+            w.tx_fees[txid] = 0
+
+    def test_iter_history(self):
+        w = self.wallet
+        for rbs in (False, True):
+            expected = w.get_history(reverse=True, receives_before_sends=rbs)
+            self.assertEqual(12, len(expected))
+            for batch_size in (1, 2, 5, 100):
+                self.assertEqual(expected, list(w.iter_history(receives_before_sends=rbs, batch_size=batch_size)))
+
+    def test_write_history(self):
+        w = self.wallet
+        expected = w.export_history(receives_before_sends=True)
+        self.assertEqual(12, len(expected))
+        self.assertEqual(expected, list(w.iter_export_history(receives_before_sends=True, batch_size=5)))
+
+        f = StringIO()
+        self.assertEqual(12, write_history(w, f, 'csv', receives_before_sends=True))
+        lines = f.getvalue().splitlines()
+        self.assertEqual(13, len(lines))
+        self.assertTrue(lines[0].startswith('transaction_hash,label,'))
+        self.assertEqual([item['txid'] for item in expected], [line.split(',')[0] for line in lines[1:]])
+
+        f = StringIO()
+        self.assertEqual(12, write_history(w, f, 'json', receives_before_sends=True))
+        self.assertEqual(json.dumps(expected, indent=4), f.getvalue())
+
+        f = StringIO()
+        self.assertEqual(12, write_history(w, f, 'jsonl', receives_before_sends=True))
+        self.assertEqual(expected, [json.loads(line) for line in f.getvalue().splitlines()])
+
+    def test_cancel_and_progress(self):
+        w = self.wallet
+        cancel_event = threading.Event()
+        progress = []
+        def on_progress(x):
+            progress.append(x)
+            if len(progress) == 3:
+                cancel_event.set()
+        with self.assertRaises(UserCancelled):
+            write_history(w, StringIO(), 'jsonl', progress_callback=on_progress, cancel_event=cancel_event)
+        self.assertEqual(3, len(progress))
+
+        progress.clear()
+        write_history(w, StringIO(), 'csv', progress_callback=progress.append)
+        self.assertEqual(1.0, progress[-1])
+        self.assertEqual(progress, sorted(progress))
+
+
+class MockBlockchain:
+
+    def __init__(self, headers):
+        self.headers = headers
+        self.reads = []
+
+    def read_header(self, height):
+        self.reads.append(height)
+        return self.headers.get(height)
+
+
+class TestVerifiedRoots(SyntheticHistoryTestCase):
+
+    def test_undo_verifications(self):
+        w = self.wallet
+        roots = {height: os.urandom(32).hex() for height in (99, 100, 101)}
+        w.verified_tx.update({'a' * 64: (99, 1, 0), 'b' * 64: (100, 2, 0), 'c' * 64: (100, 2, 3),
+                              'd' * 64: (101, 3, 0), 'e' * 64: (102, 4, 0)})
+        w.verified_roots.update(roots)
+        # the root of block 101 changed, and 102 (verified before the roots were kept) has the same timestamp
+        chain = MockBlockchain({99: {'merkle_root': roots[99], 'timestamp': 1},
+                                100: {'merkle_root': roots[100], 'timestamp': 2},
+                                101: {'merkle_root': os.urandom(32).hex(), 'timestamp': 3},
+                                102: {'merkle_root': os.urandom(32).hex(), 'timestamp': 4}})
+        self.assertEqual({'d' * 64}, w.undo_verifications(chain, 100))
+        self.assertEqual([100, 101, 102], sorted(chain.reads))
+        self.assertEqual({99: roots[99], 100: roots[100]}, w.verified_roots)
+
+        w.save_verified_tx()
+        self.assertEqual({'99': roots[99], '100': roots[100]}, w.storage.get('verified_roots'))
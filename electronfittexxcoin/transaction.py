@@ -37,6 +37,7 @@ from .address import (PublicKey, Address, Script, ScriptOutput, hash160,
                       UnknownAddress, OpCodes as opcodes,
                       P2PKH_prefix, P2PKH_suffix, P2SH_prefix, P2SH_suffix, P2SH32_prefix, P2SH32_suffix,int_to_bytess,var_int_bytes)
 from .serialize import BCDataStream, SerializationError
+from . import ecc_fast
 from . import schnorr
 from . import token
 from . import util
@@ -400,6 +401,9 @@ class Transaction:
             raise Exception('API changed: update_signatures expects a list.')
         if len(self.inputs()) != len(signatures):
             raise Exception('expected {} signatures; got {}'.format(len(self.inputs()), len(signatures)))
+        candidates = []  # (i, j, pubkey, sig_final)
+        items = []  # (pubkey, sig, pre_hash) for verify_signatures
+        todo = []
         for i, txin in enumerate(self.inputs()):
             pubkeys, x_pubkeys = self.get_sorted_pubkeys(txin)
             sig = signatures[i]
@@ -412,15 +416,23 @@ class Transaction:
                 continue
             pre_hash = Hash(bfh(self.serialize_preimage(i)))
             sig_bytes = bfh(sig)
-            added = False
-            reason = []
+            todo.append((i, pubkeys, sig, pre_hash))
             for j, pubkey in enumerate(pubkeys):
                 # see which pubkey matches this sig (in non-multisig only 1 pubkey, in multisig may be multiple pubkeys)
-                if self.verify_signature(bfh(pubkey), sig_bytes, pre_hash, reason):
-                    print_error("adding sig", i, j, pubkey, sig_final)
-                    self._inputs[i]['signatures'][j] = sig_final
-                    added = True
-            if not added:
+                candidates.append((i, j, pubkey, sig_final))
+                items.append((bfh(pubkey), sig_bytes, pre_hash))
+        added = set()
+        for (i, j, pubkey, sig_final), ok in zip(candidates, self.verify_signatures(items)):
+            if ok:
+                print_error("adding sig", i, j, pubkey, sig_final)
+                self._inputs[i]['signatures'][j] = sig_final
+                added.add(i)
+        for i, pubkeys, sig, pre_hash in todo:
+            if i not in added:
+                # verify again one at a time, for the failure reasons
+                reason = []
+                for pubkey in pubkeys:
+                    self.verify_signature(bfh(pubkey), bfh(sig), pre_hash, reason)
                 resn = ', '.join(reversed(reason)) if reason else ''
                 print_error("failed to add signature {} for any pubkey for reason(s): '{}' ; pubkey(s) / sig / pre_hash = ".format(i, resn),
                             pubkeys, '/', sig, '/', bh2u(pre_hash))
@@ -929,6 +941,34 @@ class Transaction:
                     reason.insert(0, repr(e))
             return False
 
+    @staticmethod
+    def verify_signatures(items):
+        """ Like verify_signature, for many (pubkey, sig, msghash) tuples at
+        once. Returns a list of bools, one per item. Schnorr signatures are
+        verified with schnorr.verify_batch and, if libsecp256k1 is in use,
+        ECDSA signatures with ecc_fast.verify_der_batch; everything else one
+        at a time. """
+        items = list(items)
+        for pubkey, sig, msghash in items:
+            if (any(not arg or not isinstance(arg, bytes) for arg in (pubkey, sig, msghash))
+                    or len(msghash) != 32):
+                raise ValueError('bad arguments to verify_signatures')
+        results = [None] * len(items)
+        schnorr_idx = [n for n, item in enumerate(items) if len(item[1]) == 64]
+        for n, ok in zip(schnorr_idx, schnorr.verify_batch([items[n] for n in schnorr_idx])):
+            results[n] = ok
+        if ecc_fast.is_using_fast_ecc():
+            ecdsa_idx = [n for n, item in enumerate(items) if len(item[1]) != 64]
+            for n, ok in zip(ecdsa_idx, ecc_fast.verify_der_batch([items[n] for n in ecdsa_idx])):
+                results[n] = ok
+        for n, ok in enumerate(results):
+            if ok is None:
+                try:
+                    results[n] = Transaction.verify_signature(*items[n])
+                except ValueError:
+                    results[n] = False
+        return results
+
     @staticmethod
     def _ecdsa_sign(sec, pre_hash):
         pkey = regenerate_key(sec)
@@ -1025,6 +1065,9 @@ class Transaction:
     # code, otherwise the cache may grow to 10x memory consumption if you
     # put deserialized tx's in here.
     _fetched_tx_cache = ExpiringCache(maxlen=1000, name="TransactionFetchCache")
+    # Persistent second level of the above cache (a tx_store.TxStore shared by
+    # all wallets). Set by the Network, None if there is no network.
+    tx_store = None
 
     def fetch_input_data(self, wallet, done_callback=None, done_args=tuple(),
                          prog_callback=None, *, force=False, use_network=True):
@@ -1313,9 +1356,15 @@ class Transaction:
     @classmethod
     def tx_cache_get(cls, txid : str) -> object:
         """ Attempts to retrieve txid from the tx cache that this class
-        keeps in-memory.  Returns None on failure. The returned tx is
-        not deserialized, and is a copy of the one in the cache. """
+        keeps in-memory, or else from the on-disk cls.tx_store.  Returns None
+        on failure. The returned tx is not deserialized, and is a copy of the
+        one in the cache. """
         tx = cls._fetched_tx_cache.get(txid)
+        if tx is None and cls.tx_store is not None:
+            raw = cls.tx_store.get(txid)
+            if raw:
+                tx = Transaction(raw)
+                cls._fetched_tx_cache.put(txid, tx)
         if tx is not None and tx.raw:
             # make sure to return a copy of the transaction from the cache
             # so that if caller does .deserialize(), *his* instance will
@@ -1326,11 +1375,14 @@ class Transaction:
 
     @classmethod
     def tx_cache_put(cls, tx : object, txid : str = None):
-        """ Puts a non-deserialized copy of tx into the tx_cache. """
+        """ Puts a non-deserialized copy of tx into the tx_cache (and into the
+        on-disk cls.tx_store, which checks the txid). """
         if not tx or not tx.raw:
             raise ValueError('Please pass a tx which has a valid .raw attribute!')
         txid = txid or cls._txid(tx.raw)  # optionally, caller can pass-in txid to save CPU time for hashing
         cls._fetched_tx_cache.put(txid, Transaction(tx.raw))
+        if cls.tx_store is not None:
+            cls.tx_store.put(txid, tx.raw)
 
 
 def tx_from_str(txt):
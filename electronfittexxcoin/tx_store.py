@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+#
+# Electron Cash - A Fittexxcoin SPV Wallet
+# License: MIT License
+#
+''' Persistent raw transaction cache.
+
+TxStore keeps raw transactions keyed by txid in a single file in the config
+directory, so that transactions fetched from the network (input transactions
+for fee and value computation, wallet history) survive a restart and are
+shared by all the wallets of a daemon.
+
+File format: an 8 byte magic, followed by records of
+    txid (32 bytes, display byte order) | length (uint32 LE) | raw tx bytes
+Records are only ever appended. The index (txid -> position) is rebuilt by
+scanning the record headers when the file is opened; a truncated last record
+(e.g. after a crash) is cut off. Every read recomputes the txid of the data,
+and entries which fail the check are dropped.
+
+The cache is bounded by the total size of the transactions it holds. The
+least recently used ones are evicted from the index, and the file is
+rewritten without them (in least recently used first order) once the dead
+space in it exceeds the budget. '''
+
+import os
+import struct
+import threading
+from collections import OrderedDict
+
+from .bitcoin import Hash
+from .util import PrintError
+
+MAGIC = b'FXTXS\x00\x00\x01'
+_REC = struct.Struct('<32sI')
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+
+class TxStore(PrintError):
+
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.index = OrderedDict()  # txid bytes -> (offset, length), least recently used first
+        self.live_bytes = 0  # sum of the lengths in self.index
+        self.hits = self.misses = 0
+        self.f = None
+        try:
+            self._open()
+        except OSError as e:
+            self.print_error("disabled, cannot open", path, repr(e))
+            self.f = None
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self.index.clear()
+        self.live_bytes = 0
+        try:
+            self.f = open(self.path, 'r+b')
+        except FileNotFoundError:
+            self.f = open(self.path, 'w+b')
+        f = self.f
+        if f.read(len(MAGIC)) != MAGIC:
+            f.seek(0)
+            f.truncate()
+            f.write(MAGIC)
+            f.flush()
+            return
+        end = f.seek(0, os.SEEK_END)
+        pos = len(MAGIC)
+        while pos + _REC.size <= end:
+            f.seek(pos)
+            txid, length = _REC.unpack(f.read(_REC.size))
+            if pos + _REC.size + length > end:
+                break
+            old = self.index.pop(txid, None)
+            if old:
+                self.live_bytes -= old[1]
+            self.index[txid] = (pos + _REC.size, length)
+            self.live_bytes += length
+            pos += _REC.size + length
+        if pos != end:
+            self.print_error("discarding", end - pos, "bytes of truncated data")
+            f.truncate(pos)
+        self._evict()
+
+    def close(self):
+        with self.lock:
+            if self.f:
+                self.f.close()
+                self.f = None
+
+    def get(self, txid):
+        ''' Returns the raw tx hex for txid, or None if it is not in the
+        store. '''
+        try:
+            key = bytes.fromhex(txid)
+        except (ValueError, TypeError):
+            return None
+        with self.lock:
+            ent = self.index.get(key)
+            if ent is None or not self.f:
+                self.misses += 1
+                return None
+            offset, length = ent
+            try:
+                self.f.seek(offset)
+                raw = self.f.read(length)
+            except OSError as e:
+                self.print_error("read error", repr(e))
+                raw = b''
+            if len(raw) != length or Hash(raw)[::-1] != key:
+                self.print_error("dropping corrupt entry", txid)
+                del self.index[key]
+                self.live_bytes -= length
+                self.misses += 1
+                return None
+            self.index.move_to_end(key)
+            self.hits += 1
+        return raw.hex()
+
+    def put(self, txid, raw_hex):
+        ''' Stores raw_hex under txid. Data which does not hash to txid is
+        not stored. Returns True if the tx is in the store afterwards. '''
+        try:
+            key = bytes.fromhex(txid)
+            raw = bytes.fromhex(raw_hex)
+        except (ValueError, TypeError):
+            return False
+        if len(key) != 32 or len(raw) > self.max_bytes or Hash(raw)[::-1] != key:
+            return False
+        with self.lock:
+            if not self.f:
+                return False
+            if key in self.index:
+                self.index.move_to_end(key)
+                return True
+            try:
+                pos = self.f.seek(0, os.SEEK_END)
+                self.f.write(_REC.pack(key, len(raw)) + raw)
+                self.f.flush()
+            except OSError as e:
+                self.print_error("write error", repr(e))
+                return False
+            self.index[key] = (pos + _REC.size, len(raw))
+            self.live_bytes += len(raw)
+            self._evict()
+            return key in self.index
+
+    def _evict(self):
+        while self.live_bytes > self.max_bytes:
+            _, (_, length) = self.index.popitem(last=False)
+            self.live_bytes -= length
+        try:
+            size = self.f.seek(0, os.SEEK_END)
+            if size - len(MAGIC) - self.live_bytes - _REC.size * len(self.index) > self.max_bytes:
+                self._compact()
+        except OSError as e:
+            self.print_error("compaction failed", repr(e))
+            if self.f.closed:
+                try:
+                    self._open()
+                except OSError:
+                    self.f = None
+
+    def _compact(self):
+        ''' Rewrites the file with only the entries in the index. '''
+        tmp_path = self.path + '.tmp'
+        index = OrderedDict()
+        with open(tmp_path, 'wb') as out:
+            out.write(MAGIC)
+            pos = len(MAGIC)
+            for key, (offset, length) in self.index.items():
+                self.f.seek(offset)
+                raw = self.f.read(length)
+                out.write(_REC.pack(key, length) + raw)
+                index[key] = (pos + _REC.size, length)
+                pos += _REC.size + length
+            out.flush()
+            os.fsync(out.fileno())
+        self.f.close()
+        os.replace(tmp_path, self.path)
+        self.f = open(self.path, 'r+b')
+        self.index = index
+        self.print_error("compacted,", len(index), "transactions")
+
+    def __contains__(self, txid):
+        try:
+            return bytes.fromhex(txid) in self.index
+        except (ValueError, TypeError):
+            return False
+
+    def __len__(self):
+        return len(self.index)
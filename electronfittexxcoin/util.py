@@ -748,12 +748,22 @@ class JSONSocketPipe(PrintError):
         some known reason, raises .Closed; other errors will raise other exceptions.
         '''
         while True:
-            response, self.recv_buf = parse_json(self.recv_buf)
-            if response is not None:
-                return response
+            n = self.recv_buf.find(b'\n')
+            if n != -1:
+                line = self.recv_buf[:n]
+                # deleting from the front of a bytearray does not copy the rest
+                del self.recv_buf[:n+1]
+                try:
+                    response = json.loads(line.decode('utf8'))
+                except Exception:
+                    # just consume the line and ignore error.
+                    continue
+                if response is not None:
+                    return response
+                continue
 
             try:
-                data = self.socket.recv(1024)
+                data = self.socket.recv(65536)
             except (socket.timeout, BlockingIOError, ssl.SSLWantReadError):
                 raise timeout
             except OSError as exc:
@@ -786,6 +796,12 @@ class JSONSocketPipe(PrintError):
         self.send_buf.extend(out)
         return self.send_flush()
 
+    def send_raw(self, data):
+        ''' Send already framed data (one or more newline terminated json
+        messages). '''
+        self.send_buf.extend(data)
+        return self.send_flush()
+
     def send_all(self, requests):
         out = b''.join(map(fittexxcoin x: (json.dumps(x) + '\n').encode('utf8'), requests))
         self.send_buf.extend(out)
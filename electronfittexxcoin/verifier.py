@@ -20,7 +20,10 @@
 # ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
+import time
 from abc import ABC, abstractmethod
+from collections import defaultdict
+
 from .util import ThreadJob, bh2u
 from .bitcoin import Hash, hash_decode, hash_encode
 from . import networks
@@ -82,9 +85,51 @@ class SPVDelegate(ABC):
     def diagnostic_name(self):
         ''' Make sure delegate classes have this method (PrintError interface). '''
 
+class PartialMerkleTree:
+    ''' The nodes of the merkle tree of a block which are known to be in it,
+    from the merkle branches verified against its header so far. The branch
+    of another tx of the block is then only hashed up to the first node it
+    shares with them. '''
+
+    __slots__ = ('header', 'nodes', 'pending')
+
+    def __init__(self, header):
+        self.header = header
+        self.nodes = {}  # (depth from the leaves, index) -> hash (bytes)
+        self.pending = 0  # merkle requests in flight for this block
+
+    def verify(self, merkle_s, tx_hash, pos):
+        ''' Returns True if the merkle branch merkle_s puts tx_hash at
+        position pos in the block, False otherwise. '''
+        h = hash_decode(tx_hash)
+        path = []
+        for i, item in enumerate(merkle_s):
+            known = self.nodes.get((i, pos >> i))
+            if known is not None:
+                ok = known == h
+                break
+            sibling = hash_decode(item)
+            path.append(((i, pos >> i), h))
+            path.append(((i, (pos >> i) ^ 1), sibling))
+            # See SPV.hash_merkle_root
+            h = Hash(sibling + h) if ((pos >> i) & 1) else Hash(h + sibling)
+        else:
+            ok = hash_encode(h) == self.header.get('merkle_root')
+        if ok:
+            self.nodes.update(path)
+        return ok
+
+
 class SPV(ThreadJob):
     """ Simple Payment Verification """
 
+    # The merkle proofs are requested while the network has fewer than `qlen`
+    # requests in flight. It grows by one for each proof answered within
+    # TARGET_LATENCY seconds, and halves when one is slower or errors out.
+    MIN_QLEN = 10
+    MAX_QLEN = 200
+    TARGET_LATENCY = 2.0
+
     def __init__(self, network, wallet):
         assert isinstance(wallet, SPVDelegate), "Verifier instance needs to be passed a wallet that is an object implementing the SPVDelegate interface."
         self.wallet = wallet  # despite the name, might not always be a wallet instance, may be SPVDelete (CashAcct)
@@ -92,6 +137,9 @@ class SPV(ThreadJob):
         self.blockchain = network.blockchain()
         self.merkle_roots = {}  # txid -> merkle root (once it has been verified)
         self.requested_merkle = set()  # txid set of pending requests
+        self.request_times = {}  # txid -> time its merkle proof was requested
+        self.blocks = {}  # height -> PartialMerkleTree, for the blocks with requests in flight
+        self.qlen = self.MIN_QLEN
         self.qbusy = False
         self.cleaned_up = False
         self._need_release = False
@@ -107,6 +155,7 @@ class SPV(ThreadJob):
         self._need_release = False
         self.cleaned_up = True
         self.network.cancel_requests(self.verify_merkle)
+        self.blocks.clear()
         self.network.remove_jobs([self])
 
     def release(self):
@@ -136,6 +185,9 @@ class SPV(ThreadJob):
 
         local_height = self.network.get_local_height()
         unverified = self.wallet.get_unverified_txs()
+        # The txs to verify, by block: each header is read once, and the
+        # proofs of a block are requested (and answered) together.
+        by_height = defaultdict(list)
         for tx_hash, tx_height in unverified.items():
             # do not request merkle branch if we already requested it
             if tx_hash in self.requested_merkle or tx_hash in self.merkle_roots:
@@ -143,27 +195,41 @@ class SPV(ThreadJob):
             # or before headers are available
             if tx_height <= 0 or tx_height > local_height:
                 continue
+            by_height[tx_height].append(tx_hash)
 
-            # if it's in the checkpoint region, we still might not have the header
-            header = blockchain.read_header(tx_height)
-            if header is None:
-                if tx_height <= networks.net.GENESIS1:
-                    # Per-header requests might be a lot heavier.
-                    # Also, they're not supported as header requests are
-                    # currently designed for catching up post-checkpoint headers.
-                    index = tx_height // 2016
-                    if self.network.request_chunk(interface, index):
-                        interface.print_error("verifier requesting chunk {} for height {}".format(index, tx_height))
-                continue
-            # enqueue request
-            msg_id = self.network.get_merkle_for_transaction(tx_hash, tx_height,
-                                                             self.verify_merkle)
-            self.qbusy = msg_id is None
+        missing_headers = []
+        self.qbusy = False
+        now = time.time()
+        for tx_height in sorted(by_height):
+            block = self.blocks.get(tx_height)
+            if block is None:
+                # if it's in the checkpoint region, we still might not have the header
+                header = blockchain.read_header(tx_height)
+                if header is None:
+                    if networks.net.VERIFICATION_BLOCK_HEIGHT is not None and tx_height <= networks.net.VERIFICATION_BLOCK_HEIGHT:
+                        missing_headers.append(tx_height)
+                    continue
+                block = self.blocks[tx_height] = PartialMerkleTree(header)
+            for tx_hash in by_height[tx_height]:
+                # enqueue request
+                msg_id = self.network.get_merkle_for_transaction(tx_hash, tx_height, self.verify_merkle,
+                                                                 max_qlen=self.qlen)
+                if msg_id is None:
+                    # interface queue busy, will try again later
+                    self.qbusy = True
+                    break
+                self.requested_merkle.add(tx_hash)
+                self.request_times[tx_hash] = now
+                block.pending += 1
             if self.qbusy:
-                # interface queue busy, will try again later
                 break
-            self.print_error('requested merkle', tx_hash)
-            self.requested_merkle.add(tx_hash)
+            self.print_error('requested merkle for', len(by_height[tx_height]), 'txs at height', tx_height)
+
+        if missing_headers:
+            # fetched together, as sparsely as the network allows
+            n = self.network.request_checkpoint_headers(interface, missing_headers)
+            if n:
+                interface.print_error("verifier sent {} header requests for {} txs".format(n, len(missing_headers)))
 
         if self.network.blockchain() != self.blockchain:
             self.blockchain = self.network.blockchain()
@@ -174,12 +240,32 @@ class SPV(ThreadJob):
         'misc_failure', 'tx_not_found'
     )
 
+    def _request_done(self, tx_hash, height, ok):
+        ''' Adapts qlen to how fast the merkle request for tx_hash at height
+        was answered, and forgets the block once it has no more requests in
+        flight. '''
+        sent = self.request_times.pop(tx_hash, None)
+        if sent is not None:
+            if ok and time.time() - sent <= self.TARGET_LATENCY:
+                self.qlen = min(self.MAX_QLEN, self.qlen + 1)
+            else:
+                self.qlen = max(self.MIN_QLEN, self.qlen // 2)
+        block = self.blocks.get(height)
+        if block is not None:
+            block.pending -= 1
+            if block.pending <= 0:
+                del self.blocks[height]
+
     def verify_merkle(self, response):
         if self.cleaned_up:
             return  # we have been killed, this was just a delayed callback
+        params = response.get('params')
+        tx_hash = params and params[0]
+        requested_height = params[1] if tx_hash and len(params) > 1 else None
+        block = self.blocks.get(requested_height)
+        if tx_hash:
+            self._request_done(tx_hash, requested_height, not response.get('error'))
         try:
-            params = response.get('params')
-            tx_hash = params and params[0]
             if response.get('error'):
                 e = str(response.get('error'))
                 if 'not in block' in e.lower():
@@ -200,18 +286,11 @@ class SPV(ThreadJob):
             self.print_error("verify_merkle:", str(e))
             return
 
-        try:
-            # Verify the hash of the server-provided merkle branch to a
-            # transaction matches the merkle root of its block
-            tx_height = merkle['block_height']
-            pos = merkle['pos']
-            merkle_root = self.hash_merkle_root(merkle['merkle'], tx_hash, pos)
-        except Exception as e:
-            self.print_error(f"exception while verifying tx {tx_hash}: {repr(e)}")
-            self.wallet.verification_failed(tx_hash, self.failure_reasons[4])
-            return
-
-        header = self.network.blockchain().read_header(tx_height)
+        tx_height = merkle['block_height']
+        pos = merkle['pos']
+        if tx_height != requested_height:
+            block = None
+        header = block.header if block else self.network.blockchain().read_header(tx_height)
         # FIXME: if verification fails below,
         # we should make a fresh connection to a server to
         # recover from this, as this TX will now never verify
@@ -221,10 +300,19 @@ class SPV(ThreadJob):
                 .format(tx_hash, tx_height))
             self.wallet.verification_failed(tx_hash, self.failure_reasons[1])
             return
-        if header.get('merkle_root') != merkle_root:
+        try:
+            # Verify the hash of the server-provided merkle branch to a
+            # transaction matches the merkle root of its block
+            ok = (block or PartialMerkleTree(header)).verify(merkle['merkle'], tx_hash, pos)
+        except Exception as e:
+            self.print_error(f"exception while verifying tx {tx_hash}: {repr(e)}")
+            self.wallet.verification_failed(tx_hash, self.failure_reasons[4])
+            return
+        merkle_root = header.get('merkle_root')
+        if not ok:
             self.print_error(
-                "merkle verification failed for {} (merkle root mismatch {} != {})"
-                .format(tx_hash, header.get('merkle_root'), merkle_root))
+                "merkle verification failed for {} (merkle root mismatch, block {} root {})"
+                .format(tx_hash, tx_height, merkle_root))
             self.wallet.verification_failed(tx_hash, self.failure_reasons[2])
             return
         # we passed all the tests
@@ -268,6 +356,8 @@ class SPV(ThreadJob):
 
     def undo_verifications(self):
         height = self.blockchain.get_base_height()
+        for block_height in [h for h in self.blocks if h >= height]:
+            del self.blocks[block_height]
         tx_hashes = self.wallet.undo_verifications(self.blockchain, height)
         for tx_hash in tx_hashes:
             self.print_error("redoing", tx_hash)
@@ -31,10 +31,12 @@
 #   - Multisig_Wallet: several keystores, P2SH
 #   - MultiXPubWallet: several keystores, P2PKH
 
+import bisect
 import copy
 import errno
 import json
 import hashlib
+import heapq
 import itertools
 import math
 import os
@@ -54,12 +56,15 @@ from .util import (NotEnoughFunds, ExcessiveFee, PrintError, UserCancelled, prof
 from . import util
 
 from .address import Address, Script, ScriptOutput, PublicKey, OpCodes
+from .address_cache import AddressCache
+from . import address_cache
 from .bitcoin import *
 from .version import *
 from .keystore import load_keystore, Hardware_KeyStore, Imported_KeyStore, BIP32_KeyStore, xpubkey_to_address
 from . import networks
 from . import keystore
 from .storage import multisig_type, WalletStorage
+from .sqlite_storage import SqliteWalletStorage, LazyTransactionMap, RowMap
 
 from . import transaction
 from .transaction import Transaction, InputValueMissing
@@ -259,6 +264,306 @@ class TokensBurnedError(RuntimeError):
      in that method."""
 
 
+class _AddrCoins:
+    """ Index of the coins of a single address, used by Abstract_Wallet for
+    fast balance and UTXO queries. Built from the address history and the
+    wallet's txo/txi maps (see Abstract_Wallet._get_addr_coins) and thrown away
+    whenever the address history or the txo/txi entries of the address change.
+
+    Balance totals of the non-coinbase coins are computed once at build time.
+    Coinbase coins are kept apart since their maturity depends on the chain
+    height. """
+    __slots__ = ('received', 'sent', 'utxos', 'coinbase', 'totals', 'frozen_totals')
+
+    def __init__(self, received, sent):
+        self.received = received  # "prevout_hash:n" -> (height, value, is_coinbase, token_data)
+        self.sent = sent  # "prevout_hash:n" -> height of the spending tx
+        self.utxos = {txo: v for txo, v in received.items() if txo not in sent}
+        self.coinbase = [txo for txo, v in received.items() if v[2]]
+        totals = [0, 0, 0, 0]
+        for txo, v in received.items():
+            if not v[2]:
+                self._accumulate(totals, txo, 0)
+        self.totals = tuple(totals)
+        # (frozen generation, mempool height, totals) of the frozen coins
+        self.frozen_totals = None
+
+    def _accumulate(self, totals, txo, mempool_height):
+        """ Adds the (confirmed, unconfirmed, unmatured, token_locked)
+        contribution of received coin `txo` to the balance, to `totals`. """
+        tx_height, v, is_cb, token_data = self.received[txo]
+        if is_cb and tx_height + COINBASE_MATURITY > mempool_height:
+            totals[2] += v
+        elif tx_height > 0:
+            totals[0] += v
+        else:
+            totals[1] += v
+        spent_height = self.sent.get(txo)
+        if spent_height is not None:
+            if spent_height > 0:
+                totals[0] -= v
+            else:
+                totals[1] -= v
+        elif token_data:
+            # This received output has a token on it and has not been spent.
+            # We can say its FXX amount is "locked" onto a CashToken
+            totals[3] += v
+
+    def balance(self, mempool_height):
+        if not self.coinbase:
+            return self.totals
+        totals = list(self.totals)
+        for txo in self.coinbase:
+            self._accumulate(totals, txo, mempool_height)
+        return tuple(totals)
+
+    def frozen_balance(self, frozen_sets, frozen_gen, mempool_height):
+        """ Returns the part of balance() that comes from coins in the
+        frozen coin sets. """
+        ft = self.frozen_totals
+        if ft is not None and ft[0] == frozen_gen and (not self.coinbase or ft[1] == mempool_height):
+            return ft[2]
+        totals = [0, 0, 0, 0]
+        for frozen in frozen_sets:
+            if len(frozen) < len(self.received):
+                txos = (txo for txo in frozen if txo in self.received)
+            else:
+                txos = (txo for txo in self.received if txo in frozen)
+            for txo in txos:
+                self._accumulate(totals, txo, mempool_height)
+        totals = tuple(totals)
+        self.frozen_totals = (frozen_gen, mempool_height, totals)
+        return totals
+
+class _HistoryIndex:
+    """ The whole-wallet transaction history, kept sorted in block/txpos order
+    together with the per-tx deltas and their running sum. Used by
+    Abstract_Wallet.get_history when no domain is given.
+
+    The index is maintained incrementally: the wallet marks addresses dirty
+    whenever their history or txo/txi entries change (Abstract_Wallet.
+    _invalidate_addr), and marks tx's dirty whenever their position may have
+    changed (verification, reorg). Only those are recomputed on the next query,
+    the sort order is patched in place and the running sums are recomputed
+    from the first position that changed, which for new tx's is the tail.
+    tx's with the same position (unverified tx's at the same height) are
+    ordered by tx_hash.
+
+    Deltas are stored regardless of the tx being pruned; pruned tx's are
+    reported as having a delta of None when read. All methods except
+    invalidate_addr and invalidate_txs must be called with the wallet lock
+    held. """
+
+    def __init__(self, wallet):
+        self.wallet = wallet
+        self.clear()
+
+    def clear(self):
+        self.contrib = {}  # tx_hash -> Address -> (delta, tokens_delta)
+        self.addr_txs = {}  # Address -> set of tx_hash it contributes to
+        self.agg = {}  # tx_hash -> (delta, tokens_delta) summed over addresses
+        self.keys = []  # sorted list of (txpos, tx_hash), oldest first
+        self.key_of = {}  # tx_hash -> its txpos in self.keys
+        self.sums = []  # running sum of the deltas of self.keys
+        self.sums_ok = 0  # self.sums is valid for indices below this
+        self.dirty_addrs = set()
+        self.dirty_txs = set()
+        self.need_rebuild = True
+
+    def invalidate_addr(self, address):
+        self.dirty_addrs.add(address)
+
+    def invalidate_txs(self, tx_hashes):
+        self.dirty_txs.update(tx_hashes)
+
+    def update(self):
+        """ Brings the index up to date with the wallet. """
+        w = self.wallet
+        if self.need_rebuild:
+            self.clear()
+            self.need_rebuild = False
+            dirty_addrs = list(w._history)
+        else:
+            dirty_addrs = []
+            while self.dirty_addrs:
+                dirty_addrs.append(self.dirty_addrs.pop())
+        touched = set()
+        while self.dirty_txs:
+            touched.add(self.dirty_txs.pop())
+        for addr in dirty_addrs:
+            for tx_hash in self.addr_txs.pop(addr, ()):
+                c = self.contrib[tx_hash]
+                del c[addr]
+                if not c:
+                    del self.contrib[tx_hash]
+                touched.add(tx_hash)
+            hist = w._history.get(addr)
+            if not hist or not w.is_mine(addr):
+                continue
+            txs = set()
+            for tx_hash, height in hist:
+                self.contrib.setdefault(tx_hash, {})[addr] = (w._tx_delta(tx_hash, addr),
+                                                              w._tx_tokens_delta(tx_hash, addr) or None)
+                txs.add(tx_hash)
+            self.addr_txs[addr] = txs
+            touched |= txs
+        if touched:
+            self._reorder(touched)
+
+    def _reorder(self, touched):
+        get_txpos = self.wallet.get_txpos
+        keys, key_of, agg = self.keys, self.key_of, self.agg
+        if len(touched) > len(keys) // 16:
+            # Many changes (or the initial build): cheaper to sort everything
+            for tx_hash in touched:
+                agg.pop(tx_hash, None)
+                key_of.pop(tx_hash, None)
+                if tx_hash in self.contrib:
+                    key_of[tx_hash] = get_txpos(tx_hash)
+                    agg[tx_hash] = self._sum_contrib(tx_hash)
+            self.keys = sorted((key, tx_hash) for tx_hash, key in key_of.items())
+            self.sums_ok = 0
+            return
+        low = len(keys)
+        moved = []
+        for tx_hash in touched:
+            old_key = key_of.get(tx_hash)
+            old_delta = agg.pop(tx_hash)[0] if old_key is not None else None
+            if tx_hash in self.contrib:
+                key = get_txpos(tx_hash)
+                a = agg[tx_hash] = self._sum_contrib(tx_hash)
+                if key == old_key:
+                    if a[0] != old_delta:
+                        low = min(low, bisect.bisect_left(keys, (key, tx_hash)))
+                    continue
+                moved.append((key, tx_hash))
+            if old_key is not None:
+                i = bisect.bisect_left(keys, (old_key, tx_hash))
+                del keys[i]
+                del key_of[tx_hash]
+                low = min(low, i)
+        for key, tx_hash in moved:
+            key_of[tx_hash] = key
+            i = bisect.bisect_left(keys, (key, tx_hash))
+            keys.insert(i, (key, tx_hash))
+            low = min(low, i)
+        self.sums_ok = min(self.sums_ok, low)
+
+    def _sum_contrib(self, tx_hash):
+        """ Returns (delta, tokens_delta) of tx_hash summed over the wallet's
+        addresses. """
+        delta = 0
+        tokens_delta = None
+        for d, td in self.contrib[tx_hash].values():
+            delta += d
+            if td:
+                if tokens_delta is None:
+                    tokens_delta = defaultdict(Abstract_Wallet._token_delta_dict_factory)
+                for token_id, per_tok_delta in td.items():
+                    dest = tokens_delta[token_id]
+                    dest["fungibles"] += per_tok_delta["fungibles"]
+                    dest["nfts_in"] += per_tok_delta["nfts_in"]
+                    dest["nfts_out"] += per_tok_delta["nfts_out"]
+        return delta, dict(tokens_delta) if tokens_delta else {}
+
+    def _update_sums(self):
+        keys, sums, agg = self.keys, self.sums, self.agg
+        del sums[self.sums_ok:]
+        s = sums[-1] if sums else 0
+        for i in range(len(sums), len(keys)):
+            s += agg[keys[i][1]][0]
+            sums.append(s)
+        self.sums_ok = len(keys)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def rows(self, start, stop, balance, *, receives_before_sends=False, include_tokens_balances=False):
+        """ Returns a list of (tx_hash, delta, tokens_delta, balance,
+        tokens_balances) for the history entries in [start, stop), oldest
+        first. `balance` is the current wallet balance, which is the running
+        balance after the newest tx. tokens_balances is None unless
+        include_tokens_balances is True.
+
+        If receives_before_sends is True, within a block the tx's that add to
+        the balance are ordered before the ones that spend from it. """
+        self._update_sums()
+        keys, agg = self.keys, self.agg
+        start, stop, _ = slice(start, stop).indices(len(keys))
+        if start >= stop:
+            return []
+        lo, hi = start, stop
+        if receives_before_sends:
+            # tx's only move within their block, so work on whole blocks
+            lo = bisect.bisect_left(keys, ((keys[lo][0][0], -math.inf),))
+            hi = bisect.bisect_right(keys, ((keys[hi - 1][0][0], math.inf),))
+        pruned = self.wallet.pruned_txo_values
+        entries = keys[lo:hi]
+        if receives_before_sends:
+            def receives_first(entry):
+                (height, pos), tx_hash = entry
+                delta = agg[tx_hash][0] if tx_hash not in pruned else 0
+                return height, -delta, pos
+            entries.sort(key=receives_first)
+        tx_hashes = [tx_hash for key, tx_hash in entries]
+        if pruned:
+            deltas = [agg[tx_hash] if tx_hash not in pruned else (None, {}) for tx_hash in tx_hashes]
+        else:
+            deltas = [agg[tx_hash] for tx_hash in tx_hashes]
+
+        # Running balances, walking back from the end of the range. The
+        # balance before a pruned tx (delta None) is unknown.
+        newest_pruned = -1
+        for tx_hash in pruned:
+            key = self.key_of.get(tx_hash)
+            if key is not None:
+                newest_pruned = max(newest_pruned, bisect.bisect_left(keys, (key, tx_hash)))
+        bal = None if hi - 1 < newest_pruned else balance - (self.sums[-1] - self.sums[hi - 1])
+        balances = [None] * len(deltas)
+        for i in range(len(deltas) - 1, -1, -1):
+            balances[i] = bal
+            delta = deltas[i][0]
+            bal = None if bal is None or delta is None else bal - delta
+
+        tokens_balances = [None] * len(deltas)
+        if include_tokens_balances:
+            tb = {}
+            for i in range(lo):
+                tx_hash = keys[i][1]
+                if tx_hash not in pruned:
+                    self._tally_tokens(tb, agg[tx_hash][1])
+            for i, (delta, tokens_delta) in enumerate(deltas):
+                self._tally_tokens(tb, tokens_delta)
+                tokens_balances[i] = copy.deepcopy(tb)
+
+        a, b = start - lo, stop - lo
+        return [(tx_hash, delta, tokens_delta, bal, tb)
+                for tx_hash, (delta, tokens_delta), bal, tb in zip(tx_hashes[a:b], deltas[a:b], balances[a:b],
+                                                                  tokens_balances[a:b])]
+
+    @staticmethod
+    def _tally_tokens(tokens_balances, tokens_delta):
+        for token_id, tdelta in tokens_delta.items():
+            tb = tokens_balances.get(token_id)
+            if tb is None:
+                tb = tokens_balances[token_id] = {"fungibles": 0, "nfts": 0}
+            tb["fungibles"] += tdelta.get("fungibles", 0)
+            tb["nfts"] += len(tdelta.get("nfts_in", [])) - len(tdelta.get("nfts_out", []))
+            if not tb["fungibles"] and not tb["nfts"]:
+                del tokens_balances[token_id]
+
+    def bisect_height(self, height):
+        """ Returns the index of the first entry whose txpos height is >=
+        `height`. Unconfirmed tx's sort after all confirmed ones. """
+        return bisect.bisect_left(self.keys, ((height, -1),))
+
+    def bisect_key(self, height, pos, tx_hash):
+        """ Returns the index of the first entry that does not sort before the
+        given key, see Abstract_Wallet.get_history_key. The tx itself need not
+        be in the index (anymore). """
+        return bisect.bisect_left(self.keys, ((height, pos), tx_hash))
+
+
 class Abstract_Wallet(PrintError, SPVDelegate):
     """
     Wallet classes are created to handle various address generation methods.
@@ -288,17 +593,25 @@ class Abstract_Wallet(PrintError, SPVDelegate):
         # Removes defunct entries from self.pruned_txo asynchronously
         self.pruned_txo_cleaner_thread = None
 
-        # Cache of Address -> (c,u,x) balance. This cache is used by
-        # get_addr_balance to significantly speed it up (it is called a lot).
-        # Cache entries are invalidated when tx's are seen involving this
-        # address (address history chages). Entries to this cache are added
-        # only inside get_addr_balance.
+        # Cache of Address -> _AddrCoins, the per-address index of received,
+        # spent and unspent coins with precomputed balance totals. It makes
+        # get_addr_balance O(1) and get_addr_utxo O(result) (they are called a
+        # lot). Cache entries are invalidated when tx's are seen involving this
+        # address (address history chages), and are (re)built on demand by
+        # _get_addr_coins.
         # Note that this data structure is touched by the network and GUI
         # thread concurrently without the use of locks, because Python GIL
         # allows us to get away with such things. As such do not iterate over
         # this dict, but simply add/remove items to/from it in 1-liners (which
         # Python's GIL makes thread-safe implicitly).
-        self._addr_bal_cache = {}
+        self._addr_coins = {}
+        # Bumped whenever the frozen coin sets change; invalidates the frozen
+        # totals cached in the _AddrCoins entries.
+        self._frozen_coins_gen = 0
+        # Sorted whole-wallet history with running balances, see
+        # _HistoryIndex. Addresses are marked dirty in it by _invalidate_addr,
+        # along with their _addr_coins entry.
+        self._history_index = _HistoryIndex(self)
 
         # We keep a set of the wallet and receiving addresses so that is_mine()
         # checks are O(logN) rather than O(N). This creates/resets that cache.
@@ -314,7 +627,10 @@ class Abstract_Wallet(PrintError, SPVDelegate):
         # saved fields
         self.use_change            = storage.get('use_change', True)
         self.multiple_change       = storage.get('multiple_change', False)
-        self.labels                = storage.get('labels', {})
+        if isinstance(storage, SqliteWalletStorage):
+            self.labels = RowMap(storage, 'labels', preload=True)
+        else:
+            self.labels = storage.get('labels', {})
         # Frozen addresses
         frozen_addresses = storage.get('frozen_addresses',[])
         self.frozen_addresses = set(Address.from_string(addr)
@@ -331,8 +647,13 @@ class Abstract_Wallet(PrintError, SPVDelegate):
         self.change_reserved_tmp = set() # in-memory only
 
         # address -> list(txid, height)
-        history = storage.get('addr_history',{})
-        self._history = self.to_Address_dict(history)
+        if isinstance(storage, SqliteWalletStorage):
+            # Read in full: build_reverse_history needs all of it
+            self._history = RowMap(storage, 'addr_history', decode_key=Address.from_string,
+                                   encode_key=Address.to_storage_string, preload=True)
+        else:
+            history = storage.get('addr_history',{})
+            self._history = self.to_Address_dict(history)
 
         # there is a difference between wallet.up_to_date and interface.is_up_to_date()
         # interface.is_up_to_date() returns true when all requests have been answered and processed
@@ -359,7 +680,13 @@ class Abstract_Wallet(PrintError, SPVDelegate):
         self.unverified_tx = defaultdict(int)
 
         # Verified transactions.  Each value is a (height, timestamp, block_pos) tuple.  Access with self.lock.
-        self.verified_tx = storage.get('verified_tx3', {})
+        if isinstance(storage, SqliteWalletStorage):
+            self.verified_tx = RowMap(storage, 'verified_tx3')
+        else:
+            self.verified_tx = storage.get('verified_tx3', {})
+        # The merkle root of each block the verified transactions were verified against, height -> root hex. Only
+        # the blocks at or above the fork point are checked against it after a reorg (see undo_verifications).
+        self.verified_roots = {int(height): root for height, root in storage.get('verified_roots', {}).items()}
 
         # save wallet type the first time
         if self.storage.get('wallet_type') is None:
@@ -401,6 +728,57 @@ class Abstract_Wallet(PrintError, SPVDelegate):
         return {addr.to_storage_string(): value
                 for addr, value in d.items()}
 
+    # Conversions of single txi/txo/ct_txi/ct_txo entries for the RowMaps of
+    # the SQLite storage engine. Empty entries are not stored.
+
+    @classmethod
+    def _txio_to_storage(cls, d):
+        return cls.from_Address_dict(d) or None
+
+    @classmethod
+    def _ct_txo_from_storage(cls, d):
+        ''' See load_ct_txo. Bad token data is skipped. '''
+        addrmap = cls.to_Address_dict(d)
+        for addr, outputmap in addrmap.items():
+            addrmap[addr] = token_data_map = {}
+            for n, hexdata in outputmap.items():
+                token_data = token.OutputData.fromhex(hexdata)
+                if token_data:
+                    token_data_map[int(n)] = token_data
+        return addrmap
+
+    @classmethod
+    def _ct_txo_to_storage(cls, d):
+        return {addr.to_storage_string(): {n: token_data.hex() for n, token_data in outputmap.items() if token_data}
+                for addr, outputmap in d.items()} or None
+
+    @classmethod
+    def _ct_txi_from_storage(cls, d):
+        ''' See load_ct_txi. Bad token data is skipped. '''
+        addrmap = cls.to_Address_dict(d)
+        for addr, prevout_hash_map in addrmap.items():
+            for prevout_hash, hexdata_map in prevout_hash_map.items():
+                prevout_hash_map[prevout_hash] = token_data_map = {}
+                for prevout_n, hexdata in hexdata_map.items():
+                    token_data = token.OutputData.fromhex(hexdata)
+                    if token_data:
+                        token_data_map[int(prevout_n)] = token_data
+        return addrmap
+
+    @classmethod
+    def _ct_txi_to_storage(cls, d):
+        return {addr.to_storage_string(): {prevout_hash: {n: token_data.hex()
+                                                          for n, token_data in token_data_map.items() if token_data}
+                                           for prevout_hash, token_data_map in prevout_hash_map.items()}
+                for addr, prevout_hash_map in d.items()} or None
+
+    @staticmethod
+    def _touch(d, key):
+        ''' Call after modifying the value of `key` of one of the txi/txo/...
+        maps in place, rather than assigning it. '''
+        if isinstance(d, RowMap):
+            d.touch(key)
+
     def diagnostic_name(self):
         return self.basename()
 
@@ -485,40 +863,57 @@ class Abstract_Wallet(PrintError, SPVDelegate):
 
     @profiler
     def load_transactions(self):
-        txi = self.storage.get('txi', {})
-        self.txi = {tx_hash: self.to_Address_dict(value)
-                    for tx_hash, value in txi.items()
-                    # skip empty entries to save memory and disk space
-                    if value}
-        # Map of tx_hash -> map of address -> list of tuple(prevout_n, value, iscoinbase)
-        txo = self.storage.get('txo', {})
-        self.txo = {tx_hash: self.to_Address_dict(value)
-                    for tx_hash, value in txo.items()
-                    # skip empty entries to save memory and disk space
-                    if value}
-        # Populates self.ct_txi: Map of tx_hash -> map of address -> map of "prevout_hash" -> map of n -> token_data
-        bad_ct_entry_ctr = self.load_ct_txi()
-        # Populates self.ct_txo: Map of tx_hash -> map of address -> map of prevout_n -> token.OutputData
-        bad_ct_entry_ctr += self.load_ct_txo()
-        # Detect if user opened wallet in older EC and we need to rebuild ct_txi and ct_txo
-        ct_txid_hash = self.storage.get('ct_txid_hash', None) if not bad_ct_entry_ctr else None
-        self.tx_fees = self.storage.get('tx_fees', {})
-        self.pruned_txo = self.storage.get('pruned_txo', {})
-        self.pruned_txo_values = set(self.pruned_txo.values())
-        tx_list = self.storage.get('transactions', {})
-        self.transactions = {}
-        txid_hasher = hashlib.sha256() if not bad_ct_entry_ctr else None
-        for tx_hash, raw in sorted(tx_list.items(), key=fittexxcoin x: x[0]):
+        if isinstance(self.storage, SqliteWalletStorage):
+            # Only the keys of the tables are read here. The rows are read on
+            # demand, and raw transactions too (see RowMap, LazyTransactionMap).
+            storage = self.storage
+            self.txi = RowMap(storage, 'txi', decode=self.to_Address_dict, encode=self._txio_to_storage)
+            self.txo = RowMap(storage, 'txo', decode=self.to_Address_dict, encode=self._txio_to_storage)
+            self.ct_txi = RowMap(storage, 'ct_txi', decode=self._ct_txi_from_storage, encode=self._ct_txi_to_storage)
+            self.ct_txo = RowMap(storage, 'ct_txo', decode=self._ct_txo_from_storage, encode=self._ct_txo_to_storage)
+            self.tx_fees = RowMap(storage, 'tx_fees')
+            self.pruned_txo = RowMap(storage, 'pruned_txo', preload=True)
+            self.pruned_txo_values = set(self.pruned_txo.values())
+            self.transactions = LazyTransactionMap(storage)
+            # Versions that do not track CashTokens cannot open SQLite wallet
+            # files, so there is no ct_txid_hash to check.
+            txid_hasher = None
+        else:
+            txi = self.storage.get('txi', {})
+            self.txi = {tx_hash: self.to_Address_dict(value)
+                        for tx_hash, value in txi.items()
+                        # skip empty entries to save memory and disk space
+                        if value}
+            # Map of tx_hash -> map of address -> list of tuple(prevout_n, value, iscoinbase)
+            txo = self.storage.get('txo', {})
+            self.txo = {tx_hash: self.to_Address_dict(value)
+                        for tx_hash, value in txo.items()
+                        # skip empty entries to save memory and disk space
+                        if value}
+            # Populates self.ct_txi: Map of tx_hash -> map of address -> map of "prevout_hash" -> map of n -> token_data
+            bad_ct_entry_ctr = self.load_ct_txi()
+            # Populates self.ct_txo: Map of tx_hash -> map of address -> map of prevout_n -> token.OutputData
+            bad_ct_entry_ctr += self.load_ct_txo()
+            # Detect if user opened wallet in older EC and we need to rebuild ct_txi and ct_txo
+            ct_txid_hash = self.storage.get('ct_txid_hash', None) if not bad_ct_entry_ctr else None
+            self.tx_fees = self.storage.get('tx_fees', {})
+            self.pruned_txo = self.storage.get('pruned_txo', {})
+            self.pruned_txo_values = set(self.pruned_txo.values())
+            self.transactions = {tx_hash: Transaction(raw)
+                                 for tx_hash, raw in self.storage.get('transactions', {}).items()}
+            txid_hasher = hashlib.sha256() if not bad_ct_entry_ctr else None
+        for tx_hash in sorted(self.transactions.keys()):
             if txid_hasher:
                 txid_hasher.update(bytes.fromhex(tx_hash))
-            tx = Transaction(raw)
-            self.transactions[tx_hash] = tx
-            if (not self.txi.get(tx_hash) and not self.txo.get(tx_hash) and (tx_hash not in self.pruned_txo_values)
-                    and not self.ct_txi.get(tx_hash) and not self.ct_txo.get(tx_hash)):
+            # Empty entries are never kept, so only the keys need looking at
+            if (tx_hash not in self.txi and tx_hash not in self.txo and (tx_hash not in self.pruned_txo_values)
+                    and tx_hash not in self.ct_txi and tx_hash not in self.ct_txo):
                 self.print_error("removing unreferenced tx", tx_hash)
                 self.transactions.pop(tx_hash)
                 self.cashacct.remove_transaction_hook(tx_hash)
                 self.slp.rm_tx(tx_hash)
+        if isinstance(self.storage, SqliteWalletStorage):
+            return
         if txid_hasher is None or txid_hasher.digest().hex() != ct_txid_hash:
             # Need to rebuild ct_txi and ct_txo
             # This code is here to detect case where user opened same wallet in an older version of
@@ -698,6 +1093,16 @@ class Abstract_Wallet(PrintError, SPVDelegate):
     @profiler
     def save_transactions(self, write=False):
         with self.lock:
+            if isinstance(self.storage, SqliteWalletStorage):
+                # Raw transactions were written as they were added/removed;
+                # the other maps write the rows that changed since last time.
+                for d in (self.txi, self.txo, self.ct_txi, self.ct_txo, self.tx_fees, self.pruned_txo,
+                          self._history):
+                    d.flush()
+                self.slp.save()
+                if write:
+                    self.storage.write()
+                return
             txid_hasher = hashlib.sha256()
             tx = {}
             for tx_hash, txn in sorted(self.transactions.items(), key=fittexxcoin x: x[0]):
@@ -729,6 +1134,9 @@ class Abstract_Wallet(PrintError, SPVDelegate):
     def save_verified_tx(self, write=False):
         with self.lock:
             self.storage.put('verified_tx3', self.verified_tx)
+            heights = {info[0] for info in self.verified_tx.values()}
+            self.storage.put('verified_roots', {str(height): root for height, root in self.verified_roots.items()
+                                                if height in heights})
             self.cashacct.save()
             if write:
                 self.storage.write()
@@ -742,17 +1150,25 @@ class Abstract_Wallet(PrintError, SPVDelegate):
 
     def clear_history(self):
         with self.lock:
-            self.txi = {}
-            self.txo = {}
-            self.ct_txi = {}
-            self.ct_txo = {}
-            self.tx_fees = {}
-            self.pruned_txo = {}
+            if isinstance(self.storage, SqliteWalletStorage):
+                for d in (self.txi, self.txo, self.ct_txi, self.ct_txo, self.tx_fees, self.pruned_txo):
+                    d.clear()
+            else:
+                self.txi = {}
+                self.txo = {}
+                self.ct_txi = {}
+                self.ct_txo = {}
+                self.tx_fees = {}
+                self.pruned_txo = {}
             self.pruned_txo_values = set()
             self.slp.clear()
             self.save_transactions()
-            self._addr_bal_cache = {}
-            self._history = {}
+            self._addr_coins = {}
+            self._history_index.clear()
+            if isinstance(self._history, RowMap):
+                self._history.clear()
+            else:
+                self._history = {}
             self.tx_addr_hist = defaultdict(set)
             self.cashacct.on_clear_history()
 
@@ -776,7 +1192,7 @@ class Abstract_Wallet(PrintError, SPVDelegate):
             hist = self._history[addr]
 
             for tx_hash, tx_height in hist:
-                if tx_hash in self.pruned_txo_values or self.txi.get(tx_hash) or self.txo.get(tx_hash):
+                if tx_hash in self.pruned_txo_values or tx_hash in self.txi or tx_hash in self.txo:
                     continue
                 tx = self.transactions.get(tx_hash)
                 if tx is not None:
@@ -875,6 +1291,7 @@ class Abstract_Wallet(PrintError, SPVDelegate):
         address sets only grow and never shrink and thus the length check
         of is_mine below is sufficient."""
         self._recv_address_set_cached, self._change_address_set_cached = frozenset(), frozenset()
+        self._address_index_cached = {}
 
     def is_mine(self, address):
         """Note this method assumes that the entire address set is
@@ -911,13 +1328,18 @@ class Abstract_Wallet(PrintError, SPVDelegate):
         return address in self._change_address_set_cached
 
     def get_address_index(self, address):
+        ra, ca = self.receiving_addresses, self.change_addresses
+        index = self._address_index_cached
+        if len(index) != len(ra) + len(ca):
+            # re-create the address -> index map if the lengths don't match,
+            # like the sets of is_mine() (receiving wins over change)
+            index = {addr: (True, i) for i, addr in enumerate(ca)}
+            index.update((addr, (False, i)) for i, addr in enumerate(ra))
+            if len(index) == len(ra) + len(ca):
+                self._address_index_cached = index
         try:
-            return False, self.receiving_addresses.index(address)
-        except ValueError:
-            pass
-        try:
-            return True, self.change_addresses.index(address)
-        except ValueError:
+            return index[address]
+        except KeyError:
             pass
         assert not isinstance(address, str)
         raise Exception("Address {} not found".format(address))
@@ -943,6 +1365,8 @@ class Abstract_Wallet(PrintError, SPVDelegate):
 
             # tx will be verified only if height > 0
             if tx_hash not in self.verified_tx:
+                if self.unverified_tx.get(tx_hash) != tx_height:
+                    self._history_index.invalidate_txs((tx_hash,))
                 self.unverified_tx[tx_hash] = tx_height
                 self.cashacct.add_unverified_tx_hook(tx_hash, tx_height)
 
@@ -951,6 +1375,9 @@ class Abstract_Wallet(PrintError, SPVDelegate):
         with self.lock:
             self.unverified_tx.pop(tx_hash, None)
             self.verified_tx[tx_hash] = info  # (tx_height, timestamp, pos)
+            if header and header.get('merkle_root'):
+                self.verified_roots[info[0]] = header['merkle_root']
+            self._history_index.invalidate_txs((tx_hash,))
             height, conf, timestamp = self.get_tx_height(tx_hash)
             self.cashacct.add_verified_tx_hook(tx_hash, info, header)
         self.network.trigger_callback('verified2', self, tx_hash, height, conf, timestamp)
@@ -976,17 +1403,33 @@ class Abstract_Wallet(PrintError, SPVDelegate):
         '''Used by the verifier when a reorg has happened'''
         txs = set()
         with self.lock:
-            for tx_hash, item in list(self.verified_tx.items()):
-                tx_height, timestamp, pos = item
-                if tx_height >= height:
-                    header = blockchain.read_header(tx_height)
-                    # fixme: use block hash, not timestamp
-                    if not header or header.get('timestamp') != timestamp:
+            by_height = defaultdict(list)
+            for tx_hash, item in self.verified_tx.items():
+                if item[0] >= height:
+                    by_height[item[0]].append(tx_hash)
+            for tx_height, tx_hashes in by_height.items():
+                header = blockchain.read_header(tx_height)
+                root = self.verified_roots.get(tx_height)
+                for tx_hash in tx_hashes:
+                    # the block is the same if it has the same merkle root (or, for the txs verified before the
+                    # roots were kept, the same timestamp)
+                    if (not header or (header.get('merkle_root') != root if root
+                                       else header.get('timestamp') != self.verified_tx[tx_hash][1])):
                         self.verified_tx.pop(tx_hash, None)
                         txs.add(tx_hash)
-            if txs: self.cashacct.undo_verifications_hook(txs)
+                if not header or header.get('merkle_root') != root:
+                    self.verified_roots.pop(tx_height, None)
+            if txs:
+                self._history_index.invalidate_txs(txs)
+                self.cashacct.undo_verifications_hook(txs)
         if txs:
-            self._addr_bal_cache = {}  # this is probably not necessary -- as the receive_history_callback will invalidate bad cache items -- but just to be paranoid we clear the whole balance cache on reorg anyway as a safety measure
+            # this is probably not necessary -- as the receive_history_callback will invalidate bad cache items --
+            # but just to be paranoid we invalidate the coin index of the addresses involved on reorg anyway as a
+            # safety measure
+            with self.lock:
+                for tx_hash in txs:
+                    for addr in itertools.chain(self.txi.get(tx_hash, ()), self.txo.get(tx_hash, ())):
+                        self._invalidate_addr(addr)
         for tx_hash in txs:
             self._update_request_statuses_touched_by_tx(tx_hash)
         return txs
@@ -1052,6 +1495,10 @@ class Abstract_Wallet(PrintError, SPVDelegate):
         # pruned
         if tx_hash in self.pruned_txo_values:
             return None
+        return self._tx_delta(tx_hash, address)
+
+    def _tx_delta(self, tx_hash, address):
+        """ Like get_tx_delta but disregards the tx being pruned. """
         delta = 0
         # substract the value of coins sent from address
         d = self.txi.get(tx_hash, {}).get(address, [])
@@ -1079,6 +1526,12 @@ class Abstract_Wallet(PrintError, SPVDelegate):
         assert isinstance(address, Address)
         if tx_hash in self.pruned_txo_values:
             return None
+        return self._tx_tokens_delta(tx_hash, address)
+
+    def _tx_tokens_delta(self, tx_hash, address) -> Dict[str, Dict[str, Any]]:
+        """ Like get_tx_tokens_delta but disregards the tx being pruned. """
+        if tx_hash not in self.ct_txi and tx_hash not in self.ct_txo:
+            return {}
 
         # Nota bene: self.ct_txi is a nested dict of dicts keyed by:
         # tx_hash -> dict key: address -> dict key: prevout_hash -> dict key: prevout_n -> token_data (token.OutputData)
@@ -1300,31 +1753,46 @@ class Abstract_Wallet(PrintError, SPVDelegate):
                 sent[txi] = height
         return received, sent
 
+    def _invalidate_addr(self, address):
+        ''' Call whenever the history or the txo/txi entries of `address`
+        change. Drops its coin index and marks it dirty in the history index. '''
+        self._addr_coins.pop(address, None)
+        self._history_index.invalidate_addr(address)
+
+    def _get_addr_coins(self, address) -> _AddrCoins:
+        coins = self._addr_coins.get(address)
+        if coins is None:
+            with self.lock:
+                received, sent = self.get_addr_io(address)
+                frozen_ct = len(self.frozen_coins) + len(self.frozen_coins_tmp)
+                for txi in sent:
+                    # cleanup/detect if the 'frozen coin' was spent and remove it from the frozen coin set
+                    self.frozen_coins.discard(txi)
+                    self.frozen_coins_tmp.discard(txi)
+                if frozen_ct != len(self.frozen_coins) + len(self.frozen_coins_tmp):
+                    self._frozen_coins_gen += 1
+                coins = self._addr_coins[address] = _AddrCoins(received, sent)
+        return coins
+
+    def _make_coin(self, address, txo, v):
+        tx_height, value, is_cb, token_data = v
+        prevout_hash, prevout_n = txo.split(':', 1)
+        prevout_n = int(prevout_n)
+        return {
+            'address': address,
+            'value': value,
+            'prevout_n': prevout_n,
+            'prevout_hash': prevout_hash,
+            'height': tx_height,
+            'coinbase': is_cb,
+            'is_frozen_coin': txo in self.frozen_coins or txo in self.frozen_coins_tmp,
+            'slp_token': self.slp.token_info_for_txo(txo),  # (token_id_hex, qty) tuple or None
+            'token_data': token_data,  # token.OutputData instance or None
+        }
+
     def get_addr_utxo(self, address):
-        coins, spent = self.get_addr_io(address)
-        for txi in spent:
-            coins.pop(txi)
-            # cleanup/detect if the 'frozen coin' was spent and remove it from the frozen coin set
-            self.frozen_coins.discard(txi)
-            self.frozen_coins_tmp.discard(txi)
-        out = {}
-        for txo, v in coins.items():
-            tx_height, value, is_cb, token_data = v
-            prevout_hash, prevout_n = txo.split(':', 1)
-            prevout_n = int(prevout_n)
-            x = {
-                'address': address,
-                'value': value,
-                'prevout_n': prevout_n,
-                'prevout_hash': prevout_hash,
-                'height': tx_height,
-                'coinbase': is_cb,
-                'is_frozen_coin': txo in self.frozen_coins or txo in self.frozen_coins_tmp,
-                'slp_token': self.slp.token_info_for_txo(txo),  # (token_id_hex, qty) tuple or None
-                'token_data': token_data,  # token.OutputData instance or None
-            }
-            out[txo] = x
-        return out
+        coins = self._get_addr_coins(address)
+        return {txo: self._make_coin(address, txo, v) for txo, v in coins.utxos.items()}
 
     # return the total amount ever received by an address
     def get_addr_received(self, address):
@@ -1339,76 +1807,13 @@ class Abstract_Wallet(PrintError, SPVDelegate):
             freezing, not address-level. """
         assert isinstance(address, Address)
         mempoolHeight = self.get_local_height() + 1
-        return_arity = 3 + int(tokens)
-        if not exclude_frozen_coins:
-            # Note: We do not use the cache when excluding frozen coins as frozen status is
-            # a dynamic quantity that can change at any time in the UI
-            cached = self._addr_bal_cache.get(address)
-            if cached is not None:
-                # Account for the possible variation in tokens arg, leading to cached 3-tuple vs 4-tuple...
-                # Ensure the cached value has the arity we need for this invocation
-                if len(cached) >= return_arity:
-                    return cached[:return_arity]
-        received, sent = self.get_addr_io(address)
-        c = u = x = 0
-        tok_locked = 0
-        had_cb = False
-        for txo, (tx_height, v, is_cb, token_data) in received.items():
-            if exclude_frozen_coins and (txo in self.frozen_coins or txo in self.frozen_coins_tmp):
-                continue
-            had_cb = had_cb or is_cb  # remember if this address has ever seen a coinbase txo
-            if is_cb and tx_height + COINBASE_MATURITY > mempoolHeight:
-                x += v
-            elif tx_height > 0:
-                c += v
-            else:
-                u += v
-            if txo in sent:
-                if sent[txo] > 0:
-                    c -= v
-                else:
-                    u -= v
-            elif token_data:
-                # This received output has a token on it and has not been spent.
-                # We can say its FXX amount is "locked" onto a CashToken
-                tok_locked += v
-
-        result = (c, u, x, tok_locked)[:return_arity]
-        if not exclude_frozen_coins and not had_cb:
-            # Cache the results.
-            # Cache needs to be invalidated if a transaction is added to/
-            # removed from addr history.  (See self._addr_bal_cache calls
-            # related to this littered throughout this file).
-            #
-            # Note that as a performance tweak we don't ever cache balances for
-            # addresses involving coinbase coins. The rationale being as
-            # follows: Caching of balances of the coinbase addresses involves
-            # a dynamic quantity: maturity of the coin (which considers the
-            # ever-changing block height).
-            #
-            # There wasn't a good place in this codebase to signal the maturity
-            # happening (and thus invalidate the cache entry for the exact
-            # address that holds the coinbase coin in question when a new
-            # block is found that matures a coinbase coin).
-            #
-            # In light of that fact, a possible approach would be to invalidate
-            # this entire cache when a new block arrives (this is what Electrum
-            # does). However, for Electron Cash with its focus on many addresses
-            # for privacy features such as integrated CashFusion --
-            # being notified in the wallet and invalidating the *entire* cache
-            # whenever a new block arrives (which is the exact time you do
-            # the most GUI refreshing and calling of this function) seems a bit
-            # heavy-handed, just for sake of the (relatively rare, for the
-            # average user) coinbase-carrying addresses.
-            #
-            # It's not a huge performance hit for the coinbase addresses to
-            # simply not cache their results, and have this function recompute
-            # their balance on each call, when you consider that as a
-            # consequence of this policy, all the other addresses that are
-            # non-coinbase can benefit from a cache that stays valid for longer
-            # than 1 block (so long as their balances haven't changed).
-            self._addr_bal_cache[address] = result  # Note that the arity of `result` may be 3 or 4 here
-        return result
+        coins = self._get_addr_coins(address)
+        result = coins.balance(mempoolHeight)
+        if exclude_frozen_coins and (self.frozen_coins or self.frozen_coins_tmp):
+            frozen = coins.frozen_balance((self.frozen_coins, self.frozen_coins_tmp), self._frozen_coins_gen,
+                                          mempoolHeight)
+            result = tuple(a - b for a, b in zip(result, frozen))
+        return result[:3 + int(tokens)]
 
     def get_spendable_coins(self, domain, config, isInvoice=False):
         confirmed_only = config.get('confirmed_only', DEFAULT_CONFIRMED_ONLY)
@@ -1419,7 +1824,8 @@ class Abstract_Wallet(PrintError, SPVDelegate):
                               exclude_tokens=True)
 
     def get_utxos(self, domain=None, exclude_frozen=False, mature=False, confirmed_only=False,
-                  *, addr_set_out=None, exclude_slp=True, exclude_tokens=True, tokens_only=False):
+                  *, addr_set_out=None, exclude_slp=True, exclude_tokens=True, tokens_only=False,
+                  token_category=None, from_height=None, to_height=None, after=None, limit=None):
         """Note that exclude_frozen = True checks for BOTH address-level and
         coin-level frozen status.
 
@@ -1427,9 +1833,20 @@ class Abstract_Wallet(PrintError, SPVDelegate):
         to True in EC 4.0.10+ in order to prevent inadvertently burning tokens.
 
         Optional kw-only arg `addr_set_out` specifies a set in which to add all
-        addresses encountered in the utxos returned. """
-        if tokens_only:
+        addresses encountered in the utxos returned.
+
+        Optional kw-only arg `token_category` (hex) only returns the coins with
+        tokens of that category. `from_height` and `to_height` only return the
+        coins with from_height <= height < to_height, unconfirmed coins
+        counting as newer than any block.
+
+        If `after` (a "prevout_hash:n" string) or `limit` are given, the coins
+        are returned in "prevout_hash:n" order, starting after `after`, and at
+        most `limit` of them. This allows paging through the coins, and only
+        the coins returned are built. """
+        if tokens_only or token_category is not None:
             exclude_tokens = False
+        paged = after is not None or limit is not None
         with self.lock:
             mempoolHeight = self.get_local_height() + 1
             coins = []
@@ -1437,31 +1854,60 @@ class Abstract_Wallet(PrintError, SPVDelegate):
                 domain = self.get_addresses()
             if exclude_frozen:
                 domain = set(domain) - self.frozen_addresses
+            candidates = []
             for addr in domain:
-                utxos = self.get_addr_utxo(addr)
+                utxos = self._get_addr_coins(addr).utxos
+                if not utxos:
+                    continue
                 len_before = len(coins)
-                for x in utxos.values():
-                    if exclude_tokens and x['token_data']:
+                for txo, v in utxos.items():
+                    # Cheap checks first, so that we only build coin dicts for the result
+                    tx_height, value, is_cb, token_data = v
+                    if exclude_tokens and token_data:
                         continue
-                    if tokens_only and not x['token_data']:
+                    if tokens_only and not token_data:
                         continue
-                    if exclude_slp and x['slp_token']:
+                    if token_category is not None and (not token_data or token_data.id_hex != token_category):
+                        continue
+                    if confirmed_only and tx_height <= 0:
+                        continue
+                    if from_height is not None and 0 < tx_height < from_height:
                         continue
-                    if exclude_frozen and x['is_frozen_coin']:
+                    if to_height is not None and not 0 < tx_height < to_height:
                         continue
-                    if confirmed_only and x['height'] <= 0:
+                    if after is not None and txo <= after:
                         continue
                     # A note about maturity: Previous versions of Electrum
                     # and Electron Cash were off by one. Maturity is
                     # calculated based off mempool height (chain tip height + 1).
                     # See bitcoind consensus/tx_verify.cpp Consensus::CheckTxInputs
                     # and also txmempool.cpp  CTxMemPool::removeForReorg.
-                    if mature and x['coinbase'] and mempoolHeight - x['height'] < COINBASE_MATURITY:
+                    if mature and is_cb and mempoolHeight - tx_height < COINBASE_MATURITY:
+                        continue
+                    if exclude_frozen and (txo in self.frozen_coins or txo in self.frozen_coins_tmp):
+                        continue
+                    if paged:
+                        candidates.append((txo, addr, v))
+                        continue
+                    x = self._make_coin(addr, txo, v)
+                    if exclude_slp and x['slp_token']:
                         continue
                     coins.append(x)
                 if addr_set_out is not None and len(coins) > len_before:
                     # add this address to the address set if it has results
                     addr_set_out.add(addr)
+            if paged:
+                # Select the page rather than sort all candidates: heapify is
+                # linear, and only the coins of the page are popped.
+                heapq.heapify(candidates)
+                while candidates and (limit is None or len(coins) < limit):
+                    txo, addr, v = heapq.heappop(candidates)
+                    x = self._make_coin(addr, txo, v)
+                    if exclude_slp and x['slp_token']:
+                        continue
+                    coins.append(x)
+                    if addr_set_out is not None:
+                        addr_set_out.add(addr)
             return coins
 
     def dummy_address(self):
@@ -1680,6 +2126,8 @@ class Abstract_Wallet(PrintError, SPVDelegate):
                 d = self.txi.get(tx_hash)
                 if d is None:
                     self.txi[tx_hash] = d = {}
+                else:
+                    self._touch(self.txi, tx_hash)
                 l = d.get(addr)
                 if l is None:
                     d[addr] = l = []
@@ -1689,6 +2137,8 @@ class Abstract_Wallet(PrintError, SPVDelegate):
                     d = self.ct_txi.get(tx_hash)
                     if d is None:
                         self.ct_txi[tx_hash] = d = {}
+                    else:
+                        self._touch(self.ct_txi, tx_hash)
                     dd = d.get(addr)
                     if dd is None:
                         d[addr] = dd = {}
@@ -1753,7 +2203,7 @@ class Abstract_Wallet(PrintError, SPVDelegate):
                         # the spend for when the receive tx will arrive into
                         # this function later.
                         put_pruned_txo(ser, tx_hash)
-                    self._addr_bal_cache.pop(addr, None)  # invalidate cache entry
+                    self._invalidate_addr(addr)  # invalidate cache entry
                     del dd, prevout_hash, prevout_n, ser
                 elif addr is None:
                     # Unknown/unparsed address.. may be a strange p2sh scriptSig
@@ -1764,7 +2214,7 @@ class Abstract_Wallet(PrintError, SPVDelegate):
                     addr2, v, token_data = find_in_self_txo(prevout_hash, prevout_n)
                     if addr2 is not None and self.is_mine(addr2):
                         add_to_self_txi(tx_hash, addr2, ser, v, token_data)
-                        self._addr_bal_cache.pop(addr2, None)  # invalidate cache entry
+                        self._invalidate_addr(addr2)  # invalidate cache entry
                     else:
                         # Not found in self.txo. It may still be one of ours
                         # however since tx's can come in out of order due to
@@ -1824,7 +2274,7 @@ class Abstract_Wallet(PrintError, SPVDelegate):
                             ct_d[addr] = ct_dd = {}
                         ct_dd[n] = token_data
                         self.print_error(f"Adding CashTokens txo: {tx_hash} -> {addr} -> {n} -> {token_data!r}")
-                    self._addr_bal_cache.pop(addr, None)  # invalidate cache entry
+                    self._invalidate_addr(addr)  # invalidate cache entry
                 # give v to txi that spends me
                 next_tx = pop_pruned_txo(ser)
                 if next_tx is not None and mine:
@@ -1874,12 +2324,14 @@ class Abstract_Wallet(PrintError, SPVDelegate):
                     for idx, (ser, v) in enumerate(l):
                         prev_hash, prev_n = ser.split(':')
                         if prev_hash == tx_hash:
-                            self._addr_bal_cache.pop(addr, None)  # invalidate cache entry
+                            self._invalidate_addr(addr)  # invalidate cache entry
                             del_idx.append(idx)
                             self.pruned_txo[ser] = next_tx
                             self.pruned_txo_values.add(next_tx)
                     for ctr, idx in enumerate(del_idx):
                         del l[idx - ctr]
+                    if del_idx:
+                        self._touch(self.txi, next_tx)
                     if len(l) == 0:
                         to_pop.append(addr)
                 for addr in to_pop:
@@ -1900,7 +2352,7 @@ class Abstract_Wallet(PrintError, SPVDelegate):
             # invalidate addr_bal_cache for outputs involving this tx
             d = self.txo.get(tx_hash, {})  # tx_hash -> Address -> List[Tuple[N, value, is_cb]]
             for addr in d:
-                self._addr_bal_cache.pop(addr, None)  # invalidate cache entry
+                self._invalidate_addr(addr)  # invalidate cache entry
 
             try: self.txi.pop(tx_hash)
             except KeyError: self.print_error("tx was not in input history", tx_hash)
@@ -1974,7 +2426,7 @@ class Abstract_Wallet(PrintError, SPVDelegate):
                     # and self.txo dicts
                     self.remove_transaction(tx_hash)
                     removed_ct += 1
-            self._addr_bal_cache.pop(addr, None)  # unconditionally invalidate cache entry
+            self._invalidate_addr(addr)  # unconditionally invalidate cache entry
             self._history[addr] = hist
 
             for tx_hash, tx_height in hist:
@@ -2005,6 +2457,7 @@ class Abstract_Wallet(PrintError, SPVDelegate):
                 if not any(True for x in cur_hist if x[0] == txid):
                     cur_hist.append((txid, 0))
                     self._history[addr] = cur_hist
+                    self._invalidate_addr(addr)  # invalidate cache entry
 
     # Returned by get_history iff include_tokens arg is False
     TxHistory = namedtuple("TxHistory", "tx_hash, height, conf, timestamp, amount, balance")
@@ -2013,13 +2466,19 @@ class Abstract_Wallet(PrintError, SPVDelegate):
 
     @profiler
     def get_history(self, domain=None, *, reverse=False, receives_before_sends=False,
-                    include_tokens=False, include_tokens_balances=False) -> List[Union[TxHistory, TxHistory2]]:
+                    include_tokens=False, include_tokens_balances=False,
+                    start=None, stop=None) -> List[Union[TxHistory, TxHistory2]]:
         """Iff include_tokens=True, returns a list of TxHistory2, otherwise returns a list of TxHistory
            If include_tokens_balances is False, the TxHistory2.tokens_balances dict will be empty (perf. optimization)
+           start and stop select a slice of the history in oldest-first order, as in list slicing. If domain is None
+           the history is served from the incrementally maintained _HistoryIndex, and only the requested slice is
+           built.
         """
-        # get domain
         if domain is None:
-            domain = self.get_addresses()
+            return self._get_history_from_index(reverse=reverse, receives_before_sends=receives_before_sends,
+                                                include_tokens=include_tokens,
+                                                include_tokens_balances=include_tokens_balances,
+                                                start=start, stop=stop)
         # 1. Get the history of each address in the domain, maintain the
         #    delta of a tx as the sum of its deltas on domain addresses
         tx_deltas = defaultdict(int)
@@ -2108,16 +2567,115 @@ class Abstract_Wallet(PrintError, SPVDelegate):
                 balance = None
             else:
                 balance -= delta
-        if not reverse:
+        h2.reverse()
+        if start is not None or stop is not None:
+            h2 = h2[start:stop]
+        if reverse:
             h2.reverse()
 
         return h2
 
+    def _get_history_from_index(self, *, reverse, receives_before_sends, include_tokens, include_tokens_balances,
+                                start, stop):
+        with self.lock:
+            c, u, x = self.get_balance()
+            self._history_index.update()
+            rows = self._history_index.rows(start, stop, c + u + x, receives_before_sends=receives_before_sends,
+                                            include_tokens_balances=include_tokens and include_tokens_balances)
+            # Same as get_tx_height, without the per-tx overhead
+            local_height = self.get_local_height()
+            h2 = []
+            for tx_hash, delta, tokens_deltas, balance, tokens_balances in rows:
+                info = self.verified_tx.get(tx_hash)
+                if info is not None:
+                    height, timestamp, pos = info
+                    conf = max(local_height - height + 1, 0)
+                else:
+                    height, conf, timestamp = self.unverified_tx.get(tx_hash, 0), 0, 0
+                if include_tokens:
+                    h2.append(self.TxHistory2(tx_hash, height, conf, timestamp, delta, balance, tokens_deltas,
+                                              tokens_balances or {}))
+                else:
+                    h2.append(self.TxHistory(tx_hash, height, conf, timestamp, delta, balance))
+        if reverse:
+            h2.reverse()
+        return h2
+
+    def get_history_len(self) -> int:
+        ''' Returns the number of tx's in the whole-wallet history. '''
+        with self.lock:
+            self._history_index.update()
+            return len(self._history_index)
+
+    def get_history_key(self, tx_hash) -> Tuple[Union[int, float], int, str]:
+        ''' Returns the (height, pos, tx_hash) key by which tx_hash is sorted
+        in the whole-wallet history. Unconfirmed tx's have a height above any
+        block height. '''
+        height, pos = self.get_txpos(tx_hash)
+        return height, pos, tx_hash
+
+    def get_history_bounds(self, *, from_height=None, to_height=None, before=None) -> Tuple[int, int]:
+        ''' Returns the (start, stop) of the slice of the oldest-first
+        whole-wallet history (see the start and stop args of get_history) with
+        the tx's where from_height <= height < to_height, that sort before the
+        key `before` (see get_history_key), if given. Since unconfirmed tx's
+        sort last, they are included only if to_height is not given. '''
+        with self.lock:
+            idx = self._history_index
+            idx.update()
+            start = idx.bisect_height(from_height) if from_height is not None else 0
+            stop = idx.bisect_height(to_height) if to_height is not None else len(idx)
+            if before is not None:
+                stop = min(stop, idx.bisect_key(*before))
+            return start, max(start, stop)
+
+    def iter_history(self, domain=None, *, receives_before_sends=False, batch_size=1000):
+        ''' Yields the rows of get_history(domain, reverse=True), newest first.
+        Without a domain the rows are built from the history index a batch at
+        a time, so that memory use does not depend on the size of the
+        history. '''
+        if domain is not None:
+            yield from self.get_history(domain, reverse=True, receives_before_sends=receives_before_sends)
+            return
+        before = None
+        while True:
+            with self.lock:
+                start, stop = self.get_history_bounds(before=before)
+                if start >= stop:
+                    return
+                start = max(start, stop - batch_size)
+                idx = self._history_index
+                if receives_before_sends:
+                    # tx's are reordered within a block, so don't split blocks
+                    start = idx.bisect_height(idx.keys[start][0][0])
+                (height, pos), tx_hash = idx.keys[start]
+                before = height, pos, tx_hash
+                rows = self.get_history(reverse=True, receives_before_sends=receives_before_sends,
+                                        start=start, stop=stop)
+            yield from rows
+
     def export_history(self, domain=None, from_timestamp=None, to_timestamp=None, fx=None,
                        show_addresses=False, decimal_point=8,
                        *, fee_calc_timeout=10.0, download_inputs=False,
-                       progress_callback=None, receives_before_sends=False):
-        ''' Export history. Used by RPC & GUI.
+                       progress_callback=None, receives_before_sends=False, history=None):
+        ''' Export history. Used by RPC & GUI. Returns the list of the items
+        produced by iter_export_history, see there for the args. '''
+        return list(self.iter_export_history(domain, from_timestamp, to_timestamp, fx, show_addresses,
+                                             decimal_point, fee_calc_timeout=fee_calc_timeout,
+                                             download_inputs=download_inputs,
+                                             progress_callback=progress_callback,
+                                             receives_before_sends=receives_before_sends, history=history))
+
+    def iter_export_history(self, domain=None, from_timestamp=None, to_timestamp=None, fx=None,
+                            show_addresses=False, decimal_point=8,
+                            *, fee_calc_timeout=10.0, download_inputs=False,
+                            progress_callback=None, receives_before_sends=False, history=None,
+                            cancel_event=None, batch_size=200):
+        ''' Generator of the history export items (dicts), newest first. The
+        rows are processed `batch_size` at a time, and the history is read
+        with iter_history, so that memory use does not depend on the size of
+        the history (see history_export.write_history to stream the items to
+        a file).
 
         Arg notes:
         - `fee_calc_timeout` is used when computing the fee (which is done
@@ -2138,6 +2696,13 @@ class Abstract_Wallet(PrintError, SPVDelegate):
           code. Node the progress callback is not guaranteed to be called in the
           context of the main thread, therefore GUI code should use appropriate
           signals/slots to update the GUI with progress info.
+        - `history`, if specified, is a list as returned by
+          get_history(reverse=True) to export, instead of the history of
+          `domain`. Used to export a page of the history.
+        - `cancel_event`, if specified, is a threading.Event which cancels the
+          export when set, raising UserCancelled.
+        - `fx`, if specified, adds the fiat_value, fiat_balance and fiat_fee
+          fields. The historical rates are looked up once per batch.
 
         Note on side effects: This function may update self.tx_fees. Rationale:
         it will spend some time trying very hard to calculate accurate fees by
@@ -2212,27 +2777,7 @@ class Abstract_Wallet(PrintError, SPVDelegate):
             return format_satoshis(v, decimal_point=decimal_point,
                                    is_diff=is_diff)
 
-        # grab history
-        h = self.get_history(domain, reverse=True, receives_before_sends=receives_before_sends)
-        out = []
-
-        n, l = 0, max(1, float(len(h)))
-        for tx_hash, height, conf, timestamp, value, balance in h:
-            if progress_callback:
-                progress_callback(n/l)
-            n += 1
-            timestamp_safe = timestamp
-            if timestamp is None:
-                timestamp_safe = time.time()  # set it to "now" so below code doesn't explode.
-            if from_timestamp and timestamp_safe < from_timestamp:
-                continue
-            if to_timestamp and timestamp_safe >= to_timestamp:
-                continue
-            try:
-                fee = try_calc_fee(tx_hash)
-            except MissingTx as e:
-                self.print_error(str(e))
-                continue
+        def make_item(tx_hash, height, conf, timestamp, value, balance, fee, timestamp_safe):
             item = {
                 'txid'          : tx_hash,
                 'height'        : height,
@@ -2268,15 +2813,59 @@ class Abstract_Wallet(PrintError, SPVDelegate):
                     output_addresses.append(addr.to_ui_string())
                 item['input_addresses'] = input_addresses
                 item['output_addresses'] = output_addresses
+            return item
+        def add_fiat(batch):
+            ''' Fills in the fiat fields of the items in batch, a list of
+            (item, value, balance, fee, timestamp_safe) '''
+            rates = fx.history_rates([timestamp_to_datetime(b[4]) for b in batch])
+            for (item, value, balance, fee, timestamp_safe), rate in zip(batch, rates):
+                item['fiat_value'] = fx.value_str(value, rate)
+                item['fiat_balance'] = fx.value_str(balance, rate)
+                item['fiat_fee'] = fx.value_str(fee, rate)
+
+        # grab history
+        if history is not None:
+            h, l = history, len(history)
+        elif domain is None:
+            h, l = self.iter_history(receives_before_sends=receives_before_sends), self.get_history_len()
+        else:
+            h = self.get_history(domain, reverse=True, receives_before_sends=receives_before_sends)
+            l = len(h)
+
+        n, l = 0, max(1, float(l))
+        batch = []
+        for tx_hash, height, conf, timestamp, value, balance in h:
+            if cancel_event is not None and cancel_event.is_set():
+                raise UserCancelled()
+            if progress_callback:
+                progress_callback(min(n/l, 1.0))
+            n += 1
+            timestamp_safe = timestamp
+            if timestamp is None:
+                timestamp_safe = time.time()  # set it to "now" so below code doesn't explode.
+            if from_timestamp and timestamp_safe < from_timestamp:
+                continue
+            if to_timestamp and timestamp_safe >= to_timestamp:
+                continue
+            try:
+                fee = try_calc_fee(tx_hash)
+                item = make_item(tx_hash, height, conf, timestamp, value, balance, fee, timestamp_safe)
+            except MissingTx as e:
+                self.print_error(str(e))
+                continue
+            local_tx_cache.clear()  # we are done with this tx; keeps memory use constant
+            batch.append((item, value, balance, fee, timestamp_safe))
+            if len(batch) >= batch_size:
+                if fx is not None:
+                    add_fiat(batch)
+                yield from (b[0] for b in batch)
+                batch = []
+        if batch:
             if fx is not None:
-                date = timestamp_to_datetime(timestamp_safe)
-                item['fiat_value'] = fx.historical_value_str(value, date)
-                item['fiat_balance'] = fx.historical_value_str(balance, date)
-                item['fiat_fee'] = fx.historical_value_str(fee, date)
-            out.append(item)
+                add_fiat(batch)
+            yield from (b[0] for b in batch)
         if progress_callback:
             progress_callback(1.0)  # indicate done, just in case client code expects a 1.0 in order to detect completion
-        return out
 
     def get_label(self, tx_hash):
         label = self.labels.get(tx_hash, '')
@@ -2523,7 +3112,7 @@ class Abstract_Wallet(PrintError, SPVDelegate):
 
             assert all(isinstance(addr, Address) for addr in change_addrs)
 
-            coin_chooser = coinchooser.CoinChooserPrivacy()
+            coin_chooser = coinchooser.get_coin_chooser(config)
             tx = coin_chooser.make_tx(inputs, outputs, change_addrs,
                                       fee_estimator, self.dust_threshold(), sign_schnorr=sign_schnorr,
                                       token_datas=token_datas)
@@ -2981,6 +3570,10 @@ class Abstract_Wallet(PrintError, SPVDelegate):
                     apply_operation(txo)
                     utxo['is_frozen_coin'] = bool(freeze)
                     ok += 1
+            # Bumped only once the sets are changed: get_addr_balance reads
+            # them without the lock, and a frozen balance cached against the
+            # old generation must not survive the change.
+            self._frozen_coins_gen += 1
             if original_size != len(self.frozen_coins):
                 # Performance optimization: only set storage if the perma-set
                 # changed.
@@ -3093,6 +3686,11 @@ class Abstract_Wallet(PrintError, SPVDelegate):
                         _("Please wait..."),
                         _("Addresses generated:"),
                         len(self.addresses(True)))
+                    synchronizer = self.synchronizer
+                    fetched, remaining = synchronizer.get_tx_progress() if synchronizer else (0, 0)
+                    if remaining:
+                        msg += "\n" + _("Transactions: {fetched} fetched, {remaining} remaining").format(
+                            fetched=fetched, remaining=remaining)
                     callback(msg)
                 time.sleep(0.1)
                 check_timed_out()
@@ -3580,7 +4178,7 @@ class Abstract_Wallet(PrintError, SPVDelegate):
         assert isinstance(address, Address)
         # paranoia, not really necessary -- just want to maintain the invariant that when we modify address history
         # below we invalidate cache.
-        self._addr_bal_cache.pop(address, None)
+        self._invalidate_addr(address)
         self.invalidate_address_set_cache()
         if address not in self._history:
             self._history[address] = []
@@ -3617,6 +4215,7 @@ class Abstract_Wallet(PrintError, SPVDelegate):
         do_addr_save = False
         with self.lock:
             self.transactions.clear(); self.unverified_tx.clear(); self.verified_tx.clear()
+            self.verified_roots.clear()
             self.clear_history()
             if isinstance(self, (Standard_Wallet, MultiXPubWallet)):
                 # reset the address list to default too, just in case. New synchronizer will pick up the addresses again.
@@ -3819,7 +4418,7 @@ class ImportedWalletBase(Simple_Wallet):
                 self.transactions.pop(tx_hash, None)
                 self.ct_txi.pop(tx_hash, None)
                 self.ct_txo.pop(tx_hash, None)
-                self._addr_bal_cache.pop(address, None)  # not strictly necessary, above calls also have this side-effect. but here to be safe. :)
+                self._invalidate_addr(address)  # not strictly necessary, above calls also have this side-effect. but here to be safe. :)
                 if self.verifier:
                     # TX is now gone. Toss its SPV proof in case we have it
                     # in memory. This allows user to re-add PK again and it
@@ -4044,6 +4643,16 @@ class RpaWallet(ImportedWalletBase):
     def rpa_height(self, value: int):
         self.storage.put('rpa_height', value)
 
+    @property
+    def rpa_scanned_ranges(self) -> list:
+        # Block ranges [start, end] above rpa_height that were already scanned, so that an interrupted scan
+        # resumes without scanning them again.
+        return self.storage.get('rpa_scanned_ranges', [])
+
+    @rpa_scanned_ranges.setter
+    def rpa_scanned_ranges(self, value: list):
+        self.storage.put('rpa_scanned_ranges', value)
+
     @classmethod
     def from_text(cls, storage, text, password=None):
         wallet = cls(storage)
@@ -4186,15 +4795,67 @@ class RpaWallet(ImportedWalletBase):
 
     def rebuild_history(self):
         self.storage.put('rpa_height', rpa.determine_best_rpa_start_height())
+        self.storage.put('rpa_scanned_ranges', None)
         super(RpaWallet, self).rebuild_history()
 
 
 class Deterministic_Wallet(Abstract_Wallet):
 
+    # While a restored wallet is first synchronized (storage key 'restore_lookahead'), addresses are derived and
+    # subscribed to this many past the gap limit, and at least RESTORE_BLOCK at a time, so that the history of a long
+    # used wallet is found in a few round trips rather than one per gap limit. Once synchronized, the unused
+    # addresses past the gap limit are removed again.
+    RESTORE_LOOKAHEAD = 200
+    RESTORE_BLOCK = 50
+
     def __init__(self, storage):
+        self._address_cache = None
         Abstract_Wallet.__init__(self, storage)
         self.gap_limit = storage.get('gap_limit', 20)
 
+    def _address_cache_fingerprint(self):
+        return address_cache.fingerprint(self.storage.get('wallet_type'), getattr(self, 'txin_type', None),
+                                         self.get_master_public_keys())
+
+    def _sync_address_cache(self):
+        ''' Returns self._address_cache, brought up to date with the
+        address lists (and replaced if the keystores changed). '''
+        fingerprint = self._address_cache_fingerprint()
+        cache = self._address_cache
+        if cache is None or cache.fingerprint != fingerprint:
+            cache = self._address_cache = AddressCache(fingerprint)
+        cache.sync(False, self.receiving_addresses)
+        cache.sync(True, self.change_addresses)
+        return cache
+
+    def load_addresses(self):
+        ''' Takes the addresses from the address cache if it is valid for
+        this wallet, otherwise parses the 'addresses' storage key. '''
+        d = self.storage.get('addresses', {})
+        if not isinstance(d, dict):
+            d = {}
+        loaded = AddressCache.load(self.storage.get(address_cache.STORAGE_KEY), self._address_cache_fingerprint())
+        if loaded:
+            cache, receiving, change = loaded
+            try:
+                # The counts must match, and the ends too, to be safe
+                ok = all(len(strings) == len(addrs)
+                         and (not addrs or strings[0] == addrs[0].to_storage_string()
+                              and strings[-1] == addrs[-1].to_storage_string())
+                         for strings, addrs in ((d.get('receiving', []), receiving), (d.get('change', []), change)))
+            except Exception:
+                ok = False
+            if ok:
+                self._address_cache = cache
+                self.receiving_addresses, self.change_addresses = receiving, change
+                return
+            self.print_error("address cache does not match the addresses, ignoring it")
+        super().load_addresses()
+
+    def save_addresses(self):
+        super().save_addresses()
+        self.storage.put(address_cache.STORAGE_KEY, self._sync_address_cache().dump())
+
     def has_seed(self):
         return self.keystore.has_seed()
 
@@ -4264,17 +4925,34 @@ class Deterministic_Wallet(Abstract_Wallet):
         return nmax + 1
 
     def create_new_address(self, for_change=False, save=True):
+        return self.create_new_addresses(for_change, 1, save=save)[0]
+
+    def create_new_addresses(self, for_change=False, count=1, save=True):
+        ''' Appends `count` new addresses to the receiving or change
+        addresses, with their keys derived in bulk. Returns the list of new
+        addresses. '''
         for_change = bool(for_change)
         with self.lock:
             addr_list = self.change_addresses if for_change else self.receiving_addresses
             n = len(addr_list)
-            x = self.derive_pubkeys(for_change, n)
-            address = self.pubkeys_to_address(x)
-            addr_list.append(address)
+            cache = self._sync_address_cache()
+            addresses = []
+            for x in self.derive_pubkeys_range(for_change, n, n + count):
+                address = self.pubkeys_to_address(x)
+                # also hashes the address for the synchronizer
+                cache.add(for_change, address, bytes.fromhex(x) if isinstance(x, str) else None)
+                addresses.append(address)
+            addr_list.extend(addresses)
             if save:
                 self.save_addresses()
-            self.add_address(address, for_change=for_change)
-            return address
+            for address in addresses:
+                self.add_address(address, for_change=for_change)
+            return addresses
+
+    def derive_pubkeys_range(self, c, start, stop):
+        ''' derive_pubkeys(c, i) for i in range(start, stop). Subclasses
+        whose keystores can derive in bulk reimplement this. '''
+        return [self.derive_pubkeys(c, i) for i in range(start, stop)]
 
     def create_new_preferred_address(self, for_change=False, save=True):
         """Default just calls create_new_address(). MultiXPubWallet reimplements this to keep generating
@@ -4282,21 +4960,62 @@ class Deterministic_Wallet(Abstract_Wallet):
         return self.create_new_address(for_change=for_change, save=save)
 
     def synchronize_sequence(self, for_change):
+        ''' Creates addresses until the last `limit` of them are unused.
+        Returns the number of addresses created. '''
         limit = self.gap_limit_for_change if for_change else self.gap_limit
+        restoring = self.storage.get('restore_lookahead', False)
+        if restoring:
+            limit += self.RESTORE_LOOKAHEAD
+        created = 0
         while True:
             addresses = self.get_change_addresses() if for_change else self.get_receiving_addresses()
-            if len(addresses) < limit:
-                self.create_new_address(for_change, save=False)
-                continue
-            if all(map(fittexxcoin a: not self.address_is_old(a), addresses[-limit:] )):
+            # Create all the addresses needed for the last `limit` to come
+            # after the last old one in one go, then check again.
+            n = len(addresses)
+            needed = limit - n
+            for k in range(n - 1, max(n - limit, 0) - 1, -1):
+                if self.address_is_old(addresses[k]):
+                    needed = k + 1 + limit - n
+                    break
+            if needed <= 0:
                 break
-            else:
-                self.create_new_address(for_change, save=False)
+            if restoring:
+                needed = max(needed, self.RESTORE_BLOCK)
+            self.create_new_addresses(for_change, needed, save=False)
+            created += needed
+        return created
 
     def synchronize(self):
         with self.lock:
-            self.synchronize_sequence(False)
-            self.synchronize_sequence(True)
+            created = self.synchronize_sequence(False)
+            created += self.synchronize_sequence(True)
+            if (not created and self.synchronizer and self.is_up_to_date()
+                    and self.storage.get('restore_lookahead', False)):
+                self._finish_restore()
+
+    def _finish_restore(self):
+        ''' Ends the restore lookahead once the wallet is synchronized:
+        removes the unused addresses past the gap limit on both chains, and
+        unsubscribes from them. '''
+        removed = []
+        for for_change, limit in ((False, self.gap_limit), (True, self.gap_limit_for_change)):
+            addr_list = self.change_addresses if for_change else self.receiving_addresses
+            keep = limit
+            for k in range(len(addr_list) - 1, -1, -1):
+                if self.get_address_history(addr_list[k]):
+                    keep = k + 1 + limit
+                    break
+            for address in addr_list[keep:]:
+                self._history.pop(address, None)
+                self._invalidate_addr(address)
+                removed.append(address)
+            del addr_list[keep:]
+        self.storage.put('restore_lookahead', None)
+        self.invalidate_address_set_cache()
+        self.save_addresses()
+        if removed:
+            self.print_error(f"restore done, removed {len(removed)} lookahead addresses")
+            self.synchronizer.remove(removed)
 
     def is_beyond_limit(self, address, is_change):
         with self.lock:
@@ -4345,6 +5064,9 @@ class Simple_Deterministic_Wallet(Simple_Wallet, Deterministic_Wallet):
         self.txin_type = 'p2pkh' if xtype == 'standard' else xtype
 
     def get_pubkey(self, c, i):
+        pubkey = self._address_cache and self._address_cache.get_pubkey(bool(c), i)
+        if pubkey:
+            return pubkey.hex()
         return self.derive_pubkeys(c, i)
 
     def get_public_keys(self, address):
@@ -4363,6 +5085,9 @@ class Simple_Deterministic_Wallet(Simple_Wallet, Deterministic_Wallet):
     def derive_pubkeys(self, c, i):
         return self.keystore.derive_pubkey(c, i)
 
+    def derive_pubkeys_range(self, c, start, stop):
+        return self.keystore.derive_pubkey_range(c, start, stop)
+
 
 class Standard_Wallet(Simple_Deterministic_Wallet):
     wallet_type = 'standard'
@@ -4394,6 +5119,10 @@ class Multisig_Wallet(Deterministic_Wallet):
     def derive_pubkeys(self, c, i):
         return [k.derive_pubkey(c, i) for k in self.get_keystores()]
 
+    def derive_pubkeys_range(self, c, start, stop):
+        return [list(pubkeys) for pubkeys in
+                zip(*(k.derive_pubkey_range(c, start, stop) for k in self.get_keystores()))]
+
     def load_keystore(self):
         self.keystores = {}
         for i in range(self.n):
@@ -4665,6 +5394,9 @@ class MultiXPubWallet(Deterministic_Wallet):
         return pubkey
 
     def get_pubkey(self, c, i):
+        pubkey = self._address_cache and self._address_cache.get_pubkey(bool(c), i)
+        if pubkey:
+            return pubkey.hex()
         return self.derive_pubkeys(c, i)
 
     def get_public_keys(self, address):
@@ -4823,6 +5555,9 @@ def restore_wallet_from_text(text, *, path, config,
 
     wallet.update_password(old_pw=None, new_pw=password, encrypt=encrypt_file)
     wallet.synchronize()
+    if isinstance(wallet, Deterministic_Wallet):
+        # look ahead of the gap limit when the daemon first syncs it
+        storage.put('restore_lookahead', True)
     msg = ("This wallet was restored offline. It may contain more addresses than displayed. "
            "Start a daemon and use load_wallet to sync its history.")
 
@@ -14,6 +14,7 @@ from PyQt5.QtWidgets import *
 
 from electronfittexxcoin import keystore, Wallet, WalletStorage
 from electronfittexxcoin.network import Network
+from electronfittexxcoin.storage import delete_wallet_file
 from electronfittexxcoin.util import UserCancelled, InvalidPassword, finalization_print_error, TimeoutException
 from electronfittexxcoin.base_wizard import BaseWizard
 from electronfittexxcoin.i18n import _
@@ -256,7 +257,7 @@ class InstallWizard(QDialog, MessageBoxMixin, BaseWizard):
             file_list = '\n'.join(self.storage.split_accounts())
             msg = _('Your accounts have been moved to') + ':\n' + file_list + '\n\n'+ _('Do you want to delete the old file') + ':\n' + path
             if self.question(msg):
-                os.remove(path)
+                delete_wallet_file(path)
                 self.show_warning(_('The file was removed'))
             return
 
@@ -276,7 +277,7 @@ class InstallWizard(QDialog, MessageBoxMixin, BaseWizard):
                     "Do you want to complete its creation now?").format(path)
             if not self.question(msg):
                 if self.question(_("Do you want to delete '{}'?").format(path)):
-                    os.remove(path)
+                    delete_wallet_file(path)
                     self.show_warning(_('The file was removed'))
                 return
             self.show()
@@ -58,7 +58,7 @@ import electronfittexxcoin.web as web
 from electronfittexxcoin import Transaction
 from electronfittexxcoin import util, bitcoin, commands, token
 
-from electronfittexxcoin import paymentrequest
+from electronfittexxcoin import history_export, paymentrequest
 from electronfittexxcoin.transaction import OPReturn
 from electronfittexxcoin.wallet import Multisig_Wallet, sweep_preparations, MultiXPubWallet, PrivateKeyMissing
 from electronfittexxcoin.contacts import Contact
@@ -607,7 +607,7 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin, PrintError):
 
 
     def backup_wallet(self):
-        self.wallet.storage.write()  # make sure file is committed to disk
+        self.wallet.storage.write_snapshot()  # make sure the file alone holds the whole wallet
         path = self.wallet.storage.path
         wallet_folder = os.path.dirname(path)
         filename, __ = QFileDialog.getSaveFileName(self, _('Enter a filename for the copy of your wallet'), wallet_folder)
@@ -1005,6 +1005,11 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin, PrintError):
             # Display the synchronizing message in that case.
             if not self.wallet.up_to_date or server_height == 0 or rpa_is_busy:
                 text = _("Synchronizing...")
+                synchronizer = self.wallet.synchronizer
+                fetched, remaining = synchronizer.get_tx_progress() if synchronizer else (0, 0)
+                if remaining:
+                    text += " " + _("({fetched} transactions fetched, {remaining} remaining)").format(
+                        fetched=fetched, remaining=remaining)
                 icon = icon_dict["status_waiting"]
                 status_tip = status_tip_dict["status_waiting"]
             elif server_lag > 1:
@@ -4048,64 +4053,37 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin, PrintError):
         if not wallet:
             return
         dlg = None  # this will be set at the bottom of this function
+        cancel_event = threading.Event()
         def task():
             def update_prog(x):
                 if dlg: dlg.update_progress(int(x*100))
-            return wallet.export_history(fx=self.fx,
-                                         show_addresses=include_addresses,
-                                         decimal_point=self.decimal_point,
-                                         fee_calc_timeout=timeout,
-                                         download_inputs=download_inputs,
-                                         progress_callback=update_prog,
-                                         receives_before_sends=True)
+            try:
+                with open(fileName, "w+", encoding="utf-8") as f:  # ensure encoding to utf-8. Avoid Windows cp1252. See #1453.
+                    # rows are streamed to the file as they are exported
+                    history_export.write_history(wallet, f, 'csv' if is_csv else 'json',
+                                                 fx=self.fx,
+                                                 show_addresses=include_addresses,
+                                                 decimal_point=self.decimal_point,
+                                                 fee_calc_timeout=timeout,
+                                                 download_inputs=download_inputs,
+                                                 progress_callback=update_prog,
+                                                 receives_before_sends=True,
+                                                 cancel_event=cancel_event)
+            except BaseException:
+                # don't leave a partially written file behind
+                try: os.remove(fileName)
+                except OSError: pass
+                raise
         success = False
-        def on_success(history):
+        def on_success(_):
             nonlocal success
-            ccy = (self.fx and self.fx.get_currency()) or ''
-            has_fiat_columns = history and self.fx and self.fx.show_history() and 'fiat_value' in history[0] and 'fiat_balance' in history[0] and 'fiat_fee' in history[0]
-            lines = []
-            for item in history:
-                if is_csv:
-                    cols = [item['txid'], item.get('label', ''), item['confirmations'], item['value'], item['fee'], item['date']]
-                    if has_fiat_columns:
-                        cols += [item['fiat_value'], item['fiat_balance'], item['fiat_fee']]
-                    if include_addresses:
-                        inaddrs_filtered = (x for x in (item.get('input_addresses') or [])
-                                            if Address.is_valid(x))
-                        outaddrs_filtered = (x for x in (item.get('output_addresses') or [])
-                                             if Address.is_valid(x))
-                        cols.append( ','.join(inaddrs_filtered) )
-                        cols.append( ','.join(outaddrs_filtered) )
-                    lines.append(cols)
-                else:
-                    if has_fiat_columns and ccy:
-                        item['fiat_currency'] = ccy  # add the currency to each entry in the json. this wastes space but json is bloated anyway so this won't hurt too much, we hope
-                    elif not has_fiat_columns:
-                        # No need to include these fields as they will always be 'No Data'
-                        item.pop('fiat_value', None)
-                        item.pop('fiat_balance', None)
-                        item.pop('fiat_fee', None)
-                    lines.append(item)
-
-            with open(fileName, "w+", encoding="utf-8") as f:  # ensure encoding to utf-8. Avoid Windows cp1252. See #1453.
-                if is_csv:
-                    transaction = csv.writer(f, lineterminator='\n')
-                    cols = ["transaction_hash","label", "confirmations", "value", "fee", "timestamp"]
-                    if has_fiat_columns:
-                        cols += [f"fiat_value_{ccy}", f"fiat_balance_{ccy}", f"fiat_fee_{ccy}"]  # in CSV mode, we use column names eg fiat_value_USD, etc
-                    if include_addresses:
-                        cols += ["input_addresses", "output_addresses"]
-                    transaction.writerow(cols)
-                    for line in lines:
-                        transaction.writerow(line)
-                else:
-                    f.write(json.dumps(lines, indent=4))
             success = True
         # kick off the waiting dialog to do all of the above
         dlg = WaitingDialog(self.top_level_window(),
                             _("Exporting history, please wait ..."),
-                            task, on_success, self.on_error, disable_escape_key=True,
+                            task, on_success, self.on_error,
                             auto_exec=False, auto_show=False, progress_bar=True, progress_min=0, progress_max=100)
+        dlg.rejected.connect(cancel_event.set)  # hitting Escape cancels the export
         dlg.exec_()
         # this will block heere in the WaitingDialog event loop... and set success to True if success
         return success
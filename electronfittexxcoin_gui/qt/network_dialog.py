@@ -639,7 +639,8 @@ class NetworkChoiceLayout(QObject, OnDestroyedMixin, PrintError):
         msg = _('The number of unanswered network requests.\n\n'
                 "You can configure:\n\n"
                 "    - Limit: maximum request backlog size\n"
-                "    - ChunkSize: requests to enqueue every 100ms\n\n"
+                "    - ChunkSize: initial request backlog size, which then grows\n"
+                "      up to Limit, or shrinks, following the server's latency\n\n"
                 "If the connection drops when synchronizing, you may wish "
                 "to reduce these values to throttle requests to the server.")
         grid.addWidget(QLabel(_('Pending requests') + ':'), row, 0)
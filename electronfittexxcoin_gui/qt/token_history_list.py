@@ -127,7 +127,7 @@ class TokenHistoryList(MyTreeWidget, PrintError):
 
         self.clear()
 
-        h = self.wallet.get_history(self.wallet.get_addresses(), reverse=True, receives_before_sends=True,
+        h = self.wallet.get_history(None, reverse=True, receives_before_sends=True,
                                     include_tokens=True, include_tokens_balances=True)
 
         all_items = []
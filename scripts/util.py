@@ -1,4 +1,4 @@
-import select, time, queue
+import asyncio, json, select, threading, time, queue
 from electronfittexxcoin import Connection, Interface, SimpleConfig
 
 from electronfittexxcoin.network import parse_servers
@@ -80,3 +80,100 @@ def send_request(peers, method, params):
     results = dict(zip(responses.keys(), [t[0][1].get('result') for t in responses.values()]))
     print("%d answers"%len(results))
     return results
+
+
+class StubServer:
+    ''' A minimal ElectrumX-compatible server on localhost, for benchmarks.
+
+    `handlers` maps a method name to a function of the request params that
+    returns the result. Requests for other methods get an error response.
+    blockchain.headers.subscribe is never answered, so that a Network
+    connected to the stub stays in verification mode and does not try to
+    sync headers. `delay` is added before each response to simulate network
+    latency. JSON-RPC batches (arrays of requests) are answered with batch
+    responses, or if `batches` is False, rejected like a server which does
+    not support them. '''
+
+    def __init__(self, handlers=None, *, delay=0.0, batches=True):
+        self.handlers = dict(handlers or {})
+        # results of the methods the Network queries on connection
+        self.results = {
+            'server.version': ['StubServer 1.0', '1.4'],
+            'server.banner': '',
+            'server.donation_address': '',
+            'server.features': {},
+            'server.peers.subscribe': [],
+            'server.ping': None,
+            'blockchain.relayfee': 0.00001,
+        }
+        self.delay = delay
+        self.batches = batches
+        self.num_requests = 0
+        self.num_batches = 0
+        self.port = None
+        self.loop = None
+        self.thread = None
+
+    def _respond(self, request):
+        self.num_requests += 1
+        method = request.get('method')
+        if method == 'blockchain.headers.subscribe':
+            return None
+        handler = self.handlers.get(method)
+        if handler is not None:
+            result = handler(request.get('params', []))
+        elif method in self.results:
+            result = self.results[method]
+        else:
+            return {'jsonrpc': '2.0', 'id': request.get('id'),
+                    'error': {'code': -32601, 'message': 'unknown method'}}
+        return {'jsonrpc': '2.0', 'id': request.get('id'), 'result': result}
+
+    async def _write_later(self, writer, data):
+        await asyncio.sleep(self.delay)
+        writer.write(data)
+
+    async def _serve(self, reader, writer):
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            request = json.loads(line)
+            if isinstance(request, list) and not self.batches:
+                response = {'jsonrpc': '2.0', 'id': None,
+                            'error': {'code': -32600, 'message': 'batches are not supported'}}
+            elif isinstance(request, list):
+                self.num_batches += 1
+                response = [r for r in map(self._respond, request) if r is not None]
+            else:
+                response = self._respond(request)
+            if not response:
+                continue
+            data = (json.dumps(response) + '\n').encode('utf8')
+            if self.delay:
+                asyncio.ensure_future(self._write_later(writer, data))
+            else:
+                writer.write(data)
+                await writer.drain()
+        writer.close()
+
+    def start(self):
+        ''' Starts serving on a background thread and returns the
+        'host:port:t' server string to connect to. '''
+        started = threading.Event()
+        def run():
+            self.loop = asyncio.new_event_loop()
+            server = self.loop.run_until_complete(
+                asyncio.start_server(self._serve, '127.0.0.1', 0, limit=1024*1024*32))
+            self.port = server.sockets[0].getsockname()[1]
+            started.set()
+            self.loop.run_forever()
+            server.close()
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+        started.wait()
+        return '127.0.0.1:{}:t'.format(self.port)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()